@@ -0,0 +1,328 @@
+"""Per-image latency benchmark for anime_crop_worker.py.
+
+Run with the selected vision runtime after the crop models are warmed:
+python anime_crop_benchmark.py --requests 8 --images-per-request 4
+
+Synthetic images are written to a temporary directory; no media library is
+read.  ``one-shot`` starts one worker process per request exactly like the
+current backend, ``serve`` sends the same requests to a single ``--serve``
+process.  ``batch`` runs the ``--serve`` path twice, once with one image per
+detector run and once with ``--batch-size`` images, to measure the batched
+detector throughput.  ``pose`` needs no GPU: it checks that the vectorized
+Halpe26 post-processing is byte-identical to the former per-point loop and
+times both.  ``large`` compares full-resolution decoding against
+``--max-side`` reduced decoding, with and without the refinement pass;
+use it with e.g. ``--width 6000 --height 8000``.  ``--serve`` runs also
+report the worker's peak RSS on Linux.  The result is printed as one JSON
+document.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import anime_crop_worker as worker
+
+
+WORKER = Path(__file__).with_name("anime_crop_worker.py")
+
+
+def synthetic_items(
+    directory: Path, count: int, size: tuple[int, int], image_format: str = "PNG",
+) -> list[dict[str, str]]:
+    from PIL import Image, ImageDraw
+
+    items: list[dict[str, str]] = []
+    for index in range(count):
+        image = Image.new("RGB", size, (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        width, height = size
+        # A crude figure keeps the detectors busy without shipping media.
+        draw.ellipse((width * 0.4, height * 0.08, width * 0.6, height * 0.24), fill=(240, 200, 180))
+        draw.rectangle((width * 0.35, height * 0.24, width * 0.65, height * 0.62), fill=(40, 60, 160 + index % 80))
+        draw.rectangle((width * 0.38, height * 0.62, width * 0.62, height * 0.95), fill=(30, 30, 30))
+        path = directory / f"synthetic-{index:05d}.{image_format.lower()}"
+        image.save(path, format=image_format)
+        items.append({"media_id": f"synthetic-{index}", "path": str(path)})
+    return items
+
+
+def summary(latencies: list[float], images: int, elapsed: float) -> dict[str, Any]:
+    ordered = sorted(latencies)
+    return {
+        "images": images,
+        "elapsed_seconds": elapsed,
+        "images_per_second": images / elapsed if elapsed > 0 else 0.0,
+        "per_image_ms": {
+            "mean": statistics.fmean(ordered) * 1000 if ordered else 0.0,
+            "p50": ordered[len(ordered) // 2] * 1000 if ordered else 0.0,
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000 if ordered else 0.0,
+        },
+    }
+
+
+def peak_rss_mib(pid: int) -> float | None:
+    """Peak resident set size of a live process (Linux only)."""
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text(encoding="ascii").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def check_complete(records: list[dict[str, Any]]) -> None:
+    complete = records[-1] if records else {}
+    if complete.get("type") != "complete" or not complete.get("ready"):
+        raise RuntimeError(f"worker 未成功完成: {complete.get('error') or complete}")
+
+
+def one_shot(requests: list[dict[str, Any]], env: dict[str, str]) -> dict[str, Any]:
+    latencies: list[float] = []
+    started = time.perf_counter()
+    for request in requests:
+        request_started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, str(WORKER)],
+            input=json.dumps(request).encode("utf-8"),
+            capture_output=True,
+            env=env,
+            check=True,
+        )
+        check_complete([json.loads(line) for line in output.stdout.decode("utf-8").splitlines() if line.strip()])
+        per_image = (time.perf_counter() - request_started) / max(1, len(request["items"]))
+        latencies.extend([per_image] * len(request["items"]))
+    return summary(latencies, len(latencies), time.perf_counter() - started)
+
+
+def serve(requests: list[dict[str, Any]], env: dict[str, str]) -> dict[str, Any]:
+    latencies: list[float] = []
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, str(WORKER), "--serve"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        text=True,
+        encoding="utf-8",
+    )
+    assert process.stdin is not None and process.stdout is not None
+    try:
+        for request in requests:
+            request_started = time.perf_counter()
+            process.stdin.write(json.dumps(request) + "\n")
+            process.stdin.flush()
+            records: list[dict[str, Any]] = []
+            while not records or records[-1].get("type") == "detection":
+                line = process.stdout.readline()
+                if not line:
+                    raise RuntimeError("常驻 worker 意外退出")
+                records.append(json.loads(line))
+            check_complete(records)
+            per_image = (time.perf_counter() - request_started) / max(1, len(request["items"]))
+            latencies.extend([per_image] * len(request["items"]))
+        peak = peak_rss_mib(process.pid)
+    finally:
+        process.stdin.close()
+        process.wait()
+    return {**summary(latencies, len(latencies), time.perf_counter() - started), "peak_rss_mib": peak}
+
+
+def legacy_pose_records(keypoints: Any, scores: Any, image_width: int, image_height: int) -> list[dict[str, Any]]:
+    """The per-point Python implementation ``pose_records`` replaced."""
+    poses: list[dict[str, Any]] = []
+    for person_keypoints, person_scores in zip(keypoints, scores):
+        if len(person_scores) < 26 or len(person_keypoints) < 26:
+            raise RuntimeError("BodyWithFeet 未返回完整 Halpe26 关键点")
+        import math
+
+        valid_points: dict[int, tuple[float, float, float]] = {}
+        for index in range(26):
+            x = float(person_keypoints[index][0])
+            y = float(person_keypoints[index][1])
+            score = float(person_scores[index])
+            if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(score)):
+                continue
+            if not worker.point_in_image(x, y, image_width, image_height):
+                continue
+            valid_points[index] = (x, y, score)
+
+        reliable_points = [
+            valid_points[index]
+            for index in worker.POSE_BBOX_RELIABLE_INDICES
+            if index in valid_points and valid_points[index][2] >= worker.POSE_RELIABLE_SCORE
+        ]
+        if len(reliable_points) < 5:
+            continue
+
+        reliable_x0 = min(point[0] for point in reliable_points)
+        reliable_x1 = max(point[0] for point in reliable_points)
+        reliable_y0 = min(point[1] for point in reliable_points)
+        reliable_y1 = max(point[1] for point in reliable_points)
+        horizontal_margin = max(
+            (reliable_x1 - reliable_x0) * 1.25,
+            image_width * 0.10,
+        )
+        upper_margin = max(
+            (reliable_y1 - reliable_y0) * 0.25,
+            image_height * 0.03,
+        )
+        # Knees, ankles and foot tips are frequently scored below the
+        # general-body threshold on stylized art.  Keep low-score points
+        # only when they remain anatomically associated with the reliable
+        # skeleton; this extends the pose bbox for person association
+        # without accepting arbitrary coordinates elsewhere in the image.
+        lower_association_points = [
+            valid_points[index]
+            for index in worker.POSE_LOWER_ASSOCIATION_INDICES
+            if index in valid_points
+            and valid_points[index][2] >= worker.POSE_LOWER_ASSOCIATION_SCORE
+            and reliable_x0 - horizontal_margin
+            <= valid_points[index][0]
+            <= reliable_x1 + horizontal_margin
+            and valid_points[index][1] >= reliable_y0 - upper_margin
+        ]
+        bbox_points = reliable_points + lower_association_points
+        x_values = [point[0] for point in bbox_points]
+        y_values = [point[1] for point in bbox_points]
+        torso_indices = (5, 6, 11, 12)
+        torso_scores = [
+            valid_points[index][2]
+            for index in torso_indices
+            if index in valid_points
+        ]
+
+        def keypoint(index: int) -> dict[str, float] | None:
+            point = valid_points.get(index)
+            if point is None:
+                return None
+            return {"x": point[0], "y": point[1], "score": point[2]}
+
+        def valid_score(index: int) -> float:
+            point = valid_points.get(index)
+            return point[2] if point is not None else 0.0
+
+        poses.append({
+            "bbox": {
+                "x0": min(x_values), "y0": min(y_values),
+                "x1": max(x_values), "y1": max(y_values),
+                "score": sum(point[2] for point in reliable_points) / len(reliable_points),
+            },
+            "torso_score": sum(torso_scores) / len(torso_scores) if torso_scores else 0.0,
+            "left_ankle_score": valid_score(15),
+            "right_ankle_score": valid_score(16),
+            "keypoints": {
+                "left_hip": keypoint(11),
+                "right_hip": keypoint(12),
+                "left_knee": keypoint(13),
+                "right_knee": keypoint(14),
+                "left_ankle": keypoint(15),
+                "right_ankle": keypoint(16),
+                "left_big_toe": keypoint(20),
+                "right_big_toe": keypoint(21),
+                "left_small_toe": keypoint(22),
+                "right_small_toe": keypoint(23),
+                "left_heel": keypoint(24),
+                "right_heel": keypoint(25),
+            },
+        })
+    return poses
+
+
+def synthetic_poses(persons: int, seed: int) -> tuple[Any, Any]:
+    """Halpe26 output with in-frame, out-of-frame, NaN and low-score points."""
+    import numpy as np
+
+    generator = np.random.default_rng(seed)
+    keypoints = generator.uniform(-80.0, 1100.0, size=(persons, 26, 2)).astype(np.float32)
+    scores = generator.uniform(0.0, 1.0, size=(persons, 26)).astype(np.float32)
+    keypoints[generator.random((persons, 26)) < 0.02] = np.nan
+    scores[generator.random((persons, 26)) < 0.01] = np.inf
+    return keypoints, scores
+
+
+def pose_benchmark(persons: int, repeats: int) -> dict[str, Any]:
+    """Time legacy and vectorized pose post-processing on identical input."""
+    keypoints, scores = synthetic_poses(persons, seed=persons)
+    legacy = json.dumps(legacy_pose_records(keypoints, scores, 1024, 1024))
+    vectorized = json.dumps(worker.pose_records(keypoints, scores, 1024, 1024))
+    if legacy != vectorized:
+        raise RuntimeError("向量化姿态后处理结果与原实现不一致")
+    report: dict[str, Any] = {"persons": persons, "repeats": repeats, "identical": True}
+    for name, function in (("legacy", legacy_pose_records), ("vectorized", worker.pose_records)):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            function(keypoints, scores, 1024, 1024)
+        report[f"{name}_ms_per_image"] = (time.perf_counter() - started) / repeats * 1000
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--images-per-request", type=int, default=4)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--gpu-id", default="0")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--decode-workers", type=int, default=2)
+    parser.add_argument("--prefetch", type=int, default=4)
+    parser.add_argument("--max-side", type=int, default=2048)
+    parser.add_argument("--persons", type=int, default=12)
+    parser.add_argument("--repeats", type=int, default=500)
+    parser.add_argument("--mode", choices=("both", "one-shot", "serve", "batch", "pose", "large"), default="both")
+    args = parser.parse_args()
+    if args.mode == "pose":
+        print(json.dumps(pose_benchmark(args.persons, args.repeats), indent=2))
+        return 0
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES=args.gpu_id)
+    with tempfile.TemporaryDirectory(prefix="anime-crop-benchmark-") as directory:
+        items = synthetic_items(
+            Path(directory),
+            args.requests * args.images_per_request,
+            (args.width, args.height),
+            "JPEG" if args.mode == "large" else "PNG",
+        )
+        requests = [
+            {
+                "action": "detect",
+                "gpu_id": args.gpu_id,
+                "batch_size": args.batch_size,
+                "decode_workers": args.decode_workers,
+                "prefetch": args.prefetch,
+                "items": items[index:index + args.images_per_request],
+            }
+            for index in range(0, len(items), args.images_per_request)
+        ]
+        report: dict[str, Any] = {"requests": len(requests), "images_per_request": args.images_per_request}
+        if args.mode in ("both", "one-shot"):
+            report["one_shot"] = one_shot(requests, env)
+        if args.mode in ("both", "serve"):
+            report["serve"] = serve(requests, env)
+        if args.mode == "batch":
+            unbatched = [dict(request, batch_size=1) for request in requests]
+            report["batch_size_1"] = serve(unbatched, env)
+            report[f"batch_size_{args.batch_size}"] = serve(requests, env)
+        if args.mode == "large":
+            report["full_resolution"] = serve(requests, env)
+            report[f"max_side_{args.max_side}"] = serve([dict(request, max_side=args.max_side) for request in requests], env)
+            report[f"max_side_{args.max_side}_refine"] = serve(
+                [dict(request, max_side=args.max_side, refine=True) for request in requests], env,
+            )
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
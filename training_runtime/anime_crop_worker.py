@@ -1,8 +1,11 @@
-"""One-shot, stdin/stdout JSON worker for conservative anime smart crops.
+"""stdin/stdout JSON worker for conservative anime smart crops.
 
 The Rust process validates every media path before passing it here.  This worker
-only reads images and emits a single JSON document; it never writes into a
-media library and does not expose a network service.  Hugging Face/ONNX model
+only reads images and emits JSON records; it never writes into a media library
+and does not expose a network service.  By default it answers one request read
+from stdin and exits; ``--serve`` keeps the models warm and answers one request
+per stdin line until stdin closes.  A request carrying ``gpu_ids`` is
+coordinated across one ``--serve`` child per listed GPU.  Hugging Face/ONNX model
 caches are owned by the selected Python runtime.
 """
 
@@ -11,12 +14,19 @@ from __future__ import annotations
 import inspect
 import json
 import os
+import subprocess
 import sys
 import tempfile
 import traceback
 import contextlib
+import copy
+import hashlib
+import io
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterator
 
 
 HEAD_MODEL = "head_detect_v2.0_x_yv11"
@@ -38,13 +48,48 @@ POSE_BBOX_RELIABLE_INDICES = (
 POSE_LOWER_ASSOCIATION_INDICES = (
     11, 12, 13, 14, 15, 16, 20, 21, 22, 23, 24, 25,
 )
+DETECTION_JOBS: tuple[tuple[str, tuple[str, ...], str, dict[str, Any]], ...] = (
+    ("heads", ("detect_heads",), HEAD_MODEL, {"model_name": HEAD_MODEL, "level": "s", "version": "v2.0"}),
+    ("faces", ("detect_faces", "detect_face"), "face_detect_v1.4_s", {"level": "s", "version": "v1.4"}),
+    ("persons", ("detect_persons", "detect_person"), "person_detect_v1.1_m", {"level": "m", "version": "v1.1"}),
+    ("half_bodies", ("detect_halfbodies", "detect_halfbody"), "halfbody_detect_v1.0_s", {"level": "s", "version": "v1.0"}),
+    ("hands", ("detect_hands", "detect_hand"), "hand_detect_v1.0_s", {"level": "s", "version": "v1.0"}),
+)
+DETECTION_BATCH_SIZE = 4
+MAX_DETECTION_BATCH_SIZE = 32
+MIN_WORKING_SIDE = 640
+REFINE_MIN_PART_SIZE = 24
+DETECTION_CACHE_SCHEMA_VERSION = 1
+DETECTION_CACHE_MAX_MB = 256
+DECODE_WORKERS = 2
+MAX_DECODE_WORKERS = 8
+DECODE_PREFETCH = 4
+MAX_DECODE_PREFETCH = 32
+POSE_TORSO_INDICES = (5, 6, 11, 12)
+POSE_KEYPOINT_NAMES = (
+    ("left_hip", 11),
+    ("right_hip", 12),
+    ("left_knee", 13),
+    ("right_knee", 14),
+    ("left_ankle", 15),
+    ("right_ankle", 16),
+    ("left_big_toe", 20),
+    ("right_big_toe", 21),
+    ("left_small_toe", 22),
+    ("right_small_toe", 23),
+    ("left_heel", 24),
+    ("right_heel", 25),
+)
 POSE_RELIABLE_SCORE = 0.35
 POSE_LOWER_ASSOCIATION_SCORE = 0.05
+_POSE_RELIABLE_MASK = tuple(index in POSE_BBOX_RELIABLE_INDICES for index in range(26))
+_POSE_LOWER_ASSOCIATION_MASK = tuple(index in POSE_LOWER_ASSOCIATION_INDICES for index in range(26))
 _DOWNLOAD_PATCHED = False
 _POSE_MODELS: dict[str, Any] = {}
 _CUDA_DLL_DIRECTORIES: list[Any] = []
 _CUDA_DLL_READY = False
 _POSE_LAST_ERROR: str | None = None
+_DEPENDENCY_HEALTH: dict[str, Any] | None = None
 
 
 def prepare_cuda_runtime() -> None:
@@ -69,9 +114,12 @@ def prepare_cuda_runtime() -> None:
     _CUDA_DLL_READY = True
 
 
+def model_cache_root() -> Path:
+    return Path(os.environ.get("CROP_MODEL_CACHE", Path.home() / ".cache" / "danbooru-anime-crop"))
+
+
 def warmup_marker() -> Path:
-    cache_root = Path(os.environ.get("CROP_MODEL_CACHE", Path.home() / ".cache" / "danbooru-anime-crop"))
-    return cache_root / "warmup-complete.json"
+    return model_cache_root() / "warmup-complete.json"
 
 
 def mark_models_warmed(device: str) -> None:
@@ -264,7 +312,7 @@ def install_hub_download_fallback() -> None:
     import huggingface_hub
 
     original = huggingface_hub.hf_hub_download
-    cache_root = Path(os.environ.get("CROP_MODEL_CACHE", Path.home() / ".cache" / "danbooru-anime-crop"))
+    cache_root = model_cache_root()
 
     def fallback(repo_id: str, filename: str, repo_type: str | None = None, revision: str = "main", **kwargs: Any) -> str:
         try:
@@ -369,11 +417,110 @@ def _detector(detectors: Any, names: tuple[str, ...]) -> Callable[..., Any] | No
     return None
 
 
-def point_in_image(x: float, y: float, width: int, height: int) -> bool:
-    """Reject fabricated pose coordinates instead of clamping them to media edges."""
+def point_in_image(x: Any, y: Any, width: int, height: int) -> Any:
+    """Reject fabricated pose coordinates instead of clamping them to media edges.
+
+    Accepts scalars or NumPy arrays; arrays are compared elementwise.
+    """
+    if hasattr(x, "shape"):
+        return (0.0 <= x) & (x < float(width)) & (0.0 <= y) & (y < float(height))
     return 0.0 <= x < float(width) and 0.0 <= y < float(height)
 
 
+def pose_records(keypoints: Any, scores: Any, image_width: int, image_height: int) -> list[dict[str, Any]]:
+    """Turn Halpe26 keypoints into per-person pose evidence records.
+
+    All persons are filtered at once on the ``(persons, 26, 3)`` array.  Sums
+    are accumulated in index order from 0.0 exactly like Python's ``sum`` so
+    every value matches the former per-point implementation bit for bit.
+    """
+    import numpy as np
+
+    if any(len(person_scores) < 26 or len(person_keypoints) < 26 for person_keypoints, person_scores in zip(keypoints, scores)):
+        raise RuntimeError("BodyWithFeet 未返回完整 Halpe26 关键点")
+    persons = min(len(keypoints), len(scores))
+    if persons == 0:
+        return []
+    points = np.empty((persons, 26, 3), dtype=np.float64)
+    points[:, :, :2] = np.asarray(keypoints[:persons], dtype=np.float64)[:, :26, :2]
+    points[:, :, 2] = np.asarray(scores[:persons], dtype=np.float64)[:, :26]
+    x, y, score = points[:, :, 0], points[:, :, 1], points[:, :, 2]
+    with np.errstate(invalid="ignore"):
+        valid = np.isfinite(points).all(axis=2) & point_in_image(x, y, image_width, image_height)
+        reliable = valid & _POSE_RELIABLE_MASK & (score >= POSE_RELIABLE_SCORE)
+    keep = reliable.sum(axis=1) >= 5
+    if not keep.any():
+        return []
+    points, valid, reliable = points[keep], valid[keep], reliable[keep]
+    x, y, score = points[:, :, 0], points[:, :, 1], points[:, :, 2]
+
+    reliable_x0 = np.where(reliable, x, np.inf).min(axis=1)
+    reliable_x1 = np.where(reliable, x, -np.inf).max(axis=1)
+    reliable_y0 = np.where(reliable, y, np.inf).min(axis=1)
+    reliable_y1 = np.where(reliable, y, -np.inf).max(axis=1)
+    horizontal_margin = np.maximum((reliable_x1 - reliable_x0) * 1.25, image_width * 0.10)
+    upper_margin = np.maximum((reliable_y1 - reliable_y0) * 0.25, image_height * 0.03)
+    # Knees, ankles and foot tips are frequently scored below the
+    # general-body threshold on stylized art.  Keep low-score points
+    # only when they remain anatomically associated with the reliable
+    # skeleton; this extends the pose bbox for person association
+    # without accepting arbitrary coordinates elsewhere in the image.
+    with np.errstate(invalid="ignore"):
+        lower_association_points = (
+            valid
+            & _POSE_LOWER_ASSOCIATION_MASK
+            & (score >= POSE_LOWER_ASSOCIATION_SCORE)
+            & ((reliable_x0 - horizontal_margin)[:, None] <= x)
+            & (x <= (reliable_x1 + horizontal_margin)[:, None])
+            & (y >= (reliable_y0 - upper_margin)[:, None])
+        )
+    bbox_points = reliable | lower_association_points
+    bbox_x0 = np.where(bbox_points, x, np.inf).min(axis=1)
+    bbox_x1 = np.where(bbox_points, x, -np.inf).max(axis=1)
+    bbox_y0 = np.where(bbox_points, y, np.inf).min(axis=1)
+    bbox_y1 = np.where(bbox_points, y, -np.inf).max(axis=1)
+
+    # cumsum adds left to right, unlike the pairwise ``sum``; the leading zero
+    # column reproduces Python's ``0 + first`` for a -0.0 score as well.
+    zero = np.zeros((len(points), 1))
+    reliable_total = np.cumsum(np.hstack((zero, np.where(reliable, score, 0.0))), axis=1)[:, -1]
+    torso_valid = valid[:, POSE_TORSO_INDICES]
+    torso_total = np.cumsum(np.hstack((zero, np.where(torso_valid, score[:, POSE_TORSO_INDICES], 0.0))), axis=1)[:, -1]
+    torso_count = torso_valid.sum(axis=1)
+    bbox_score = reliable_total / reliable.sum(axis=1)
+    torso_score = np.where(torso_count > 0, torso_total / np.maximum(torso_count, 1), 0.0)
+
+    columns = [
+        values.tolist() for values in (
+            bbox_x0, bbox_y0, bbox_x1, bbox_y1, bbox_score, torso_score,
+        )
+    ]
+    point_values = points.tolist()
+    valid_values = valid.tolist()
+    poses: list[dict[str, Any]] = []
+    for person, (x0, y0, x1, y1, bbox_score_value, torso_score_value) in enumerate(zip(*columns)):
+        person_points = point_values[person]
+        person_valid = valid_values[person]
+
+        def keypoint(index: int) -> dict[str, float] | None:
+            if not person_valid[index]:
+                return None
+            point = person_points[index]
+            return {"x": point[0], "y": point[1], "score": point[2]}
+
+        def valid_score(index: int) -> float:
+            return person_points[index][2] if person_valid[index] else 0.0
+
+        poses.append({
+            "bbox": {"x0": x0, "y0": y0, "x1": x1, "y1": y1, "score": bbox_score_value},
+            "torso_score": torso_score_value,
+            "left_ankle_score": valid_score(15),
+            "right_ankle_score": valid_score(16),
+            "keypoints": {name: keypoint(index) for name, index in POSE_KEYPOINT_NAMES},
+        })
+    return poses
+
+
 def detect_poses(image: Any, device: str) -> list[dict[str, Any]]:
     """Return per-person HumanArt/RTMPose evidence for full-body crops.
 
@@ -405,114 +552,104 @@ def detect_poses(image: Any, device: str) -> list[dict[str, Any]]:
             return []
         if len(scores) == 0:
             return []
-        image_width, image_height = image.size
-        poses: list[dict[str, Any]] = []
-        for person_keypoints, person_scores in zip(keypoints, scores):
-            if len(person_scores) < 26 or len(person_keypoints) < 26:
-                raise RuntimeError("BodyWithFeet 未返回完整 Halpe26 关键点")
-            import math
-
-            valid_points: dict[int, tuple[float, float, float]] = {}
-            for index in range(26):
-                x = float(person_keypoints[index][0])
-                y = float(person_keypoints[index][1])
-                score = float(person_scores[index])
-                if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(score)):
-                    continue
-                if not point_in_image(x, y, image_width, image_height):
-                    continue
-                valid_points[index] = (x, y, score)
-
-            reliable_points = [
-                valid_points[index]
-                for index in POSE_BBOX_RELIABLE_INDICES
-                if index in valid_points and valid_points[index][2] >= POSE_RELIABLE_SCORE
-            ]
-            if len(reliable_points) < 5:
-                continue
-
-            reliable_x0 = min(point[0] for point in reliable_points)
-            reliable_x1 = max(point[0] for point in reliable_points)
-            reliable_y0 = min(point[1] for point in reliable_points)
-            reliable_y1 = max(point[1] for point in reliable_points)
-            horizontal_margin = max(
-                (reliable_x1 - reliable_x0) * 1.25,
-                image_width * 0.10,
-            )
-            upper_margin = max(
-                (reliable_y1 - reliable_y0) * 0.25,
-                image_height * 0.03,
-            )
-            # Knees, ankles and foot tips are frequently scored below the
-            # general-body threshold on stylized art.  Keep low-score points
-            # only when they remain anatomically associated with the reliable
-            # skeleton; this extends the pose bbox for person association
-            # without accepting arbitrary coordinates elsewhere in the image.
-            lower_association_points = [
-                valid_points[index]
-                for index in POSE_LOWER_ASSOCIATION_INDICES
-                if index in valid_points
-                and valid_points[index][2] >= POSE_LOWER_ASSOCIATION_SCORE
-                and reliable_x0 - horizontal_margin
-                <= valid_points[index][0]
-                <= reliable_x1 + horizontal_margin
-                and valid_points[index][1] >= reliable_y0 - upper_margin
-            ]
-            bbox_points = reliable_points + lower_association_points
-            x_values = [point[0] for point in bbox_points]
-            y_values = [point[1] for point in bbox_points]
-            torso_indices = (5, 6, 11, 12)
-            torso_scores = [
-                valid_points[index][2]
-                for index in torso_indices
-                if index in valid_points
-            ]
-
-            def keypoint(index: int) -> dict[str, float] | None:
-                point = valid_points.get(index)
-                if point is None:
-                    return None
-                return {"x": point[0], "y": point[1], "score": point[2]}
-
-            def valid_score(index: int) -> float:
-                point = valid_points.get(index)
-                return point[2] if point is not None else 0.0
-
-            poses.append({
-                "bbox": {
-                    "x0": min(x_values), "y0": min(y_values),
-                    "x1": max(x_values), "y1": max(y_values),
-                    "score": sum(point[2] for point in reliable_points) / len(reliable_points),
-                },
-                "torso_score": sum(torso_scores) / len(torso_scores) if torso_scores else 0.0,
-                "left_ankle_score": valid_score(15),
-                "right_ankle_score": valid_score(16),
-                "keypoints": {
-                    "left_hip": keypoint(11),
-                    "right_hip": keypoint(12),
-                    "left_knee": keypoint(13),
-                    "right_knee": keypoint(14),
-                    "left_ankle": keypoint(15),
-                    "right_ankle": keypoint(16),
-                    "left_big_toe": keypoint(20),
-                    "right_big_toe": keypoint(21),
-                    "left_small_toe": keypoint(22),
-                    "right_small_toe": keypoint(23),
-                    "left_heel": keypoint(24),
-                    "right_heel": keypoint(25),
-                },
-            })
-        return poses
+        return pose_records(keypoints, scores, *image.size)
     except Exception as error:
         _POSE_LAST_ERROR = str(error)
         return []
 
 
-def analyze_item(item: dict[str, Any], device: str) -> dict[str, Any]:
-    media_id = str(item.get("media_id", ""))
-    path = Path(str(item.get("path", "")))
-    result: dict[str, Any] = {
-        "media_id": media_id,
+def _yolo_batch_target(function: Callable[..., Any]) -> tuple[Any, float, float] | None:
+    """Resolve the imgutils YOLO model and thresholds behind a detector entry.
+
+    The public ``detect_*`` helpers accept a single image.  Their module-level
+    repository ID and signature defaults are all that is needed to call the
+    same cached session with a batch; anything unexpected disables batching.
+    """
+    module = sys.modules.get(getattr(function, "__module__", ""))
+    repo_id = getattr(module, "_REPO_ID", None)
+    if not isinstance(repo_id, str):
+        return None
+    parameters = inspect.signature(function).parameters
+    conf = parameters.get("conf_threshold")
+    iou = parameters.get("iou_threshold")
+    if conf is None or iou is None or not isinstance(conf.default, (int, float)) or not isinstance(iou.default, (int, float)):
+        return None
+    from imgutils.generic.yolo import _open_models_for_repo_id
+
+    return _open_models_for_repo_id(repo_id), float(conf.default), float(iou.default)
+
+
+def _batched_predict(holder: Any, model_name: str, images: list[Any], conf: float, iou: float) -> list[Any] | None:
+    """Run one ONNX call per input size, mirroring ``YOLOModel.predict``.
+
+    Preprocessing and post-processing are the imgutils functions used for a
+    single image, so every row yields the same detections as a batch of one.
+    Returns ``None`` when the exported session has a fixed batch dimension.
+    """
+    import numpy as np
+    from imgutils.data import rgb_encode
+    from imgutils.generic import yolo
+
+    session, max_infer_size, labels, exec_lock = holder._open_model(model_name)
+    if isinstance(session.get_inputs()[0].shape[0], int):
+        return None
+    postprocess = {
+        "yolo": yolo._yolo_postprocess,
+        "rtdetr": yolo._rtdetr_postprocess,
+    }.get(holder._get_model_type(model_name))
+    if postprocess is None:
+        return None
+    prepared = [yolo._image_preprocess(image, max_infer_size) for image in images]
+    groups: dict[tuple[int, int], list[int]] = {}
+    for index, (_, _, new_size) in enumerate(prepared):
+        groups.setdefault(tuple(new_size), []).append(index)
+    results: list[Any] = [None] * len(images)
+    for indices in groups.values():
+        data = np.stack([rgb_encode(prepared[index][0]) for index in indices])
+        with exec_lock:
+            output, = session.run(["output0"], {"images": data})
+        for row, index in enumerate(indices):
+            _, old_size, new_size = prepared[index]
+            results[index] = postprocess(
+                output=output[row],
+                conf_threshold=conf,
+                iou_threshold=iou,
+                old_size=old_size,
+                new_size=new_size,
+                labels=labels,
+            )
+    return results
+
+
+def _detect_many(function: Callable[..., Any], model_name: str, kwargs: dict[str, Any], images: list[Any]) -> list[Any]:
+    """Detect every image, batching when the detector session allows it.
+
+    Each entry is the raw detector result or the exception raised for that
+    image.  A failed batch falls back to per-image calls so one bad input
+    cannot fail its neighbours.
+    """
+    if len(images) > 1:
+        try:
+            target = _yolo_batch_target(function)
+            if target is not None:
+                holder, conf, iou = target
+                batched = _batched_predict(holder, model_name, images, conf, iou)
+                if batched is not None:
+                    return batched
+        except Exception:
+            pass
+    outputs: list[Any] = []
+    for image in images:
+        try:
+            outputs.append(_call_detector(function, image, **kwargs))
+        except Exception as error:
+            outputs.append(error)
+    return outputs
+
+
+def empty_result(item: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "media_id": str(item.get("media_id", "")),
         "width": 0,
         "height": 0,
         "persons": [],
@@ -526,57 +663,356 @@ def analyze_item(item: dict[str, Any], device: str) -> dict[str, Any]:
         "pose_error": None,
         "segmentation_error": None,
     }
+
+
+def finish_item(result: dict[str, Any], image: Any, device: str, segmenters: Any) -> None:
+    """Add segmentation and pose evidence once the detector boxes are known."""
+    # ISNet segmentation is optional protection only.  A missing model or
+    # uncertain mask must not make a crop wider than detection evidence.
+    segment = _detector(segmenters, ("segment_rgba_with_isnetis",))
+    if segment and len(result["persons"]) == 1:
+        try:
+            rgba = segment(image)
+            # imgutils 0.19 returns ``(mask_ndarray, rgba_image)``;
+            # older releases returned the RGBA image directly.  Support
+            # both contracts so the optional ISNet boundary is actually
+            # used rather than silently skipped.
+            if isinstance(rgba, tuple):
+                rgba = rgba[-1]
+            alpha = rgba.getchannel("A") if hasattr(rgba, "getchannel") else None
+            if alpha:
+                bbox = alpha.getbbox()
+                if bbox:
+                    result["foreground"] = {"x0": float(bbox[0]), "y0": float(bbox[1]), "x1": float(bbox[2]), "y1": float(bbox[3]), "score": 1.0}
+        except Exception as error:
+            result["segmentation_error"] = str(error)
+    result["poses"] = detect_poses(image, device)
+    result["pose_error"] = _POSE_LAST_ERROR
+    result["pose_complete"] = any(
+        pose["torso_score"] >= 0.45
+        and pose["left_ankle_score"] >= 0.45
+        and pose["right_ankle_score"] >= 0.45
+        for pose in result["poses"]
+    )
+
+
+def decode_item(item: dict[str, Any], data: bytes | None = None, max_side: int = 0) -> Any:
+    """Return the item's RGB image, or the exception that prevented decoding.
+
+    ``data`` lets a caller that already read the file for hashing decode the
+    same bytes instead of reading the file a second time.  With ``max_side``
+    a larger image is decoded at reduced scale (JPEG DCT scaling via
+    ``draft``) and resized to fit; its source size is kept in
+    ``image.info["crop_source_size"]`` so results can be mapped back.
+    """
     try:
         from PIL import Image
 
+        source: Any = io.BytesIO(data) if data is not None else Path(str(item.get("path", "")))
+        with Image.open(source) as opened:
+            width, height = opened.size
+            if max_side <= 0 or max(width, height) <= max_side:
+                return opened.convert("RGB")
+            ratio = max_side / max(width, height)
+            target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+            opened.draft("RGB", target)
+            image = opened.convert("RGB")
+        if image.size != target:
+            image = image.resize(target, Image.Resampling.BOX)
+        image.info["crop_source_size"] = (width, height)
+        return image
+    except Exception as error:
+        return error
+
+
+class DetectionCache:
+    """Size-bounded on-disk cache of ``analyze_item`` records.
+
+    ``analyze_item`` output depends only on the pixels and the detector/pose
+    stack, so a record is keyed by the file's SHA-256 and a fingerprint of
+    the model set, detector arguments and package versions.  A new model or
+    package version therefore never returns an older stack's record.  Only
+    records without any error are stored.  Entries live beside the model
+    downloads, never in a media library, and the least recently used ones
+    are removed once the directory exceeds its byte budget.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, options: dict[str, Any] | None = None) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fingerprint = hashlib.sha256(json.dumps({
+            "options": options or {},
+            "schema": DETECTION_CACHE_SCHEMA_VERSION,
+            "models": list(WARMUP_MODELS),
+            "jobs": [[name, model_name, kwargs] for name, _, model_name, kwargs in DETECTION_JOBS],
+            "pose": [POSE_RELIABLE_SCORE, POSE_LOWER_ASSOCIATION_SCORE],
+            "imgutils": module_version("dghs-imgutils"),
+            "rtmlib": module_version("rtmlib"),
+        }, sort_keys=True).encode("utf-8")).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, options: dict[str, Any] | None = None) -> "DetectionCache":
+        try:
+            max_bytes = int(float(os.environ.get("CROP_DETECTION_CACHE_MAX_MB", DETECTION_CACHE_MAX_MB)) * 1024 * 1024)
+        except ValueError:
+            max_bytes = DETECTION_CACHE_MAX_MB * 1024 * 1024
+        return cls(model_cache_root() / "detections", max(0, max_bytes), options)
+
+    def key(self, data: bytes) -> str:
+        return hashlib.sha256(self.fingerprint.encode("ascii") + hashlib.sha256(data).digest()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        path = self._path(key)
+        try:
+            record = json.loads(path.read_text(encoding="utf-8"))
+            if not isinstance(record, dict):
+                raise ValueError("detection cache entry is not an object")
+            os.utime(path)  # recency for LRU eviction
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return record
+
+    def put(self, key: str, result: dict[str, Any]) -> None:
+        if self.max_bytes <= 0 or any(result.get(field) for field in ("error", "pose_error", "segmentation_error")):
+            return
+        record = {field: value for field, value in result.items() if field != "media_id"}
+        path = self._path(key)
+        temporary: str | None = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                mode="w", encoding="utf-8", prefix=f"{key}-", suffix=".tmp", dir=path.parent, delete=False,
+            ) as stream:
+                temporary = stream.name
+                json.dump(record, stream, ensure_ascii=False, separators=(",", ":"))
+            os.replace(temporary, path)
+            self.stored += 1
+        except OSError:
+            # A read-only or full cache disk must not fail the detection run.
+            if temporary is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(temporary)
+
+    def prune(self) -> None:
+        """Remove least recently used entries until 90% of the budget remains."""
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        try:
+            for shard in os.scandir(self.root):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        except OSError:
+            return
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+                total -= size
+                self.evicted += 1
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "stored": self.stored, "evicted": self.evicted}
+
+
+def prefetched_chunks(
+    items: list[dict[str, Any]],
+    batch_size: int,
+    workers: int,
+    depth: int,
+    load: Callable[[dict[str, Any]], Any] | None = None,
+) -> Iterator[tuple[list[dict[str, Any]], list[Any]]]:
+    """Yield ``(items, decoded images)`` chunks in input order.
+
+    A small thread pool decodes ahead while the caller runs inference; PIL
+    releases the GIL while decoding.  At most ``depth`` items beyond the chunk
+    being analysed are submitted, which bounds the decoded images in memory.
+    ``load`` replaces ``decode_item`` when the caller needs more per item.
+    """
+    load = load or decode_item
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="anime-crop-decode")
+    pending: deque[tuple[dict[str, Any], Future[Any]]] = deque()
+    source = iter(items)
+    try:
+        while True:
+            while len(pending) < batch_size + depth:
+                try:
+                    item = next(source)
+                except StopIteration:
+                    break
+                pending.append((item, pool.submit(load, item)))
+            if not pending:
+                return
+            chunk = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            yield [item for item, _ in chunk], [future.result() for _, future in chunk]
+            chunk.clear()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _scaled_box(box: dict[str, float], scale_x: float, scale_y: float) -> dict[str, float]:
+    return {
+        "x0": box["x0"] * scale_x, "y0": box["y0"] * scale_y,
+        "x1": box["x1"] * scale_x, "y1": box["y1"] * scale_y,
+        "score": box["score"],
+    }
+
+
+def scale_result(result: dict[str, Any], scale_x: float, scale_y: float) -> None:
+    """Map boxes and keypoints found on a reduced image to source pixels."""
+    for name in ("persons", "heads", "faces", "half_bodies", "hands"):
+        result[name] = [_scaled_box(box, scale_x, scale_y) for box in result[name]]
+    if result["foreground"] is not None:
+        result["foreground"] = _scaled_box(result["foreground"], scale_x, scale_y)
+    for pose in result["poses"]:
+        pose["bbox"] = _scaled_box(pose["bbox"], scale_x, scale_y)
+        for name, point in pose["keypoints"].items():
+            if point is not None:
+                pose["keypoints"][name] = {"x": point["x"] * scale_x, "y": point["y"] * scale_y, "score": point["score"]}
+
+
+def needs_refinement(result: dict[str, Any], scale_x: float, scale_y: float) -> bool:
+    """Whether reduced-scale heads or hands are too small to trust.
+
+    ``scale_result`` has already run, so box sizes are divided by the scale
+    to measure them in the pixels the detector actually saw.
+    """
+    if result["persons"] and not result["heads"]:
+        return True
+    return any(
+        min((box["x1"] - box["x0"]) / scale_x, (box["y1"] - box["y0"]) / scale_y) < REFINE_MIN_PART_SIZE
+        for box in result["heads"] + result["hands"]
+    )
+
+
+def refine_small_parts(result: dict[str, Any], item: dict[str, Any], detectors: Any) -> None:
+    """Re-detect heads and hands at source resolution inside each person.
+
+    Only the regions around detected persons are re-run.  Reduced-scale
+    heads and hands whose centre lies in a refined region are replaced;
+    those elsewhere are kept.  The full-resolution image is decoded here
+    for one item at a time and released before the next.
+    """
+    image = decode_item(item)
+    if isinstance(image, Exception):
+        raise image
+    width, height = image.size
+    regions: list[tuple[int, int, int, int]] = []
+    for person in result["persons"]:
+        pad_x = (person["x1"] - person["x0"]) * 0.10
+        pad_y = (person["y1"] - person["y0"]) * 0.10
+        regions.append((
+            max(0, int(person["x0"] - pad_x)), max(0, int(person["y0"] - pad_y)),
+            min(width, int(person["x1"] + pad_x) + 1), min(height, int(person["y1"] + pad_y) + 1),
+        ))
+
+    def inside(box: dict[str, float]) -> bool:
+        centre_x, centre_y = (box["x0"] + box["x1"]) / 2, (box["y0"] + box["y1"]) / 2
+        return any(x0 <= centre_x < x1 and y0 <= centre_y < y1 for x0, y0, x1, y1 in regions)
+
+    for name, names, _, kwargs in DETECTION_JOBS:
+        if name not in ("heads", "hands"):
+            continue
+        function = _detector(detectors, names)
+        if function is None:
+            raise RuntimeError(f"imgutils 缺少 {name} 检测入口")
+        refined = [box for box in result[name] if not inside(box)]
+        for x0, y0, x1, y1 in regions:
+            for box in _boxes(_call_detector(function, image.crop((x0, y0, x1, y1)), **kwargs)):
+                refined.append({
+                    "x0": box["x0"] + x0, "y0": box["y0"] + y0,
+                    "x1": box["x1"] + x0, "y1": box["y1"] + y0,
+                    "score": box["score"],
+                })
+        result[name] = refined
+
+
+def analyze_items(
+    items: list[dict[str, Any]],
+    device: str,
+    images: list[Any] | None = None,
+    refine: bool = False,
+) -> list[dict[str, Any]]:
+    """Analyse several items, sharing each detector's ONNX runs between them.
+
+    ``images`` may carry already decoded images (or decode exceptions) in
+    item order.  An image decoded at reduced scale is analysed as is and its
+    record is mapped back to source pixels; with ``refine`` small heads and
+    hands are re-detected at source resolution.  The returned records are in
+    input order and equal the ones produced for the same items one at a
+    time.  Errors stay scoped to their own item.
+    """
+    results = [empty_result(item) for item in items]
+    try:
         install_hub_download_fallback()
         from imgutils import detect as detectors
         from imgutils import segment as segmenters
-
-        with Image.open(path) as opened:
-            image = opened.convert("RGB")
-        result["width"], result["height"] = image.size
-        jobs = {
-            "heads": (_detector(detectors, ("detect_heads",)), {"model_name": HEAD_MODEL, "level": "s", "version": "v2.0"}),
-            "faces": (_detector(detectors, ("detect_faces", "detect_face")), {"level": "s", "version": "v1.4"}),
-            "persons": (_detector(detectors, ("detect_persons", "detect_person")), {"level": "m", "version": "v1.1"}),
-            "half_bodies": (_detector(detectors, ("detect_halfbodies", "detect_halfbody")), {"level": "s", "version": "v1.0"}),
-            "hands": (_detector(detectors, ("detect_hands", "detect_hand")), {"level": "s", "version": "v1.0"}),
-        }
-        for name, (function, kwargs) in jobs.items():
-            if function is None:
-                raise RuntimeError(f"imgutils 缺少 {name} 检测入口")
-            result[name] = _boxes(_call_detector(function, image, **kwargs))
-        # ISNet segmentation is optional protection only.  A missing model or
-        # uncertain mask must not make a crop wider than detection evidence.
-        segment = _detector(segmenters, ("segment_rgba_with_isnetis",))
-        if segment and len(result["persons"]) == 1:
-            try:
-                rgba = segment(image)
-                # imgutils 0.19 returns ``(mask_ndarray, rgba_image)``;
-                # older releases returned the RGBA image directly.  Support
-                # both contracts so the optional ISNet boundary is actually
-                # used rather than silently skipped.
-                if isinstance(rgba, tuple):
-                    rgba = rgba[-1]
-                alpha = rgba.getchannel("A") if hasattr(rgba, "getchannel") else None
-                if alpha:
-                    bbox = alpha.getbbox()
-                    if bbox:
-                        result["foreground"] = {"x0": float(bbox[0]), "y0": float(bbox[1]), "x1": float(bbox[2]), "y1": float(bbox[3]), "score": 1.0}
-            except Exception as error:
-                result["segmentation_error"] = str(error)
-        result["poses"] = detect_poses(image, device)
-        result["pose_error"] = _POSE_LAST_ERROR
-        result["pose_complete"] = any(
-            pose["torso_score"] >= 0.45
-            and pose["left_ankle_score"] >= 0.45
-            and pose["right_ankle_score"] >= 0.45
-            for pose in result["poses"]
-        )
     except Exception as error:
-        result["error"] = str(error)
-    return result
+        for result in results:
+            result["error"] = str(error)
+        return results
+    if images is None:
+        images = [decode_item(item) for item in items]
+    for index, image in enumerate(images):
+        if isinstance(image, Exception):
+            results[index]["error"] = str(image)
+        else:
+            results[index]["width"], results[index]["height"] = image.info.get("crop_source_size", image.size)
+    for name, names, model_name, kwargs in DETECTION_JOBS:
+        pending = [index for index in range(len(items)) if "error" not in results[index]]
+        if not pending:
+            break
+        function = _detector(detectors, names)
+        if function is None:
+            for index in pending:
+                results[index]["error"] = f"imgutils 缺少 {name} 检测入口"
+            break
+        outputs = _detect_many(function, model_name, kwargs, [images[index] for index in pending])
+        for index, output in zip(pending, outputs):
+            if isinstance(output, Exception):
+                results[index]["error"] = str(output)
+            else:
+                results[index][name] = _boxes(output)
+    for index, result in enumerate(results):
+        if "error" in result:
+            continue
+        image = images[index]
+        images[index] = None
+        try:
+            finish_item(result, image, device, segmenters)
+            if "crop_source_size" in image.info:
+                scale_x = result["width"] / image.width
+                scale_y = result["height"] / image.height
+                scale_result(result, scale_x, scale_y)
+                if refine and needs_refinement(result, scale_x, scale_y):
+                    del image
+                    refine_small_parts(result, items[index], detectors)
+        except Exception as error:
+            result["error"] = str(error)
+    return results
+
+
+def analyze_item(item: dict[str, Any], device: str) -> dict[str, Any]:
+    return analyze_items([item], device)[0]
 
 
 def warmup(device: str) -> dict[str, Any]:
@@ -619,64 +1055,389 @@ def warmup(device: str) -> dict[str, Any]:
     }
 
 
-def main() -> int:
+def pin_device(gpu_id: str) -> str:
+    # Force CUDA-only inference semantics.  The Rust health check rejects a
+    # provider failure; no implicit CPU execution is allowed.  Once a
+    # physical GPU is isolated by CUDA_VISIBLE_DEVICES it is visible to
+    # ONNX Runtime as cuda:0, including when the user selected GPU 2+.
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", gpu_id)
+    os.environ["ONNX_MODE"] = "CUDAExecutionProvider"
+    return "cuda:0"
+
+
+def cached_dependency_health(device: str) -> dict[str, Any]:
+    """Reuse a successful dependency probe for the lifetime of this process.
+
+    The CUDA session probe opens a real detector, which dominates a small
+    request once the worker is already warm.  Only a ready result is reused;
+    the warmup marker is re-read on every call so its state stays current.
+    """
+    global _DEPENDENCY_HEALTH
+    if _DEPENDENCY_HEALTH is None:
+        status = dependency_health(device)
+        if status["dependencies_ready"]:
+            _DEPENDENCY_HEALTH = copy.deepcopy(status)
+        return status
+    status = copy.deepcopy(_DEPENDENCY_HEALTH)
+    update_model_marker_health(status, device)
+    return status
+
+
+def detect(payload: dict[str, Any], device: str) -> int:
+    health = cached_dependency_health(device)
+    if not health["dependencies_ready"]:
+        return emit({"ready": False, "health": health, "items": []})
+    items = payload.get("items", [])
+    if not isinstance(items, list):
+        return emit({"ready": False, "error": "items 必须为数组", "items": []})
     try:
-        payload = json.loads(sys.stdin.read())
-        action = str(payload.get("action", "health"))
-        gpu_id = str(payload.get("gpu_id", "0"))
-        # Force CUDA-only inference semantics.  The Rust health check rejects a
-        # provider failure; no implicit CPU execution is allowed.  Once a
-        # physical GPU is isolated by CUDA_VISIBLE_DEVICES it is visible to
-        # ONNX Runtime as cuda:0, including when the user selected GPU 2+.
-        os.environ.setdefault("CUDA_VISIBLE_DEVICES", gpu_id)
-        os.environ["ONNX_MODE"] = "CUDAExecutionProvider"
-        device = "cuda:0"
-        if action == "health":
-            return emit(dependency_health(device))
-        if action == "warmup":
-            return emit(warmup(device))
-        if action != "detect":
-            return emit({"error": "unknown_action", "ready": False})
-        health = dependency_health(device)
-        if not health["dependencies_ready"]:
-            return emit({"ready": False, "health": health, "items": []})
-        items = payload.get("items", [])
-        if not isinstance(items, list):
-            return emit({"ready": False, "error": "items 必须为数组", "items": []})
-        completed = 0
-        detected_any = False
-        pose_failures: list[str] = []
-        for item in items:
-            # Third-party detector packages occasionally log to stdout. Keep
-            # their output out of the JSONL stream, then flush this item's
-            # contract record immediately so a long batch is observable.
-            with contextlib.redirect_stdout(sys.stderr):
-                result = analyze_item(item, device)
-            detected_any = detected_any or not bool(result.get("error"))
+        batch_size = min(MAX_DETECTION_BATCH_SIZE, max(1, int(payload.get("batch_size", DETECTION_BATCH_SIZE))))
+        workers = min(MAX_DECODE_WORKERS, max(1, int(payload.get("decode_workers", DECODE_WORKERS))))
+        depth = min(MAX_DECODE_PREFETCH, max(0, int(payload.get("prefetch", DECODE_PREFETCH))))
+        max_side = max(0, int(payload.get("max_side", 0) or 0))
+    except (TypeError, ValueError):
+        return emit({"ready": False, "error": "batch_size、decode_workers、prefetch 与 max_side 必须为整数", "items": []})
+    if 0 < max_side < MIN_WORKING_SIDE:
+        return emit({"ready": False, "error": f"max_side 不能小于 {MIN_WORKING_SIDE}", "items": []})
+    refine = bool(payload.get("refine", False)) and max_side > 0
+    cache = DetectionCache.open({"max_side": max_side, "refine": refine}) if payload.get("cache", True) is not False else None
+
+    def load(item: dict[str, Any]) -> tuple[str | None, Any]:
+        # Returns the cache key and either a cached record (dict) or the
+        # decoded image / decode exception for a cache miss.
+        if cache is None:
+            return None, decode_item(item, max_side=max_side)
+        try:
+            data = Path(str(item.get("path", ""))).read_bytes()
+        except OSError as error:
+            return None, error
+        key = cache.key(data)
+        cached = cache.get(key)
+        return (key, cached) if cached is not None else (key, decode_item(item, data, max_side))
+
+    completed = 0
+    detected_any = False
+    pose_failures: list[str] = []
+    for chunk, loaded in prefetched_chunks(items, batch_size, workers, depth, load):
+        fresh = [index for index, (_, value) in enumerate(loaded) if not isinstance(value, dict)]
+        # Third-party detector packages occasionally log to stdout. Keep
+        # their output out of the JSONL stream, then flush this batch's
+        # contract records immediately so a long run is observable.
+        with contextlib.redirect_stdout(sys.stderr):
+            analysed = analyze_items(
+                [chunk[index] for index in fresh], device, [loaded[index][1] for index in fresh], refine,
+            )
+        # Only fresh analyses prove the model stack works; cache hits do not.
+        detected_any = detected_any or any(not result.get("error") for result in analysed)
+        results: list[dict[str, Any]] = []
+        fresh_results = iter(analysed)
+        for index, (key, value) in enumerate(loaded):
+            if isinstance(value, dict):
+                results.append({"media_id": str(chunk[index].get("media_id", "")), **value})
+                continue
+            result = next(fresh_results)
+            if cache is not None and key is not None:
+                cache.put(key, result)
+            results.append(result)
+        del loaded, analysed, fresh_results
+        for result in results:
             if result.get("pose_error"):
                 pose_failures.append(
                     f"{result.get('media_id') or '<unknown>'}: {result['pose_error']}"
                 )
             emit({"type": "detection", "item": result})
             completed += 1
-        if pose_failures:
-            health["ready"] = False
-            health["pose_ready"] = False
-            return emit({
-                "type": "complete",
-                "ready": False,
-                "health": health,
-                "error": "HumanArt/RTMPose 姿态检测失败: " + "; ".join(pose_failures[:3]),
-                "pose_failure_count": len(pose_failures),
-                "count": completed,
-            })
-        if detected_any:
-            mark_models_warmed(device)
-            update_model_marker_health(health, device)
-        # The task protocol is JSONL rather than a single unbounded response:
-        # the Rust parent can validate every returned media ID independently
-        # and never needs to grant the worker write access to the workspace.
-        return emit({"type": "complete", "ready": True, "health": health, "count": completed})
+    cache_stats: dict[str, int] | None = None
+    if cache is not None:
+        if cache.stored:
+            cache.prune()
+        cache_stats = cache.stats()
+    if pose_failures:
+        health["ready"] = False
+        health["pose_ready"] = False
+        return emit({
+            "type": "complete",
+            "ready": False,
+            "health": health,
+            "error": "HumanArt/RTMPose 姿态检测失败: " + "; ".join(pose_failures[:3]),
+            "pose_failure_count": len(pose_failures),
+            "count": completed,
+            "cache": cache_stats,
+        })
+    if detected_any:
+        mark_models_warmed(device)
+        update_model_marker_health(health, device)
+    # The task protocol is JSONL rather than a single unbounded response:
+    # the Rust parent can validate every returned media ID independently
+    # and never needs to grant the worker write access to the workspace.
+    return emit({"type": "complete", "ready": True, "health": health, "count": completed, "cache": cache_stats})
+
+
+def handle(payload: dict[str, Any], device: str) -> int:
+    action = str(payload.get("action", "health"))
+    if action == "health":
+        return emit(dependency_health(device))
+    if action == "warmup":
+        return emit(warmup(device))
+    if action != "detect":
+        return emit({"error": "unknown_action", "ready": False})
+    return detect(payload, device)
+
+
+def serve() -> int:
+    """Answer newline-delimited requests until stdin closes.
+
+    Every request line has the same shape as the one-shot document and gets
+    the same response records, so a parent can switch modes without a new
+    parser.  Imported packages, ONNX sessions and the pose model stay loaded
+    between requests.  The process is pinned to the first request's GPU; a
+    request for another GPU is refused instead of silently running elsewhere.
+    """
+    pinned: str | None = None
+    device = ""
+    for line in iter(sys.stdin.readline, ""):
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+            if not isinstance(payload, dict):
+                raise ValueError("请求必须是 JSON 对象")
+            gpu_id = str(payload.get("gpu_id", pinned or "0"))
+            if pinned is None:
+                pinned = gpu_id
+                device = pin_device(gpu_id)
+            elif gpu_id != pinned:
+                emit({"ready": False, "error": f"常驻 worker 已绑定 GPU {pinned}，拒绝 GPU {gpu_id} 的请求"})
+                continue
+            handle(payload, device)
+        except Exception as error:
+            emit({"ready": False, "error": str(error), "traceback": traceback.format_exc(limit=3)})
+    return 0
+
+
+class ServeWorker:
+    """One warm ``--serve`` child process isolated to a single physical GPU."""
+
+    def __init__(self, gpu_id: str) -> None:
+        self.gpu_id = gpu_id
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=gpu_id, PYTHONIOENCODING="utf-8")
+        self.process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            text=True,
+            encoding="utf-8",
+        )
+
+    def request(self, payload: dict[str, Any]) -> list[dict[str, Any]]:
+        """Send one request line and collect records up to the terminal one."""
+        assert self.process.stdin is not None and self.process.stdout is not None
+        self.process.stdin.write(json.dumps({**payload, "gpu_id": self.gpu_id}, ensure_ascii=False) + "\n")
+        self.process.stdin.flush()
+        records: list[dict[str, Any]] = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError(f"GPU {self.gpu_id} 的常驻 worker 意外退出")
+            record = json.loads(line)
+            records.append(record)
+            if record.get("type") != "detection":
+                return records
+
+    def close(self) -> None:
+        with contextlib.suppress(OSError):
+            if self.process.stdin is not None:
+                self.process.stdin.close()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def combine_device_status(statuses: dict[str, dict[str, Any]]) -> dict[str, Any]:
+    """Fold per-GPU health/warmup answers into one document.
+
+    The first device's fields keep the single-GPU shape the Rust parent
+    already parses; ``ready`` only holds when every device is ready, and the
+    first failing device's error is reported with its GPU id.
+    """
+    combined = dict(next(iter(statuses.values())))
+    combined["ready"] = all(bool(status.get("ready")) for status in statuses.values())
+    missing: list[str] = []
+    for gpu_id, status in statuses.items():
+        missing.extend(f"GPU {gpu_id}: {label}" for label in status.get("missing") or [])
+    if "missing" in combined:
+        combined["missing"] = missing
+    for gpu_id, status in statuses.items():
+        if not status.get("ready") and status.get("error"):
+            combined["error"] = f"GPU {gpu_id}: {status['error']}"
+            break
+    combined["devices"] = statuses
+    return combined
+
+
+def _merge_cache_stats(terminals: list[dict[str, Any]]) -> dict[str, int] | None:
+    stats = [record["cache"] for record in terminals if isinstance(record.get("cache"), dict)]
+    if not stats:
+        return None
+    return {name: sum(int(entry.get(name, 0)) for entry in stats) for name in stats[0]}
+
+
+def coordinate(
+    payload: dict[str, Any],
+    gpu_ids: list[str],
+    spawn: Callable[[str], Any] = ServeWorker,
+) -> int:
+    """Run one request across several GPUs, one warm ``--serve`` child each.
+
+    ``health`` and ``warmup`` are answered by every device.  ``detect`` items
+    are cut into ``batch_size`` chunks on a shared queue that idle devices
+    pull from, so a slower GPU simply takes fewer chunks.  A device whose
+    child fails or reports itself not ready returns its chunk to the queue
+    and drops out.  Detection records are re-emitted strictly in input order
+    and the complete record aggregates every device's terminal record.
+    """
+    action = str(payload.get("action", "health"))
+    request = {key: value for key, value in payload.items() if key not in ("gpu_id", "gpu_ids")}
+    workers: list[Any] = []
+    try:
+        for gpu_id in gpu_ids:
+            workers.append(spawn(gpu_id))
+        if action in ("health", "warmup"):
+            statuses: dict[str, dict[str, Any]] = {}
+            for child in workers:
+                try:
+                    statuses[child.gpu_id] = child.request(request)[-1]
+                except Exception as error:
+                    statuses[child.gpu_id] = {"ready": False, "error": str(error)}
+            return emit(combine_device_status(statuses))
+        if action != "detect":
+            return emit({"error": "unknown_action", "ready": False})
+        items = payload.get("items", [])
+        if not isinstance(items, list):
+            return emit({"ready": False, "error": "items 必须为数组", "items": []})
+        try:
+            batch_size = min(MAX_DETECTION_BATCH_SIZE, max(1, int(payload.get("batch_size", DETECTION_BATCH_SIZE))))
+        except (TypeError, ValueError):
+            return emit({"ready": False, "error": "batch_size 必须为整数", "items": []})
+        return _coordinate_detect(request, items, batch_size, workers)
+    finally:
+        for child in workers:
+            child.close()
+
+
+def _coordinate_detect(
+    request: dict[str, Any], items: list[Any], batch_size: int, workers: list[Any],
+) -> int:
+    pending = deque(range(0, len(items), batch_size))
+    results: dict[int, dict[str, Any]] = {}
+    terminals: dict[str, list[dict[str, Any]]] = {child.gpu_id: [] for child in workers}
+    failures: dict[str, dict[str, Any]] = {}
+    condition = threading.Condition()
+    running = len(workers)
+    in_flight = 0
+
+    def drain(child: Any) -> None:
+        nonlocal running, in_flight
+        try:
+            while True:
+                with condition:
+                    # Stay available while another device still holds a
+                    # chunk: if that device fails, its chunk comes back.
+                    while not pending and in_flight:
+                        condition.wait()
+                    if not pending:
+                        return
+                    start = pending.popleft()
+                    in_flight += 1
+                chunk = items[start:start + batch_size]
+                terminal: dict[str, Any] = {}
+                try:
+                    records = child.request({**request, "items": chunk})
+                    terminal = records[-1]
+                    detections = [record["item"] for record in records[:-1]]
+                    if terminal.get("type") != "complete" or len(detections) != len(chunk):
+                        raise RuntimeError(worker_error(terminal))
+                except Exception as error:
+                    with condition:
+                        pending.appendleft(start)
+                        in_flight -= 1
+                        failures[child.gpu_id] = {"ready": False, "error": str(error), "health": terminal.get("health")}
+                        condition.notify_all()
+                    return
+                with condition:
+                    in_flight -= 1
+                    terminals[child.gpu_id].append(terminal)
+                    for offset, item in enumerate(detections):
+                        results[start + offset] = item
+                    condition.notify_all()
+        finally:
+            with condition:
+                running -= 1
+                condition.notify_all()
+
+    threads = [threading.Thread(target=drain, args=(child,), daemon=True) for child in workers]
+    for thread in threads:
+        thread.start()
+    emitted = 0
+    while emitted < len(items):
+        with condition:
+            while emitted not in results and running:
+                condition.wait()
+            item = results.pop(emitted, None)
+        if item is None:
+            break
+        emit({"type": "detection", "item": item})
+        emitted += 1
+    for thread in threads:
+        thread.join()
+
+    health: dict[str, dict[str, Any]] = {}
+    for gpu_id in terminals:
+        if gpu_id in failures:
+            health[gpu_id] = failures[gpu_id]["health"] or failures[gpu_id]
+        elif terminals[gpu_id]:
+            health[gpu_id] = terminals[gpu_id][-1].get("health") or {}
+    finished = [record for records in terminals.values() for record in records]
+    complete: dict[str, Any] = {
+        "type": "complete",
+        "ready": True,
+        "health": combine_device_status(health) if health else {"ready": False},
+        "count": emitted,
+        "cache": _merge_cache_stats(finished),
+    }
+    pose_failures = sum(int(record.get("pose_failure_count", 0)) for record in finished)
+    if emitted < len(items):
+        complete["ready"] = False
+        complete["error"] = "所有 GPU worker 均不可用: " + "; ".join(
+            f"GPU {gpu_id}: {worker_error(status)}" for gpu_id, status in failures.items()
+        )
+    elif pose_failures:
+        complete["ready"] = False
+        complete["error"] = next(record["error"] for record in finished if record.get("pose_failure_count"))
+        complete["pose_failure_count"] = pose_failures
+    return emit(complete)
+
+
+def worker_error(record: dict[str, Any]) -> str:
+    if record.get("error"):
+        return str(record["error"])
+    missing = (record.get("health") or record).get("missing") or []
+    return "缺少 " + "、".join(str(label) for label in missing) if missing else "动漫检测运行时未就绪"
+
+
+def main() -> int:
+    if "--serve" in sys.argv[1:]:
+        return serve()
+    try:
+        payload = json.loads(sys.stdin.read())
+        gpu_ids = payload.get("gpu_ids")
+        if isinstance(gpu_ids, list) and gpu_ids:
+            return coordinate(payload, [str(gpu_id) for gpu_id in dict.fromkeys(gpu_ids)])
+        device = pin_device(str(payload.get("gpu_id", "0")))
+        return handle(payload, device)
     except Exception as error:
         return emit({"ready": False, "error": str(error), "traceback": traceback.format_exc(limit=3)})
 
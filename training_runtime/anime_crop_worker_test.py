@@ -0,0 +1,450 @@
+"""Run with an installed training runtime:
+python anime_crop_worker_test.py
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import anime_crop_benchmark as benchmark
+import anime_crop_worker as worker
+
+
+def ready_health(device: str) -> dict[str, Any]:
+    return {"device": device, "dependencies_ready": True, "ready": True, "missing": []}
+
+
+def fake_analysis(item: dict[str, Any], device: str) -> dict[str, Any]:
+    return {"media_id": str(item.get("media_id", "")), "width": 8, "height": 8, "persons": [], "poses": []}
+
+
+def fake_batch(
+    items: list[dict[str, Any]], device: str, images: list[Any] | None = None, refine: bool = False,
+) -> list[dict[str, Any]]:
+    return [fake_analysis(item, device) for item in items]
+
+
+class FakeDetectorSession:
+    """Dynamic-batch stand-in for a YOLO export with eight anchors per image."""
+
+    def __init__(self, batch_dim: Any = "batch") -> None:
+        self.batch_dim = batch_dim
+        self.batches: list[int] = []
+
+    def get_inputs(self) -> list[Any]:
+        return [mock.Mock(shape=[self.batch_dim, 3, 64, 64])]
+
+    def run(self, names: list[str], feeds: dict[str, Any]) -> list[Any]:
+        import numpy as np
+
+        data = feeds["images"]
+        self.batches.append(int(data.shape[0]))
+        means = data.mean(axis=(2, 3))
+        output = np.zeros((data.shape[0], 5, 8), dtype=np.float32)
+        for anchor in range(8):
+            output[:, 0, anchor] = 8 + anchor * 6 + means[:, 0] * 4
+            output[:, 1, anchor] = 10 + anchor * 5 + means[:, 1] * 4
+            output[:, 2, anchor] = 6 + means[:, 2] * 3
+            output[:, 3, anchor] = 7 + anchor
+            output[:, 4, anchor] = (means[:, anchor % 3] + anchor / 10) % 1
+        return [output]
+
+
+def yolo_holder(session: FakeDetectorSession) -> Any:
+    from imgutils.generic.yolo import YOLOModel
+
+    holder = YOLOModel("deepghs/fake_detection")
+    holder._models[(os.getpid(), threading.get_ident(), "fake")] = (session, 64, ["head"], threading.Lock())
+    holder._model_types["fake"] = "yolo"
+    return holder
+
+
+def gradient_images(count: int) -> list[Any]:
+    from PIL import Image
+
+    images = []
+    for index in range(count):
+        image = Image.new("RGB", (96 + index * 17, 128 - index * 9))
+        image.putdata([((x * 7 + index * 40) % 256, (y * 5) % 256, (x + y + index * 30) % 256)
+                       for y in range(image.height) for x in range(image.width)])
+        images.append(image)
+    return images
+
+
+class FakeServeWorker:
+    """In-process stand-in for a ``--serve`` child used by the coordinator."""
+
+    def __init__(self, gpu_id: str, delay: float = 0.0, fail: bool = False, health: dict[str, Any] | None = None) -> None:
+        self.gpu_id = gpu_id
+        self.delay = delay
+        self.fail = fail
+        self.health = health or ready_health("cuda:0")
+        self.chunks: list[list[str]] = []
+        self.closed = False
+
+    def request(self, payload: dict[str, Any]) -> list[dict[str, Any]]:
+        if self.fail:
+            raise RuntimeError(f"GPU {self.gpu_id} 的常驻 worker 意外退出")
+        if payload["action"] != "detect":
+            return [dict(self.health)]
+        time.sleep(self.delay)
+        items = payload["items"]
+        self.chunks.append([item["media_id"] for item in items])
+        records = [{"type": "detection", "item": fake_analysis(item, "cuda:0")} for item in items]
+        cache = {"hits": 0, "misses": len(items), "stored": len(items), "evicted": 0}
+        return records + [{"type": "complete", "ready": True, "health": self.health, "count": len(items), "cache": cache}]
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class AnimeCropWorkerTests(unittest.TestCase):
+    def setUp(self) -> None:
+        worker._DEPENDENCY_HEALTH = None
+
+    def serve(self, *requests: dict[str, Any]) -> list[dict[str, Any]]:
+        stdin = io.StringIO("".join(json.dumps(request) + "\n" for request in requests))
+        stdout = io.StringIO()
+        with mock.patch.dict(os.environ, {}, clear=False), \
+                mock.patch.object(worker.sys, "stdin", stdin), \
+                mock.patch.object(worker.sys, "stdout", stdout), \
+                mock.patch.object(worker, "mark_models_warmed"), \
+                mock.patch.object(worker, "update_model_marker_health"):
+            self.assertEqual(worker.serve(), 0)
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_serve_answers_each_detect_line_with_the_one_shot_jsonl_contract(self) -> None:
+        with mock.patch.object(worker, "dependency_health", side_effect=ready_health) as probe, \
+                mock.patch.object(worker, "analyze_items", side_effect=fake_batch):
+            records = self.serve(
+                {"action": "detect", "gpu_id": "0", "items": [{"media_id": "a"}, {"media_id": "b"}]},
+                {"action": "detect", "gpu_id": "0", "items": [{"media_id": "c"}]},
+            )
+
+        self.assertEqual([record["type"] for record in records], ["detection", "detection", "complete"] + ["detection", "complete"])
+        self.assertEqual([record["item"]["media_id"] for record in records if record["type"] == "detection"], ["a", "b", "c"])
+        self.assertEqual([record["count"] for record in records if record["type"] == "complete"], [2, 1])
+        self.assertEqual(probe.call_count, 1)
+
+    def test_serve_refuses_a_request_for_a_different_gpu(self) -> None:
+        with mock.patch.object(worker, "dependency_health", side_effect=ready_health), \
+                mock.patch.object(worker, "analyze_items", side_effect=fake_batch) as analyze:
+            records = self.serve(
+                {"action": "detect", "gpu_id": "0", "items": []},
+                {"action": "detect", "gpu_id": "1", "items": [{"media_id": "a"}]},
+            )
+
+        self.assertTrue(records[0]["ready"])
+        self.assertFalse(records[1]["ready"])
+        self.assertIn("GPU 0", records[1]["error"])
+        analyze.assert_not_called()
+
+    def test_serve_reports_a_malformed_line_and_keeps_running(self) -> None:
+        stdin = io.StringIO("not-json\n" + json.dumps({"action": "unknown"}) + "\n")
+        stdout = io.StringIO()
+        with mock.patch.dict(os.environ, {}, clear=False), \
+                mock.patch.object(worker.sys, "stdin", stdin), \
+                mock.patch.object(worker.sys, "stdout", stdout):
+            worker.serve()
+        records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+        self.assertFalse(records[0]["ready"])
+        self.assertEqual(records[1]["error"], "unknown_action")
+
+    def test_failed_dependency_probe_is_not_reused(self) -> None:
+        missing = {"dependencies_ready": False, "ready": False, "missing": ["rtmlib"]}
+        with mock.patch.object(worker, "dependency_health", return_value=missing) as probe, \
+                mock.patch.object(worker, "analyze_items", side_effect=fake_batch):
+            records = self.serve({"action": "detect", "items": []}, {"action": "detect", "items": []})
+
+        self.assertEqual(probe.call_count, 2)
+        self.assertFalse(records[0]["ready"])
+
+    def test_batched_detector_rows_equal_single_image_predictions(self) -> None:
+        session = FakeDetectorSession()
+        holder = yolo_holder(session)
+        images = gradient_images(5)
+
+        expected = [holder.predict(image, "fake", conf_threshold=0.3, iou_threshold=0.7) for image in images]
+        session.batches.clear()
+        batched = worker._batched_predict(holder, "fake", images, 0.3, 0.7)
+
+        self.assertEqual(batched, expected)
+        self.assertEqual(session.batches, [5])
+
+    def test_fixed_batch_sessions_fall_back_to_per_image_detection(self) -> None:
+        holder = yolo_holder(FakeDetectorSession(batch_dim=1))
+
+        self.assertIsNone(worker._batched_predict(holder, "fake", gradient_images(2), 0.3, 0.7))
+
+    def test_detector_failure_stays_scoped_to_its_own_image(self) -> None:
+        def detector(image: Any, **kwargs: Any) -> Any:
+            if image == "broken":
+                raise RuntimeError("decode failed")
+            return [((0, 0, 4, 4), "head", 0.9)]
+
+        with mock.patch.object(worker, "_yolo_batch_target", return_value=None):
+            outputs = worker._detect_many(detector, "fake", {}, ["ok", "broken", "ok"])
+
+        self.assertEqual(outputs[0], [((0, 0, 4, 4), "head", 0.9)])
+        self.assertIsInstance(outputs[1], RuntimeError)
+        self.assertEqual(outputs[2], outputs[0])
+
+    def test_detect_emits_batched_results_in_input_order(self) -> None:
+        with mock.patch.object(worker, "dependency_health", side_effect=ready_health), \
+                mock.patch.object(worker, "analyze_items", side_effect=fake_batch) as batches:
+            records = self.serve({"action": "detect", "batch_size": 2, "items": [{"media_id": str(index)} for index in range(5)]})
+
+        self.assertEqual([len(call.args[0]) for call in batches.call_args_list], [2, 2, 1])
+        self.assertEqual([record["item"]["media_id"] for record in records[:-1]], ["0", "1", "2", "3", "4"])
+        self.assertEqual(records[-1]["count"], 5)
+
+
+    def test_prefetch_keeps_input_order_and_bounds_decoded_images(self) -> None:
+        decoded: list[str] = []
+
+        def decode(item: dict[str, Any]) -> str:
+            decoded.append(item["media_id"])
+            return "image-" + item["media_id"]
+
+        items = [{"media_id": str(index)} for index in range(9)]
+        with mock.patch.object(worker, "decode_item", side_effect=decode):
+            chunks = worker.prefetched_chunks(items, batch_size=2, workers=3, depth=3)
+            first_items, first_images = next(chunks)
+            submitted = len(decoded)
+            rest = list(chunks)
+
+        self.assertEqual([item["media_id"] for item in first_items], ["0", "1"])
+        self.assertEqual(first_images, ["image-0", "image-1"])
+        self.assertLessEqual(submitted, 5)
+        self.assertEqual(
+            [image for _, images in rest for image in images],
+            [f"image-{index}" for index in range(2, 9)],
+        )
+
+    def test_decode_failure_is_reported_for_that_item_only(self) -> None:
+        missing = {"media_id": "missing", "path": os.path.join(os.path.dirname(__file__), "missing.png")}
+
+        result = worker.analyze_items([missing], "cuda:0", [worker.decode_item(missing)])[0]
+
+        self.assertEqual(result["media_id"], "missing")
+        self.assertIn("missing.png", result["error"])
+        self.assertEqual(result["persons"], [])
+
+
+    def test_repeat_detect_is_served_from_the_content_hash_cache(self) -> None:
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as directory:
+            items = []
+            for index in range(2):
+                path = Path(directory) / f"image-{index}.png"
+                Image.new("RGB", (8 + index, 8), "white").save(path)
+                items.append({"media_id": f"first-{index}", "path": str(path)})
+            # A copy of the same bytes under another media ID shares its record.
+            copied = Path(directory) / "copy.png"
+            copied.write_bytes(Path(items[0]["path"]).read_bytes())
+            with mock.patch.dict(os.environ, {"CROP_MODEL_CACHE": directory}), \
+                    mock.patch.object(worker, "dependency_health", side_effect=ready_health), \
+                    mock.patch.object(worker, "analyze_items", side_effect=fake_batch) as analyze:
+                first = self.serve({"action": "detect", "items": items})
+                second = self.serve({"action": "detect", "items": [*items, {"media_id": "copy", "path": str(copied)}]})
+
+        self.assertEqual(first[-1]["cache"], {"hits": 0, "misses": 2, "stored": 2, "evicted": 0})
+        self.assertEqual(second[-1]["cache"], {"hits": 3, "misses": 0, "stored": 0, "evicted": 0})
+        self.assertEqual([len(call.args[0]) for call in analyze.call_args_list], [2, 0])
+        self.assertEqual([record["item"]["media_id"] for record in second[:-1]], ["first-0", "first-1", "copy"])
+        self.assertEqual(second[0]["item"], {**first[0]["item"], "media_id": "first-0"})
+
+    def test_failed_analyses_are_not_cached(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            cache = worker.DetectionCache(Path(directory), 1024 * 1024)
+            cache.put("a" * 64, {"media_id": "x", "persons": [], "pose_error": "CUDA session failed"})
+            cache.put("b" * 64, {"media_id": "y", "persons": [], "error": "decode failed"})
+
+            self.assertIsNone(cache.get("a" * 64))
+            self.assertIsNone(cache.get("b" * 64))
+            self.assertEqual(cache.stats()["stored"], 0)
+
+    def test_cache_evicts_least_recently_used_entries_beyond_its_budget(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            cache = worker.DetectionCache(Path(directory), 1024 * 1024)
+            keys = [f"{index:02d}" * 32 for index in range(4)]
+            for age, key in enumerate(keys):
+                cache.put(key, {"persons": [], "padding": "x" * 300})
+                path = cache._path(key)
+                os.utime(path, (time.time() - 100 + age, time.time() - 100 + age))
+            cache.get(keys[0])  # most recently used now
+            cache.max_bytes = cache._path(keys[0]).stat().st_size * 3
+
+            cache.prune()
+
+            self.assertEqual(cache.stats()["evicted"], 2)
+            self.assertIsNotNone(cache.get(keys[0]))
+            self.assertIsNone(cache.get(keys[1]))
+            self.assertIsNone(cache.get(keys[2]))
+            self.assertIsNotNone(cache.get(keys[3]))
+
+
+    def test_vectorized_pose_records_are_byte_identical_to_the_per_point_loop(self) -> None:
+        for persons in (1, 3, 17):
+            for seed in range(20):
+                keypoints, scores = benchmark.synthetic_poses(persons, seed)
+                # Threshold-equal and negative-zero scores exercise the
+                # comparison and summation edge cases.
+                scores[:, 5] = worker.POSE_RELIABLE_SCORE
+                scores[:, 6] = -0.0
+                expected = json.dumps(benchmark.legacy_pose_records(keypoints, scores, 1024, 768))
+                actual = json.dumps(worker.pose_records(keypoints, scores, 1024, 768))
+                self.assertEqual(actual, expected, f"persons={persons} seed={seed}")
+
+    def test_pose_records_reject_incomplete_halpe26_output(self) -> None:
+        keypoints, scores = benchmark.synthetic_poses(2, 0)
+
+        with self.assertRaisesRegex(RuntimeError, "Halpe26"):
+            worker.pose_records(keypoints[:, :17], scores[:, :17], 1024, 1024)
+        self.assertEqual(worker.pose_records(keypoints[:0], scores[:0], 1024, 1024), [])
+
+
+    def test_large_jpeg_is_decoded_at_bounded_size_with_its_source_size(self) -> None:
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "large.jpg"
+            Image.new("RGB", (4000, 2500), (200, 120, 40)).save(path, quality=80)
+            reduced = worker.decode_item({"path": str(path)}, max_side=1024)
+            full = worker.decode_item({"path": str(path)})
+            small = worker.decode_item({"path": str(path)}, max_side=4096)
+
+        self.assertEqual(reduced.size, (1024, 640))
+        self.assertEqual(reduced.info["crop_source_size"], (4000, 2500))
+        self.assertEqual(full.size, (4000, 2500))
+        self.assertNotIn("crop_source_size", small.info)
+
+    def test_reduced_scale_results_are_mapped_back_to_source_pixels(self) -> None:
+        result = worker.empty_result({"media_id": "large"})
+        result["persons"] = [{"x0": 10.0, "y0": 20.0, "x1": 110.0, "y1": 220.0, "score": 0.9}]
+        result["foreground"] = {"x0": 5.0, "y0": 5.0, "x1": 120.0, "y1": 230.0, "score": 1.0}
+        result["poses"] = [{
+            "bbox": {"x0": 12.0, "y0": 22.0, "x1": 100.0, "y1": 210.0, "score": 0.8},
+            "torso_score": 0.7,
+            "left_ankle_score": 0.6,
+            "right_ankle_score": 0.0,
+            "keypoints": {"left_ankle": {"x": 40.0, "y": 200.0, "score": 0.6}, "right_ankle": None},
+        }]
+
+        worker.scale_result(result, 4.0, 2.0)
+
+        self.assertEqual(result["persons"][0], {"x0": 40.0, "y0": 40.0, "x1": 440.0, "y1": 440.0, "score": 0.9})
+        self.assertEqual(result["foreground"]["x1"], 480.0)
+        self.assertEqual(result["poses"][0]["bbox"]["y1"], 420.0)
+        self.assertEqual(result["poses"][0]["keypoints"]["left_ankle"], {"x": 160.0, "y": 400.0, "score": 0.6})
+        self.assertIsNone(result["poses"][0]["keypoints"]["right_ankle"])
+        self.assertEqual(result["poses"][0]["torso_score"], 0.7)
+
+    def test_refinement_replaces_small_parts_inside_persons_only(self) -> None:
+        from PIL import Image
+        from types import SimpleNamespace
+
+        crops: list[tuple[int, int]] = []
+
+        def detect_heads(image: Any, **kwargs: Any) -> Any:
+            crops.append(image.size)
+            return [((30, 40, 90, 100), "head", 0.8)]
+
+        def detect_hands(image: Any, **kwargs: Any) -> Any:
+            return []
+
+        result = worker.empty_result({"media_id": "large"})
+        result["persons"] = [{"x0": 100.0, "y0": 100.0, "x1": 600.0, "y1": 1100.0, "score": 0.9}]
+        result["heads"] = [
+            {"x0": 300.0, "y0": 150.0, "x1": 340.0, "y1": 190.0, "score": 0.5},
+            {"x0": 1500.0, "y0": 100.0, "x1": 1600.0, "y1": 200.0, "score": 0.7},
+        ]
+        self.assertTrue(worker.needs_refinement(result, 4.0, 4.0))
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "large.png"
+            Image.new("RGB", (2000, 1500), "white").save(path)
+            worker.refine_small_parts(result, {"path": str(path)}, SimpleNamespace(detect_heads=detect_heads, detect_hands=detect_hands))
+
+        self.assertEqual(crops, [(601, 1201)])
+        self.assertEqual(result["heads"], [
+            {"x0": 1500.0, "y0": 100.0, "x1": 1600.0, "y1": 200.0, "score": 0.7},
+            {"x0": 80.0, "y0": 40.0, "x1": 140.0, "y1": 100.0, "score": 0.8},
+        ])
+        self.assertEqual(result["hands"], [])
+
+
+    def coordinate(self, payload: dict[str, Any], children: dict[str, FakeServeWorker]) -> list[dict[str, Any]]:
+        stdout = io.StringIO()
+        with mock.patch.object(worker.sys, "stdout", stdout):
+            self.assertEqual(worker.coordinate(payload, list(children), children.__getitem__), 0)
+        self.assertTrue(all(child.closed for child in children.values()))
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_coordinator_shards_dynamically_and_merges_in_input_order(self) -> None:
+        children = {"0": FakeServeWorker("0"), "1": FakeServeWorker("1", delay=0.05)}
+        items = [{"media_id": str(index), "path": f"{index}.png"} for index in range(24)]
+        records = self.coordinate({"action": "detect", "items": items, "batch_size": 2}, children)
+
+        self.assertEqual([record["item"]["media_id"] for record in records[:-1]], [str(index) for index in range(24)])
+        self.assertEqual(records[-1]["type"], "complete")
+        self.assertTrue(records[-1]["ready"])
+        self.assertEqual(records[-1]["count"], 24)
+        self.assertEqual(records[-1]["cache"], {"hits": 0, "misses": 24, "stored": 24, "evicted": 0})
+        self.assertEqual(set(records[-1]["health"]["devices"]), {"0", "1"})
+        # The fast device steals the slow device's share instead of waiting on a static half.
+        self.assertGreater(len(children["0"].chunks), len(children["1"].chunks))
+        self.assertEqual(sum(len(chunk) for child in children.values() for chunk in child.chunks), 24)
+
+    def test_coordinator_requeues_the_chunk_of_a_failed_device(self) -> None:
+        children = {"0": FakeServeWorker("0", fail=True), "1": FakeServeWorker("1")}
+        items = [{"media_id": str(index)} for index in range(5)]
+        records = self.coordinate({"action": "detect", "items": items, "batch_size": 2}, children)
+
+        self.assertEqual([record["item"]["media_id"] for record in records[:-1]], ["0", "1", "2", "3", "4"])
+        self.assertTrue(records[-1]["ready"])
+        self.assertFalse(records[-1]["health"]["devices"]["0"]["ready"])
+
+    def test_coordinator_reports_not_ready_when_every_device_fails(self) -> None:
+        missing = {"dependencies_ready": False, "ready": False, "missing": ["imgutils"]}
+        children = {"0": FakeServeWorker("0", fail=True), "1": FakeServeWorker("1", health=missing)}
+        children["1"].request = lambda payload: [{"ready": False, "health": missing, "items": []}]
+        records = self.coordinate({"action": "detect", "items": [{"media_id": "a"}]}, children)
+
+        self.assertEqual(len(records), 1)
+        self.assertFalse(records[0]["ready"])
+        self.assertEqual(records[0]["count"], 0)
+        self.assertIn("GPU 1: 缺少 imgutils", records[0]["error"])
+
+    def test_coordinator_answers_health_per_device(self) -> None:
+        missing = {"device": "cuda:0", "dependencies_ready": True, "ready": False, "missing": ["完整 Halpe26 动漫检测模型预热"]}
+        children = {"0": FakeServeWorker("0"), "2": FakeServeWorker("2", health=missing)}
+        records = self.coordinate({"action": "health"}, children)
+
+        self.assertEqual(len(records), 1)
+        self.assertFalse(records[0]["ready"])
+        self.assertEqual(records[0]["missing"], ["GPU 2: 完整 Halpe26 动漫检测模型预热"])
+        self.assertTrue(records[0]["devices"]["0"]["ready"])
+
+    def test_serve_child_round_trips_requests_over_pipes(self) -> None:
+        child = worker.ServeWorker("0")
+        try:
+            self.assertEqual(child.request({"action": "unknown"}), [{"error": "unknown_action", "ready": False}])
+            self.assertEqual(child.request({"action": "unknown"}), [{"error": "unknown_action", "ready": False}])
+        finally:
+            child.close()
+        self.assertEqual(child.process.returncode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
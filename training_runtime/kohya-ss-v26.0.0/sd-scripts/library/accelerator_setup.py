@@ -20,6 +20,7 @@ from accelerate import Accelerator, DistributedDataParallelKwargs, InitProcessGr
 from packaging.version import Version
 
 import library.deepspeed_utils as deepspeed_utils
+import library.latent_store as latent_store
 from library.utils import setup_logging
 
 setup_logging()
@@ -32,6 +33,11 @@ logger = logging.getLogger(__name__)
 HIGH_VRAM = False
 
 
+# Mutable module-level setting of prepare_dataset_args(). Read from caching to size latents caching batches per bucket;
+# None keeps the fixed vae_batch_size.
+LATENTS_CACHING_MEMORY_BUDGET_MB = None
+
+
 def enable_high_vram(args: argparse.Namespace):
     if args.highvram:
         logger.info("highvram is enabled / highvramが有効です")
@@ -70,6 +76,11 @@ def prepare_dataset_args(args: argparse.Namespace, support_metadata: bool):
     else:
         args.face_crop_aug_range = None
 
+    latent_store.set_latents_cache_format(getattr(args, "latents_cache_format", None))
+
+    global LATENTS_CACHING_MEMORY_BUDGET_MB
+    LATENTS_CACHING_MEMORY_BUDGET_MB = getattr(args, "latents_caching_memory_budget", None)
+
     if support_metadata:
         if args.in_json is not None and (args.color_aug or args.random_crop):
             logger.warning(
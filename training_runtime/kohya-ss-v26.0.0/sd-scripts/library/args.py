@@ -603,6 +603,13 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         ],
         help=f"sampler (scheduler) type for sample images / サンプル出力時のサンプラー（スケジューラ）の種類",
     )
+    parser.add_argument(
+        "--sample_batch_size",
+        type=int,
+        default=4,
+        help="max number of sample prompts with the same size, steps, sampler and scale generated together (1 to generate one by one, default 4)"
+        + " / サイズ・ステップ数・サンプラー・スケールが同じサンプルプロンプトをまとめて生成する最大数（1で1枚ずつ生成、デフォルト4）",
+    )
 
     parser.add_argument(
         "--config_file",
@@ -980,6 +987,14 @@ def add_dataset_arguments(
     parser.add_argument(
         "--vae_batch_size", type=int, default=1, help="batch size for caching latents / latentのcache時のバッチサイズ"
     )
+    parser.add_argument(
+        "--latents_caching_memory_budget",
+        type=float,
+        default=None,
+        help="memory budget in MB for one VAE batch when caching latents (VRAM, or RAM if the VAE is on CPU). The batch size is computed"
+        " for each bucket from its resolution and replaces vae_batch_size; halved on out of memory"
+        " / latentのcache時のVAEの1バッチあたりのメモリ予算（MB、VAEがCPUの場合はRAM）。バッチサイズはbucketごとに解像度から計算され、vae_batch_sizeの代わりに使われる。メモリ不足の場合は半分にする",
+    )
     parser.add_argument(
         "--cache_latents_to_disk",
         action="store_true",
@@ -991,6 +1006,14 @@ def add_dataset_arguments(
         help="skip the content validation of cache (latent and text encoder output). Cache file existence check is always performed, and cache processing is performed if the file does not exist"
         " / cacheの内容の検証をスキップする（latentとテキストエンコーダの出力）。キャッシュファイルの存在確認は常に行われ、ファイルがなければキャッシュ処理が行われる",
     )
+    parser.add_argument(
+        "--latents_cache_format",
+        type=str,
+        default="npz",
+        choices=["npz", "store"],
+        help="format of latents cached to disk: one .npz per image, or an append-only store per image directory read through mmap"
+        " / ディスクにキャッシュするlatentの形式：画像ごとの.npz、または画像ディレクトリごとの追記型ストア（mmapで読み込む）",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -0,0 +1,204 @@
+"""Per-directory manifest of ``.npz`` latents caches.
+
+``LatentsCachingStrategy`` checks every cache file before training. Opening
+each ``.npz`` for that is slow on a large dataset, especially on network
+storage, so the keys and array shapes of every cache file are recorded in
+append-only manifest files next to the caches::
+
+    <image_dir>/_latents_manifest-<writer>.jsonl
+
+together with the size and mtime of the cache file and of the source image it
+was encoded from. A check then needs one manifest read per directory and a
+``stat`` per file; the key probing of the strategy runs on the recorded keys.
+If the cache file or its source image no longer matches the recorded stat, the
+check falls back to opening the ``.npz`` as before and records the result, so
+an edited or re-cached file is never judged by a stale entry. A writer's file
+is rewritten with only its current entries once superseded entries outnumber
+them, and on read-only storage the results are kept in memory for the run.
+
+The strategy parameters (latent stride, resolution suffix, flip and alpha mask
+settings) are not part of an entry: they are applied to the recorded keys at
+check time, exactly as they are applied to the keys of an opened ``.npz``.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_PREFIX = "_latents_manifest-"
+
+
+def _writer_id() -> str:
+    # each process of a distributed caching run appends to its own file, as in library.latent_store
+    return os.environ.get("RANK", os.environ.get("LOCAL_RANK", "0"))
+
+
+def npz_keys(npz_path: str) -> Dict[str, None]:
+    """Array names of an ``.npz`` from its zip directory, the same probe ``np.load`` does. Shapes would need every header."""
+    with np.load(npz_path) as npz:
+        return {name: None for name in npz.files}
+
+
+def _stat_signature(stat: os.stat_result):
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class CacheManifest:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{MANIFEST_PREFIX}{_writer_id()}.jsonl")
+        self.entries: Dict[str, dict] = {}
+        self.writable = True
+        self._file = None
+        self._lock = threading.Lock()
+        self._own_names = set()  # names whose current entry is in this writer's file
+        self._own_lines = 0
+        for path in sorted(glob.glob(os.path.join(directory, MANIFEST_PREFIX + "*.jsonl"))):
+            own = path == self.path
+            with open(path, "rb") as f:
+                for line in f:
+                    self._own_lines += own
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line of an interrupted run
+                    self.entries[entry["name"]] = entry
+                    if own:
+                        self._own_names.add(entry["name"])
+                    else:
+                        self._own_names.discard(entry["name"])
+        with self._lock:
+            self._compact_if_needed()
+
+    def lookup(self, npz_path: str, npz_stat: os.stat_result) -> Optional[Dict[str, Optional[list]]]:
+        r"""
+        Recorded ``{key: shape}`` of ``npz_path`` if the file and its source image are unchanged since the entry was written.
+        Shapes are known for files written by ``save_latents_to_disk`` and ``None`` for files recorded by a check.
+        """
+        entry = self.entries.get(os.path.basename(npz_path))
+        if entry is None or entry["stat"] != _stat_signature(npz_stat):
+            return None
+        image = entry.get("image")
+        if image is not None:
+            try:
+                image_stat = os.stat(image["path"])
+            except OSError:
+                pass  # the cache may be all that is left of the image
+            else:
+                if image["stat"] != _stat_signature(image_stat):
+                    return None
+        return entry["keys"]
+
+    def record(
+        self,
+        npz_path: str,
+        shapes: Dict[str, Optional[tuple]],
+        image_path: Optional[str] = None,
+        npz_stat: Optional[os.stat_result] = None,
+    ):
+        r"""
+        Record the keys of ``npz_path``. Writing the manifest is best-effort: if the directory is read-only, the entry is
+        kept for this run only and the manifest is not written again.
+        """
+        name = os.path.basename(npz_path)
+        if image_path is None:
+            previous = self.entries.get(name)
+            image_path = previous["image"]["path"] if previous is not None and previous.get("image") else None
+
+        entry = {
+            "name": name,
+            "stat": _stat_signature(npz_stat or os.stat(npz_path)),
+            "keys": {k: None if v is None else list(v) for k, v in shapes.items()},
+        }
+        if image_path is not None:
+            try:
+                entry["image"] = {"path": image_path, "stat": _stat_signature(os.stat(image_path))}
+            except OSError:
+                pass
+
+        with self._lock:
+            self.entries[name] = entry
+            if not self.writable:
+                return
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                self._file.write(json.dumps(entry, separators=(",", ":")).encode("utf-8") + b"\n")
+                self._file.flush()
+            except OSError as e:
+                self._disable(e)
+                return
+            self._own_names.add(name)
+            self._own_lines += 1
+            self._compact_if_needed()
+
+    def _disable(self, e: OSError):
+        self.writable = False
+        logger.warning(
+            f"cannot write latents cache manifest, checking caches without it / latentsキャッシュのマニフェストを書き込めません: {self.path}: {e}"
+        )
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _compact_if_needed(self):
+        # re-caching a directory appends a superseding entry per file: rewrite this writer's file once they outnumber the live ones
+        if not self.writable or self._own_lines - len(self._own_names) <= len(self._own_names):
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(tmp_path, "wb") as f:
+                for name in self._own_names:
+                    f.write(json.dumps(self.entries[name], separators=(",", ":")).encode("utf-8") + b"\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._disable(e)
+            return
+        self._own_lines = len(self._own_names)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_MANIFESTS: Dict[str, CacheManifest] = {}
+_MANIFESTS_LOCK = threading.Lock()
+
+
+def manifest_for(npz_path: str) -> CacheManifest:
+    directory = os.path.dirname(os.path.abspath(npz_path))
+    with _MANIFESTS_LOCK:
+        manifest = _MANIFESTS.get(directory)
+        if manifest is None:
+            manifest = CacheManifest(directory)
+            _MANIFESTS[directory] = manifest
+    return manifest
+
+
+def cached_keys(npz_path: str, npz_stat: os.stat_result) -> Dict[str, Optional[list]]:
+    """Keys of an existing ``.npz``, from the manifest if it is up to date, otherwise from the file (and recorded)."""
+    manifest = manifest_for(npz_path)
+    keys = manifest.lookup(npz_path, npz_stat)
+    if keys is None:
+        keys = npz_keys(npz_path)
+        manifest.record(npz_path, keys, npz_stat=npz_stat)
+    return keys
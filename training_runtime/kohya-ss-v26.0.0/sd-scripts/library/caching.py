@@ -13,9 +13,12 @@ module free of any (circular) dependency on ``library.dataset``.
 module so it is imported directly.
 """
 
+import functools
 import logging
 import os
-from typing import TYPE_CHECKING, List, Tuple
+import queue
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -32,6 +35,16 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+# batches that new_cache_latents prepares (decode, resize, normalize) in worker threads ahead of the one being encoded.
+# cache files are written by an AsyncCacheWriter meanwhile. 0 restores the sequential flow: workers only decode images
+PIPELINE_DEPTH = 2
+
+# estimated VAE encoder memory per input pixel in half precision (SD-style encoder, SDPA attention in the mid block)
+# used by LatentsBatchSizer with --latents_caching_memory_budget. an underestimate is caught by the out of memory back-off
+VAE_BYTES_PER_PIXEL = 2048
+MAX_LATENTS_CACHING_BATCH_SIZE = 64
+
+
 def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alpha_mask: bool):
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
 
@@ -68,10 +81,11 @@ def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alph
 
 # for new_cache_latents
 def load_images_and_masks_for_caching(
-    image_infos: List["ImageInfo"], use_alpha_mask: bool, random_crop: bool
+    image_infos: List["ImageInfo"], use_alpha_mask: bool, random_crop: bool, pin_memory: bool = False
 ) -> Tuple[torch.Tensor, List[np.ndarray], List[Tuple[int, int]], List[Tuple[int, int, int, int]]]:
     r"""
-    requires image_infos to have: [absolute_path or image], bucket_reso, resized_size
+    requires image_infos to have: [absolute_path or image or latents_input], bucket_reso, resized_size
+    if pin_memory is True, image_tensor is allocated in page-locked memory
 
     returns: image_tensor, alpha_masks, original_sizes, crop_ltrbs
 
@@ -85,36 +99,204 @@ def load_images_and_masks_for_caching(
     original_sizes: List[Tuple[int, int]] = []
     crop_ltrbs: List[Tuple[int, int, int, int]] = []
     for info in image_infos:
-        image = (
-            load_image(info.absolute_path, use_alpha_mask)
-            if info.image is None
-            else np.array(info.image, np.uint8)
-        )
-        # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
-        image, original_size, crop_ltrb = trim_and_resize_if_required(
-            random_crop, image, info.bucket_reso, info.resized_size, resize_interpolation=info.resize_interpolation
-        )
-
+        latents_input = getattr(info, "latents_input", None)  # prepared by a worker of new_cache_latents
+        if latents_input is not None:
+            image, alpha_mask, original_size, crop_ltrb = latents_input
+        else:
+            image, alpha_mask, original_size, crop_ltrb = prepare_image_for_caching(info, use_alpha_mask, random_crop)
+        images.append(image)
+        alpha_masks.append(alpha_mask)
         original_sizes.append(original_size)
         crop_ltrbs.append(crop_ltrb)
 
-        if use_alpha_mask:
-            if image.shape[2] == 4:
-                alpha_mask = image[:, :, 3]  # [H,W]
-                alpha_mask = alpha_mask.astype(np.float32) / 255.0
-                alpha_mask = torch.FloatTensor(alpha_mask)  # [H,W]
-            else:
-                alpha_mask = torch.ones_like(image[:, :, 0], dtype=torch.float32)  # [H,W]
+    if pin_memory:
+        # stack straight into page-locked memory, so that the upload to the VAE can be non-blocking
+        img_tensor = torch.empty((len(images), *images[0].shape), dtype=images[0].dtype, pin_memory=True)
+        torch.stack(images, dim=0, out=img_tensor)
+    else:
+        img_tensor = torch.stack(images, dim=0)
+    return img_tensor, alpha_masks, original_sizes, crop_ltrbs
+
+
+def prepare_image_for_caching(
+    info: "ImageInfo", use_alpha_mask: bool, random_crop: bool
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Tuple[int, int], Tuple[int, int, int, int]]:
+    r"""
+    load, trim/resize and normalize one image for the VAE. Safe to call from worker threads unless random_crop is True
+    (the crop position is drawn from the global random state).
+
+    returns: image_tensor [3, H, W], alpha_mask [H, W] or None, original_size (W, H), crop_ltrb (L, T, R, B)
+    """
+    image = load_image(info.absolute_path, use_alpha_mask) if info.image is None else np.array(info.image, np.uint8)
+    # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
+    image, original_size, crop_ltrb = trim_and_resize_if_required(
+        random_crop, image, info.bucket_reso, info.resized_size, resize_interpolation=info.resize_interpolation
+    )
+
+    if use_alpha_mask:
+        if image.shape[2] == 4:
+            alpha_mask = image[:, :, 3]  # [H,W]
+            alpha_mask = alpha_mask.astype(np.float32) / 255.0
+            alpha_mask = torch.FloatTensor(alpha_mask)  # [H,W]
         else:
-            alpha_mask = None
-        alpha_masks.append(alpha_mask)
+            alpha_mask = torch.ones_like(image[:, :, 0], dtype=torch.float32)  # [H,W]
+    else:
+        alpha_mask = None
 
-        image = image[:, :, :3]  # remove alpha channel if exists
-        image = IMAGE_TRANSFORMS(image)
-        images.append(image)
+    image = image[:, :, :3]  # remove alpha channel if exists
+    image = IMAGE_TRANSFORMS(image)
+    return image, alpha_mask, original_size, crop_ltrb
 
-    img_tensor = torch.stack(images, dim=0)
-    return img_tensor, alpha_masks, original_sizes, crop_ltrbs
+
+def encode_with_flipped(
+    encode_by_vae: Callable[[torch.Tensor], torch.Tensor],
+    img_tensor: torch.Tensor,
+    flip_aug: bool,
+    max_batch_size: Optional[int] = None,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    r"""
+    encode images and, if flip_aug is True, their horizontally flipped copies.
+
+    max_batch_size is the number of images per VAE call, B by default: vae_batch_size was chosen for B images, and a
+    batch of 2B needs about twice the activation memory. if it allows 2B (LatentsBatchSizer passes that on GPU when its
+    memory budget counted the flipped images), the images and the flipped images are concatenated into one batch, so
+    that the VAE runs once at full occupancy instead of twice at half.
+
+    returns: latents [B, ...], flipped latents [B, ...] or None
+    """
+    num_images = img_tensor.shape[0]
+    if max_batch_size is None:
+        max_batch_size = num_images
+    parts = [img_tensor, torch.flip(img_tensor, dims=[3])] if flip_aug else [img_tensor]
+
+    with torch.no_grad():
+        if num_images * len(parts) <= max_batch_size:
+            latents = encode_by_vae(torch.cat(parts, dim=0) if flip_aug else img_tensor)
+        else:
+            # chunks do not cross the images and the flipped images, so no concatenated copy is needed
+            chunks = [chunk for part in parts for chunk in torch.split(part, max_batch_size)]
+            latents = torch.cat([encode_by_vae(chunk) for chunk in chunks], dim=0)
+
+    if not flip_aug:
+        return latents, None
+    return latents[:num_images], latents[num_images:]
+
+
+class LatentsBatchSizer:
+    r"""
+    Batch sizes of latents caching per bucket resolution.
+
+    Without a memory budget every bucket uses ``default_batch_size`` (vae_batch_size). With a budget (MB of VRAM, or RAM
+    for a VAE on CPU), the batch size of a bucket is the number of images whose estimated VAE memory fits the budget:
+    ``VAE_BYTES_PER_PIXEL`` per input pixel for a half precision VAE, twice that in float32, and flipped images count
+    as images, so with a budget the images and their flipped copies are encoded in one VAE call. A batch that runs out of
+    memory anyway is encoded again in halves, and later batches of that resolution are encoded in chunks of the size that
+    fitted.
+    """
+
+    def __init__(
+        self,
+        default_batch_size: int,
+        memory_budget_mb: Optional[float] = None,
+        vae_dtype: Optional[torch.dtype] = None,
+        max_batch_size: int = MAX_LATENTS_CACHING_BATCH_SIZE,
+    ):
+        self.default_batch_size = default_batch_size
+        self.memory_budget_mb = memory_budget_mb
+        self.bytes_per_pixel = VAE_BYTES_PER_PIXEL * (2 if vae_dtype == torch.float32 else 1)
+        self.max_batch_size = max_batch_size
+        self.batch_sizes: Dict[Tuple[int, int], int] = {}  # bucket_reso -> images per batch
+        self.encode_limits: Dict[Tuple[int, int], int] = {}  # bucket_reso -> images per VAE call after out of memory
+        self.num_encoded: Dict[Tuple[int, int], int] = {}
+
+    def batch_size(self, reso: Tuple[int, int], flip_aug: bool) -> int:
+        if self.memory_budget_mb is None:
+            return self.default_batch_size
+        image_bytes = reso[0] * reso[1] * self.bytes_per_pixel * (2 if flip_aug else 1)
+        batch_size = int(self.memory_budget_mb * 1024 * 1024 // image_bytes)
+        batch_size = max(1, min(self.max_batch_size, batch_size))
+        self.batch_sizes[reso] = batch_size
+        return batch_size
+
+    def encode(
+        self, encode_by_vae: Callable[[torch.Tensor], torch.Tensor], img_tensor: torch.Tensor, flip_aug: bool, reso: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """encode_with_flipped, halving the images per VAE call on out of memory."""
+        while True:
+            max_batch_size = self.encode_limits.get(reso)
+            if max_batch_size is None:
+                # the budget counted the flipped images; without one, vae_batch_size was chosen for the images alone.
+                # CPU kernels do not gain from the larger batch (it measured slower, see tools/dev/benchmark_flip_encode.py)
+                same_call = flip_aug and self.memory_budget_mb is not None and img_tensor.device.type != "cpu"
+                max_batch_size = img_tensor.shape[0] * (2 if same_call else 1)
+            try:
+                latents = encode_with_flipped(encode_by_vae, img_tensor, flip_aug, max_batch_size)
+                break
+            except torch.cuda.OutOfMemoryError:
+                if max_batch_size <= 1:
+                    raise
+            # outside of the except block, so that the tensors of the failed attempt can be freed
+            self.encode_limits[reso] = max_batch_size // 2
+            logger.warning(
+                f"out of memory while caching latents for bucket {reso}, retry with {max_batch_size // 2} images per VAE call"
+                + f" / bucket {reso} のlatentのcache中にメモリ不足になりました。VAEの1回あたり {max_batch_size // 2} 枚で再試行します"
+            )
+            clean_memory_on_device(img_tensor.device)
+
+        self.num_encoded[reso] = self.num_encoded.get(reso, 0) + img_tensor.shape[0]
+        return latents
+
+    def log_summary(self):
+        if self.memory_budget_mb is None and not self.encode_limits:
+            return
+        budget = "none" if self.memory_budget_mb is None else f"{self.memory_budget_mb:g} MB"
+        logger.info(f"latents caching batch sizes (memory budget: {budget}):")
+        for reso in sorted(self.num_encoded, key=lambda reso: reso[0] * reso[1]):
+            line = f"  bucket {reso}: batch size {self.batch_sizes.get(reso, self.default_batch_size)}, images {self.num_encoded[reso]}"
+            if reso in self.encode_limits:
+                line += f", out of memory -> {self.encode_limits[reso]} images per VAE call"
+            logger.info(line)
+
+
+class AsyncCacheWriter:
+    r"""
+    Runs cache file writes on a background thread, so that the VAE does not wait for ``np.savez`` and the disk.
+
+    At most ``max_pending`` writes are queued; ``submit`` blocks beyond that, which bounds the latents held in memory.
+    Writes run in submission order. The first failing write stops the writer and is raised by the next ``submit`` or by
+    ``close``.
+    """
+
+    def __init__(self, max_pending: int = 16):
+        self._queue: "queue.Queue[Optional[Callable[[], None]]]" = queue.Queue(max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="latents-cache-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            write = self._queue.get()
+            if write is None:
+                return
+            if self._error is None:
+                try:
+                    write()
+                except BaseException as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("failed to write latents cache / latentsのキャッシュの書き込みに失敗しました") from self._error
+
+    def submit(self, function: Callable, *args, **kwargs):
+        self._raise_error()
+        self._queue.put(functools.partial(function, *args, **kwargs))
+
+    def close(self):
+        """Wait for the queued writes."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
 
 
 def cache_batch_latents(
@@ -168,15 +350,11 @@ def cache_batch_latents(
     img_tensors = torch.stack(images, dim=0)
     img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype)
 
-    with torch.no_grad():
-        latents = vae.encode(img_tensors).latent_dist.sample().to("cpu")
-
-    if flip_aug:
-        img_tensors = torch.flip(img_tensors, dims=[3])
-        with torch.no_grad():
-            flipped_latents = vae.encode(img_tensors).latent_dist.sample().to("cpu")
-    else:
-        flipped_latents = [None] * len(latents)
+    latents, flipped_latents = encode_with_flipped(
+        lambda img_tensor: vae.encode(img_tensor).latent_dist.sample(), img_tensors, flip_aug
+    )
+    latents = latents.to("cpu")
+    flipped_latents = [None] * len(latents) if flipped_latents is None else flipped_latents.to("cpu")
 
     for info, latent, flipped_latent, alpha_mask in zip(image_infos, latents, flipped_latents, alpha_masks):
         # check NaN
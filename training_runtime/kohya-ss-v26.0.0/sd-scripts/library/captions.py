@@ -0,0 +1,187 @@
+"""Captions parsed once for ``BaseDataset.process_caption``.
+
+``process_caption`` used to parse the caption on every ``__getitem__``: prefix
+and suffix, wildcard escaping and substitution, the ``keep_tokens_separator`` /
+``caption_separator`` splits and the strip of every tag. :func:`compile_caption`
+does this once per caption and subset into a :class:`CompiledCaption`: per line,
+the tags in one tuple with the bounds of the fixed, flexible and fixed suffix
+tags, and the alternatives of the wildcards. The dataset compiles the captions
+of its images when the buckets are made; per sample only the random parts are
+left (:func:`draw_line`, then shuffle, tag dropout and join in
+``process_caption``). The random numbers are drawn in the same order as by the
+parsing code, so seeded runs give the same captions.
+
+Lines that cannot be compiled exactly are parsed per sample as before: lines
+containing the escape characters ``⦅`` / ``⦆``, and, for the tags only, lines
+with a wildcard alternative that is blank or holds a separator character (the
+split depends on the alternative chosen).
+"""
+
+import random
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+WILDCARD_PATTERN = re.compile(r"\{([^}]+)\}")
+
+# stand-ins for the wildcards in a line while it is split into tags (private use area)
+PLACEHOLDER_START = 0xE000
+
+
+class CompiledLine(NamedTuple):
+    # the line; with wildcards a str.format template taking the chosen alternatives, the raw line if ``wildcards`` is None
+    text: str
+    wildcards: Optional[Tuple[Tuple[str, ...], ...]]  # alternatives of each wildcard; None: substituted per sample
+    tags: Optional[Tuple[str, ...]]  # None: split per sample
+    fixed_end: int  # tags[:fixed_end] are fixed, tags[fixed_end:suffix_start] flexible, the rest the fixed suffix
+    suffix_start: int
+    templates: Tuple[Tuple[int, str], ...] = ()  # tags holding wildcards: index and template, formatted and stripped per sample
+
+
+class CompiledCaption(NamedTuple):
+    lines: Tuple[CompiledLine, ...]
+    choose_line: bool  # multiline caption with wildcards: one line is chosen at random
+
+
+def split_tags(subset, caption: str) -> Tuple[List[str], List[str], List[str]]:
+    """Split a caption into the fixed, flexible and fixed suffix tags with the subset's separators and ``keep_tokens``."""
+    fixed_tokens = []
+    flex_tokens = []
+    fixed_suffix_tokens = []
+    if hasattr(subset, "keep_tokens_separator") and subset.keep_tokens_separator and subset.keep_tokens_separator in caption:
+        fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
+        if subset.keep_tokens_separator in flex_part:
+            flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
+            fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
+
+        fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
+        flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+    else:
+        tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
+        flex_tokens = tokens[:]
+        if subset.keep_tokens > 0:
+            fixed_tokens = flex_tokens[: subset.keep_tokens]
+            flex_tokens = tokens[subset.keep_tokens :]
+    return fixed_tokens, flex_tokens, fixed_suffix_tokens
+
+
+def escape_replacers(caption: str) -> Tuple[str, str]:
+    # wildcard is like '{aaa|bbb|ccc...}', the curly braces are escaped like {{ or }}
+    replacer1 = "⦅"
+    replacer2 = "⦆"
+    while replacer1 in caption or replacer2 in caption:
+        replacer1 += "⦅"
+        replacer2 += "⦆"
+    return replacer1, replacer2
+
+
+def substitute_wildcards(caption: str) -> str:
+    """Replace each wildcard with one of its alternatives, chosen at random."""
+    replacer1, replacer2 = escape_replacers(caption)
+    caption = caption.replace("{{", replacer1).replace("}}", replacer2)
+
+    def replace_wildcard(match):
+        return random.choice(match.group(1).split("|"))
+
+    caption = WILDCARD_PATTERN.sub(replace_wildcard, caption)
+    return caption.replace(replacer1, "{").replace(replacer2, "}")
+
+
+def _format_escape(s: str) -> str:
+    return s.replace("{", "{{").replace("}", "}}")
+
+
+def _compile_tags(subset, text: str, template: str = None, wildcards: tuple = (), placeholders: str = "") -> CompiledLine:
+    fixed, flex, suffix = split_tags(subset, text)
+    tags = fixed + flex + suffix
+    templates = {}
+    if placeholders:
+        # each placeholder ends up in exactly one tag, and tags have no line breaks
+        joined = "\n".join(tags)
+        for k, placeholder in enumerate(placeholders):
+            i = joined.count("\n", 0, joined.index(placeholder))
+            tag_template = templates[i] if i in templates else _format_escape(tags[i])
+            templates[i] = tag_template.replace(placeholder, f"{{{k}}}")
+    return CompiledLine(
+        text if template is None else template, wildcards, tuple(tags), len(fixed), len(fixed) + len(flex), tuple(templates.items())
+    )
+
+
+def _compile_line(subset, line: str, enable_wildcard: bool) -> CompiledLine:
+    if not enable_wildcard or ("{" not in line and "}" not in line):
+        return _compile_tags(subset, line)
+
+    replacer1, replacer2 = escape_replacers(line)
+    if replacer1 != "⦅":
+        # longer replacers could pair up differently around the substituted text
+        return CompiledLine(line, None, None, 0, 0)
+
+    # literals at even positions, wildcards at odd positions
+    escaped = "{{" in line or "}}" in line
+    if escaped:
+        parts = WILDCARD_PATTERN.split(line.replace("{{", replacer1).replace("}}", replacer2))
+        parts = [part.replace(replacer1, "{").replace(replacer2, "}") for part in parts]
+    else:
+        parts = WILDCARD_PATTERN.split(line)
+    if len(parts) == 1:
+        return _compile_tags(subset, parts[0])
+
+    literals = parts[0::2]
+    wildcards = tuple(tuple(part.split("|")) for part in parts[1::2])
+    template = "".join(_format_escape(literal) + f"{{{k}}}" for k, literal in enumerate(literals[:-1])) + _format_escape(literals[-1])
+
+    separator_chars = subset.caption_separator + (getattr(subset, "keep_tokens_separator", None) or "")
+    alternatives = "".join(map("".join, wildcards))
+    if any(c in alternatives for c in separator_chars) or not all(a.strip() for w in wildcards for a in w):
+        return CompiledLine(template, wildcards, None, 0, 0)
+
+    placeholders = ""
+    code = PLACEHOLDER_START
+    while len(placeholders) < len(wildcards):
+        placeholder = chr(code)
+        if placeholder not in line and placeholder not in separator_chars:
+            placeholders += placeholder
+        code += 1
+    text = "".join(literal + placeholder for literal, placeholder in zip(literals, placeholders)) + literals[-1]
+    return _compile_tags(subset, text, template, wildcards, placeholders)
+
+
+def compile_caption(subset, caption: str) -> CompiledCaption:
+    # caption に prefix/suffix を付ける
+    if subset.caption_prefix:
+        caption = subset.caption_prefix + " " + caption
+    if subset.caption_suffix:
+        caption = caption + " " + subset.caption_suffix
+
+    if not subset.enable_wildcard:
+        # if caption is multiline, use the first line
+        return CompiledCaption((_compile_line(subset, caption.split("\n")[0], False),), False)
+
+    # if caption is multiline, random choice one line
+    lines = caption.split("\n")
+    return CompiledCaption(tuple(_compile_line(subset, line, True) for line in lines), len(lines) > 1)
+
+
+def draw_line(compiled: CompiledCaption) -> Tuple[CompiledLine, Optional[List[str]]]:
+    """Choose the line and the alternatives of its wildcards, in the order the parsing code did."""
+    line = random.choice(compiled.lines) if compiled.choose_line else compiled.lines[0]
+    if line.wildcards is None:
+        return line._replace(text=substitute_wildcards(line.text), wildcards=()), None
+    if not line.wildcards:
+        return line, None
+    return line, [random.choice(alternatives) for alternatives in line.wildcards]
+
+
+def line_text(line: CompiledLine, choices: Optional[List[str]]) -> str:
+    return line.text if choices is None else line.text.format(*choices)
+
+
+def line_tags(subset, line: CompiledLine, choices: Optional[List[str]]) -> Tuple[List[str], List[str], List[str]]:
+    """The fixed, flexible and fixed suffix tags of the drawn line, as new lists."""
+    if line.tags is None:
+        return split_tags(subset, line_text(line, choices))
+    tags = line.tags
+    if line.templates:
+        tags = list(tags)
+        for i, template in line.templates:
+            tags[i] = template.format(*choices).strip()
+    return list(tags[: line.fixed_end]), list(tags[line.fixed_end : line.suffix_start]), list(tags[line.suffix_start :])
@@ -13,6 +13,9 @@ This module hosts:
   :func:`save_sd_model_on_train_end` /
   :func:`save_sd_model_on_train_end_common` — Stable Diffusion 1.x/2.x
   checkpoint saving (with HF Hub upload + rotation).
+- :func:`save_network_weights` / :class:`AsyncNetworkSaver` — network
+  weights saving, optionally on a background thread
+  (``--async_checkpoint_save``).
 - :func:`save_and_remove_state_on_epoch_end` /
   :func:`save_and_remove_state_stepwise` / :func:`save_state_on_train_end`
   — accelerator state saving with HF Hub upload + rotation.
@@ -23,12 +26,18 @@ module.
 """
 
 import argparse
+import functools
 import os
+import queue
 import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional
 
 import torch
 
 import library.huggingface_util as huggingface_util
+import library.model_io as model_io
 import library.model_util as model_util
 from library.model_io import get_sai_model_spec
 from library.utils import setup_logging
@@ -95,6 +104,160 @@ def get_remove_step_no(args: argparse.Namespace, step_no: int):
     return remove_step_no
 
 
+def save_network_weights(state_dict: Dict[str, torch.Tensor], file: str, metadata: Optional[Dict[str, str]]):
+    """Write a network state dict as the ``save_weights`` of the network modules do, with the addnet hashes for safetensors."""
+    if os.path.splitext(file)[1] == ".safetensors":
+        model_io.save_safetensors_with_hashes(state_dict, file, metadata if metadata is not None else {})
+    else:
+        torch.save(state_dict, file)
+
+
+class AsyncNetworkSaver:
+    r"""
+    Saves network weights on a background thread, so that training goes on while a checkpoint is serialized, hashed and
+    written.
+
+    ``submit`` copies the state dict, cast to the save dtype, into CPU buffers (pinned if the weights are on the GPU; the
+    copy is asynchronous and the writer waits for it). At most ``max_pending`` saves are submitted and not yet written:
+    ``submit`` blocks beyond that, which bounds the host memory held by snapshots. Buffers of written snapshots are
+    reused. Saves and the tasks passed to ``enqueue`` (uploads, removal of old checkpoints) run in submission order. The
+    first failing task stops the writer and is raised by the next ``submit`` or by ``close``. Each file is written under a
+    temporary name and renamed when complete.
+
+    The writer is a daemon thread: the trainer calls ``close`` also when training is interrupted, so that the queued saves
+    and uploads are finished before the process exits.
+
+    ``completed`` returns the logs of the saves finished since the last call, for the training thread to log.
+    """
+
+    def __init__(self, max_pending: int = 2):
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be 1 or more / max_pendingは1以上である必要があります: {max_pending}")
+        self.max_pending = max_pending
+        self._slots = threading.Semaphore(max_pending)
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._free_buffers: List[Dict[str, torch.Tensor]] = []
+        self._completed: List[Dict[str, float]] = []
+        self._pending = 0
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-saver", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            function, holds_slot = task
+            if self._error is None:
+                try:
+                    function()
+                except BaseException as e:
+                    self._error = e
+            if holds_slot:
+                with self._lock:
+                    self._pending -= 1
+                self._slots.release()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("failed to save checkpoint / チェックポイントの保存に失敗しました") from self._error
+
+    def _snapshot(self, state_dict: Dict[str, torch.Tensor], dtype: Optional[torch.dtype]):
+        def matches(buffers):
+            return buffers.keys() == state_dict.keys() and all(
+                b.shape == v.shape and b.dtype == (dtype or v.dtype) for b, v in zip(buffers.values(), state_dict.values())
+            )
+
+        with self._lock:
+            buffers = next((b for b in self._free_buffers if matches(b)), None)
+            if buffers is not None:
+                self._free_buffers.remove(buffers)
+
+        on_cuda = any(v.is_cuda for v in state_dict.values())
+        if buffers is None:
+            buffers = {
+                k: torch.empty(v.shape, dtype=dtype or v.dtype, device="cpu", pin_memory=on_cuda) for k, v in state_dict.items()
+            }
+        for k, v in state_dict.items():
+            buffers[k].copy_(v.detach(), non_blocking=True)
+
+        copied = None
+        if on_cuda:
+            copied = torch.cuda.Event()
+            copied.record()
+        return buffers, copied
+
+    def _save(self, buffers, copied, file: str, metadata: Optional[Dict[str, str]], logs: Dict[str, float], after_save):
+        try:
+            if copied is not None:
+                copied.synchronize()
+            start = time.perf_counter()
+            # written under a temporary name, so that a save cut off by the end of the process never looks like a checkpoint
+            root, ext = os.path.splitext(file)
+            temp_file = root + ".saving" + ext  # the extension selects the format
+            try:
+                save_network_weights(buffers, temp_file, metadata)
+                os.replace(temp_file, file)
+            except BaseException:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                raise
+            logs["checkpoint/save_seconds"] = time.perf_counter() - start
+        finally:
+            with self._lock:
+                if len(self._free_buffers) < self.max_pending:
+                    self._free_buffers.append(buffers)
+        logger.info(f"checkpoint saved / チェックポイントを保存しました: {file}")
+        if after_save is not None:
+            after_save()
+        with self._lock:
+            self._completed.append(logs)
+
+    def submit(
+        self,
+        state_dict: Dict[str, torch.Tensor],
+        dtype: Optional[torch.dtype],
+        file: str,
+        metadata: Optional[Dict[str, str]],
+        steps: int,
+        epoch: int,
+        after_save: Optional[Callable[[], None]] = None,
+    ):
+        r"""
+        Snapshot ``state_dict`` and save it to ``file`` in the background. ``metadata`` is owned by the saver from now on
+        (the hashes are added to it). ``after_save`` runs on the writer once the file is written.
+        """
+        self._raise_error()
+        start = time.perf_counter()
+        self._slots.acquire()
+        with self._lock:
+            self._pending += 1
+        buffers, copied = self._snapshot(state_dict, dtype)
+        logs = {"checkpoint/steps": steps, "checkpoint/epoch": epoch, "checkpoint/snapshot_seconds": time.perf_counter() - start}
+        self._queue.put((functools.partial(self._save, buffers, copied, file, metadata, logs, after_save), True))
+
+    def enqueue(self, function: Callable, *args, **kwargs):
+        """Run ``function`` on the writer after the saves submitted so far."""
+        self._raise_error()
+        self._queue.put((functools.partial(function, *args, **kwargs), False))
+
+    def completed(self) -> List[Dict[str, float]]:
+        with self._lock:
+            completed, self._completed = self._completed, []
+            pending = self._pending
+        for logs in completed:
+            logs["checkpoint/pending_saves"] = pending
+        return completed
+
+    def close(self):
+        """Wait for the submitted saves and tasks."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
 # epochとstepの保存、メタデータにepoch/stepが含まれ引数が同じになるため、統合している
 # on_epoch_end: Trueならepoch終了時、Falseならstep経過時
 def save_sd_model_on_epoch_end_or_stepwise(
@@ -23,6 +23,8 @@ in ``library.accelerator_setup``; that module has no cycle with this one so it
 is imported directly.
 """
 
+import collections
+import concurrent.futures
 import glob
 import importlib
 import logging
@@ -32,7 +34,7 @@ import pathlib
 import random
 import re
 from concurrent.futures import Future, ThreadPoolExecutor
-from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import cv2
 import imagesize
@@ -45,8 +47,9 @@ from torchvision import transforms
 from tqdm import tqdm
 from transformers import CLIPTokenizer
 
+import library.captions as captions_util
 import library.model_util as model_util
-from library import accelerator_setup
+from library import accelerator_setup, caching
 from library.device_utils import clean_memory_on_device
 from library.strategy_base import (
     LatentsCachingStrategy,
@@ -143,6 +146,49 @@ def split_train_val(
         return paths[split:], sizes[split:]
 
 
+def map_in_threads(function: Callable[[Any], Any], items: Sequence[Any], desc: Optional[str] = None) -> List[Any]:
+    r"""
+    Apply ``function`` to every item in a bounded thread pool and return the results in input order.
+
+    Meant for I/O bound dataset scans (image headers, caption files) on slow or network disks. The worker count is split
+    between the processes of a multi-GPU launch on this machine, and at most a few items per worker are in flight, so an
+    exception (or Ctrl-C) stops the scan after the running items instead of after the whole list. An exception is raised
+    for the first failing item in input order, as in a serial loop.
+    """
+    num_processes = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    max_workers = min(32, (os.cpu_count() or 1) + 4) // max(1, num_processes)
+    max_workers = max(1, min(max_workers, len(items)))
+    if max_workers == 1:
+        return [function(item) for item in tqdm(items, desc=desc)]
+
+    results = []
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        with tqdm(total=len(items), desc=desc) as progress:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= max_workers * 4:
+                    results.append(_wait_result(pending.popleft()))
+                    progress.update(1)
+            while pending:
+                results.append(_wait_result(pending.popleft()))
+                progress.update(1)
+    finally:
+        # on an error or Ctrl-C do not start the queued items
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+
+def _wait_result(future: Future):
+    # wait in short slices: a blocking wait cannot be interrupted by Ctrl-C on Windows
+    while True:
+        try:
+            return future.result(timeout=0.5)
+        except concurrent.futures.TimeoutError:
+            continue
+
+
 class ImageInfo:
     def __init__(
         self, image_key: str, num_repeats: int, caption: str, is_reg: bool, absolute_path: str, caption_dropout_rate: float = 0.0
@@ -165,6 +211,7 @@ class ImageInfo:
         )
         self.cond_img_path: Optional[str] = None
         self.image: Optional[Image.Image] = None  # optional, original PIL Image
+        self.latents_input = None  # optional, VAE input prepared in new_cache_latents, see caching.prepare_image_for_caching
         self.text_encoder_outputs_npz: Optional[str] = None  # filename. set in cache_text_encoder_outputs
 
         # new
@@ -415,6 +462,7 @@ class BaseDataset(torch.utils.data.Dataset):
 
         self.image_data: Dict[str, ImageInfo] = {}
         self.image_to_subset: Dict[str, Union[DreamBoothSubset, FineTuningSubset]] = {}
+        self.metadata_indexes = []  # library.metadata_index.SubsetMetadataIndex of subsets with cache_info
 
         self.replacements = {}
 
@@ -498,12 +546,18 @@ class BaseDataset(torch.utils.data.Dataset):
     def add_replacement(self, str_from, str_to):
         self.replacements[str_from] = str_to
 
+    def compile_captions(self):
+        """Parse the captions of the images once, see library.captions."""
+        for image_key, info in self.image_data.items():
+            subset = self.image_to_subset[image_key]
+            if isinstance(info.caption, str) and info.caption not in subset.compiled_captions:
+                subset.compiled_captions[info.caption] = captions_util.compile_caption(subset, info.caption)
+
     def process_caption(self, subset: BaseSubset, caption):
-        # caption に prefix/suffix を付ける
-        if subset.caption_prefix:
-            caption = subset.caption_prefix + " " + caption
-        if subset.caption_suffix:
-            caption = caption + " " + subset.caption_suffix
+        compiled = subset.compiled_captions.get(caption)
+        if compiled is None:
+            compiled = captions_util.compile_caption(subset, caption)
+            subset.compiled_captions[caption] = compiled
 
         # dropoutの決定：tag dropがこのメソッド内にあるのでここで行うのが良い
         is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
@@ -516,56 +570,11 @@ class BaseDataset(torch.utils.data.Dataset):
         if is_drop_out:
             caption = ""
         else:
-            # process wildcards
-            if subset.enable_wildcard:
-                # if caption is multiline, random choice one line
-                if "\n" in caption:
-                    caption = random.choice(caption.split("\n"))
-
-                # wildcard is like '{aaa|bbb|ccc...}'
-                # escape the curly braces like {{ or }}
-                replacer1 = "⦅"
-                replacer2 = "⦆"
-                while replacer1 in caption or replacer2 in caption:
-                    replacer1 += "⦅"
-                    replacer2 += "⦆"
-
-                caption = caption.replace("{{", replacer1).replace("}}", replacer2)
-
-                # replace the wildcard
-                def replace_wildcard(match):
-                    return random.choice(match.group(1).split("|"))
-
-                caption = re.sub(r"\{([^}]+)\}", replace_wildcard, caption)
-
-                # unescape the curly braces
-                caption = caption.replace(replacer1, "{").replace(replacer2, "}")
-            else:
-                # if caption is multiline, use the first line
-                caption = caption.split("\n")[0]
+            # choose the line and the wildcard alternatives
+            line, choices = captions_util.draw_line(compiled)
 
             if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
-                fixed_tokens = []
-                flex_tokens = []
-                fixed_suffix_tokens = []
-                if (
-                    hasattr(subset, "keep_tokens_separator")
-                    and subset.keep_tokens_separator
-                    and subset.keep_tokens_separator in caption
-                ):
-                    fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
-                    if subset.keep_tokens_separator in flex_part:
-                        flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
-                        fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
-
-                    fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
-                    flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
-                else:
-                    tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
-                    flex_tokens = tokens[:]
-                    if subset.keep_tokens > 0:
-                        fixed_tokens = flex_tokens[: subset.keep_tokens]
-                        flex_tokens = tokens[subset.keep_tokens :]
+                fixed_tokens, flex_tokens, fixed_suffix_tokens = captions_util.line_tags(subset, line, choices)
 
                 if subset.token_warmup_step < 1:  # 初回に上書きする
                     subset.token_warmup_step = math.floor(subset.token_warmup_step * self.max_train_steps)
@@ -578,21 +587,15 @@ class BaseDataset(torch.utils.data.Dataset):
                     )
                     flex_tokens = flex_tokens[:tokens_len]
 
-                def dropout_tags(tokens):
-                    if subset.caption_tag_dropout_rate <= 0:
-                        return tokens
-                    l = []
-                    for token in tokens:
-                        if random.random() >= subset.caption_tag_dropout_rate:
-                            l.append(token)
-                    return l
-
                 if subset.shuffle_caption:
                     random.shuffle(flex_tokens)
 
-                flex_tokens = dropout_tags(flex_tokens)
+                if subset.caption_tag_dropout_rate > 0:
+                    flex_tokens = [t for t in flex_tokens if random.random() >= subset.caption_tag_dropout_rate]
 
                 caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
+            else:
+                caption = captions_util.line_text(line, choices)
 
             # process secondary separator
             if subset.secondary_separator:
@@ -621,26 +624,14 @@ class BaseDataset(torch.utils.data.Dataset):
         min_size and max_size are ignored when enable_bucket is False
         """
         logger.info("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
-
-        # # run in parallel
-        # max_workers = min(os.cpu_count(), len(self.image_data))  # TODO consider multi-gpu (processes)
-        # with ThreadPoolExecutor(max_workers) as executor:
-        #     futures = []
-        #     for info in tqdm(self.image_data.values(), desc="loading image sizes"):
-        #         if info.image_size is None:
-        #             def get_and_set_image_size(info):
-        #                 info.image_size = self.get_image_size(info.absolute_path)
-        #             futures.append(executor.submit(get_and_set_image_size, info))
-        #             # consume futures to reduce memory usage and prevent Ctrl-C hang
-        #             if len(futures) >= max_workers:
-        #                 for future in futures:
-        #                     future.result()
-        #                 futures = []
-        #     for future in futures:
-        #         future.result()
+        infos = [info for info in self.image_data.values() if info.image_size is None]
+        sizes = map_in_threads(lambda info: self.get_image_size(info.absolute_path), infos)
+        for info, size in zip(infos, sizes):
+            info.image_size = size
+        if infos:
+            probed = {info.absolute_path: info.image_size for info in infos}
+            for metadata_index in self.metadata_indexes:
+                metadata_index.record_sizes(probed)
 
         if self.enable_bucket:
             logger.info("make buckets")
@@ -714,6 +705,8 @@ class BaseDataset(torch.utils.data.Dataset):
         self.shuffle_buckets()
         self._length = len(self.buckets_indices)
 
+        self.compile_captions()
+
     def shuffle_buckets(self):
         # set random seed for this epoch
         random.seed(self.seed + self.current_epoch)
@@ -780,23 +773,55 @@ class BaseDataset(torch.utils.data.Dataset):
         num_processes = accelerator.num_processes
         process_index = accelerator.process_index
 
+        # batches waiting for the VAE. their images are prepared by the workers meanwhile
+        pipeline_depth = caching.PIPELINE_DEPTH
+        pending_batches: Deque[Tuple[List[ImageInfo], Condition]] = collections.deque()
+        encoded_condition = None
+
         # define a function to submit a batch to cache
         def submit_batch(batch, cond):
+            nonlocal encoded_condition
+            if cond != encoded_condition and accelerator_setup.HIGH_VRAM:  # even with high VRAM, if shape is changed
+                clean_memory_on_device(accelerator.device)
+            encoded_condition = cond
+
             for info in batch:
                 if info.image is not None and isinstance(info.image, Future):
                     info.image = info.image.result()  # future to image
+                if info.latents_input is not None and isinstance(info.latents_input, Future):
+                    info.latents_input = info.latents_input.result()
             caching_strategy.cache_batch_latents(model, batch, cond.flip_aug, cond.alpha_mask, cond.random_crop)
 
             # remove image from memory
             for info in batch:
                 info.image = None
+                info.latents_input = None
+
+        def enqueue_batch(batch, cond):
+            pending_batches.append((batch, cond))
+            while len(pending_batches) > pipeline_depth:
+                submit_batch(*pending_batches.popleft())
+
+        # batch size of each bucket: vae_batch_size, or computed from the resolution with --latents_caching_memory_budget
+        batch_sizer = caching.LatentsBatchSizer(
+            caching_strategy.batch_size, accelerator_setup.LATENTS_CACHING_MEMORY_BUDGET_MB, getattr(model, "dtype", None)
+        )
+        max_batch_size = max(
+            [batch_sizer.batch_size(info.bucket_reso, self.image_to_subset[info.image_key].flip_aug) for info in image_infos],
+            default=1,
+        )
 
         # define ThreadPoolExecutor to load images in parallel
         max_workers = min(os.cpu_count(), len(image_infos))
         max_workers = max(1, max_workers // num_processes)  # consider multi-gpu
-        max_workers = min(max_workers, caching_strategy.batch_size)  # max_workers should be less than batch_size
+        # max_workers should be less than the number of images in flight
+        max_workers = min(max_workers, max_batch_size * (pipeline_depth + 1))
         executor = ThreadPoolExecutor(max_workers)
+        caching_strategy.batch_sizer = batch_sizer
+        if caching_strategy.cache_to_disk and pipeline_depth > 0:
+            caching_strategy.cache_writer = caching.AsyncCacheWriter()
 
+        failed = True
         try:
             # iterate images
             logger.info("caching latents...")
@@ -827,12 +852,15 @@ class BaseDataset(torch.utils.data.Dataset):
                 # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
                 condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
                 if len(batch) > 0 and current_condition != condition:
-                    submit_batch(batch, current_condition)
+                    enqueue_batch(batch, current_condition)
                     batch = []
-                if condition != current_condition and accelerator_setup.HIGH_VRAM:  # even with high VRAM, if shape is changed
-                    clean_memory_on_device(accelerator.device)
 
-                if info.image is None:
+                if pipeline_depth > 0 and not condition.random_crop:  # random crops are drawn on this thread, in order
+                    # load, resize and normalize in parallel
+                    info.latents_input = executor.submit(
+                        caching.prepare_image_for_caching, info, condition.alpha_mask, condition.random_crop
+                    )
+                elif info.image is None:
                     # load image in parallel
                     info.image = executor.submit(load_image, info.absolute_path, condition.alpha_mask)
 
@@ -840,16 +868,29 @@ class BaseDataset(torch.utils.data.Dataset):
                 current_condition = condition
 
                 # if number of data in batch is enough, flush the batch
-                if len(batch) >= caching_strategy.batch_size:
-                    submit_batch(batch, current_condition)
+                if len(batch) >= batch_sizer.batch_size(condition.reso, condition.flip_aug):
+                    enqueue_batch(batch, current_condition)
                     batch = []
-                    # current_condition = None  # keep current_condition to avoid next `clean_memory_on_device` call
 
             if len(batch) > 0:
-                submit_batch(batch, current_condition)
+                enqueue_batch(batch, current_condition)
+            while pending_batches:
+                submit_batch(*pending_batches.popleft())
 
+            batch_sizer.log_summary()
+            failed = False
         finally:
-            executor.shutdown()
+            executor.shutdown(cancel_futures=True)  # after a failure, the images queued for preparation are not needed
+            caching_strategy.batch_sizer = None
+            cache_writer, caching_strategy.cache_writer = caching_strategy.cache_writer, None
+            if cache_writer is not None:
+                try:
+                    cache_writer.close()  # wait for the cache files
+                except Exception:
+                    if not failed:
+                        raise
+                    # keep the error that stopped caching
+                    logger.exception("failed to write latents cache / latentsのキャッシュの書き込みに失敗しました")
 
     def new_cache_text_encoder_outputs(self, models: List[Any], accelerator: Accelerator):
         r"""
@@ -6,7 +6,6 @@ imports the abstract :class:`~library.dataset.BaseDataset` and its
 """
 
 import glob
-import json
 import logging
 import os
 from typing import List, Optional, Sequence, Tuple
@@ -17,8 +16,10 @@ from library.dataset import (
     BaseDataset,
     ImageInfo,
     glob_images,
+    map_in_threads,
     split_train_val,
 )
+from library.metadata_index import SubsetMetadataIndex
 from library.strategy_base import LatentsCachingStrategy
 from library.subset import DreamBoothSubset
 from library.utils import setup_logging
@@ -27,9 +28,20 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 
-class DreamBoothDataset(BaseDataset):
-    IMAGE_INFO_CACHE_FILE = "metadata_cache.json"
+def caption_candidates(img_path: str, caption_extension: str) -> List[str]:
+    # captionの候補ファイル名を作る
+    base_name = os.path.splitext(img_path)[0]
+    base_name_face_det = base_name
+    tokens = base_name.split("_")
+    if len(tokens) >= 5:
+        base_name_face_det = "_".join(tokens[:-4])
+    cap_paths = [base_name + caption_extension]
+    if base_name_face_det != base_name:
+        cap_paths.append(base_name_face_det + caption_extension)
+    return cap_paths
+
 
+class DreamBoothDataset(BaseDataset):
     # The is_training_dataset defines the type of dataset, training or validation
     # if is_training_dataset is True -> training dataset
     # if is_training_dataset is False -> validation dataset
@@ -88,13 +100,7 @@ class DreamBoothDataset(BaseDataset):
             self.bucket_no_upscale = False
 
         def read_caption(img_path, caption_extension, enable_wildcard):
-            # captionの候補ファイル名を作る
-            base_name = os.path.splitext(img_path)[0]
-            base_name_face_det = base_name
-            tokens = base_name.split("_")
-            if len(tokens) >= 5:
-                base_name_face_det = "_".join(tokens[:-4])
-            cap_paths = [base_name + caption_extension, base_name_face_det + caption_extension]
+            cap_paths = caption_candidates(img_path, caption_extension)
 
             caption = None
             for cap_path in cap_paths:
@@ -118,73 +124,72 @@ class DreamBoothDataset(BaseDataset):
                 logger.warning(f"not directory: {subset.image_dir}")
                 return [], [], []
 
-            info_cache_file = os.path.join(subset.image_dir, self.IMAGE_INFO_CACHE_FILE)
-            use_cached_info_for_subset = subset.cache_info
-            if use_cached_info_for_subset:
+            img_paths = glob_images(subset.image_dir, "*")
+            sizes: List[Optional[Tuple[int, int]]] = [None] * len(img_paths)
+
+            metadata_index = SubsetMetadataIndex.open(subset.image_dir) if subset.cache_info else None
+            indexed_captions = None
+            if metadata_index is not None:
                 logger.info(
-                    f"using cached image info for this subset / このサブセットで、キャッシュされた画像情報を使います: {info_cache_file}"
+                    f"using metadata index for this subset / このサブセットでメタデータのインデックスを使います: {metadata_index.path}"
                 )
-                if not os.path.isfile(info_cache_file):
-                    logger.warning(
-                        f"image info file not found. You can ignore this warning if this is the first time to use this subset"
-                        + " / キャッシュファイルが見つかりませんでした。初回実行時はこの警告を無視してください: {metadata_file}"
-                    )
-                    use_cached_info_for_subset = False
-
-            if use_cached_info_for_subset:
-                # json: {`img_path`:{"caption": "caption...", "resolution": [width, height]}, ...}
-                with open(info_cache_file, "r", encoding="utf-8") as f:
-                    metas = json.load(f)
-                img_paths = list(metas.keys())
-                sizes: List[Optional[Tuple[int, int]]] = [meta["resolution"] for meta in metas.values()]
-
-                # we may need to check image size and existence of image files, but it takes time, so user should check it before training
-            else:
-                img_paths = glob_images(subset.image_dir, "*")
-                sizes: List[Optional[Tuple[int, int]]] = [None] * len(img_paths)
-
-                # new caching: get image size from cache files
-                strategy = LatentsCachingStrategy.get_strategy()
-                if strategy is not None:
-                    logger.info("get image size from name of cache files")
-
-                    # make image path to npz path mapping
-                    npz_paths = glob.glob(os.path.join(subset.image_dir, "*" + strategy.cache_suffix))
-                    npz_paths.sort(
-                        key=lambda item: item.rsplit("_", maxsplit=2)[0]
-                    )  # sort by name excluding resolution and cache_suffix
-                    npz_path_index = 0
-
-                    size_set_count = 0
-                    for i, img_path in enumerate(tqdm(img_paths)):
-                        l = len(os.path.splitext(img_path)[0])  # remove extension
-                        found = False
-                        while npz_path_index < len(npz_paths):  # until found or end of npz_paths
-                            # npz_paths are sorted, so if npz_path > img_path, img_path is not found
-                            if npz_paths[npz_path_index][:l] > img_path[:l]:
-                                break
-                            if npz_paths[npz_path_index][:l] == img_path[:l]:  # found
-                                found = True
-                                break
-                            npz_path_index += 1  # next npz_path
-
-                        if found:
-                            w, h = strategy.get_image_size_from_disk_cache_path(img_path, npz_paths[npz_path_index])
-                        else:
-                            w, h = None, None
+                captions, sizes = metadata_index.scan(
+                    img_paths,
+                    f"{subset.caption_extension}|{subset.enable_wildcard}",
+                    lambda img_path: caption_candidates(img_path, subset.caption_extension),
+                    lambda img_path: read_caption(img_path, subset.caption_extension, subset.enable_wildcard),
+                )
+                indexed_captions = dict(zip(img_paths, captions))
+                self.metadata_indexes.append(metadata_index)
+                logger.info(f"image sizes from metadata index: {sum(size is not None for size in sizes)}/{len(img_paths)}")
+
+            # new caching: get image size from cache files
+            strategy = LatentsCachingStrategy.get_strategy()
+            if strategy is not None and any(size is None for size in sizes):
+                logger.info("get image size from name of cache files")
+
+                # make image path to npz path mapping
+                npz_paths = glob.glob(os.path.join(subset.image_dir, "*" + strategy.cache_suffix))
+                npz_paths.sort(key=lambda item: item.rsplit("_", maxsplit=2)[0])  # sort by name excluding resolution and cache_suffix
+                npz_path_index = 0
+
+                size_set_count = 0
+                for i, img_path in enumerate(tqdm(img_paths)):
+                    if sizes[i] is not None:
+                        continue
+                    l = len(os.path.splitext(img_path)[0])  # remove extension
+                    found = False
+                    while npz_path_index < len(npz_paths):  # until found or end of npz_paths
+                        # npz_paths are sorted, so if npz_path > img_path, img_path is not found
+                        if npz_paths[npz_path_index][:l] > img_path[:l]:
+                            break
+                        if npz_paths[npz_path_index][:l] == img_path[:l]:  # found
+                            found = True
+                            break
+                        npz_path_index += 1  # next npz_path
+
+                    if found:
+                        w, h = strategy.get_image_size_from_disk_cache_path(img_path, npz_paths[npz_path_index])
+                    else:
+                        w, h = None, None
 
-                        if w is not None and h is not None:
-                            sizes[i] = (w, h)
-                            size_set_count += 1
-                    logger.info(f"set image size from cache files: {size_set_count}/{len(img_paths)}")
+                    if w is not None and h is not None:
+                        sizes[i] = (w, h)
+                        size_set_count += 1
+                logger.info(f"set image size from cache files: {size_set_count}/{len(img_paths)}")
 
             if self.skip_image_resolution is not None:
                 filtered_img_paths = []
                 filtered_sizes = []
                 skip_image_area = self.skip_image_resolution[0] * self.skip_image_resolution[1]
+                # no latents cache file, get image size by reading image file (slow)
+                missing = [i for i, size in enumerate(sizes) if size is None]
+                missing_sizes = map_in_threads(self.get_image_size, [img_paths[i] for i in missing], "get image size")
+                for i, size in zip(missing, missing_sizes):
+                    sizes[i] = size
+                if metadata_index is not None and missing:
+                    metadata_index.record_sizes({img_paths[i]: sizes[i] for i in missing})
                 for img_path, size in zip(img_paths, sizes):
-                    if size is None:  # no latents cache file, get image size by reading image file (slow)
-                        size = self.get_image_size(img_path)
                     if size[0] * size[1] <= skip_image_area:
                         continue
                     filtered_img_paths.append(img_path)
@@ -220,27 +225,28 @@ class DreamBoothDataset(BaseDataset):
 
             logger.info(f"found directory {subset.image_dir} contains {len(img_paths)} image files")
 
-            if use_cached_info_for_subset:
-                captions = [metas[img_path]["caption"] for img_path in img_paths]
-                missing_captions = [img_path for img_path, caption in zip(img_paths, captions) if caption is None or caption == ""]
+            # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
+            if indexed_captions is not None:
+                caps_for_imgs = [indexed_captions[img_path] for img_path in img_paths]
             else:
-                # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
-                captions = []
-                missing_captions = []
-                for img_path in tqdm(img_paths, desc="read caption"):
-                    cap_for_img = read_caption(img_path, subset.caption_extension, subset.enable_wildcard)
-                    if cap_for_img is None and subset.class_tokens is None:
-                        logger.warning(
-                            f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
-                        )
-                        captions.append("")
+                caps_for_imgs = map_in_threads(
+                    lambda img_path: read_caption(img_path, subset.caption_extension, subset.enable_wildcard), img_paths, "read caption"
+                )
+            captions = []
+            missing_captions = []
+            for img_path, cap_for_img in zip(img_paths, caps_for_imgs):
+                if cap_for_img is None and subset.class_tokens is None:
+                    logger.warning(
+                        f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
+                    )
+                    captions.append("")
+                    missing_captions.append(img_path)
+                else:
+                    if cap_for_img is None:
+                        captions.append(subset.class_tokens)
                         missing_captions.append(img_path)
                     else:
-                        if cap_for_img is None:
-                            captions.append(subset.class_tokens)
-                            missing_captions.append(img_path)
-                        else:
-                            captions.append(cap_for_img)
+                        captions.append(cap_for_img)
 
             self.set_tag_frequency(os.path.basename(subset.image_dir), captions)  # タグ頻度を記録
 
@@ -258,16 +264,6 @@ class DreamBoothDataset(BaseDataset):
                         break
                     logger.warning(missing_caption)
 
-            if not use_cached_info_for_subset and subset.cache_info:
-                logger.info(f"cache image info for / 画像情報をキャッシュします : {info_cache_file}")
-                sizes = [self.get_image_size(img_path) for img_path in tqdm(img_paths, desc="get image size")]
-                matas = {}
-                for img_path, caption, size in zip(img_paths, captions, sizes):
-                    matas[img_path] = {"caption": caption, "resolution": list(size)}
-                with open(info_cache_file, "w", encoding="utf-8") as f:
-                    json.dump(matas, f, ensure_ascii=False, indent=2)
-                logger.info(f"cache image info done for / 画像情報を出力しました : {info_cache_file}")
-
             # if sizes are not set, image size will be read in make_buckets
             return img_paths, captions, sizes
 
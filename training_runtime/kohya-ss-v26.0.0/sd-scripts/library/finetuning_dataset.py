@@ -16,6 +16,7 @@ from library.dataset import (
     ImageInfo,
     glob_images,
 )
+from library import latent_store
 from library.strategy_base import LatentsCachingStrategy
 from library.subset import FineTuningSubset
 from library.utils import setup_logging
@@ -148,6 +149,8 @@ class FineTuningDataset(BaseDataset):
             if strategy is not None:    # If `cache_latents` is not enabled (and no strategy is set), skip this part
                 for image_dir in image_dirs:
                     npz_paths.extend(glob.glob(os.path.join(image_dir, "*" + strategy.cache_suffix)))
+                    if strategy.uses_latent_store:
+                        npz_paths.extend(latent_store.cached_paths(image_dir, strategy.cache_suffix))
             npz_paths = sorted(npz_paths, key=lambda item: len(os.path.basename(item)), reverse=True)  # longer paths first
 
             # Match image filename longer to shorter because some images share same prefix
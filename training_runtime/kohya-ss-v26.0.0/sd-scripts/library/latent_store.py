@@ -0,0 +1,271 @@
+"""Consolidated latent cache store.
+
+An alternative on-disk backend for ``LatentsCachingStrategy`` that replaces
+one ``.npz`` per image with a few append-only files per image directory::
+
+    <image_dir>/_latent_store/
+        index-<writer>.jsonl      one JSON line per cached record
+        <H>x<W>-<writer>.bin      raw arrays of one latent resolution
+
+Every array is written at a ``ALIGNMENT``-byte boundary of the shard of its
+latent resolution and read back through ``np.memmap``, so loading a sample in
+``BaseDataset.__getitem__`` is a dictionary lookup and a slice instead of a zip
+parse. Records are keyed by the basename of the ``.npz`` path the strategy
+would have used (which already carries the image size and the architecture
+suffix) plus the resolution key suffix, so the strategy API and
+``ImageInfo.latents_npz`` are unchanged; only the bytes live elsewhere.
+
+Re-caching an image appends a new record that supersedes the older one.
+``<writer>`` is the distributed rank, so processes that cache different images
+of the same directory never append to the same file. The backend is selected
+with ``--latents_cache_format store``: ``set_latents_cache_format`` sets the
+process default, and each ``LatentsCachingStrategy`` keeps the format it was
+created with (``uses_latent_store``), so DataLoader workers started with spawn,
+which import this module afresh, read the store too. Existing ``.npz`` caches
+can be imported with ``convert_npz_directory`` or
+``tools/convert_latents_to_store.py``.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+STORE_DIR_NAME = "_latent_store"
+ALIGNMENT = 64
+LATENTS_CACHE_FORMATS = ("npz", "store")
+
+# Process default set by set_latents_cache_format(), before the strategies are
+# created; LatentsCachingStrategy copies it and routes latents by its own copy.
+LATENTS_CACHE_FORMAT = "npz"
+
+ARRAY_KEYS = ("latents", "latents_flipped", "alpha_mask")
+
+
+def set_latents_cache_format(cache_format: Optional[str]):
+    if cache_format is None:
+        cache_format = "npz"
+    if cache_format not in LATENTS_CACHE_FORMATS:
+        raise ValueError(f"unknown latents cache format: {cache_format} / 不明なlatentキャッシュ形式です")
+    global LATENTS_CACHE_FORMAT
+    if cache_format != LATENTS_CACHE_FORMAT:
+        logger.info(f"latents cache format: {cache_format}")
+    LATENTS_CACHE_FORMAT = cache_format
+
+
+def is_enabled() -> bool:
+    return LATENTS_CACHE_FORMAT == "store"
+
+
+def _writer_id() -> str:
+    # each process of a distributed caching run appends to its own files
+    return os.environ.get("RANK", os.environ.get("LOCAL_RANK", "0"))
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class LatentStore:
+    r"""
+    The store of one image directory. Use ``store_for`` to share one instance per directory and process.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.records: Dict[Tuple[str, str], dict] = {}
+        self._index_offsets: Dict[str, int] = {}
+        self._maps: Dict[str, np.memmap] = {}
+        self._shards: Dict[str, object] = {}
+        self._index = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Read index lines appended since the last refresh, by this or any other writer."""
+        for index_path in sorted(glob.glob(os.path.join(self.root, "index-*.jsonl"))):
+            offset = self._index_offsets.get(index_path, 0)
+            with open(index_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1  # a torn last line is read again on the next refresh
+            for line in data[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"skipping a broken record in {index_path}")
+                    continue
+                key = (record["key"], record["suffix"])
+                current = self.records.get(key)
+                if current is None or current["seq"] <= record["seq"]:
+                    self.records[key] = record
+            self._index_offsets[index_path] = offset + end
+
+    def get(self, key: str, suffix: str, refresh: bool = False) -> Optional[dict]:
+        r"""
+        ``refresh`` re-reads the index on a miss, because another process may have cached the record since we last looked.
+        Cache checks leave it off: a miss there is the common case and each process only checks what it caches itself.
+        """
+        record = self.records.get((key, suffix))
+        if record is None and refresh:
+            self.refresh()
+            record = self.records.get((key, suffix))
+        return record
+
+    def keys(self) -> List[str]:
+        return sorted({key for key, _ in self.records})
+
+    def is_complete(self, record: dict) -> bool:
+        """Whether every array of the record lies inside its shard."""
+        try:
+            size = os.path.getsize(os.path.join(self.root, record["shard"]))
+        except OSError:
+            return False
+        for offset, shape, dtype in record["arrays"].values():
+            if offset + int(np.prod(shape)) * np.dtype(dtype).itemsize > size:
+                return False
+        return True
+
+    def _map(self, shard: str, end: int) -> np.memmap:
+        mapped = self._maps.get(shard)
+        if mapped is None or len(mapped) < end:
+            # first access, or the shard has grown since it was mapped. copy-on-write keeps the
+            # returned arrays writable (torch warns on read-only arrays) without touching the shard
+            mapped = np.memmap(os.path.join(self.root, shard), dtype=np.uint8, mode="c")
+            self._maps[shard] = mapped
+        return mapped
+
+    def load_array(self, record: dict, name: str) -> Optional[np.ndarray]:
+        if name not in record["arrays"]:
+            return None
+        offset, shape, dtype = record["arrays"][name]
+        dtype = np.dtype(dtype)
+        end = offset + int(np.prod(shape)) * dtype.itemsize
+        return self._map(record["shard"], end)[offset:end].view(dtype).reshape(shape)
+
+    def load(
+        self, key: str, suffix: str
+    ) -> Tuple[np.ndarray, List[int], List[int], Optional[np.ndarray], Optional[np.ndarray]]:
+        record = self.get(key, suffix, refresh=True)
+        if record is None:
+            raise ValueError(f"latents{suffix} not found in {self.root} for {key}")
+        return (
+            self.load_array(record, "latents"),
+            record["original_size"],
+            record["crop_ltrb"],
+            self.load_array(record, "latents_flipped"),
+            self.load_array(record, "alpha_mask"),
+        )
+
+    def put(self, key: str, suffix: str, arrays: Dict[str, np.ndarray], original_size, crop_ltrb):
+        r"""
+        Append the arrays of one image. ``arrays`` must contain ``latents``; ``latents_flipped`` and ``alpha_mask`` are optional.
+        """
+        latents_h, latents_w = arrays["latents"].shape[-2:]
+        shard = f"{latents_h}x{latents_w}-{_writer_id()}.bin"
+
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            f = self._shards.get(shard)
+            if f is None:
+                f = open(os.path.join(self.root, shard), "ab")
+                self._shards[shard] = f
+
+            entries = {}
+            position = f.tell()
+            for name in ARRAY_KEYS:
+                array = arrays.get(name)
+                if array is None:
+                    continue
+                array = np.ascontiguousarray(array)
+                start = _aligned(position)
+                f.write(b"\0" * (start - position))
+                f.write(array.tobytes())
+                position = start + array.nbytes
+                entries[name] = [start, list(array.shape), array.dtype.str]
+            f.flush()  # data before the index line that refers to it
+
+            record = {
+                "key": key,
+                "suffix": suffix,
+                "seq": time.time_ns(),
+                "shard": shard,
+                "arrays": entries,
+                "original_size": [int(v) for v in original_size],
+                "crop_ltrb": [int(v) for v in crop_ltrb],
+            }
+            if self._index is None:
+                self._index = open(os.path.join(self.root, f"index-{_writer_id()}.jsonl"), "ab")
+            self._index.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+            self._index.flush()
+            self.records[(key, suffix)] = record
+
+    def close(self):
+        with self._lock:
+            for f in self._shards.values():
+                f.close()
+            self._shards.clear()
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+            self._maps.clear()
+
+
+_STORES: Dict[str, LatentStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def store_for(npz_path: str) -> LatentStore:
+    """The store holding the record that would otherwise be ``npz_path``."""
+    root = os.path.join(os.path.dirname(os.path.abspath(npz_path)), STORE_DIR_NAME)
+    with _STORES_LOCK:
+        store = _STORES.get(root)
+        if store is None:
+            store = LatentStore(root)
+            _STORES[root] = store
+    return store
+
+
+def record_key(npz_path: str) -> str:
+    return os.path.basename(npz_path)
+
+
+def cached_paths(image_dir: str, cache_suffix: str) -> List[str]:
+    """Virtual ``.npz`` paths of the records in the store of ``image_dir``, the counterpart of globbing for cache files."""
+    if not os.path.isdir(os.path.join(image_dir, STORE_DIR_NAME)):
+        return []
+    store = store_for(os.path.join(image_dir, "_"))
+    return [os.path.join(image_dir, key) for key in store.keys() if key.endswith(cache_suffix)]
+
+
+def convert_npz_directory(directory: str, cache_suffix: str = ".npz", remove_npz: bool = False) -> int:
+    r"""
+    Import every ``*<cache_suffix>`` latents cache of ``directory`` into its store. Returns the number of converted files.
+
+    Resolution keyed entries (``latents_64x48`` etc.) become one record per resolution; old files without the suffix become
+    one record with an empty suffix, which is what the loader falls back to.
+    """
+    store = store_for(os.path.join(directory, "_"))
+    converted = 0
+    for npz_path in sorted(glob.glob(os.path.join(directory, "*" + cache_suffix))):
+        with np.load(npz_path) as npz:
+            suffixes = [name[len("latents") :] for name in npz.files if name.startswith("latents") and not name.startswith("latents_flipped")]
+            if not suffixes:
+                logger.warning(f"no latents in {npz_path}, skipped")
+                continue
+            for suffix in suffixes:
+                arrays = {name: npz[name + suffix] for name in ARRAY_KEYS if name + suffix in npz.files}
+                store.put(record_key(npz_path), suffix, arrays, npz["original_size" + suffix], npz["crop_ltrb" + suffix])
+        converted += 1
+        if remove_npz:
+            os.remove(npz_path)
+    return converted
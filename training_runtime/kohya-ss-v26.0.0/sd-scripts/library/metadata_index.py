@@ -0,0 +1,196 @@
+"""Per-subset index of image sizes and captions, used when ``cache_info`` is enabled.
+
+Replaces the former ``metadata_cache.json``, which stored captions and sizes
+without any way to notice that an image was replaced or a caption edited. The
+index is a SQLite database in the image directory::
+
+    <image_dir>/metadata_index.sqlite
+
+with one row per image: its file name, size and mtime, its resolution, and the
+caption file it was read from with that file's size and mtime. Each dataset load still lists the directory and stats every image and
+caption candidate (in a thread pool), but only images whose stat changed are
+probed again and only changed captions are read again. Rows of images that
+left the directory are dropped. Names are stored relative to the directory, so
+a moved or remounted dataset keeps its index.
+
+The database is written from the main thread only; the stats and reads run in
+``map_in_threads``. If the directory is read-only or the database is unusable
+or locked, the subset is loaded without the index: a failed open skips it, a
+failed read or write is logged and the index is not written again.
+"""
+
+import contextlib
+import logging
+import os
+import sqlite3
+from stat import S_ISREG
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from library.dataset import map_in_threads
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_FILE_NAME = "metadata_index.sqlite"
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    caption_options TEXT,
+    caption_path TEXT,
+    caption_size INTEGER,
+    caption_mtime_ns INTEGER,
+    caption TEXT
+)
+"""
+
+# (path, size, mtime_ns) of the first existing caption candidate, or None
+CaptionSignature = Optional[Tuple[str, int, int]]
+
+
+def _caption_signature(candidates: Sequence[str]) -> CaptionSignature:
+    for cap_path in candidates:
+        try:
+            stat = os.stat(cap_path)
+        except OSError:
+            continue
+        if S_ISREG(stat.st_mode):  # same as the os.path.isfile check of read_caption
+            return os.path.basename(cap_path), stat.st_size, stat.st_mtime_ns
+    return None
+
+
+class SubsetMetadataIndex:
+    r"""
+    The index of one image directory. No connection is kept between calls, so the dataset holding it stays picklable for
+    DataLoader workers.
+    """
+
+    def __init__(self, image_dir: str):
+        self.image_dir = os.path.normpath(image_dir)
+        self.path = os.path.join(image_dir, INDEX_FILE_NAME)
+        self.usable = True
+        with self._connect() as connection:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                with connection:
+                    connection.execute("DROP TABLE IF EXISTS images")
+                    connection.execute(_SCHEMA)
+                    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)  # other ranks may be writing the same index
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @classmethod
+    def open(cls, image_dir: str) -> Optional["SubsetMetadataIndex"]:
+        try:
+            return cls(image_dir)
+        except sqlite3.Error as e:
+            logger.warning(
+                f"metadata index is not available, loading without it / メタデータのインデックスを使用できません: {image_dir}: {e}"
+            )
+            return None
+
+    def _disable(self, e: sqlite3.Error):
+        self.usable = False
+        logger.warning(
+            f"metadata index is not available, continuing without it / メタデータのインデックスを使用できません: {self.path}: {e}"
+        )
+
+    def scan(
+        self,
+        img_paths: List[str],
+        caption_options: str,
+        caption_candidates: Callable[[str], List[str]],
+        read_caption: Callable[[str], Optional[str]],
+    ) -> Tuple[List[Optional[str]], List[Optional[Tuple[int, int]]]]:
+        r"""
+        Captions and sizes of ``img_paths``. Sizes are None for new or changed images (probe them and call ``record_sizes``).
+
+        ``caption_options`` identifies the caption settings (extension, wildcard): rows read with other settings are read again.
+        """
+        rows = {}
+        if self.usable:
+            try:
+                with self._connect() as connection:
+                    rows = {row[0]: row[1:] for row in connection.execute("SELECT * FROM images")}
+            except sqlite3.Error as e:
+                self._disable(e)
+
+        def signature(img_path):
+            stat = os.stat(img_path)
+            return stat.st_size, stat.st_mtime_ns, _caption_signature(caption_candidates(img_path))
+
+        signatures = map_in_threads(signature, img_paths, "check metadata index")
+
+        sizes: List[Optional[Tuple[int, int]]] = []
+        captions: List[Optional[str]] = [None] * len(img_paths)
+        to_read = []
+        for i, (img_path, (size, mtime_ns, cap_sig)) in enumerate(zip(img_paths, signatures)):
+            row = rows.get(os.path.basename(img_path))
+            image_unchanged = row is not None and row[0] == size and row[1] == mtime_ns and row[2] is not None
+            sizes.append((row[2], row[3]) if image_unchanged else None)
+
+            cached_cap_sig = None if row is None or row[5] is None else (row[5], row[6], row[7])
+            if row is not None and row[4] == caption_options and cached_cap_sig == cap_sig:
+                captions[i] = row[8]
+            elif cap_sig is not None:
+                to_read.append(i)
+
+        if to_read:
+            logger.info(f"read {len(to_read)} new or changed captions")
+            for i, caption in zip(to_read, map_in_threads(lambda i: read_caption(img_paths[i]), to_read, "read caption")):
+                captions[i] = caption
+
+        if not self.usable:
+            return captions, sizes
+        try:
+            with self._connect() as connection, connection:
+                connection.execute("CREATE TEMP TABLE IF NOT EXISTS present (path TEXT PRIMARY KEY)")
+                connection.execute("DELETE FROM present")
+                connection.executemany("INSERT OR IGNORE INTO present VALUES (?)", ((os.path.basename(p),) for p in img_paths))
+                connection.execute("DELETE FROM images WHERE path NOT IN (SELECT path FROM present)")
+                connection.executemany(
+                    "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        (
+                            os.path.basename(img_path),
+                            img_size,
+                            mtime_ns,
+                            None if size is None else size[0],
+                            None if size is None else size[1],
+                            caption_options,
+                            *(cap_sig if cap_sig is not None else (None, None, None)),
+                            caption,
+                        )
+                        for img_path, (img_size, mtime_ns, cap_sig), size, caption in zip(img_paths, signatures, sizes, captions)
+                    ),
+                )
+        except sqlite3.Error as e:
+            self._disable(e)
+        return captions, sizes
+
+    def record_sizes(self, sizes: Dict[str, Tuple[int, int]]):
+        """Store probed image sizes. Paths outside this image directory are ignored."""
+        if not self.usable:
+            return
+        rows = [
+            (w, h, os.path.basename(path))
+            for path, (w, h) in sizes.items()
+            if os.path.normpath(os.path.dirname(path)) == self.image_dir
+        ]
+        try:
+            with self._connect() as connection, connection:
+                connection.executemany("UPDATE images SET width = ?, height = ? WHERE path = ?", rows)
+        except sqlite3.Error as e:
+            self._disable(e)
@@ -3,7 +3,8 @@
 Hosts the routines that load Stable Diffusion / Diffusers checkpoints into
 the in-memory training pipeline (``load_target_model`` / ``_load_target_model``),
 the SD-WebUI / additional-networks compatible hashes (``model_hash``,
-``calculate_sha256``, ``addnet_hash_*``, ``precalculate_safetensors_hashes``),
+``calculate_sha256``, ``addnet_hash_*``, ``precalculate_safetensors_hashes``,
+``save_safetensors_with_hashes``),
 the ``ss_*`` LoRA metadata helpers (``build_minimum_network_metadata`` and the
 ``SS_METADATA_*`` keys), the SAI ModelSpec wrappers
 (``get_sai_model_spec``, ``get_sai_model_spec_dataclass``), the
@@ -18,6 +19,7 @@ import hashlib
 import json
 import logging
 import os
+import struct
 import subprocess
 import time
 from io import BytesIO
@@ -26,6 +28,7 @@ from typing import TYPE_CHECKING, Optional
 import safetensors
 import safetensors.torch
 
+import library.safetensors_utils as safetensors_utils
 import library.sai_model_spec as sai_model_spec
 from library.device_utils import clean_memory_on_device
 from library.utils import setup_logging
@@ -96,6 +99,58 @@ def precalculate_safetensors_hashes(tensors, metadata):
     return model_hash, legacy_hash
 
 
+def save_safetensors_with_hashes(tensors, filename, metadata):
+    """Save ``tensors`` with the hashes of ``precalculate_safetensors_hashes`` in ``metadata`` (as ``sshs_model_hash`` and
+    ``sshs_legacy_hash``), hashing the tensor data while it is written instead of serializing the model to memory first.
+
+    The tensor data is laid out as ``safetensors.torch.save`` lays it out, so it is the data hashed by
+    ``addnet_hash_safetensors``; the window of ``addnet_hash_legacy`` is located from the length of the header with the
+    ``ss_*`` metadata only. The header is written with placeholders of the same length as the hashes and rewritten after
+    the data. Returns the hashes."""
+
+    for key, value in metadata.items():
+        if not isinstance(value, str):
+            raise TypeError(f"metadata value must be a string: {key}={value!r}")
+
+    layout = safetensors_utils.safetensors_layout(tensors)
+    training_metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    legacy_start = 0x100000 - 8 - len(safetensors_utils.safetensors_header(layout, training_metadata))
+    legacy_end = legacy_start + 0x10000
+    if legacy_start < 0:
+        # the legacy hash window starts in the header, whose metadata order is up to safetensors: serialize as before
+        model_hash, legacy_hash = precalculate_safetensors_hashes(tensors, metadata)
+        metadata["sshs_model_hash"] = model_hash
+        metadata["sshs_legacy_hash"] = legacy_hash
+        safetensors.torch.save_file(tensors, filename, metadata)
+        return model_hash, legacy_hash
+
+    metadata["sshs_model_hash"] = "0" * 64
+    metadata["sshs_legacy_hash"] = "0" * 8
+    header = safetensors_utils.safetensors_header(layout, metadata)
+
+    model_sha256 = hashlib.sha256()
+    legacy_sha256 = hashlib.sha256()
+    with open(filename, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+
+        offset = 0  # in the tensor data
+        for _, tensor in layout:
+            data = safetensors_utils.tensor_bytes(tensor)
+            model_sha256.update(data)
+            start, end = max(offset, legacy_start), min(offset + len(data), legacy_end)
+            if start < end:
+                legacy_sha256.update(data[start - offset : end - offset])
+            f.write(data)
+            offset += len(data)
+
+        metadata["sshs_model_hash"] = model_sha256.hexdigest()
+        metadata["sshs_legacy_hash"] = legacy_sha256.hexdigest()[0:8]
+        f.seek(8)
+        f.write(safetensors_utils.safetensors_header(layout, metadata))  # same length as the placeholders
+    return metadata["sshs_model_hash"], metadata["sshs_legacy_hash"]
+
+
 def addnet_hash_legacy(b):
     """Old model hash used by sd-webui-additional-networks for .safetensors format files"""
     m = hashlib.sha256()
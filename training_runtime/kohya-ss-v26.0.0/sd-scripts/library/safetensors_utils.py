@@ -5,32 +5,38 @@ import numpy as np
 import torch
 import json
 import struct
-from typing import Dict, Any, Union, Optional
+from typing import Dict, Any, List, Tuple, Union, Optional
 
 from safetensors.torch import load_file
 
 from library.device_utils import synchronize_device
 
 
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+    getattr(torch, "float8_e5m2", None): "F8_E5M2",
+    getattr(torch, "float8_e4m3fn", None): "F8_E4M3",
+}
+
+# order of the Dtype enum of safetensors. safetensors.torch.save lays out the tensor data by dtype, the last of these first
+SAFETENSORS_DTYPE_ORDER = ("BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "F64", "I64", "U64")
+
+
 def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None):
     """
     memory efficient save file
     """
 
-    _TYPES = {
-        torch.float64: "F64",
-        torch.float32: "F32",
-        torch.float16: "F16",
-        torch.bfloat16: "BF16",
-        torch.int64: "I64",
-        torch.int32: "I32",
-        torch.int16: "I16",
-        torch.int8: "I8",
-        torch.uint8: "U8",
-        torch.bool: "BOOL",
-        getattr(torch, "float8_e5m2", None): "F8_E5M2",
-        getattr(torch, "float8_e4m3fn", None): "F8_E4M3",
-    }
+    _TYPES = SAFETENSORS_DTYPES
     _ALIGN = 256
 
     def validate_metadata(metadata: Dict[str, Any]) -> Dict[str, str]:
@@ -83,6 +89,37 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
                 v.contiguous().view(torch.uint8).numpy().tofile(f)
 
 
+def safetensors_layout(tensors: Dict[str, torch.Tensor]) -> List[Tuple[str, torch.Tensor]]:
+    """
+    Tensors in the order ``safetensors.torch.save`` writes their data: by dtype (see ``SAFETENSORS_DTYPE_ORDER``), then by name.
+    """
+    return sorted(
+        tensors.items(), key=lambda item: (-SAFETENSORS_DTYPE_ORDER.index(SAFETENSORS_DTYPES[item[1].dtype]), item[0])
+    )
+
+
+def safetensors_header(layout: List[Tuple[str, torch.Tensor]], metadata: Optional[Dict[str, str]]) -> bytes:
+    """
+    Header of a safetensors file with the tensors of ``layout``, without the length prefix. Compact JSON padded with spaces
+    to 8 bytes, as ``safetensors.torch.save`` writes it, so it has the same length (the order of metadata keys may differ).
+    """
+    header = {}
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    offset = 0
+    for name, tensor in layout:
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+    hjson = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hjson + b" " * (-len(hjson) % 8)
+
+
+def tensor_bytes(tensor: torch.Tensor) -> np.ndarray:
+    """Raw little-endian bytes of a tensor as a flat uint8 array, without a copy for contiguous CPU tensors."""
+    return tensor.detach().contiguous().cpu().view(-1).view(torch.uint8).numpy()
+
+
 class MemoryEfficientSafeOpen:
     """Memory-efficient reader for safetensors files.
 
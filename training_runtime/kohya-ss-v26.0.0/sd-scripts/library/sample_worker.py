@@ -0,0 +1,425 @@
+"""Sample image generation in a separate process (``--sample_worker_device``).
+
+Instead of stopping the optimization to generate sample images, the trainer
+writes the network weights to a snapshot file and hands it to a worker process,
+which has its own copy of the base model on the configured device (a second GPU,
+or the CPU for small models) and generates the images while training goes on.
+
+The worker is ``python -m library.sample_worker``, a stdin/stdout JSON worker:
+it answers one request per stdin line until stdin closes. A request is::
+
+    {"id": 3, "network_weights": "<snapshot file>", "sample_prompts": "<prompt file>", "epoch": 2, "steps": 500}
+
+``epoch`` and ``steps`` are the values the trainer passes to ``sample_images``,
+so the images are written to ``output_dir/sample`` with the same names as when
+sampled in the training process. ``id`` numbers the requests: step and epoch
+end sampling can both happen at one step. The reply is one JSON line::
+
+    {"id": 3, "steps": 500, "epoch": 2, "seconds": 12.3, "images": ["<file name>", ...]}
+
+or ``{"id": ..., "steps": ..., "epoch": ..., "error": "..."}``. Anything else the worker
+prints goes to stderr, which is shared with the trainer.
+
+- :class:`SampleWorker` — the trainer side: starts the worker, writes the
+  snapshots, sends the requests and collects the replies as logs.
+- :func:`start_sample_worker` — start the worker for a trainer class.
+- :func:`worker_environment` — environment of the worker process for a device.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from safetensors.torch import save_file
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# requests sent and not answered yet; further sample steps are skipped while the worker is this far behind
+MAX_PENDING_REQUESTS = 2
+
+# seconds ``close`` waits for the outstanding requests before the worker is killed
+CLOSE_TIMEOUT = 600
+
+# set by torchrun / accelerate launch; the worker is a single process of its own
+DISTRIBUTED_ENV_KEYS = ("RANK", "LOCAL_RANK", "WORLD_SIZE", "LOCAL_WORLD_SIZE", "GROUP_RANK", "ROLE_RANK", "MASTER_ADDR", "MASTER_PORT")
+
+SD_SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker_environment(device: str, environ: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Environment of the worker process: without the distributed launch variables, with ``sd-scripts`` importable, and
+    with only the sampling device visible, so that ``accelerate`` picks it as the default device.
+    """
+    env = dict(os.environ if environ is None else environ)
+    for key in list(env):
+        if key in DISTRIBUTED_ENV_KEYS or key.startswith("TORCHELASTIC_"):
+            del env[key]
+    env["PYTHONPATH"] = os.pathsep.join([SD_SCRIPTS_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+
+    device = torch.device(device)
+    if device.type == "cpu":
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    elif device.type == "cuda" and device.index is not None:
+        # the index is relative to the devices visible to the trainer
+        visible = env.get("CUDA_VISIBLE_DEVICES")
+        visible = [d.strip() for d in visible.split(",")] if visible else [str(i) for i in range(device.index + 1)]
+        if device.index >= len(visible):
+            raise ValueError(f"sample worker device is not visible / サンプル生成用のデバイスが見つかりません: {device}")
+        env["CUDA_VISIBLE_DEVICES"] = visible[device.index]
+    return env
+
+
+class SampleWorker:
+    r"""
+    The trainer side of the worker process started with ``command``.
+
+    ``submit`` writes the network state dict to a snapshot file in ``work_dir`` and sends the request; it returns at
+    once. At most ``max_pending`` requests are outstanding: beyond that the sample step is skipped with a warning, so a
+    slow worker never holds training up. A reader thread collects the replies; ``completed`` returns them as logs for
+    the training thread to log, and removes the snapshots. ``close`` waits for the outstanding requests (killing the
+    worker if they take longer than ``timeout``), stops the worker and removes ``work_dir``.
+    """
+
+    def __init__(self, command: List[str], work_dir: str, env: Optional[Dict[str, str]] = None, max_pending: int = MAX_PENDING_REQUESTS):
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be 1 or more / max_pendingは1以上である必要があります: {max_pending}")
+        self.max_pending = max_pending
+        self.work_dir = work_dir
+        self._lock = threading.Lock()
+        self._pending: Dict[int, str] = {}  # request id -> snapshot file
+        self._next_id = 0
+        self._replies: List[dict] = []
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True, encoding="utf-8")
+        self._reader = threading.Thread(target=self._read, name="sample-worker-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    def _read(self):
+        for line in self._process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                reply = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"unexpected output from the sample worker / サンプル生成プロセスの予期しない出力: {line}")
+                continue
+            with self._lock:
+                self._replies.append(reply)
+
+    def submit(self, state_dict: Dict[str, torch.Tensor], sample_prompts: str, epoch: Optional[int], steps: int) -> bool:
+        """Send the weights in ``state_dict`` to be sampled at ``epoch`` / ``steps``. Returns False if the step is skipped."""
+        if not self.alive:
+            logger.warning(
+                f"sample worker has exited, no sample images at step {steps} / サンプル生成プロセスが終了しているため、ステップ {steps} のサンプル画像は生成されません"
+            )
+            return False
+        with self._lock:
+            pending = len(self._pending)
+        if pending >= self.max_pending:
+            logger.warning(
+                f"sample worker is {pending} requests behind, skipping sample images at step {steps}"
+                + f" / サンプル生成プロセスの処理が {pending} 件遅れているため、ステップ {steps} のサンプル画像をスキップします"
+            )
+            return False
+
+        request_id = self._next_id
+        self._next_id += 1
+        snapshot_file = os.path.join(self.work_dir, f"network-{request_id:06d}-step{steps:08d}.safetensors")
+        save_file({k: v.detach().contiguous() for k, v in state_dict.items()}, snapshot_file)
+        request = {"id": request_id, "network_weights": snapshot_file, "sample_prompts": sample_prompts, "epoch": epoch, "steps": steps}
+        with self._lock:
+            self._pending[request_id] = snapshot_file
+        try:
+            self._process.stdin.write(json.dumps(request) + "\n")
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            with self._lock:
+                self._pending.pop(request_id, None)
+            os.remove(snapshot_file)
+            logger.warning("sample worker has exited / サンプル生成プロセスが終了しています")
+            return False
+        return True
+
+    def completed(self) -> List[Dict[str, float]]:
+        """Logs of the requests answered since the last call. Failed requests are logged as errors and not returned."""
+        with self._lock:
+            replies, self._replies = self._replies, []
+            snapshots = [self._pending.pop(reply.get("id"), None) for reply in replies]
+            pending = len(self._pending)
+
+        logs = []
+        for reply, snapshot_file in zip(replies, snapshots):
+            if snapshot_file is not None and os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
+            if "error" in reply:
+                logger.error(
+                    f"sample worker failed at step {reply.get('steps')} / サンプル生成プロセスがステップ {reply.get('steps')} で失敗しました: {reply['error']}"
+                )
+                continue
+            logger.info(f"sample images at step {reply['steps']} / ステップ {reply['steps']} のサンプル画像: {', '.join(reply['images'])}")
+            logs.append(
+                {
+                    "samples/worker_steps": reply["steps"],
+                    "samples/worker_seconds": reply["seconds"],
+                    "samples/worker_images": len(reply["images"]),
+                    "samples/worker_pending": pending,
+                }
+            )
+        return logs
+
+    def close(self, timeout: Optional[float] = CLOSE_TIMEOUT):
+        """Wait for the outstanding requests and stop the worker. ``completed`` still returns the last replies."""
+        try:
+            self._process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        try:
+            returncode = self._process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(
+                f"sample worker did not finish in {timeout} seconds, killing it / サンプル生成プロセスが {timeout} 秒以内に終了しないため強制終了します"
+            )
+            self._process.kill()
+            returncode = self._process.wait()
+        self._reader.join()
+        if returncode != 0:
+            logger.warning(f"sample worker exited with code {returncode} / サンプル生成プロセスが終了コード {returncode} で終了しました")
+        with self._lock:
+            self._pending.clear()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def start_sample_worker(trainer_class: type, args: argparse.Namespace, resolutions: List[Tuple[int, int]]) -> SampleWorker:
+    """
+    Start the worker, which loads the models with ``trainer_class`` (a ``NetworkTrainer``) and the training ``args``.
+    ``resolutions`` are those of the training datasets, which some trainers set up their models for.
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="sample-worker-", dir=args.output_dir)
+    setup_file = os.path.join(work_dir, "setup.pkl")
+    with open(setup_file, "wb") as f:
+        pickle.dump((args, resolutions), f)
+
+    trainer_script = os.path.abspath(sys.modules[trainer_class.__module__].__file__)
+    command = [
+        sys.executable,
+        "-m",
+        "library.sample_worker",
+        "--trainer_script",
+        trainer_script,
+        "--trainer_class",
+        trainer_class.__qualname__,
+        "--setup_file",
+        setup_file,
+        "--device",
+        args.sample_worker_device,
+    ]
+    logger.info(f"starting sample worker on {args.sample_worker_device} / サンプル生成プロセスを開始します: {args.sample_worker_device}")
+    return SampleWorker(command, work_dir, env=worker_environment(args.sample_worker_device))
+
+
+# region worker process
+
+
+def load_trainer_class(trainer_script: str, class_name: str) -> type:
+    # the train scripts are not a package; their main block is not run
+    spec = importlib.util.spec_from_file_location("sample_worker_trainer", trainer_script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+
+class _SamplingDatasets:
+    """
+    Stands in for the training datasets in the trainer's setup methods. The trainer process has checked and cached
+    the datasets already; only the resolutions are needed here.
+    """
+
+    def __init__(self, resolutions: List[Tuple[int, int]]):
+        self.resolutions = list(resolutions)
+
+    def verify_bucket_reso_steps(self, min_steps: int):
+        pass
+
+    def is_text_encoder_output_cacheable(self, cache_supports_dropout: bool = False) -> bool:
+        return True
+
+    def get_resolutions(self) -> List[Tuple[int, int]]:
+        return self.resolutions
+
+    def new_cache_text_encoder_outputs(self, models, accelerator):
+        pass
+
+
+class _Sampler:
+    """
+    The models of the trainer with the network applied, prepared in the order of ``NetworkTrainer.train``: the
+    trainer's ``assert_extra_args`` and ``cache_text_encoder_outputs_if_needed`` set up its sampling state (model
+    type, text encoder flags, text encoder outputs of the sample prompts).
+    """
+
+    def __init__(self, trainer, args: argparse.Namespace, device: torch.device, resolutions: List[Tuple[int, int]]):
+        from accelerate import Accelerator
+
+        from library import accelerator_setup, strategy_base
+
+        if device.type == "cpu":
+            args.mixed_precision = "no"  # half precision is slow or unsupported on CPU
+        self.trainer = trainer
+        self.args = args
+        datasets = _SamplingDatasets(resolutions)
+        trainer.assert_extra_args(args, datasets, None)
+
+        self.accelerator = accelerator = Accelerator(mixed_precision=args.mixed_precision, cpu=device.type == "cpu")
+        weight_dtype, _ = accelerator_setup.prepare_dtype(args)
+
+        tokenize_strategy = trainer.get_tokenize_strategy(args)
+        strategy_base.TokenizeStrategy.set_strategy(tokenize_strategy)
+        self.tokenizers = trainer.get_tokenizers(tokenize_strategy)
+
+        _, text_encoder, vae, unet = trainer.load_target_model(args, weight_dtype, accelerator)
+        text_encoders = text_encoder if isinstance(text_encoder, list) else [text_encoder]
+
+        strategy_base.TextEncodingStrategy.set_strategy(trainer.get_text_encoding_strategy(args))
+        text_encoder_outputs_caching_strategy = trainer.get_text_encoder_outputs_caching_strategy(args)
+        if text_encoder_outputs_caching_strategy is not None:
+            strategy_base.TextEncoderOutputsCachingStrategy.set_strategy(text_encoder_outputs_caching_strategy)
+        trainer.cache_text_encoder_outputs_if_needed(args, accelerator, unet, vae, text_encoders, datasets, weight_dtype)
+
+        if unet is None:
+            unet, text_encoders = trainer.load_unet_lazily(args, weight_dtype, accelerator, text_encoders)
+
+        network_module = importlib.import_module(args.network_module)
+        for i, weight_path in enumerate(args.base_weights or []):
+            multiplier = 1.0 if args.base_weights_multiplier is None or len(args.base_weights_multiplier) <= i else args.base_weights_multiplier[i]
+            module, weights_sd = network_module.create_network_from_weights(
+                multiplier, weight_path, vae, text_encoder, unet, for_inference=True
+            )
+            module.merge_to(text_encoder, unet, weights_sd, weight_dtype, "cpu")
+
+        net_kwargs = dict(net_arg.split("=", 1) for net_arg in args.network_args or [])
+        if args.dim_from_weights:
+            network, _ = network_module.create_network_from_weights(1, args.network_weights, vae, text_encoder, unet, **net_kwargs)
+        else:
+            net_kwargs.setdefault("dropout", args.network_dropout)
+            network = network_module.create_network(
+                1.0, args.network_dim, args.network_alpha, vae, text_encoder, unet, neuron_dropout=args.network_dropout, **net_kwargs
+            )
+        if hasattr(network, "prepare_network"):
+            network.prepare_network(args)
+        trainer.post_process_network(args, accelerator, network, text_encoders, unet)
+        train_unet = not args.network_train_text_encoder_only
+        train_text_encoder = trainer.is_train_text_encoder(args)
+        network.apply_to(text_encoder, unet, train_text_encoder, train_unet)
+
+        # on the device as in training: the trained models are prepared, the others are where the trainer left them
+        if train_unet:
+            unet = trainer.prepare_unet_with_accelerator(args, accelerator, unet)
+        else:
+            unet.to(accelerator.device)
+        if train_text_encoder:
+            text_encoders = [
+                (t_enc.to(accelerator.device) if flag else t_enc)
+                for t_enc, flag in zip(text_encoders, trainer.get_text_encoders_train_flags(args, text_encoders))
+            ]
+        network.to(accelerator.device)
+        network.requires_grad_(False)
+        network.eval()
+        for model in [unet, vae] + text_encoders:
+            if model is not None:
+                model.requires_grad_(False)
+                model.eval()
+
+        self.network = network
+        self.vae = vae
+        self.text_encoder = text_encoder
+        self.unet = unet
+
+    def sample(self, request: dict) -> dict:
+        args = self.args
+        args.sample_prompts = request["sample_prompts"]
+        info = self.network.load_weights(request["network_weights"])
+        logger.info(f"load network weights from {request['network_weights']}: {info}")
+
+        save_dir = os.path.join(args.output_dir, "sample")
+        before = set(os.listdir(save_dir)) if os.path.isdir(save_dir) else set()
+        start = time.perf_counter()
+        with torch.no_grad():
+            self.trainer.sample_images(
+                self.accelerator,
+                args,
+                request["epoch"],
+                request["steps"],
+                self.accelerator.device,
+                self.vae,
+                self.tokenizers,
+                self.text_encoder,
+                self.unet,
+            )
+        seconds = time.perf_counter() - start
+        images = sorted(set(os.listdir(save_dir)) - before) if os.path.isdir(save_dir) else []
+        return {"steps": request["steps"], "epoch": request["epoch"], "seconds": seconds, "images": images}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sample image worker for network training / ネットワーク学習のサンプル画像生成プロセス")
+    parser.add_argument("--trainer_script", type=str, required=True, help="train script defining the trainer / トレーナーを定義する学習スクリプト")
+    parser.add_argument("--trainer_class", type=str, required=True, help="trainer class name / トレーナーのクラス名")
+    parser.add_argument(
+        "--setup_file", type=str, required=True, help="pickled training arguments and resolutions / pickleした学習の引数と解像度"
+    )
+    parser.add_argument("--device", type=str, required=True, help="device to sample on / サンプル生成に使うデバイス")
+    worker_args = parser.parse_args()
+
+    # replies only on the original stdout; prints and logs of the models go to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    with open(worker_args.setup_file, "rb") as f:
+        args, resolutions = pickle.load(f)
+    trainer = load_trainer_class(worker_args.trainer_script, worker_args.trainer_class)()
+    sampler = _Sampler(trainer, args, torch.device(worker_args.device), resolutions)
+    logger.info(f"sample worker is ready on {sampler.accelerator.device} / サンプル生成プロセスの準備ができました")
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            reply = sampler.sample(request)
+        except Exception as e:
+            logger.exception("failed to sample images / サンプル画像の生成に失敗しました")
+            reply = {"steps": request.get("steps"), "epoch": request.get("epoch"), "error": repr(e)}
+        reply["id"] = request.get("id")
+        protocol.write(json.dumps(reply) + "\n")
+        protocol.flush()
+
+
+# endregion
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,11 @@ call periodically (every N steps / epochs) to produce preview images:
   :func:`sample_image_inference` — orchestrate one round of sample
   generation (multi-GPU split via ``accelerate.PartialState``, RNG
   save/restore, optional inpainting input, W&B image upload).
+- :func:`is_sampling_step` — whether ``--sample_every_n_steps`` /
+  ``--sample_every_n_epochs`` / ``--sample_at_first`` sample at a step.
+- :func:`group_sample_prompts` / :func:`sample_image_batch_inference` —
+  generate prompts with the same settings in one pipeline call
+  (``--sample_batch_size``), with per-prompt seeds.
 
 These used to live in ``library.train_util`` and are still re-exported
 from there for backward compatibility. New code should import from this
@@ -25,7 +30,7 @@ import json
 import os
 import re
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import toml
 import torch
@@ -47,7 +52,7 @@ from diffusers import (
 )
 
 from library.device_utils import clean_memory_on_device
-from library.lpw_stable_diffusion import StableDiffusionLongPromptWeightingPipeline
+from library.lpw_stable_diffusion import StableDiffusionLongPromptWeightingPipeline, get_prompts_with_weights
 
 # library.sdxl_lpw_stable_diffusion pulls in train_util / sdxl_train_util, which
 # in turn re-export from this module. Importing the SDXL pipeline at module top
@@ -244,6 +249,18 @@ def load_prompts(prompt_file: str) -> List[Dict]:
     return prompts
 
 
+def is_sampling_step(args: argparse.Namespace, epoch: Optional[int], steps: int) -> bool:
+    """Whether images are sampled at ``steps``. ``epoch`` is None within an epoch and the epoch number at its end."""
+    if steps == 0:
+        return bool(args.sample_at_first)
+    if args.sample_every_n_steps is None and args.sample_every_n_epochs is None:
+        return False
+    if args.sample_every_n_epochs is not None:
+        # sample_every_n_steps は無視する
+        return epoch is not None and epoch % args.sample_every_n_epochs == 0
+    return steps % args.sample_every_n_steps == 0 and epoch is None  # steps is divisible and not end of epoch
+
+
 def sample_images_common(
     pipe_class,
     accelerator: Accelerator,
@@ -261,27 +278,19 @@ def sample_images_common(
     """
     StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
     TODO Use strategies here
+
+    Returns the seconds spent, or None if no images are sampled at this step.
     """
 
-    if steps == 0:
-        if not args.sample_at_first:
-            return
-    else:
-        if args.sample_every_n_steps is None and args.sample_every_n_epochs is None:
-            return
-        if args.sample_every_n_epochs is not None:
-            # sample_every_n_steps は無視する
-            if epoch is None or epoch % args.sample_every_n_epochs != 0:
-                return
-        else:
-            if steps % args.sample_every_n_steps != 0 or epoch is not None:  # steps is not divisible or end of epoch
-                return
+    if not is_sampling_step(args, epoch, steps):
+        return
 
     logger.info("")
     logger.info(f"generating sample images at step / サンプル画像生成 ステップ: {steps}")
     if not os.path.isfile(args.sample_prompts):
         logger.error(f"No prompt file / プロンプトファイルがありません: {args.sample_prompts}")
         return
+    start_time = time.perf_counter()
 
     distributed_state = PartialState()  # for multi gpu distributed inference. this is a singleton, so it's safe to use it here
 
@@ -345,13 +354,19 @@ def sample_images_common(
     except Exception:
         pass
 
+    def sample_prompt_dicts(prompt_dicts):
+        for batch in group_sample_prompts(args, pipeline, prompt_dicts, prompt_replacement, controlnet):
+            if len(batch) == 1:
+                sample_image_inference(
+                    accelerator, args, pipeline, save_dir, batch[0], epoch, steps, prompt_replacement, controlnet=controlnet
+                )
+            else:
+                sample_image_batch_inference(accelerator, args, pipeline, save_dir, batch, epoch, steps, prompt_replacement)
+
     if distributed_state.num_processes <= 1:
         # If only one device is available, just use the original prompt list. We don't need to care about the distribution of prompts.
         with torch.no_grad():
-            for prompt_dict in prompts:
-                sample_image_inference(
-                    accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
-                )
+            sample_prompt_dicts(prompts)
     else:
         # Creating list with N elements, where each element is a list of prompt_dicts, and N is the number of processes available (number of devices available)
         # prompt_dicts are assigned to lists based on order of processes, to attempt to time the image creation time to match enum order. Probably only works when steps and sampler are identical.
@@ -361,10 +376,7 @@ def sample_images_common(
 
         with torch.no_grad():
             with distributed_state.split_between_processes(per_process_prompts) as prompt_dict_lists:
-                for prompt_dict in prompt_dict_lists[0]:
-                    sample_image_inference(
-                        accelerator, args, pipeline, save_dir, prompt_dict, epoch, steps, prompt_replacement, controlnet=controlnet
-                    )
+                sample_prompt_dicts(prompt_dict_lists[0])
 
     # clear pipeline and cache to reduce vram usage
     del pipeline
@@ -376,6 +388,165 @@ def sample_images_common(
 
     clean_memory_on_device(accelerator.device)
 
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"sample images generated in {elapsed:.1f}s / サンプル画像生成時間: {elapsed:.1f}秒")
+    return elapsed
+
+
+def _text_embeddings_multiples(pipeline, prompt: str, negative_prompt: Optional[str], scale: float) -> int:
+    r"""
+    Number of 75-token chunks of the text embeddings of the SD1/2 and SDXL long prompt weighting pipelines for this prompt,
+    counted with the pipeline's (first) tokenizer. The pipelines pad all prompts of a call to the longest one, so only
+    prompts with the same number can share a call.
+    """
+    texts = [prompt] if scale <= 1.0 else [prompt, negative_prompt or ""]
+    chunk_length = pipeline.tokenizer.model_max_length - 2
+    max_embeddings_multiples = 3  # default of the pipeline
+    tokens, _ = get_prompts_with_weights(pipeline, texts, chunk_length * max_embeddings_multiples)
+    longest = max(len(token) for token in tokens)
+    return max(1, min(max_embeddings_multiples, (longest - 1) // chunk_length + 1))
+
+
+def _batch_sample_settings(args: argparse.Namespace, pipeline, prompt_dict: dict, prompt_replacement) -> dict:
+    """Settings of a prompt as ``sample_image_inference`` resolves them, for prompts that can be generated in a batch."""
+    from library.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
+
+    prompt: str = prompt_dict.get("prompt", "")
+    negative_prompt = prompt_dict.get("negative_prompt")
+    if prompt_replacement is not None:
+        prompt = prompt.replace(prompt_replacement[0], prompt_replacement[1])
+        if negative_prompt is not None:
+            negative_prompt = negative_prompt.replace(prompt_replacement[0], prompt_replacement[1])
+
+    divisor = 32 if isinstance(pipeline, SdxlStableDiffusionLongPromptWeightingPipeline) else 64
+    height = prompt_dict.get("height", 512)
+    width = prompt_dict.get("width", 512)
+    return {
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "sample_steps": prompt_dict.get("sample_steps", 30),
+        "width": max(divisor, width - width % divisor),
+        "height": max(divisor, height - height % divisor),
+        "scale": prompt_dict.get("scale", 7.5),
+        "seed": prompt_dict.get("seed"),
+        "sample_sampler": prompt_dict.get("sample_sampler", args.sample_sampler),
+    }
+
+
+def group_sample_prompts(
+    args: argparse.Namespace, pipeline, prompt_dicts: List[dict], prompt_replacement, controlnet=None
+) -> List[List[dict]]:
+    r"""
+    Split ``prompt_dicts`` into batches of at most ``args.sample_batch_size`` prompts that can be generated in one pipeline
+    call: same size, steps, sampler and scale (and text embedding length for SD1/2 and SDXL). ControlNet and inpainting
+    samples are generated one by one. Batches are in the order of their first prompt.
+    """
+    from library.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
+
+    batches: List[List[dict]] = []
+    open_batches = {}
+    for prompt_dict in prompt_dicts:
+        key = None
+        if args.sample_batch_size > 1 and controlnet is None and not getattr(args, "train_inpainting", False):
+            settings = _batch_sample_settings(args, pipeline, prompt_dict, prompt_replacement)
+            key = (settings["width"], settings["height"], settings["sample_steps"], settings["sample_sampler"], settings["scale"])
+            if isinstance(pipeline, (StableDiffusionLongPromptWeightingPipeline, SdxlStableDiffusionLongPromptWeightingPipeline)):
+                key += (_text_embeddings_multiples(pipeline, settings["prompt"], settings["negative_prompt"], settings["scale"]),)
+
+        batch = open_batches.get(key) if key is not None else None
+        if batch is None or len(batch) >= args.sample_batch_size:
+            batch = []
+            batches.append(batch)
+            if key is not None:
+                open_batches[key] = batch
+        batch.append(prompt_dict)
+    return batches
+
+
+def sample_image_batch_inference(
+    accelerator: Accelerator,
+    args: argparse.Namespace,
+    pipeline,
+    save_dir,
+    prompt_dicts: List[dict],
+    epoch,
+    steps,
+    prompt_replacement,
+):
+    r"""
+    Generate the images of a batch from ``group_sample_prompts`` in one pipeline call. Each image gets its own generator
+    seeded with its prompt's seed, so its initial noise and the noise of ancestral samplers are those of
+    ``sample_image_inference``; the images differ from it only by floating point differences of the batched U-Net.
+    """
+    settings = [_batch_sample_settings(args, pipeline, prompt_dict, prompt_replacement) for prompt_dict in prompt_dicts]
+    first = settings[0]
+
+    # the default generator of the device after torch.manual_seed(seed), as used by sample_image_inference
+    device = pipeline._execution_device
+    generator_device = "cpu" if device.type == "mps" else device
+    generators = []
+    for setting in settings:
+        generator = torch.Generator(device=generator_device)
+        if setting["seed"] is not None:
+            generator.manual_seed(setting["seed"])
+        else:
+            generator.seed()  # True random sample image generation
+        generators.append(generator)
+
+    pipeline.scheduler = get_my_scheduler(sample_sampler=first["sample_sampler"], v_parameterization=args.v_parameterization)
+
+    for setting in settings:
+        logger.info(f"prompt: {setting['prompt']}")
+        logger.info(f"negative_prompt: {setting['negative_prompt']}")
+        if setting["seed"] is not None:
+            logger.info(f"seed: {setting['seed']}")
+    logger.info(f"height: {first['height']}")
+    logger.info(f"width: {first['width']}")
+    logger.info(f"sample_steps: {first['sample_steps']}")
+    logger.info(f"scale: {first['scale']}")
+    logger.info(f"sample_sampler: {first['sample_sampler']}")
+    logger.info(f"batch size: {len(settings)}")
+
+    with accelerator.autocast(), torch.no_grad():
+        latents = pipeline(
+            prompt=[setting["prompt"] for setting in settings],
+            height=first["height"],
+            width=first["width"],
+            num_inference_steps=first["sample_steps"],
+            guidance_scale=first["scale"],
+            negative_prompt=[setting["negative_prompt"] or "" for setting in settings],
+            generator=generators,
+        )
+
+    if torch.cuda.is_available():
+        with torch.cuda.device(torch.cuda.current_device()):
+            torch.cuda.empty_cache()
+
+    for i, (prompt_dict, setting) in enumerate(zip(prompt_dicts, settings)):
+        image = pipeline.latents_to_image(latents[i : i + 1])[0]  # one by one as sample_image_inference decodes
+        _save_sample_image(accelerator, args, save_dir, image, prompt_dict, setting["prompt"], setting["seed"], epoch, steps)
+
+
+def _save_sample_image(accelerator: Accelerator, args: argparse.Namespace, save_dir, image, prompt_dict, prompt, seed, epoch, steps):
+    # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
+    # but adding 'enum' to the filename should be enough
+
+    ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+    num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+    seed_suffix = "" if seed is None else f"_{seed}"
+    i: int = prompt_dict["enum"]
+    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
+    image.save(os.path.join(save_dir, img_filename))
+
+    # send images to wandb if enabled
+    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
+        wandb_tracker = accelerator.get_tracker("wandb")
+
+        import wandb
+
+        # not to commit images to avoid inconsistency between training and logging steps
+        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+
 
 def sample_image_inference(
     accelerator: Accelerator,
@@ -482,22 +653,4 @@ def sample_image_inference(
             torch.cuda.empty_cache()
 
     image = pipeline.latents_to_image(latents)[0]
-
-    # adding accelerator.wait_for_everyone() here should sync up and ensure that sample images are saved in the same order as the original prompt list
-    # but adding 'enum' to the filename should be enough
-
-    ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-    num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-    seed_suffix = "" if seed is None else f"_{seed}"
-    i: int = prompt_dict["enum"]
-    img_filename = f"{'' if args.output_name is None else args.output_name + '_'}{num_suffix}_{i:02d}_{ts_str}{seed_suffix}.png"
-    image.save(os.path.join(save_dir, img_filename))
-
-    # send images to wandb if enabled
-    if "wandb" in [tracker.name for tracker in accelerator.trackers]:
-        wandb_tracker = accelerator.get_tracker("wandb")
-
-        import wandb
-
-        # not to commit images to avoid inconsistency between training and logging steps
-        wandb_tracker.log({f"sample_{i}": wandb.Image(image, caption=prompt)}, commit=False)  # positive prompt as a caption
+    _save_sample_image(accelerator, args, save_dir, image, prompt_dict, prompt, seed, epoch, steps)
@@ -684,7 +684,12 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             )
 
             if latents is None:
-                if device.type == "mps":
+                if isinstance(generator, list):
+                    # one generator per image: each image gets the noise of a batch of one generated with its generator
+                    rand_device = "cpu" if device.type == "mps" else device
+                    latents = [torch.randn((1, *shape[1:]), generator=g, device=rand_device, dtype=dtype) for g in generator]
+                    latents = torch.cat(latents).to(device)
+                elif device.type == "mps":
                     # randn does not work reproducibly on mps
                     latents = torch.randn(shape, generator=generator, device="cpu", dtype=dtype).to(device)
                 else:
@@ -1,5 +1,6 @@
 # base class for platform strategies. this file defines the interface for strategies
 
+import functools
 import os
 import re
 from typing import Any, List, Optional, Tuple, Union, Callable
@@ -9,7 +10,7 @@ import torch
 from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextModelWithProjection
 
 
-from library import caching
+from library import cache_manifest, caching, latent_store
 from library.utils import setup_logging
 
 setup_logging()
@@ -386,6 +387,10 @@ class LatentsCachingStrategy:
         self._cache_to_disk = cache_to_disk
         self._batch_size = batch_size
         self.skip_disk_cache_validity_check = skip_disk_cache_validity_check
+        self.cache_writer: Optional[caching.AsyncCacheWriter] = None  # set by new_cache_latents while caching
+        self.batch_sizer: Optional[caching.LatentsBatchSizer] = None  # set by new_cache_latents while caching
+        # kept on the instance: DataLoader workers started with spawn get it with the dataset, not from latent_store
+        self.latents_cache_format = latent_store.LATENTS_CACHE_FORMAT
 
     @classmethod
     def set_strategy(cls, strategy):
@@ -405,6 +410,10 @@ class LatentsCachingStrategy:
     def batch_size(self):
         return self._batch_size
 
+    @property
+    def uses_latent_store(self) -> bool:
+        return self.latents_cache_format == "store"
+
     @property
     def cache_suffix(self):
         raise NotImplementedError
@@ -447,18 +456,36 @@ class LatentsCachingStrategy:
         """
         if not self.cache_to_disk:
             return False
-        if not os.path.exists(npz_path):
-            return False
-        if self.skip_disk_cache_validity_check:
-            return True
 
         expected_latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
 
         # e.g. "_32x64", HxW
         key_reso_suffix = f"_{expected_latents_size[0]}x{expected_latents_size[1]}" if multi_resolution else ""
 
+        if self.uses_latent_store:
+            store = latent_store.store_for(npz_path)
+            key = latent_store.record_key(npz_path)
+            record = store.get(key, key_reso_suffix) or store.get(key, "")  # "" if converted from an old npz
+            if record is None:
+                return False
+            if self.skip_disk_cache_validity_check:
+                return True
+            if flip_aug and "latents_flipped" not in record["arrays"]:
+                return False
+            if apply_alpha_mask and "alpha_mask" not in record["arrays"]:
+                return False
+            return store.is_complete(record)
+
         try:
-            npz = np.load(npz_path)
+            npz_stat = os.stat(npz_path)
+        except FileNotFoundError:
+            return False
+        if self.skip_disk_cache_validity_check:
+            return True
+
+        try:
+            # keys and shapes from the directory manifest, or from the array headers if the file changed since recorded
+            npz = cache_manifest.cached_keys(npz_path, npz_stat)
 
             # In old SD/SDXL npz files, if the actual latents shape does not match the expected shape, it doesn't raise an error as long as "latents" key exists (backward compatibility)
             # In non-SD/SDXL npz files (multi-resolution support), the latents key always has the resolution suffix, and no latents key without suffix exists, so it raises an error if the expected resolution suffix key is not found (this doesn't change the behavior for non-SD/SDXL npz files).
@@ -502,19 +529,20 @@ class LatentsCachingStrategy:
         Returns:
             None
         """
+        # pinned memory lets the upload overlap with the rest of the pipeline (see caching.PIPELINE_DEPTH)
+        pin_memory = torch.device(vae_device).type == "cuda" and caching.PIPELINE_DEPTH > 0
         img_tensor, alpha_masks, original_sizes, crop_ltrbs = caching.load_images_and_masks_for_caching(
-            image_infos, apply_alpha_mask, random_crop
+            image_infos, apply_alpha_mask, random_crop, pin_memory=pin_memory
         )
-        img_tensor = img_tensor.to(device=vae_device, dtype=vae_dtype)
-
-        with torch.no_grad():
-            latents_tensors = encode_by_vae(img_tensor).to("cpu")
-        if flip_aug:
-            img_tensor = torch.flip(img_tensor, dims=[3])
-            with torch.no_grad():
-                flipped_latents = encode_by_vae(img_tensor).to("cpu")
+        img_tensor = img_tensor.to(device=vae_device, dtype=vae_dtype, non_blocking=pin_memory)
+
+        # flipped images are encoded in the same VAE call if the memory budget allows it
+        if self.batch_sizer is not None:
+            latents_tensors, flipped_latents = self.batch_sizer.encode(encode_by_vae, img_tensor, flip_aug, image_infos[0].bucket_reso)
         else:
-            flipped_latents = [None] * len(latents_tensors)
+            latents_tensors, flipped_latents = caching.encode_with_flipped(encode_by_vae, img_tensor, flip_aug)
+        latents_tensors = latents_tensors.to("cpu")
+        flipped_latents = [None] * len(latents_tensors) if flipped_latents is None else flipped_latents.to("cpu")
 
         # for info, latents, flipped_latent, alpha_mask in zip(image_infos, latents_tensors, flipped_latents, alpha_masks):
         for i in range(len(image_infos)):
@@ -529,8 +557,18 @@ class LatentsCachingStrategy:
             key_reso_suffix = f"_{latents_size[0]}x{latents_size[1]}" if multi_resolution else ""  # e.g. "_32x64", HxW
 
             if self.cache_to_disk:
-                self.save_latents_to_disk(
-                    info.latents_npz, latents, original_size, crop_ltrb, flipped_latent, alpha_mask, key_reso_suffix
+                save = self.save_latents_to_disk if self.cache_writer is None else functools.partial(
+                    self.cache_writer.submit, self.save_latents_to_disk
+                )
+                save(
+                    info.latents_npz,
+                    latents,
+                    original_size,
+                    crop_ltrb,
+                    flipped_latent,
+                    alpha_mask,
+                    key_reso_suffix,
+                    image_path=info.absolute_path,
                 )
             else:
                 info.latents_original_size = original_size
@@ -585,6 +623,13 @@ class LatentsCachingStrategy:
             expected_latents_size = (bucket_reso[1] // latents_stride, bucket_reso[0] // latents_stride)  # bucket_reso is (W, H)
             key_reso_suffix = f"_{expected_latents_size[0]}x{expected_latents_size[1]}"  # e.g. "_32x64", HxW
 
+        if self.uses_latent_store:
+            store = latent_store.store_for(npz_path)
+            key = latent_store.record_key(npz_path)
+            if store.get(key, key_reso_suffix, refresh=True) is None and store.get(key, "") is not None:
+                key_reso_suffix = ""  # converted from an old npz without resolution suffix
+            return store.load(key, key_reso_suffix)
+
         npz = np.load(npz_path)
         if "latents" + key_reso_suffix not in npz:
             # raise ValueError(f"latents{key_reso_suffix} not found in {npz_path}")
@@ -614,20 +659,33 @@ class LatentsCachingStrategy:
         flipped_latents_tensor=None,
         alpha_mask=None,
         key_reso_suffix="",
+        image_path=None,
     ):
         """
         Args:
-            npz_path (str): Path to the npz file.
+            npz_path (str): Path to the npz file (its basename is the record key if the latent store is enabled).
             latents_tensor (torch.Tensor): Latent tensor
             original_size (List[int]): Original size of the image
             crop_ltrb (List[int]): Crop left top right bottom
             flipped_latents_tensor (Optional[torch.Tensor]): Flipped latent tensor
             alpha_mask (Optional[torch.Tensor]): Alpha mask
             key_reso_suffix (str): Key resolution suffix
+            image_path (Optional[str]): Source image, whose size and mtime are recorded in the cache manifest
 
         Returns:
             None
         """
+        if self.uses_latent_store:
+            # TODO float() is needed if vae is in bfloat16. Remove it if vae is float16.
+            arrays = {"latents": latents_tensor.float().cpu().numpy()}
+            if flipped_latents_tensor is not None:
+                arrays["latents_flipped"] = flipped_latents_tensor.float().cpu().numpy()
+            if alpha_mask is not None:
+                arrays["alpha_mask"] = alpha_mask.float().cpu().numpy()
+            # appended as a new record: no need to read back what is already cached for other resolutions
+            latent_store.store_for(npz_path).put(latent_store.record_key(npz_path), key_reso_suffix, arrays, original_size, crop_ltrb)
+            return
+
         kwargs = {}
 
         if os.path.exists(npz_path):
@@ -645,3 +703,4 @@ class LatentsCachingStrategy:
         if alpha_mask is not None:
             kwargs["alpha_mask" + key_reso_suffix] = alpha_mask.float().cpu().numpy()
         np.savez(npz_path, **kwargs)
+        cache_manifest.manifest_for(npz_path).record(npz_path, {k: v.shape for k, v in kwargs.items()}, image_path)
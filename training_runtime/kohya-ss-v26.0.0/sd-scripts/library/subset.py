@@ -68,6 +68,8 @@ class BaseSubset:
 
         self.resize_interpolation = resize_interpolation
 
+        self.compiled_captions = {}  # caption -> library.captions.CompiledCaption, filled by the dataset
+
 
 class DreamBoothSubset(BaseSubset):
     def __init__(
@@ -1106,17 +1106,12 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             import library.model_io as model_io
 
-            # Precalculate model hashes to save time on indexing
+            # Precalculate model hashes to save time on indexing, hashing the data while it is written
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = model_io.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            model_io.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
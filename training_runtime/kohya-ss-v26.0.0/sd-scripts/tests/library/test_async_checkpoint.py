@@ -0,0 +1,102 @@
+import os
+import threading
+
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library import model_io
+from library.checkpoint_io import AsyncNetworkSaver
+
+
+def network_state_dict():
+    torch.manual_seed(0)
+    return {f"lora_unet_{i}.lora_down.weight": torch.randn(4, 64) for i in range(8)} | {"lora_unet_0.alpha": torch.tensor(2.0)}
+
+
+def test_saves_a_snapshot_with_hashes(tmp_path):
+    state_dict = network_state_dict()
+    expected = {k: v.to(torch.bfloat16) for k, v in state_dict.items()}
+    file = str(tmp_path / "at-step00000010.safetensors")
+
+    saver = AsyncNetworkSaver()
+    saver.submit(state_dict, torch.bfloat16, file, {"ss_steps": "10"}, steps=10, epoch=1)
+    for v in state_dict.values():
+        v.zero_()  # training goes on: the snapshot is already taken
+    saver.close()
+    assert os.listdir(tmp_path) == ["at-step00000010.safetensors"]  # the temporary file is renamed
+
+    loaded = load_file(file)
+    assert all(torch.equal(loaded[k], v) for k, v in expected.items())
+    with safe_open(file, framework="pt") as f:
+        metadata = f.metadata()
+    assert (metadata["sshs_model_hash"], metadata["sshs_legacy_hash"]) == model_io.precalculate_safetensors_hashes(
+        expected, {"ss_steps": "10"}
+    )
+
+    (logs,) = saver.completed()
+    assert logs["checkpoint/steps"] == 10 and logs["checkpoint/epoch"] == 1 and logs["checkpoint/pending_saves"] == 0
+    assert logs["checkpoint/save_seconds"] >= 0 and saver.completed() == []
+
+
+def test_pending_saves_are_bounded_and_run_in_order(tmp_path):
+    release = threading.Event()
+    events = []
+    saver = AsyncNetworkSaver(max_pending=2)
+    saver.enqueue(release.wait)
+
+    state_dict = network_state_dict()
+    files = [str(tmp_path / f"{i}.safetensors") for i in range(3)]
+    saver.submit(state_dict, None, files[0], None, steps=1, epoch=1, after_save=lambda: events.append("saved 0"))
+    saver.enqueue(lambda: events.append(f"remove, 0 exists: {os.path.exists(files[0])}"))
+    saver.submit(state_dict, None, files[1], None, steps=2, epoch=1)
+
+    third = threading.Thread(target=saver.submit, args=(state_dict, None, files[2], None, 3, 1))
+    third.start()
+    third.join(timeout=0.5)
+    assert third.is_alive()  # two saves pending: training waits
+
+    release.set()
+    third.join()
+    saver.close()
+    assert events == ["saved 0", "remove, 0 exists: True"]
+    assert all(os.path.exists(file) for file in files)
+    assert [logs["checkpoint/steps"] for logs in saver.completed()] == [1, 2, 3]
+
+
+def test_failed_save_is_raised(tmp_path):
+    saver = AsyncNetworkSaver()
+    saver.submit(network_state_dict(), None, str(tmp_path / "missing" / "a.safetensors"), None, steps=1, epoch=1)
+    with pytest.raises(RuntimeError) as e:
+        saver.close()
+    assert isinstance(e.value.__cause__, OSError)
+
+
+def test_cut_off_save_leaves_no_checkpoint(tmp_path, monkeypatch):
+    def save_part(state_dict, file, metadata):
+        with open(file, "wb") as f:
+            f.write(b"partial header")
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(model_io, "save_safetensors_with_hashes", save_part)
+    saver = AsyncNetworkSaver()
+    saver.submit(network_state_dict(), None, str(tmp_path / "a.safetensors"), None, steps=1, epoch=1)
+    with pytest.raises(RuntimeError):
+        saver.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_interrupted_training_finishes_the_saves(tmp_path):
+    from train_network import NetworkTrainer
+
+    trainer = NetworkTrainer()
+    trainer._checkpoint_saver = AsyncNetworkSaver()
+    release = threading.Event()
+    trainer._checkpoint_saver.enqueue(release.wait)
+    trainer._checkpoint_saver.submit(network_state_dict(), None, str(tmp_path / "a.safetensors"), None, steps=1, epoch=1)
+    trainer._checkpoint_saver.submit(network_state_dict(), None, str(tmp_path / "missing" / "b.safetensors"), None, steps=2, epoch=1)
+    threading.Timer(0.2, release.set).start()
+
+    trainer._close_checkpoint_saver_on_error()  # waits; the failure of the second save is logged, not raised
+    assert os.listdir(tmp_path) == ["a.safetensors"] and trainer._checkpoint_saver is None
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pytest
+
+from library import cache_manifest
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    cache_manifest._MANIFESTS.clear()
+    yield
+    for manifest in cache_manifest._MANIFESTS.values():
+        manifest.close()
+    cache_manifest._MANIFESTS.clear()
+
+
+def write_cache(tmp_path, name="a_0048x0064_sdxl.npz", flipped=True):
+    npz_path = str(tmp_path / name)
+    arrays = {
+        "latents_8x6": np.zeros((4, 8, 6), dtype=np.float32),
+        "original_size_8x6": np.array([48, 64]),
+        "crop_ltrb_8x6": np.array([0, 0, 48, 64]),
+    }
+    if flipped:
+        arrays["latents_flipped_8x6"] = np.zeros((4, 8, 6), dtype=np.float32)
+    np.savez(npz_path, **arrays)
+    return npz_path
+
+
+def test_npz_keys_lists_the_arrays(tmp_path):
+    npz_path = write_cache(tmp_path)
+    assert cache_manifest.npz_keys(npz_path) == {
+        "latents_8x6": None,
+        "original_size_8x6": None,
+        "crop_ltrb_8x6": None,
+        "latents_flipped_8x6": None,
+    }
+
+
+def test_unchanged_files_are_answered_from_the_manifest(tmp_path, monkeypatch):
+    npz_path = write_cache(tmp_path)
+    image_path = tmp_path / "a.png"
+    image_path.write_bytes(b"png")
+    shapes = {"latents_8x6": (4, 8, 6), "latents_flipped_8x6": (4, 8, 6)}
+    cache_manifest.manifest_for(npz_path).record(npz_path, shapes, str(image_path))
+
+    cache_manifest._MANIFESTS.clear()  # as in the next training run
+    monkeypatch.setattr(cache_manifest, "npz_keys", lambda path: pytest.fail("cache file was opened"))
+    keys = cache_manifest.cached_keys(npz_path, os.stat(npz_path))
+    assert "latents_flipped_8x6" in keys and keys["latents_8x6"] == [4, 8, 6]
+
+
+def test_changed_cache_file_or_image_falls_back_to_the_file(tmp_path):
+    npz_path = write_cache(tmp_path)
+    image_path = tmp_path / "a.png"
+    image_path.write_bytes(b"png")
+    manifest = cache_manifest.manifest_for(npz_path)
+    manifest.record(npz_path, cache_manifest.npz_keys(npz_path), str(image_path))
+
+    write_cache(tmp_path, flipped=False)  # re-cached by another tool
+    assert manifest.lookup(npz_path, os.stat(npz_path)) is None
+    keys = cache_manifest.cached_keys(npz_path, os.stat(npz_path))
+    assert "latents_flipped_8x6" not in keys
+    assert manifest.lookup(npz_path, os.stat(npz_path)) == keys
+
+    image_path.write_bytes(b"edited png")
+    assert manifest.lookup(npz_path, os.stat(npz_path)) is None
+    cache_manifest.cached_keys(npz_path, os.stat(npz_path))
+    assert manifest.entries[os.path.basename(npz_path)]["image"]["path"] == str(image_path)
+    assert manifest.lookup(npz_path, os.stat(npz_path)) == keys
+
+    image_path.unlink()  # fine tuning on caches only
+    assert manifest.lookup(npz_path, os.stat(npz_path)) == keys
+
+
+def test_torn_manifest_line_is_ignored(tmp_path):
+    npz_path = write_cache(tmp_path)
+    cache_manifest.cached_keys(npz_path, os.stat(npz_path))
+    cache_manifest.manifest_for(npz_path).close()
+    with open(tmp_path / "_latents_manifest-0.jsonl", "ab") as f:
+        f.write(b'{"name": "b.npz", "st')
+
+    cache_manifest._MANIFESTS.clear()
+    manifest = cache_manifest.manifest_for(npz_path)
+    assert list(manifest.entries) == [os.path.basename(npz_path)]
+
+
+def test_unwritable_manifest_keeps_the_entries_in_memory(tmp_path, monkeypatch):
+    npz_path = write_cache(tmp_path)
+    manifest = cache_manifest.manifest_for(npz_path)
+    real_open = open
+
+    def read_only_open(path, mode="r", *args, **kwargs):
+        if "r" not in mode:
+            raise PermissionError(13, "Read-only file system", path)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", read_only_open)
+    keys = cache_manifest.cached_keys(npz_path, os.stat(npz_path))
+    assert not manifest.writable and manifest.lookup(npz_path, os.stat(npz_path)) == keys
+
+    monkeypatch.setattr(cache_manifest, "npz_keys", lambda path: pytest.fail("cache file was opened"))
+    assert cache_manifest.cached_keys(npz_path, os.stat(npz_path)) == keys
+    assert not os.path.exists(manifest.path)
+
+
+def test_superseded_entries_are_compacted(tmp_path):
+    npz_paths = [write_cache(tmp_path, f"{name}_0048x0064_sdxl.npz") for name in "abc"]
+    manifest = cache_manifest.manifest_for(npz_paths[0])
+    for _ in range(5):  # re-cached in five runs
+        for npz_path in npz_paths:
+            manifest.record(npz_path, {"latents_8x6": (4, 8, 6)})
+    manifest.close()
+
+    with open(manifest.path, "rb") as f:
+        assert len(f.readlines()) <= 2 * len(npz_paths)
+    cache_manifest._MANIFESTS.clear()
+    reloaded = cache_manifest.manifest_for(npz_paths[0])
+    assert reloaded.entries == manifest.entries
+    for npz_path in npz_paths:
+        assert reloaded.lookup(npz_path, os.stat(npz_path)) == {"latents_8x6": [4, 8, 6]}
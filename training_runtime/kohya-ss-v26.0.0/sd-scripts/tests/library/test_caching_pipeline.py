@@ -0,0 +1,179 @@
+import threading
+from dataclasses import asdict
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from library import caching
+from library.config_util import DreamBoothDatasetParams, DreamBoothSubsetParams
+from library.dreambooth_dataset import DreamBoothDataset
+from library.strategy_base import LatentsCachingStrategy
+from library.subset import DreamBoothSubset
+from library.caching import AsyncCacheWriter, LatentsBatchSizer, encode_with_flipped
+
+
+def test_writes_run_in_order_on_one_background_thread():
+    written = []
+    threads = set()
+
+    def write(i, suffix=""):
+        threads.add(threading.get_ident())
+        written.append(f"{i}{suffix}")
+
+    writer = AsyncCacheWriter(max_pending=2)
+    for i in range(50):
+        writer.submit(write, i, suffix="!")
+    writer.close()
+    assert written == [f"{i}!" for i in range(50)]
+    assert len(threads) == 1 and threading.get_ident() not in threads
+
+
+def test_failed_write_is_raised_and_stops_the_writer():
+    written = []
+    release = threading.Event()
+
+    def write(i):
+        if i == 1:
+            release.wait()
+            raise OSError("disk full")
+        written.append(i)
+
+    writer = AsyncCacheWriter()
+    for i in range(4):
+        writer.submit(write, i)
+    release.set()
+    with pytest.raises(RuntimeError) as e:
+        writer.close()
+    assert isinstance(e.value.__cause__, OSError)
+    assert written == [0]
+
+
+class RecordingVAE(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.conv = torch.nn.Conv2d(3, 4, 8, stride=8)
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(x.shape[0])
+        return self.conv(x)
+
+
+@pytest.mark.parametrize("max_batch_size, batch_sizes", [(8, [8]), (3, [3, 1, 3, 1]), (None, [4, 4])])
+def test_flipped_images_are_encoded_in_the_same_batch(max_batch_size, batch_sizes):
+    vae = RecordingVAE()
+    img_tensor = torch.rand(4, 3, 32, 48) * 2 - 1
+    with torch.no_grad():
+        expected = vae(img_tensor), vae(torch.flip(img_tensor, dims=[3]))
+    vae.batch_sizes.clear()
+
+    latents, flipped_latents = encode_with_flipped(vae, img_tensor, True, max_batch_size=max_batch_size)
+    assert vae.batch_sizes == batch_sizes  # None: the images and the flipped images are encoded separately
+    assert torch.allclose(latents, expected[0], atol=1e-6)
+    assert torch.allclose(flipped_latents, expected[1], atol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "memory_budget_mb, device, max_batch_size", [(None, "meta", 4), (8192, "meta", 8), (8192, "cpu", 4)]
+)
+def test_flipped_images_share_a_vae_call_only_within_a_memory_budget(monkeypatch, memory_budget_mb, device, max_batch_size):
+    calls = []
+    monkeypatch.setattr(caching, "encode_with_flipped", lambda encode_by_vae, img_tensor, flip_aug, size: calls.append(size))
+    sizer = LatentsBatchSizer(4, memory_budget_mb=memory_budget_mb)
+    sizer.encode(None, torch.empty(4, 3, 16, 16, device=device), True, (16, 16))
+    assert calls == [max_batch_size]
+
+
+def test_without_flip_aug_the_batch_is_encoded_once():
+    vae = RecordingVAE()
+    latents, flipped_latents = encode_with_flipped(vae, torch.zeros(2, 3, 16, 16), False)
+    assert vae.batch_sizes == [2] and latents.shape == (2, 4, 2, 2) and flipped_latents is None
+
+
+def test_batch_size_follows_the_memory_budget():
+    assert LatentsBatchSizer(4).batch_size((2048, 2048), True) == 4  # no budget: vae_batch_size
+
+    sizer = LatentsBatchSizer(4, memory_budget_mb=8192, vae_dtype=torch.float16)
+    assert sizer.batch_size((512, 512), False) == 16
+    assert sizer.batch_size((512, 512), True) == 8
+    assert sizer.batch_size((1024, 1024), False) == 4
+    assert sizer.batch_size((4096, 4096), False) == 1
+    assert sizer.batch_size((64, 64), False) == 64  # capped
+    assert LatentsBatchSizer(4, memory_budget_mb=8192, vae_dtype=torch.float32).batch_size((512, 512), False) == 8
+
+
+def test_out_of_memory_halves_the_images_per_vae_call():
+    vae = RecordingVAE()
+    limit = 3
+
+    def encode_by_vae(img_tensor):
+        if img_tensor.shape[0] > limit:
+            raise torch.cuda.OutOfMemoryError("out of memory")
+        return vae(img_tensor)
+
+    sizer = LatentsBatchSizer(4)
+    img_tensor = torch.rand(4, 3, 16, 16)
+    latents, flipped_latents = sizer.encode(encode_by_vae, img_tensor, True, (16, 16))
+    assert vae.batch_sizes == [2, 2, 2, 2]  # 8 failed, then 4
+    assert sizer.encode_limits == {(16, 16): 2}
+    assert latents.shape == flipped_latents.shape == (4, 4, 2, 2)
+
+    vae.batch_sizes.clear()
+    sizer.encode(encode_by_vae, img_tensor, True, (16, 16))
+    assert vae.batch_sizes == [2, 2, 2, 2]  # no retry for later batches of the bucket
+
+    limit = 0
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        sizer.encode(encode_by_vae, img_tensor[:1], False, (8, 8))
+
+
+class FailingCachingStrategy:
+    """Writes of the first batch fail in the background; encoding the second batch fails on the caching thread."""
+
+    cache_to_disk = True
+    batch_size = 1
+
+    def __init__(self):
+        self.batch_sizer = None
+        self.cache_writer = None
+        self.write_failed = threading.Event()
+        self.batches = 0
+
+    def get_latents_npz_path(self, absolute_path, image_size):
+        return absolute_path + ".npz"
+
+    def is_disk_cached_latents_expected(self, bucket_reso, npz_path, flip_aug, alpha_mask):
+        return False
+
+    def cache_batch_latents(self, model, batch, flip_aug, alpha_mask, random_crop):
+        self.batches += 1
+        if self.batches == 1:
+            def write():
+                self.write_failed.set()
+                raise OSError("disk full")
+
+            self.cache_writer.submit(write)
+            return
+        self.write_failed.wait(10)
+        raise ValueError("encode failed")
+
+
+def test_encode_error_is_kept_when_the_writer_also_failed(tmp_path, monkeypatch, caplog):
+    for i in range(4):
+        Image.new("RGB", (64, 64)).save(tmp_path / f"{i}.png")
+    subset_params = DreamBoothSubsetParams(image_dir=str(tmp_path), caption_separator=",", keep_tokens_separator="")
+    dataset = DreamBoothDataset(
+        subsets=[DreamBoothSubset(**asdict(subset_params))], is_training_dataset=True, **asdict(DreamBoothDatasetParams(resolution=(64, 64)))
+    )
+    dataset.make_buckets()
+    strategy = FailingCachingStrategy()
+    monkeypatch.setattr(LatentsCachingStrategy, "_strategy", strategy)
+
+    accelerator = SimpleNamespace(num_processes=1, process_index=0, device=torch.device("cpu"))
+    with pytest.raises(ValueError, match="encode failed"):
+        dataset.new_cache_latents(torch.nn.Identity(), accelerator)
+    assert "failed to write latents cache" in caplog.text
+    assert strategy.cache_writer is None and strategy.batch_sizer is None
@@ -0,0 +1,158 @@
+import math
+import random
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from library import captions
+from library.dataset import BaseDataset
+
+
+def parse_caption(dataset, subset, caption):
+    """process_caption as it was before the captions were compiled."""
+    if subset.caption_prefix:
+        caption = subset.caption_prefix + " " + caption
+    if subset.caption_suffix:
+        caption = caption + " " + subset.caption_suffix
+
+    is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
+    is_drop_out = (
+        is_drop_out or subset.caption_dropout_every_n_epochs > 0 and dataset.current_epoch % subset.caption_dropout_every_n_epochs == 0
+    )
+
+    if is_drop_out:
+        caption = ""
+    else:
+        if subset.enable_wildcard:
+            if "\n" in caption:
+                caption = random.choice(caption.split("\n"))
+            replacer1 = "⦅"
+            replacer2 = "⦆"
+            while replacer1 in caption or replacer2 in caption:
+                replacer1 += "⦅"
+                replacer2 += "⦆"
+            caption = caption.replace("{{", replacer1).replace("}}", replacer2)
+            caption = re.sub(r"\{([^}]+)\}", lambda match: random.choice(match.group(1).split("|")), caption)
+            caption = caption.replace(replacer1, "{").replace(replacer2, "}")
+        else:
+            caption = caption.split("\n")[0]
+
+        if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
+            fixed_tokens = []
+            flex_tokens = []
+            fixed_suffix_tokens = []
+            if subset.keep_tokens_separator and subset.keep_tokens_separator in caption:
+                fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
+                if subset.keep_tokens_separator in flex_part:
+                    flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
+                    fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
+                fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
+                flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+            else:
+                tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
+                flex_tokens = tokens[:]
+                if subset.keep_tokens > 0:
+                    fixed_tokens = flex_tokens[: subset.keep_tokens]
+                    flex_tokens = tokens[subset.keep_tokens :]
+
+            if subset.token_warmup_step < 1:
+                subset.token_warmup_step = math.floor(subset.token_warmup_step * dataset.max_train_steps)
+            if subset.token_warmup_step and dataset.current_step < subset.token_warmup_step:
+                tokens_len = (
+                    math.floor(dataset.current_step * ((len(flex_tokens) - subset.token_warmup_min) / subset.token_warmup_step))
+                    + subset.token_warmup_min
+                )
+                flex_tokens = flex_tokens[:tokens_len]
+
+            if subset.shuffle_caption:
+                random.shuffle(flex_tokens)
+            if subset.caption_tag_dropout_rate > 0:
+                flex_tokens = [t for t in flex_tokens if random.random() >= subset.caption_tag_dropout_rate]
+            caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
+
+        if subset.secondary_separator:
+            caption = caption.replace(subset.secondary_separator, subset.caption_separator)
+
+        for str_from, str_to in dataset.replacements.items():
+            if str_from == "":
+                caption = random.choice(str_to) if type(str_to) == list else str_to
+            else:
+                caption = caption.replace(str_from, str_to)
+
+    return caption
+
+
+WORDS = ["1girl", " solo ", "long hair", "", "  ", "{{", "}}", "{a|b}", "{red| blue |green}", "{x}", "{ |y}", "{a,b|c}", "⦅", "|||", ";", "\n", "{p|q;r}"]
+
+
+def random_caption(rng):
+    separators = rng.choice([",", ",", ";"])
+    return separators.join(rng.choice(WORDS) + rng.choice(["", " ", "{1|2}"]) for _ in range(rng.randint(0, 12)))
+
+
+def random_subset(rng):
+    return SimpleNamespace(
+        caption_prefix=rng.choice([None, "", "masterpiece, {best|good}"]),
+        caption_suffix=rng.choice([None, "trigger |||end"]),
+        caption_dropout_rate=rng.choice([0.0, 0.2]),
+        caption_dropout_every_n_epochs=rng.choice([0, 3]),
+        enable_wildcard=rng.random() < 0.7,
+        shuffle_caption=rng.random() < 0.7,
+        token_warmup_step=rng.choice([0, 0, 40, 0.5]),
+        token_warmup_min=rng.choice([1, 2]),
+        caption_tag_dropout_rate=rng.choice([0.0, 0.3]),
+        keep_tokens_separator=rng.choice([None, "|||"]),
+        caption_separator=rng.choice([",", ",", ";"]),
+        keep_tokens=rng.choice([0, 0, 2]),
+        secondary_separator=rng.choice([None, ";;;"]),
+        compiled_captions={},
+    )
+
+
+def test_compiled_captions_match_parsing():
+    rng = random.Random(0)
+    for trial in range(400):
+        subset = random_subset(rng)
+        reference_subset = SimpleNamespace(**vars(subset))
+        caption_texts = [random_caption(rng) for _ in range(5)]
+        dataset = SimpleNamespace(
+            current_epoch=rng.randint(0, 5),
+            current_step=rng.randint(0, 60),
+            max_train_steps=100,
+            replacements=rng.choice([{}, {"solo": "duo"}]),
+            image_data={str(i): SimpleNamespace(caption=c) for i, c in enumerate(caption_texts)},
+            image_to_subset={str(i): subset for i in range(len(caption_texts))},
+        )
+        BaseDataset.compile_captions(dataset)
+        for seed in range(4):
+            for caption in caption_texts:
+                random.seed(trial * 100 + seed)
+                expected = parse_caption(dataset, reference_subset, caption)
+                expected_state = random.getstate()
+                random.seed(trial * 100 + seed)
+                assert BaseDataset.process_caption(dataset, subset, caption) == expected, (vars(subset), caption)
+                assert random.getstate() == expected_state
+
+
+@pytest.mark.parametrize(
+    "caption, wildcards, templates",
+    [
+        ("a, b, c", (), ()),
+        ("a, {b|c} d, e", (("b", "c"),), ((1, "{0} d"),)),
+        ("a, {{x}} {b|c}, {d|e}", (("b", "c"), ("d", "e")), ((1, "{{x}} {0}"), (2, "{1}"))),
+        ("a, {{b}}, {c|d,e}", (("c", "d,e"),), None),  # the alternative holds the separator: split per sample
+        ("⦅ {b|c}", None, None),  # escape character in the caption: parsed per sample
+    ],
+)
+def test_compiled_structure(caption, wildcards, templates):
+    subset = SimpleNamespace(
+        caption_prefix=None, caption_suffix=None, enable_wildcard=True, caption_separator=",", keep_tokens_separator=None, keep_tokens=1
+    )
+    (line,) = captions.compile_caption(subset, caption).lines
+    assert line.wildcards == wildcards
+    if templates is None:
+        assert line.tags is None
+    else:
+        assert line.templates == templates
+        assert (len(line.tags), line.fixed_end, line.suffix_start) == (3, 1, 3)
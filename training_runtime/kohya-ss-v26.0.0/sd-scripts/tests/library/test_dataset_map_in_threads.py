@@ -0,0 +1,38 @@
+import threading
+import time
+
+import pytest
+
+from library.dataset import map_in_threads
+
+
+def test_results_keep_input_order():
+    def slow_square(x):
+        time.sleep(0.001 * (x % 3))
+        return x * x
+
+    assert map_in_threads(slow_square, list(range(200))) == [x * x for x in range(200)]
+
+
+def test_first_failing_item_in_order_is_raised_and_the_rest_is_not_started():
+    started = []
+
+    def probe(x):
+        started.append(x)
+        if x == 120:
+            time.sleep(0.05)
+            raise ValueError(x)
+        if x == 130:
+            raise KeyError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        map_in_threads(probe, list(range(10000)))
+    assert len(started) < 1000
+
+
+def test_workers_are_shared_between_local_processes(monkeypatch):
+    monkeypatch.setenv("LOCAL_WORLD_SIZE", "1000")
+    threads = set()
+    map_in_threads(lambda x: threads.add(threading.get_ident()), list(range(50)))
+    assert threads == {threading.get_ident()}
@@ -0,0 +1,181 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import torch
+
+from library import latent_store
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry():
+    latent_store._STORES.clear()
+    yield
+    for store in latent_store._STORES.values():
+        store.close()
+    latent_store._STORES.clear()
+
+
+def sample_arrays(seed, h=8, w=6, alpha=False):
+    rng = np.random.default_rng(seed)
+    arrays = {
+        "latents": rng.standard_normal((4, h, w), dtype=np.float32),
+        "latents_flipped": rng.standard_normal((4, h, w), dtype=np.float32),
+    }
+    if alpha:
+        arrays["alpha_mask"] = rng.random((h * 8, w * 8), dtype=np.float32)
+    return arrays
+
+
+def test_records_round_trip_from_aligned_shards(tmp_path):
+    npz_path = str(tmp_path / "a_0048x0064_sdxl.npz")
+    store = latent_store.store_for(npz_path)
+    arrays = sample_arrays(0, alpha=True)
+    store.put(latent_store.record_key(npz_path), "_8x6", arrays, (48, 64), (0, 0, 48, 64))
+    store.put(latent_store.record_key(npz_path), "_4x3", sample_arrays(1, 4, 3), (48, 64), (0, 0, 48, 64))
+
+    latents, original_size, crop_ltrb, flipped, alpha_mask = store.load("a_0048x0064_sdxl.npz", "_8x6")
+    np.testing.assert_array_equal(latents, arrays["latents"])
+    np.testing.assert_array_equal(flipped, arrays["latents_flipped"])
+    np.testing.assert_array_equal(alpha_mask, arrays["alpha_mask"])
+    assert original_size == [48, 64] and crop_ltrb == [0, 0, 48, 64]
+    assert latents.flags.writeable
+
+    record = store.get("a_0048x0064_sdxl.npz", "_8x6")
+    assert all(offset % latent_store.ALIGNMENT == 0 for offset, _, _ in record["arrays"].values())
+    assert sorted(os.listdir(store.root)) == ["4x3-0.bin", "8x6-0.bin", "index-0.jsonl"]
+
+    # a fresh process sees the same records from the index
+    latent_store._STORES.clear()
+    reopened = latent_store.store_for(npz_path)
+    assert reopened.is_complete(reopened.get("a_0048x0064_sdxl.npz", "_4x3"))
+    assert reopened.load("a_0048x0064_sdxl.npz", "_4x3")[3].shape == (4, 4, 3)
+
+
+def test_recaching_appends_a_superseding_record(tmp_path):
+    store = latent_store.store_for(str(tmp_path / "a.npz"))
+    store.put("a.npz", "_8x6", sample_arrays(0), (48, 64), (0, 0, 48, 64))
+    newer = sample_arrays(1)
+    store.put("a.npz", "_8x6", newer, (40, 64), (4, 0, 44, 64))
+
+    latent_store._STORES.clear()
+    latents, original_size, _, _, _ = latent_store.store_for(str(tmp_path / "a.npz")).load("a.npz", "_8x6")
+    np.testing.assert_array_equal(latents, newer["latents"])
+    assert original_size == [40, 64]
+
+
+def test_records_of_other_writers_are_found_after_a_miss(tmp_path):
+    reader = latent_store.store_for(str(tmp_path / "a.npz"))
+    assert reader.get("b.npz", "_8x6") is None
+
+    writer = latent_store.LatentStore(reader.root)
+    with patch.dict(os.environ, {"RANK": "1"}):
+        writer.put("b.npz", "_8x6", sample_arrays(2), (48, 64), (0, 0, 48, 64))
+    writer.close()
+
+    assert os.path.exists(os.path.join(reader.root, "index-1.jsonl"))
+    assert reader.get("b.npz", "_8x6") is None
+    assert reader.get("b.npz", "_8x6", refresh=True) is not None
+    assert reader.load("b.npz", "_8x6")[0].shape == (4, 8, 6)
+
+
+def test_torn_index_line_and_truncated_shard_are_not_served(tmp_path):
+    store = latent_store.store_for(str(tmp_path / "a.npz"))
+    store.put("a.npz", "_8x6", sample_arrays(0), (48, 64), (0, 0, 48, 64))
+    store.close()
+    with open(os.path.join(store.root, "index-0.jsonl"), "ab") as f:
+        f.write(b'{"key": "b.npz", "suf')
+    with open(os.path.join(store.root, "8x6-0.bin"), "r+b") as f:
+        f.truncate(100)
+
+    latent_store._STORES.clear()
+    reopened = latent_store.store_for(str(tmp_path / "a.npz"))
+    assert reopened.get("b.npz", "_8x6") is None
+    assert not reopened.is_complete(reopened.get("a.npz", "_8x6"))
+
+
+def test_npz_caches_are_converted_per_resolution(tmp_path):
+    arrays = sample_arrays(0)
+    np.savez(
+        tmp_path / "new_0048x0064_sdxl.npz",
+        latents_8x6=arrays["latents"],
+        latents_flipped_8x6=arrays["latents_flipped"],
+        original_size_8x6=np.array([48, 64]),
+        crop_ltrb_8x6=np.array([0, 0, 48, 64]),
+        latents_4x3=arrays["latents"][:, :4, :3],
+        original_size_4x3=np.array([24, 32]),
+        crop_ltrb_4x3=np.array([0, 0, 24, 32]),
+    )
+    np.savez(
+        tmp_path / "old_0048x0064_sdxl.npz",
+        latents=arrays["latents"],
+        original_size=np.array([48, 64]),
+        crop_ltrb=np.array([0, 0, 48, 64]),
+    )
+    np.savez(tmp_path / "caption_te_outputs.npz", hidden_state=np.zeros(3))
+
+    converted = latent_store.convert_npz_directory(str(tmp_path), "_sdxl.npz", remove_npz=True)
+
+    assert converted == 2
+    assert sorted(os.listdir(tmp_path)) == ["_latent_store", "caption_te_outputs.npz"]
+    store = latent_store.store_for(str(tmp_path / "new_0048x0064_sdxl.npz"))
+    np.testing.assert_array_equal(store.load("new_0048x0064_sdxl.npz", "_8x6")[3], arrays["latents_flipped"])
+    assert store.load("new_0048x0064_sdxl.npz", "_4x3")[1] == [24, 32]
+    assert store.get("old_0048x0064_sdxl.npz", "") is not None
+    assert latent_store.cached_paths(str(tmp_path), "_sdxl.npz") == [
+        str(tmp_path / "new_0048x0064_sdxl.npz"),
+        str(tmp_path / "old_0048x0064_sdxl.npz"),
+    ]
+
+
+def test_cache_format_flag():
+    try:
+        latent_store.set_latents_cache_format("store")
+        assert latent_store.is_enabled()
+        with pytest.raises(ValueError):
+            latent_store.set_latents_cache_format("zip")
+    finally:
+        latent_store.set_latents_cache_format(None)
+    assert not latent_store.is_enabled()
+
+
+class StrategyLatentsDataset(torch.utils.data.Dataset):
+    """Loads latents like ``BaseDataset.__getitem__``: through the dataset's latents caching strategy."""
+
+    def __init__(self, strategy, npz_paths, bucket_reso):
+        self.strategy = strategy
+        self.npz_paths = npz_paths
+        self.bucket_reso = bucket_reso
+
+    def __len__(self):
+        return len(self.npz_paths)
+
+    def __getitem__(self, index):
+        latents, _, _, _, _ = self.strategy.load_latents_from_disk(self.npz_paths[index], self.bucket_reso)
+        return torch.from_numpy(np.array(latents))
+
+
+def test_spawned_workers_load_from_the_store(tmp_path):
+    from library.strategy_sd import SdSdxlLatentsCachingStrategy
+
+    try:
+        latent_store.set_latents_cache_format("store")
+        strategy = SdSdxlLatentsCachingStrategy(False, True, 1, False)
+    finally:
+        latent_store.set_latents_cache_format(None)
+    assert strategy.uses_latent_store and not latent_store.is_enabled()
+
+    npz_paths = [str(tmp_path / f"image{i}_0048x0064_sdxl.npz") for i in range(4)]
+    expected = []
+    for i, npz_path in enumerate(npz_paths):
+        arrays = sample_arrays(i)
+        strategy.save_latents_to_disk(npz_path, torch.from_numpy(arrays["latents"]), (48, 64), (0, 0, 48, 64), key_reso_suffix="_8x6")
+        expected.append(arrays["latents"])
+    assert not any(os.path.exists(npz_path) for npz_path in npz_paths)
+
+    # spawned workers import latent_store afresh, with the npz default; the strategy comes with the dataset
+    dataset = StrategyLatentsDataset(strategy, npz_paths, (48, 64))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2, num_workers=2, multiprocessing_context="spawn")
+    loaded = torch.cat(list(loader))
+    np.testing.assert_array_equal(loaded.numpy(), np.stack(expected))
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import stat
+from dataclasses import asdict
+
+from PIL import Image
+
+from library import metadata_index
+from library.config_util import DreamBoothDatasetParams, DreamBoothSubsetParams
+from library.dreambooth_dataset import DreamBoothDataset
+from library.subset import DreamBoothSubset
+from library.metadata_index import SubsetMetadataIndex
+
+
+def candidates(img_path):
+    return [os.path.splitext(img_path)[0] + ".txt"]
+
+
+class CaptionReader:
+    def __init__(self):
+        self.read = []
+
+    def __call__(self, img_path):
+        self.read.append(os.path.basename(img_path))
+        cap_path = candidates(img_path)[0]
+        if not os.path.isfile(cap_path):
+            return None
+        with open(cap_path, encoding="utf-8") as f:
+            return f.readline().strip()
+
+
+def write_image(tmp_path, name, data=b"image", caption=None):
+    path = tmp_path / name
+    path.write_bytes(data)
+    if caption is not None:
+        (tmp_path / (os.path.splitext(name)[0] + ".txt")).write_text(caption, encoding="utf-8")
+    return str(path)
+
+
+def scan(tmp_path, img_paths, reader, options=".txt|False"):
+    return SubsetMetadataIndex(str(tmp_path)).scan(img_paths, options, candidates, reader)
+
+
+def test_second_scan_reuses_sizes_and_captions(tmp_path):
+    img_paths = [write_image(tmp_path, "a.png", caption="a cat"), write_image(tmp_path, "b.png")]
+    reader = CaptionReader()
+    captions, sizes = scan(tmp_path, img_paths, reader)
+    assert captions == ["a cat", None] and sizes == [None, None]
+    assert reader.read == ["a.png"]  # no caption file, nothing to read
+    SubsetMetadataIndex(str(tmp_path)).record_sizes({img_paths[0]: (64, 48), img_paths[1]: (32, 32)})
+
+    reader = CaptionReader()
+    captions, sizes = scan(tmp_path, img_paths, reader)
+    assert captions == ["a cat", None] and sizes == [(64, 48), (32, 32)]
+    assert reader.read == []
+
+
+def test_changed_files_are_read_again(tmp_path):
+    img_paths = [write_image(tmp_path, "a.png", caption="a cat"), write_image(tmp_path, "b.png", caption="a dog")]
+    scan(tmp_path, img_paths, CaptionReader())
+    SubsetMetadataIndex(str(tmp_path)).record_sizes({img_paths[0]: (64, 48), img_paths[1]: (32, 32)})
+
+    write_image(tmp_path, "a.png", data=b"a larger image")
+    (tmp_path / "b.txt").write_text("a black dog", encoding="utf-8")
+    reader = CaptionReader()
+    captions, sizes = scan(tmp_path, img_paths, reader)
+    assert captions == ["a cat", "a black dog"] and sizes == [None, (32, 32)]
+    assert reader.read == ["b.png"]
+
+    reader = CaptionReader()
+    assert scan(tmp_path, img_paths, reader, options=".txt|True")[0] == ["a cat", "a black dog"]
+    assert reader.read == ["a.png", "b.png"]
+
+
+def test_removed_images_are_dropped(tmp_path):
+    img_paths = [write_image(tmp_path, "a.png", caption="a cat"), write_image(tmp_path, "b.png")]
+    scan(tmp_path, img_paths, CaptionReader())
+    scan(tmp_path, img_paths[1:], CaptionReader())
+
+    with sqlite3.connect(str(tmp_path / metadata_index.INDEX_FILE_NAME)) as connection:
+        rows = connection.execute("SELECT path, caption FROM images").fetchall()
+    assert rows == [("b.png", None)]
+
+
+def test_sizes_of_other_directories_are_ignored(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    img_path = write_image(tmp_path / "a", "x.png")
+    other_path = write_image(tmp_path / "b", "x.png")
+    scan(tmp_path / "a", [img_path], CaptionReader())
+    SubsetMetadataIndex(str(tmp_path / "a")).record_sizes({other_path: (8, 8)})
+    assert scan(tmp_path / "a", [img_path], CaptionReader())[1] == [None]
+
+
+def test_unusable_index_is_skipped(tmp_path):
+    (tmp_path / metadata_index.INDEX_FILE_NAME).write_bytes(b"not a database" * 100)
+    assert SubsetMetadataIndex.open(str(tmp_path)) is None
+
+
+def test_read_only_index_is_used_without_writing(tmp_path, monkeypatch, caplog):
+    img_dir = tmp_path / "img"
+    img_dir.mkdir()
+    for name, size in [("a.png", (64, 48)), ("b.png", (32, 64))]:
+        Image.new("RGB", size).save(img_dir / name)
+        (img_dir / name).with_suffix(".caption").write_text(f"caption of {name}", encoding="utf-8")
+
+    def load_dataset():
+        subset_params = DreamBoothSubsetParams(image_dir=str(img_dir), cache_info=True, caption_separator=",", keep_tokens_separator="")
+        subset = DreamBoothSubset(**asdict(subset_params))
+        dataset = DreamBoothDataset(
+            subsets=[subset], is_training_dataset=True, **asdict(DreamBoothDatasetParams(resolution=(64, 64)))
+        )
+        dataset.make_buckets()
+        return {os.path.basename(info.absolute_path): (info.image_size, info.caption) for info in dataset.image_data.values()}
+
+    load_dataset()
+    Image.new("RGB", (48, 48)).save(img_dir / "c.png")  # new image: the scan and make_buckets would write its row and size
+
+    index_path = img_dir / metadata_index.INDEX_FILE_NAME
+    os.chmod(index_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.chmod(img_dir, stat.S_IRUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+    connect = sqlite3.connect
+    # root ignores the permission bits, so also open the database read-only as an unprivileged user would find it
+    monkeypatch.setattr(sqlite3, "connect", lambda path, **kwargs: connect(f"file:{path}?mode=ro", uri=True, **kwargs))
+    try:
+        images = load_dataset()
+    finally:
+        os.chmod(img_dir, stat.S_IRWXU)
+        os.chmod(index_path, stat.S_IRUSR | stat.S_IWUSR)
+
+    assert images == {
+        "a.png": ((64, 48), "caption of a.png"),
+        "b.png": ((32, 64), "caption of b.png"),
+        "c.png": ((48, 48), ""),
+    }
+    assert "metadata index is not available, continuing without it" in caplog.text
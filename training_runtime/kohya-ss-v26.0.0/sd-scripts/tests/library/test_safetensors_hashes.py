@@ -0,0 +1,44 @@
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from library import model_io
+
+
+def lora_state_dict(rank):
+    torch.manual_seed(0)
+    state_dict = {}
+    for i in range(24):
+        state_dict[f"lora_unet_block_{i}.lora_down.weight"] = torch.randn(rank, 320)
+        state_dict[f"lora_unet_block_{i}.lora_up.weight"] = torch.randn(320, rank).to(torch.bfloat16)
+        state_dict[f"lora_unet_block_{i}.alpha"] = torch.tensor(rank / 2)
+    state_dict["lora_te_mask"] = torch.tensor([True, False, True])
+    state_dict["lora_te_scale"] = torch.randn(7).half()
+    state_dict["lora_te_empty"] = torch.zeros(0, 4)
+    return state_dict
+
+
+# rank 4: smaller than the legacy hash offset (1 MiB), rank 64: the window lies in the data
+@pytest.mark.parametrize("rank", [4, 64])
+def test_hashes_match_serializing_first(tmp_path, rank):
+    state_dict = lora_state_dict(rank)
+    metadata = {"ss_network_dim": str(rank), "ss_tag_frequency": '{"dé\\n": 1}\t\x01', "modelspec.title": "タイトル"}
+    expected = model_io.precalculate_safetensors_hashes(state_dict, dict(metadata))
+
+    path = str(tmp_path / "lora.safetensors")
+    assert model_io.save_safetensors_with_hashes(state_dict, path, metadata) == expected
+    assert (metadata["sshs_model_hash"], metadata["sshs_legacy_hash"]) == expected
+
+    loaded = load_file(path)
+    assert loaded.keys() == state_dict.keys()
+    assert all(torch.equal(loaded[key], tensor) for key, tensor in state_dict.items())
+    with safe_open(path, framework="pt") as f:
+        assert f.metadata() == metadata
+
+
+def test_header_beyond_the_legacy_offset_falls_back(tmp_path):
+    state_dict = lora_state_dict(4)
+    metadata = {"ss_tag_frequency": "x" * 0x100000}
+    expected = model_io.precalculate_safetensors_hashes(state_dict, dict(metadata))
+    assert model_io.save_safetensors_with_hashes(state_dict, str(tmp_path / "lora.safetensors"), metadata) == expected
@@ -0,0 +1,207 @@
+import os
+import sys
+import textwrap
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from library import sampling
+from library.sample_worker import SD_SCRIPTS_DIR, SampleWorker, worker_environment
+
+# answers like the worker: reads the snapshot, fails for step 30, samples epoch ends once the "go" file exists
+FAKE_WORKER = textwrap.dedent(
+    """
+    import json, os, sys, time
+    from safetensors.torch import load_file
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        while request["epoch"] == 5 and not os.path.exists(os.path.join(os.path.dirname(__file__), "go")):
+            time.sleep(0.01)
+        if request["steps"] == 30:
+            reply = {"steps": 30, "epoch": request["epoch"], "error": "RuntimeError('out of memory')"}
+        else:
+            weights = load_file(request["network_weights"])
+            images = [f"{request['sample_prompts']}_{request['steps']}_{name}.png" for name in sorted(weights)]
+            reply = {"steps": request["steps"], "epoch": request["epoch"], "seconds": 1.5, "images": images}
+        reply["id"] = request["id"]
+        print(json.dumps(reply), flush=True)
+    """
+)
+
+
+def start_fake_worker(tmp_path, max_pending=2):
+    script = tmp_path / "fake_worker.py"
+    script.write_text(FAKE_WORKER)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    return SampleWorker([sys.executable, str(script)], str(work_dir), max_pending=max_pending)
+
+
+def test_samples_are_sent_and_logged(tmp_path):
+    worker = start_fake_worker(tmp_path)
+    state_dict = {"lora_up": torch.ones(2, 2), "lora_down": torch.zeros(2, 2)}
+    assert worker.submit(state_dict, "prompts", None, 10)
+    assert worker.submit(state_dict, "prompts", 1, 20)
+    assert not worker.submit(state_dict, "prompts", None, 30)  # two requests outstanding
+    worker.close()
+
+    logs = worker.completed()
+    assert logs == [
+        {"samples/worker_steps": 10, "samples/worker_seconds": 1.5, "samples/worker_images": 2, "samples/worker_pending": 0},
+        {"samples/worker_steps": 20, "samples/worker_seconds": 1.5, "samples/worker_images": 2, "samples/worker_pending": 0},
+    ]
+    assert not os.path.exists(worker.work_dir)
+    assert not worker.submit(state_dict, "prompts", None, 40)  # exited
+
+
+def test_failed_samples_are_not_logged(tmp_path):
+    worker = start_fake_worker(tmp_path, max_pending=1)
+    assert worker.submit({"lora_up": torch.ones(1)}, "prompts", None, 30)
+    worker.close()
+    assert worker.completed() == []
+    with pytest.raises(ValueError):
+        SampleWorker([sys.executable, "-c", ""], str(tmp_path), max_pending=0)
+
+
+def test_step_and_epoch_end_samples_at_the_same_step(tmp_path):
+    worker = start_fake_worker(tmp_path)
+    assert worker.submit({"lora_up": torch.ones(1)}, "prompts", None, 20)
+    assert worker.submit({"lora_up": torch.ones(1), "lora_down": torch.ones(1)}, "prompts", 5, 20)
+
+    logs = []
+    deadline = time.monotonic() + 60
+    while not logs and time.monotonic() < deadline:
+        logs = worker.completed()  # removes the snapshot of the first request while the second is waiting
+        time.sleep(0.01)
+    assert [log["samples/worker_images"] for log in logs] == [1]
+
+    (tmp_path / "go").touch()
+    worker.close()
+    assert [log["samples/worker_images"] for log in worker.completed()] == [2]
+
+
+def test_hung_worker_is_killed_on_close(tmp_path):
+    worker = SampleWorker([sys.executable, "-c", "import time; time.sleep(60)"], str(tmp_path / "work"))
+    start = time.monotonic()
+    worker.close(timeout=0.5)
+    assert time.monotonic() - start < 30 and not worker.alive
+
+
+def test_worker_environment():
+    environ = {"RANK": "0", "LOCAL_RANK": "0", "WORLD_SIZE": "2", "TORCHELASTIC_RUN_ID": "x", "PYTHONPATH": "other", "HOME": "/home"}
+    env = worker_environment("cpu", environ)
+    assert env == {"PYTHONPATH": os.pathsep.join([SD_SCRIPTS_DIR, "other"]), "HOME": "/home", "CUDA_VISIBLE_DEVICES": ""}
+
+    assert worker_environment("cuda:1", {})["CUDA_VISIBLE_DEVICES"] == "1"
+    assert worker_environment("cuda:1", {"CUDA_VISIBLE_DEVICES": "2, 3"})["CUDA_VISIBLE_DEVICES"] == "3"
+    assert "CUDA_VISIBLE_DEVICES" not in worker_environment("cuda", {})
+    with pytest.raises(ValueError):
+        worker_environment("cuda:2", {"CUDA_VISIBLE_DEVICES": "0,1"})
+
+
+def test_sampling_steps():
+    def args(**kwargs):
+        return SimpleNamespace(**{"sample_at_first": False, "sample_every_n_steps": None, "sample_every_n_epochs": None, **kwargs})
+
+    assert sampling.is_sampling_step(args(sample_at_first=True), 0, 0)
+    assert not sampling.is_sampling_step(args(sample_every_n_steps=10), 0, 0)
+    assert sampling.is_sampling_step(args(sample_every_n_steps=10), None, 20)
+    assert not sampling.is_sampling_step(args(sample_every_n_steps=10), None, 25)
+    assert not sampling.is_sampling_step(args(sample_every_n_steps=10), 2, 20)  # end of epoch
+    assert sampling.is_sampling_step(args(sample_every_n_steps=10, sample_every_n_epochs=2), 2, 25)
+    assert not sampling.is_sampling_step(args(sample_every_n_epochs=2), None, 20)
+    assert not sampling.is_sampling_step(args(), 1, 20)
+
+
+class TinyModel(torch.nn.Module):
+    """Stands in for the FLUX.1 models: a linear layer, with the device and dtype properties the trainer reads."""
+
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(2, 2)
+
+    @property
+    def device(self):
+        return self.linear.weight.device
+
+    @property
+    def dtype(self):
+        return self.linear.weight.dtype
+
+
+FAKE_NETWORK = textwrap.dedent(
+    """
+    import torch
+
+    class Network(torch.nn.Module):
+        train_t5xxl = False
+
+        def apply_to(self, text_encoder, unet, apply_text_encoder, apply_unet):
+            self.applied_to = (apply_text_encoder, apply_unet)
+
+        def load_weights(self, file):
+            return file
+
+    def create_network(multiplier, network_dim, network_alpha, vae, text_encoder, unet, neuron_dropout=None, **kwargs):
+        return Network()
+    """
+)
+
+
+def test_sampler_sets_up_flux_trainer(tmp_path, monkeypatch):
+    import flux_train_network
+    from library import sample_worker, strategy_base
+
+    for strategy_class in [strategy_base.TokenizeStrategy, strategy_base.TextEncodingStrategy, strategy_base.TextEncoderOutputsCachingStrategy]:
+        monkeypatch.setattr(strategy_class, "_strategy", None)
+    (tmp_path / "fake_network.py").write_text(FAKE_NETWORK)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    class TokenizeStrategy:
+        clip_l = t5xxl = None
+
+        def tokenize(self, text):
+            return [text]
+
+    class TextEncodingStrategy:
+        def encode_tokens(self, tokenize_strategy, models, tokens, apply_t5_attn_mask=False):
+            return [torch.zeros(1)]
+
+    class Trainer(flux_train_network.FluxNetworkTrainer):
+        def get_tokenize_strategy(self, args):
+            return TokenizeStrategy()
+
+        def get_text_encoding_strategy(self, args):
+            return TextEncodingStrategy()
+
+        def load_target_model(self, args, weight_dtype, accelerator):
+            assert self.model_type == "flux"  # set by assert_extra_args
+            return "flux", [TinyModel(), TinyModel()], TinyModel(), TinyModel()
+
+    prompts = tmp_path / "prompts.txt"
+    prompts.write_text("a cat\na dog --n blurry\n")
+    args = flux_train_network.setup_parser().parse_args(
+        ["--network_module", "fake_network", "--network_train_unet_only", "--cache_text_encoder_outputs"]
+        + ["--sample_prompts", str(prompts), "--output_dir", str(tmp_path / "output")]
+    )
+    sampler = sample_worker._Sampler(Trainer(), args, torch.device("cpu"), [(512, 512)])
+
+    trainer = sampler.trainer
+    assert (trainer.train_clip_l, trainer.train_t5xxl) == (False, False)
+    assert sorted(trainer.sample_prompts_te_outputs) == ["", "a cat", "a dog", "blurry"]
+    assert sampler.network.applied_to == (False, True)
+
+    calls = []
+
+    def sample_images(accelerator, args, epoch, steps, flux, ae, text_encoders, sample_prompts_te_outputs):
+        calls.append((text_encoders, sample_prompts_te_outputs))
+        os.makedirs(os.path.join(args.output_dir, "sample"), exist_ok=True)
+        (tmp_path / "output" / "sample" / f"image_{steps}.png").touch()
+
+    monkeypatch.setattr(flux_train_network.flux_train_utils, "sample_images", sample_images)
+    reply = sampler.sample({"network_weights": "weights.safetensors", "sample_prompts": str(prompts), "epoch": None, "steps": 10})
+    assert reply["images"] == ["image_10.png"]
+    assert calls == [(None, trainer.sample_prompts_te_outputs)]  # both text encoders cached
@@ -0,0 +1,132 @@
+import contextlib
+import glob
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from library import sampling
+from library.lpw_stable_diffusion import StableDiffusionLongPromptWeightingPipeline
+
+
+class StandInPipeline:
+    """Draws the initial noise with the LPW pipeline's ``prepare_latents`` and ancestral noise every step, as samplers do."""
+
+    def __init__(self):
+        self._execution_device = torch.device("cpu")
+        self.scheduler = None
+        self.batch_sizes = []
+
+    def __call__(self, prompt, height, width, num_inference_steps, guidance_scale, negative_prompt=None, generator=None, **kwargs):
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        self.batch_sizes.append(len(prompts))
+        shapes = SimpleNamespace(
+            vae=SimpleNamespace(config=SimpleNamespace(latent_channels=4)),
+            vae_scale_factor=8,
+            scheduler=SimpleNamespace(init_noise_sigma=1.0),
+        )
+        latents, _, _ = StableDiffusionLongPromptWeightingPipeline.prepare_latents(
+            shapes, None, None, len(prompts), height, width, torch.float32, self._execution_device, generator
+        )
+        for _ in range(num_inference_steps):
+            if isinstance(generator, list):
+                noise = torch.cat([torch.randn((1, *latents.shape[1:]), generator=g) for g in generator])
+            else:
+                noise = torch.randn(latents.shape, generator=generator)
+            latents = latents * 0.5 + noise * 0.1 * guidance_scale
+        return latents + torch.tensor([float(len(p)) for p in prompts]).view(-1, 1, 1, 1) / 10
+
+    def latents_to_image(self, latents):
+        pixels = (latents[:, :3].clamp(-4, 4) * 30 + 128).to(torch.uint8).permute(0, 2, 3, 1).numpy()
+        return [Image.fromarray(p) for p in pixels]
+
+
+def sample_args(**kwargs):
+    return SimpleNamespace(sample_sampler="ddim", sample_batch_size=4, v_parameterization=False, output_name="test", **kwargs)
+
+
+def prompt_dicts(*settings):
+    return [{"prompt": f"prompt {i}", "enum": i, **s} for i, s in enumerate(settings)]
+
+
+def test_compatible_prompts_are_grouped():
+    prompts = prompt_dicts(
+        {"seed": 1},
+        {"seed": 2, "width": 520},  # rounded down to 512
+        {"width": 768},
+        {"seed": 3},
+        {"sample_sampler": "euler_a"},
+        {"scale": 5.0},
+    )
+    pipeline = StandInPipeline()
+
+    def enums(batches):
+        return [[p["enum"] for p in batch] for batch in batches]
+
+    assert enums(sampling.group_sample_prompts(sample_args(), pipeline, prompts, None)) == [[0, 1, 3], [2], [4], [5]]
+    args = sample_args()
+    args.sample_batch_size = 2
+    assert enums(sampling.group_sample_prompts(args, pipeline, prompts, None)) == [[0, 1], [2], [3], [4], [5]]
+    args.sample_batch_size = 1
+    assert enums(sampling.group_sample_prompts(args, pipeline, prompts, None)) == [[i] for i in range(6)]
+    assert len(sampling.group_sample_prompts(sample_args(train_inpainting=True), pipeline, prompts, None)) == 6
+
+
+@pytest.mark.parametrize("seeds", [[7, 8, 9], [42, 42, 3]])
+def test_batched_images_match_one_by_one(tmp_path, seeds):
+    accelerator = SimpleNamespace(autocast=contextlib.nullcontext, trackers=[])
+    prompts = prompt_dicts(*({"seed": seed, "width": 64, "height": 128, "sample_steps": 3} for seed in seeds))
+
+    def images(save_dir):
+        return {
+            os.path.basename(path).split("_")[2]: np.asarray(Image.open(path))
+            for path in glob.glob(os.path.join(save_dir, "*.png"))
+        }
+
+    single_dir, batch_dir = tmp_path / "single", tmp_path / "batch"
+    single_dir.mkdir()
+    batch_dir.mkdir()
+    pipeline = StandInPipeline()
+    for prompt_dict in prompts:
+        sampling.sample_image_inference(accelerator, sample_args(), pipeline, str(single_dir), prompt_dict, None, 10, None)
+    sampling.sample_image_batch_inference(accelerator, sample_args(), pipeline, str(batch_dir), prompts, None, 10, None)
+    assert pipeline.batch_sizes == [1, 1, 1, 3]
+
+    single, batched = images(str(single_dir)), images(str(batch_dir))
+    assert single.keys() == batched.keys() == {"00", "01", "02"}
+    assert all(np.array_equal(single[i], batched[i]) for i in single)
+
+
+class StandInTokenizer:
+    """One token per word, between BOS and EOS."""
+
+    model_max_length = 77
+
+    def __call__(self, text):
+        return SimpleNamespace(input_ids=[0] + [1] * len(text.split()) + [2])
+
+
+@pytest.mark.parametrize("pipeline_class", ["sd", "sdxl"])
+def test_prompts_are_grouped_by_text_embedding_length(pipeline_class):
+    from library.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
+
+    # both pipelines pad the prompts of a call to the longest, in 75-token chunks
+    if pipeline_class == "sd":
+        pipeline = object.__new__(StableDiffusionLongPromptWeightingPipeline)
+    else:
+        pipeline = object.__new__(SdxlStableDiffusionLongPromptWeightingPipeline)
+    pipeline.tokenizer = StandInTokenizer()
+
+    long_prompt = " ".join(["word"] * 80)
+    prompts = [
+        {"prompt": "short", "enum": 0},
+        {"prompt": long_prompt, "enum": 1},
+        {"prompt": "short", "negative_prompt": long_prompt, "enum": 2},
+        {"prompt": "another short one", "enum": 3},
+        {"prompt": "short", "negative_prompt": long_prompt, "scale": 1.0, "enum": 4},  # no negative prompt without guidance
+    ]
+    batches = sampling.group_sample_prompts(sample_args(), pipeline, prompts, None)
+    assert [[p["enum"] for p in batch] for batch in batches] == [[0, 3], [1, 2], [4]]
@@ -0,0 +1,57 @@
+# latentsの.npzキャッシュを追記型ストアに変換する / convert .npz latents caches to the latent store
+
+import argparse
+import os
+
+from library import latent_store
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def convert(image_dirs, cache_suffix: str, recursive: bool, remove_npz: bool):
+    directories = []
+    for image_dir in image_dirs:
+        if recursive:
+            for root, dirs, _ in os.walk(image_dir):
+                dirs[:] = [d for d in dirs if d != latent_store.STORE_DIR_NAME]
+                directories.append(root)
+        else:
+            directories.append(image_dir)
+
+    total = 0
+    for directory in directories:
+        converted = latent_store.convert_npz_directory(directory, cache_suffix, remove_npz)
+        if converted > 0:
+            logger.info(f"{directory}: {converted} files converted")
+        total += converted
+    logger.info(f"done. {total} files converted / {total}個のファイルを変換しました")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Convert latents cached as .npz files to the latent store used by --latents_cache_format store"
+        " / .npzとしてキャッシュされたlatentを --latents_cache_format store 用のストアに変換する"
+    )
+    parser.add_argument("image_dirs", type=str, nargs="+", help="image directories containing .npz caches / .npzキャッシュを含む画像ディレクトリ")
+    parser.add_argument(
+        "--cache_suffix",
+        type=str,
+        default=".npz",
+        help="suffix of the latents cache files, e.g. _sdxl.npz or _flux.npz (text encoder caches must be excluded)"
+        " / latentキャッシュファイルのサフィックス、例：_sdxl.npz、_flux.npz（テキストエンコーダのキャッシュは除外すること）",
+    )
+    parser.add_argument("--recursive", action="store_true", help="also convert subdirectories / サブディレクトリも変換する")
+    parser.add_argument(
+        "--remove_npz", action="store_true", help="remove each .npz file after it is converted / 変換後に.npzファイルを削除する"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+    args = parser.parse_args()
+    convert(args.image_dirs, args.cache_suffix, args.recursive, args.remove_npz)
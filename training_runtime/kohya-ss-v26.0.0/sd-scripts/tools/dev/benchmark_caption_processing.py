@@ -0,0 +1,197 @@
+"""
+Benchmark of ``BaseDataset.process_caption`` over many tag captions.
+
+Usage:
+    python tools/dev/benchmark_caption_processing.py [--captions 100000] [--tags 30] [--wildcard_ratio 0.1] [--tag_dropout 0.1]
+
+Generates ``--captions`` Danbooru-style captions (``--tags`` tags each, some of
+them with ``{a|b}`` wildcards and a ``|||`` keep tokens separator) and processes
+each once with shuffle, tag dropout and wildcards enabled: as before, parsing the
+caption on every call, and with the captions compiled when the dataset is built
+(the compile time is reported separately). Both must give the same captions
+with the same seed.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from library.dataset import BaseDataset
+
+
+def parse_caption(dataset, subset, caption):
+    """process_caption as it was before the captions were compiled."""
+    if subset.caption_prefix:
+        caption = subset.caption_prefix + " " + caption
+    if subset.caption_suffix:
+        caption = caption + " " + subset.caption_suffix
+
+    is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
+    is_drop_out = (
+        is_drop_out or subset.caption_dropout_every_n_epochs > 0 and dataset.current_epoch % subset.caption_dropout_every_n_epochs == 0
+    )
+    if is_drop_out:
+        return ""
+
+    if subset.enable_wildcard:
+        if "\n" in caption:
+            caption = random.choice(caption.split("\n"))
+        replacer1 = "⦅"
+        replacer2 = "⦆"
+        while replacer1 in caption or replacer2 in caption:
+            replacer1 += "⦅"
+            replacer2 += "⦆"
+        caption = caption.replace("{{", replacer1).replace("}}", replacer2)
+
+        def replace_wildcard(match):
+            return random.choice(match.group(1).split("|"))
+
+        caption = re.sub(r"\{([^}]+)\}", replace_wildcard, caption)
+        caption = caption.replace(replacer1, "{").replace(replacer2, "}")
+    else:
+        caption = caption.split("\n")[0]
+
+    if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
+        fixed_tokens = []
+        flex_tokens = []
+        fixed_suffix_tokens = []
+        if subset.keep_tokens_separator and subset.keep_tokens_separator in caption:
+            fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
+            if subset.keep_tokens_separator in flex_part:
+                flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
+                fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
+            fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
+            flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+        else:
+            tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
+            flex_tokens = tokens[:]
+            if subset.keep_tokens > 0:
+                fixed_tokens = flex_tokens[: subset.keep_tokens]
+                flex_tokens = tokens[subset.keep_tokens :]
+
+        if subset.token_warmup_step < 1:
+            subset.token_warmup_step = math.floor(subset.token_warmup_step * dataset.max_train_steps)
+        if subset.token_warmup_step and dataset.current_step < subset.token_warmup_step:
+            tokens_len = (
+                math.floor(dataset.current_step * ((len(flex_tokens) - subset.token_warmup_min) / subset.token_warmup_step))
+                + subset.token_warmup_min
+            )
+            flex_tokens = flex_tokens[:tokens_len]
+
+        def dropout_tags(tokens):
+            if subset.caption_tag_dropout_rate <= 0:
+                return tokens
+            l = []
+            for token in tokens:
+                if random.random() >= subset.caption_tag_dropout_rate:
+                    l.append(token)
+            return l
+
+        if subset.shuffle_caption:
+            random.shuffle(flex_tokens)
+        flex_tokens = dropout_tags(flex_tokens)
+        caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
+
+    if subset.secondary_separator:
+        caption = caption.replace(subset.secondary_separator, subset.caption_separator)
+
+    for str_from, str_to in dataset.replacements.items():
+        if str_from == "":
+            caption = random.choice(str_to) if type(str_to) == list else str_to
+        else:
+            caption = caption.replace(str_from, str_to)
+    return caption
+
+
+def make_captions(args):
+    rng = random.Random(0)
+    vocabulary = [f"tag_{i}" for i in range(5000)]
+    captions = []
+    for i in range(args.captions):
+        tags = [rng.choice(vocabulary).replace("_", " ") for _ in range(args.tags)]
+        for j in range(len(tags)):
+            if rng.random() < args.wildcard_ratio:
+                tags[j] = "{" + tags[j] + "|" + rng.choice(vocabulary) + "}"
+        if i % 2 == 0:
+            tags[2] = "||| " + tags[2]  # the first two tags are kept in place
+        captions.append(", ".join(tags))
+    return captions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--captions", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=30)
+    parser.add_argument("--wildcard_ratio", type=float, default=0.1)
+    parser.add_argument("--tag_dropout", type=float, default=0.1)
+    args = parser.parse_args()
+
+    captions = make_captions(args)
+
+    def subset():
+        return SimpleNamespace(
+            caption_prefix="masterpiece",
+            caption_suffix=None,
+            caption_dropout_rate=0.0,
+            caption_dropout_every_n_epochs=0,
+            enable_wildcard=True,
+            shuffle_caption=True,
+            token_warmup_step=0,
+            token_warmup_min=1,
+            caption_tag_dropout_rate=args.tag_dropout,
+            keep_tokens_separator="|||",
+            caption_separator=",",
+            keep_tokens=1,
+            secondary_separator=None,
+            compiled_captions={},
+        )
+
+    parse_subset, compile_subset = subset(), subset()
+    dataset = SimpleNamespace(
+        current_epoch=1,
+        current_step=0,
+        max_train_steps=1000,
+        replacements={},
+        image_data={str(i): SimpleNamespace(caption=c) for i, c in enumerate(captions)},
+        image_to_subset={str(i): compile_subset for i in range(len(captions))},
+    )
+
+    random.seed(42)
+    start = time.perf_counter()
+    parsed = [parse_caption(dataset, parse_subset, c) for c in captions]
+    parse_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    BaseDataset.compile_captions(dataset)
+    compile_seconds = time.perf_counter() - start
+
+    random.seed(42)
+    start = time.perf_counter()
+    processed = [BaseDataset.process_caption(dataset, compile_subset, c) for c in captions]
+    compiled_seconds = time.perf_counter() - start
+
+    if parsed != processed:
+        raise SystemExit("compiled captions differ")
+
+    report = {
+        "captions": args.captions,
+        "tags": args.tags,
+        "wildcard_ratio": args.wildcard_ratio,
+        "parsed": {"seconds": parse_seconds, "captions_per_sec": args.captions / parse_seconds},
+        "compiled": {"seconds": compiled_seconds, "captions_per_sec": args.captions / compiled_seconds},
+        "compile_seconds": compile_seconds,
+        "speedup": parse_seconds / compiled_seconds,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Time-to-first-step benchmark of DreamBooth dataset construction on a synthetic directory tree.
+
+Usage:
+    python tools/dev/benchmark_dataset_scan.py [--images 20000] [--subsets 4] [--latency_ms 2]
+
+Writes ``--images`` tiny PNGs with caption files into ``--subsets`` directories,
+then builds a ``DreamBoothDataset`` over them and calls ``make_buckets`` twice:
+once with the scan forced serial (as before) and once with the bounded thread
+pool of ``map_in_threads``. ``--latency_ms`` adds a sleep to every image header
+read and caption file check to emulate a network disk; with 0 the files come
+from the page cache and only the Python overhead is measured. Both runs must
+produce the same captions and bucket assignment in the same order.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import library.dataset as dataset_util
+import library.dreambooth_dataset as dreambooth_dataset
+from library.subset import DreamBoothSubset
+
+
+def write_tree(root: str, images: int, subsets: int):
+    sizes = [(64, 48), (48, 64), (56, 56)]
+    dirs = []
+    for s in range(subsets):
+        directory = os.path.join(root, f"{s + 1}_subset{s}")
+        os.makedirs(directory)
+        dirs.append(directory)
+    for i in range(images):
+        directory = dirs[i % subsets]
+        Image.new("RGB", sizes[i % len(sizes)]).save(os.path.join(directory, f"img{i:06d}.png"))
+        if i % 10 != 0:  # some images rely on class tokens
+            with open(os.path.join(directory, f"img{i:06d}.txt"), "w", encoding="utf-8") as f:
+                f.write(f"1girl, tag{i % 97}, tag{i % 13}\n")
+    return dirs
+
+
+def make_subset(directory: str) -> DreamBoothSubset:
+    return DreamBoothSubset(
+        image_dir=directory,
+        is_reg=False,
+        class_tokens="sks",
+        caption_extension=".txt",
+        cache_info=False,
+        alpha_mask=False,
+        num_repeats=1,
+        shuffle_caption=False,
+        caption_separator=",",
+        keep_tokens=0,
+        keep_tokens_separator=None,
+        secondary_separator=None,
+        enable_wildcard=False,
+        color_aug=False,
+        flip_aug=False,
+        face_crop_aug_range=None,
+        random_crop=False,
+        caption_dropout_rate=0.0,
+        caption_dropout_every_n_epochs=0,
+        caption_tag_dropout_rate=0.0,
+        caption_prefix=None,
+        caption_suffix=None,
+        token_warmup_min=0,
+        token_warmup_step=0,
+    )
+
+
+def build(dirs, serial: bool):
+    environ = {"LOCAL_WORLD_SIZE": "1024"} if serial else {}
+    with mock.patch.dict(os.environ, environ):
+        start = time.perf_counter()
+        dataset = dreambooth_dataset.DreamBoothDataset(
+            [make_subset(d) for d in dirs],
+            is_training_dataset=True,
+            batch_size=4,
+            resolution=(64, 64),
+            network_multiplier=1.0,
+            enable_bucket=True,
+            min_bucket_reso=32,
+            max_bucket_reso=128,
+            bucket_reso_steps=8,
+            bucket_no_upscale=False,
+            prior_loss_weight=1.0,
+            train_inpainting=False,
+            debug_dataset=False,
+            validation_split=0.0,
+            validation_seed=None,
+            resize_interpolation=None,
+        )
+        loaded = time.perf_counter()
+        dataset.make_buckets()
+        bucketed = time.perf_counter()
+    order = [(key, info.caption, info.bucket_reso) for key, info in dataset.image_data.items()]
+    return {"load_dreambooth_dir_s": loaded - start, "make_buckets_s": bucketed - loaded, "total_s": bucketed - start}, order
+
+
+def with_latency(latency_ms: float, root: str) -> contextlib.ExitStack:
+    """Sleep before header reads and caption lookups below ``root``."""
+    stack = contextlib.ExitStack()
+    if latency_ms <= 0:
+        return stack
+    delay = latency_ms / 1000
+    imagesize_get = dataset_util.imagesize.get
+    isfile = os.path.isfile
+
+    def slow_imagesize_get(path, *args, **kwargs):
+        time.sleep(delay)
+        return imagesize_get(path, *args, **kwargs)
+
+    def slow_isfile(path):
+        if str(path).startswith(root):
+            time.sleep(delay)
+        return isfile(path)
+
+    stack.enter_context(mock.patch.object(dataset_util.imagesize, "get", slow_imagesize_get))
+    stack.enter_context(mock.patch("os.path.isfile", slow_isfile))
+    return stack
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--subsets", type=int, default=4)
+    parser.add_argument("--latency_ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="dataset-scan-benchmark-") as root:
+        dirs = write_tree(root, args.images, args.subsets)
+        with with_latency(args.latency_ms, root):
+            serial, serial_order = build(dirs, serial=True)
+            threaded, threaded_order = build(dirs, serial=False)
+    if serial_order != threaded_order:
+        raise SystemExit("threaded scan differs from the serial scan")
+    report = {
+        "images": args.images,
+        "subsets": args.subsets,
+        "latency_ms": args.latency_ms,
+        "workers": min(32, (os.cpu_count() or 1) + 4),
+        "serial": serial,
+        "threaded": threaded,
+        "speedup": serial["total_s"] / threaded["total_s"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
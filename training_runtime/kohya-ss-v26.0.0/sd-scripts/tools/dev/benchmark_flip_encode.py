@@ -0,0 +1,103 @@
+"""
+Benchmark of encoding flipped images for ``flip_aug`` in the same VAE batch as the originals.
+
+Usage:
+    python tools/dev/benchmark_flip_encode.py [--batch_size 4] [--resolution 512] [--iterations 20] [--device cuda]
+
+Encodes random batches with a stand-in VAE (a few strided convolutions, see
+``benchmark_latent_caching.py``) in turns: as before, one call for
+the images and a second call for the flipped images, and with
+``caching.encode_with_flipped``, one call on the concatenated batch. Reports
+milliseconds per cached image (original and flipped latents) and the largest
+difference between the two results, which must be within float tolerance.
+``default_ms_per_image`` is ``encode_with_flipped`` without ``max_batch_size``,
+as the caching strategies call it without a memory budget: one call per B images.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from library import caching
+from tools.dev.benchmark_latent_caching import StandInVAE
+
+
+def two_pass(vae, img_tensor):
+    with torch.no_grad():
+        latents = vae(img_tensor)
+        flipped_latents = vae(torch.flip(img_tensor, dims=[3]))
+    return latents, flipped_latents
+
+
+def same_batch(vae, img_tensor):
+    return caching.encode_with_flipped(vae, img_tensor, True, max_batch_size=img_tensor.shape[0] * 2)
+
+
+def default(vae, img_tensor):
+    return caching.encode_with_flipped(vae, img_tensor, True)  # as used by the caching strategies without a memory budget
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def measure(functions, vae, batches, device):
+    """Seconds spent in each function. The functions take turns on every batch, so drift affects them alike."""
+    for function in functions:
+        function(vae, batches[0])  # warm up kernels and allocator
+    seconds = [0.0] * len(functions)
+    for img_tensor in batches:
+        for i, function in enumerate(functions):
+            synchronize(device)
+            start = time.perf_counter()
+            function(vae, img_tensor)
+            synchronize(device)
+            seconds[i] += time.perf_counter() - start
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    vae = StandInVAE().eval().to(device)
+    batches = [
+        torch.rand(args.batch_size, 3, args.resolution, args.resolution, device=device) * 2 - 1 for _ in range(args.iterations)
+    ]
+
+    expected = two_pass(vae, batches[0])
+    actual = same_batch(vae, batches[0])
+    max_abs_diff = max((e - a).abs().max().item() for e, a in zip(expected, actual))
+    if max_abs_diff > 1e-4:
+        raise SystemExit(f"same-batch latents differ: {max_abs_diff}")
+
+    images = args.batch_size * args.iterations
+    two_pass_seconds, same_batch_seconds, default_seconds = measure([two_pass, same_batch, default], vae, batches, device)
+    report = {
+        "device": str(device),
+        "batch_size": args.batch_size,
+        "resolution": args.resolution,
+        "two_pass_ms_per_image": two_pass_seconds / images * 1000,
+        "same_batch_ms_per_image": same_batch_seconds / images * 1000,
+        "speedup": two_pass_seconds / same_batch_seconds,
+        "default_ms_per_image": default_seconds / images * 1000,
+        "max_abs_diff": max_abs_diff,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Throughput benchmark of ``BaseDataset.new_cache_latents`` with a tiny stand-in VAE on CPU.
+
+Usage:
+    python tools/dev/benchmark_latent_caching.py [--images 256] [--batch_size 8] [--resolution 512] [--flip_aug] [--memory_budget MB]
+
+Writes ``--images`` random-noise JPEGs larger than the bucket resolution into a
+temporary DreamBooth directory, then caches their latents to disk twice: once
+with ``caching.PIPELINE_DEPTH = 0`` (workers only decode, resize/normalize, the
+VAE and ``np.savez`` run in sequence on the main thread, as before) and once
+with the default pipeline (workers prepare upcoming batches, cache files are
+written by a background thread). The stand-in VAE is a few strided
+convolutions, cheap enough that the host-side work is visible. Both runs must
+produce identical cache files. ``--memory_budget`` sizes the batches per bucket
+(``--latents_caching_memory_budget``) instead of ``--batch_size``.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from library import accelerator_setup, caching
+from library.dreambooth_dataset import DreamBoothDataset
+from library.strategy_base import LatentsCachingStrategy
+from library.subset import DreamBoothSubset
+
+
+class StandInVAE(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 16, 3, stride=2, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(16, 16, 3, stride=2, padding=1),
+            torch.nn.SiLU(),
+            torch.nn.Conv2d(16, 4, 3, stride=2, padding=1),
+        )
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+class StandInLatentsCachingStrategy(LatentsCachingStrategy):
+    @property
+    def cache_suffix(self) -> str:
+        return "_bench.npz"
+
+    def get_latents_npz_path(self, absolute_path, image_size) -> str:
+        return os.path.splitext(absolute_path)[0] + f"_{image_size[0]:04d}x{image_size[1]:04d}" + self.cache_suffix
+
+    def is_disk_cached_latents_expected(self, bucket_reso, npz_path, flip_aug, alpha_mask):
+        return self._default_is_disk_cached_latents_expected(8, bucket_reso, npz_path, flip_aug, alpha_mask, multi_resolution=True)
+
+    def cache_batch_latents(self, vae, image_infos, flip_aug, alpha_mask, random_crop):
+        self._default_cache_batch_latents(
+            vae, torch.device("cpu"), torch.float32, image_infos, flip_aug, alpha_mask, random_crop, multi_resolution=True
+        )
+
+
+def write_images(directory: str, images: int, resolution: int):
+    rng = np.random.default_rng(0)
+    sizes = [(resolution * 5 // 4, resolution), (resolution, resolution * 5 // 4), (resolution * 9 // 8, resolution * 9 // 8)]
+    for i in range(images):
+        w, h = sizes[i % len(sizes)]
+        pixels = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(directory, f"img{i:05d}.jpg"), quality=90)
+
+
+def make_dataset(directory: str, batch_size: int, resolution: int, flip_aug: bool) -> DreamBoothDataset:
+    subset = DreamBoothSubset(
+        image_dir=directory,
+        is_reg=False,
+        class_tokens="sks",
+        caption_extension=".txt",
+        cache_info=False,
+        alpha_mask=False,
+        num_repeats=1,
+        shuffle_caption=False,
+        caption_separator=",",
+        keep_tokens=0,
+        keep_tokens_separator=None,
+        secondary_separator=None,
+        enable_wildcard=False,
+        color_aug=False,
+        flip_aug=flip_aug,
+        face_crop_aug_range=None,
+        random_crop=False,
+        caption_dropout_rate=0.0,
+        caption_dropout_every_n_epochs=0,
+        caption_tag_dropout_rate=0.0,
+        caption_prefix=None,
+        caption_suffix=None,
+        token_warmup_min=0,
+        token_warmup_step=0,
+    )
+    dataset = DreamBoothDataset(
+        [subset],
+        is_training_dataset=True,
+        batch_size=batch_size,
+        resolution=(resolution, resolution),
+        network_multiplier=1.0,
+        enable_bucket=True,
+        min_bucket_reso=resolution // 2,
+        max_bucket_reso=resolution * 2,
+        bucket_reso_steps=64,
+        bucket_no_upscale=False,
+        prior_loss_weight=1.0,
+        train_inpainting=False,
+        debug_dataset=False,
+        validation_split=0.0,
+        validation_seed=None,
+        resize_interpolation=None,
+    )
+    dataset.make_buckets()
+    return dataset
+
+
+def run(directory: str, args, pipeline_depth: int, vae: torch.nn.Module):
+    for path in glob.glob(os.path.join(directory, "*_bench.npz")) + glob.glob(os.path.join(directory, "_latents_manifest-*")):
+        os.remove(path)
+
+    LatentsCachingStrategy._strategy = None
+    LatentsCachingStrategy.set_strategy(StandInLatentsCachingStrategy(True, args.batch_size, False))
+    caching.PIPELINE_DEPTH = pipeline_depth
+    dataset = make_dataset(directory, args.batch_size, args.resolution, args.flip_aug)
+    accelerator = SimpleNamespace(num_processes=1, process_index=0, device=torch.device("cpu"))
+
+    start = time.perf_counter()
+    dataset.new_cache_latents(vae, accelerator)
+    elapsed = time.perf_counter() - start
+
+    outputs = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*_bench.npz"))):
+        with np.load(path) as npz:
+            outputs[os.path.basename(path)] = {key: npz[key] for key in npz.files}
+    return {"seconds": elapsed, "images_per_sec": args.images / elapsed}, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--flip_aug", action="store_true")
+    parser.add_argument("--memory_budget", type=float, default=None)
+    args = parser.parse_args()
+    accelerator_setup.LATENTS_CACHING_MEMORY_BUDGET_MB = args.memory_budget
+
+    torch.manual_seed(0)
+    vae = StandInVAE().eval()
+
+    with tempfile.TemporaryDirectory(prefix="latent-caching-benchmark-") as directory:
+        write_images(directory, args.images, args.resolution)
+        run(directory, args, caching.PIPELINE_DEPTH, vae)  # warm up the page cache and the thread pools
+        sequential, sequential_outputs = run(directory, args, 0, vae)
+        pipelined, pipelined_outputs = run(directory, args, 2, vae)
+
+    if sequential_outputs.keys() != pipelined_outputs.keys() or any(
+        sequential_outputs[name].keys() != arrays.keys()
+        or any(not np.array_equal(sequential_outputs[name][key], array) for key, array in arrays.items())
+        for name, arrays in pipelined_outputs.items()
+    ):
+        raise SystemExit("pipelined caching wrote different latents")
+
+    report = {
+        "images": args.images,
+        "batch_size": args.batch_size,
+        "resolution": args.resolution,
+        "flip_aug": args.flip_aug,
+        "memory_budget": args.memory_budget,
+        "cpu_count": os.cpu_count(),
+        "sequential": sequential,
+        "pipelined": pipelined,
+        "speedup": pipelined["images_per_sec"] / sequential["images_per_sec"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
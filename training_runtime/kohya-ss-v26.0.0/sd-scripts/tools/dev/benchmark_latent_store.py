@@ -0,0 +1,139 @@
+"""
+Dataloader throughput of the latent store against per-image .npz caches.
+
+Usage:
+    python tools/dev/benchmark_latent_store.py [--images 4000] [--workers 0 4] [--batch_size 8]
+
+Synthetic SDXL-sized latents (4 channels, three bucket resolutions, flipped
+latents included) are written as .npz files like ``save_latents_to_disk`` does,
+then imported into a store with ``convert_npz_directory``. Each DataLoader pass
+reads every sample the way ``BaseDataset.__getitem__`` does (load, pick the
+flipped latents for half of them, convert to a tensor). Files are re-read from
+the page cache after the first epoch, so the numbers show the per-sample
+parsing overhead rather than disk speed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from library import latent_store
+
+RESOLUTIONS = [(128, 128), (112, 144), (144, 112)]  # latent H, W of 1024px SDXL buckets
+
+
+class LatentsDataset(Dataset):
+    def __init__(self, npz_paths, store_format: bool):
+        self.npz_paths = npz_paths
+        self.store_format = store_format
+
+    def __len__(self):
+        return len(self.npz_paths)
+
+    def __getitem__(self, index):
+        npz_path, suffix = self.npz_paths[index]
+        if self.store_format:
+            latents, _, _, flipped_latents, _ = latent_store.store_for(npz_path).load(latent_store.record_key(npz_path), suffix)
+        else:
+            npz = np.load(npz_path)
+            latents = npz["latents" + suffix]
+            npz["original_size" + suffix].tolist()
+            npz["crop_ltrb" + suffix].tolist()
+            flipped_latents = npz["latents_flipped" + suffix]
+        if index % 2 == 1:
+            latents = flipped_latents
+        return torch.FloatTensor(latents)
+
+
+def write_npz_caches(directory: str, images: int):
+    rng = np.random.default_rng(0)
+    npz_paths = []
+    for i in range(images):
+        h, w = RESOLUTIONS[i % len(RESOLUTIONS)]
+        suffix = f"_{h}x{w}"
+        npz_path = os.path.join(directory, f"image{i:06d}_{w * 8:04d}x{h * 8:04d}_sdxl.npz")
+        np.savez(
+            npz_path,
+            **{
+                "latents" + suffix: rng.standard_normal((4, h, w), dtype=np.float32),
+                "original_size" + suffix: np.array([w * 8, h * 8]),
+                "crop_ltrb" + suffix: np.array([0, 0, w * 8, h * 8]),
+                "latents_flipped" + suffix: rng.standard_normal((4, h, w), dtype=np.float32),
+            },
+        )
+        npz_paths.append((npz_path, suffix))
+    return npz_paths
+
+
+def throughput(npz_paths, store_format: bool, workers: int, batch_size: int, epochs: int):
+    dataset = LatentsDataset(npz_paths, store_format)
+    # one resolution per batch as with buckets
+    batches = [
+        [i for i in range(len(npz_paths)) if i % len(RESOLUTIONS) == r][j : j + batch_size]
+        for r in range(len(RESOLUTIONS))
+        for j in range(0, len(npz_paths) // len(RESOLUTIONS), batch_size)
+    ]
+    loader = DataLoader(dataset, batch_sampler=batches, num_workers=workers, persistent_workers=workers > 0)
+    samples_per_second = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        count = 0
+        for batch in loader:
+            count += len(batch)
+        samples_per_second.append(count / (time.perf_counter() - start))
+    return {"first_epoch": samples_per_second[0], "best_epoch": max(samples_per_second)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="latent-store-benchmark-") as directory:
+        npz_paths = write_npz_caches(directory, args.images)
+        npz_bytes = sum(os.path.getsize(path) for path, _ in npz_paths)
+
+        start = time.perf_counter()
+        latent_store.convert_npz_directory(directory, "_sdxl.npz")
+        convert_seconds = time.perf_counter() - start
+        store_dir = os.path.join(directory, latent_store.STORE_DIR_NAME)
+        store_files = os.listdir(store_dir)
+        store_bytes = sum(os.path.getsize(os.path.join(store_dir, name)) for name in store_files)
+
+        # a fresh process would start with an empty registry and read the index once
+        latent_store._STORES.clear()
+        start = time.perf_counter()
+        latent_store.store_for(npz_paths[0][0])
+        index_seconds = time.perf_counter() - start
+
+        report = {
+            "images": args.images,
+            "npz": {"files": len(npz_paths), "mib": npz_bytes / 1024**2},
+            "store": {"files": len(store_files), "mib": store_bytes / 1024**2},
+            "convert_s": convert_seconds,
+            "index_load_ms": index_seconds * 1000,
+            "samples_per_second": {},
+        }
+        for workers in args.workers:
+            report["samples_per_second"][f"workers_{workers}"] = {
+                "npz": throughput(npz_paths, False, workers, args.batch_size, args.epochs),
+                "store": throughput(npz_paths, True, workers, args.batch_size, args.epochs),
+            }
+        latent_store.store_for(npz_paths[0][0]).close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
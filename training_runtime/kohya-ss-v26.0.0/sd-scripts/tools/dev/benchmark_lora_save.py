@@ -0,0 +1,99 @@
+"""
+Benchmark of saving a LoRA state dict with its addnet hashes.
+
+Usage:
+    python tools/dev/benchmark_lora_save.py [--modules 264] [--dim 32] [--features 1280] [--dtype bf16] [--iterations 5]
+
+Saves a LoRA-shaped state dict (down, up and alpha per module) in turns: as
+before, serializing the whole file to memory with ``safetensors.torch.save`` to
+hash it and then writing it with ``save_file``, and with
+``model_io.save_safetensors_with_hashes``, which hashes the tensor data while
+it is written. Reports the seconds per save and the peak memory allocated by
+Python during a save (``tracemalloc``; the serialized file is a Python bytes
+object, tensor storage is not counted). Both must give the same hashes and
+tensors.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import torch
+from safetensors.torch import load_file, save_file
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from library import model_io
+
+
+def save_serialized_first(state_dict, file, metadata):
+    model_hash, legacy_hash = model_io.precalculate_safetensors_hashes(state_dict, metadata)
+    metadata["sshs_model_hash"] = model_hash
+    metadata["sshs_legacy_hash"] = legacy_hash
+    save_file(state_dict, file, metadata)
+    return model_hash, legacy_hash
+
+
+def measure(save, state_dict, metadata, file, iterations):
+    seconds = 0.0
+    peak = 0
+    for _ in range(iterations):
+        md = dict(metadata)
+        tracemalloc.start()
+        start = time.perf_counter()
+        hashes = save(state_dict, file, md)
+        seconds += time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {"seconds_per_save": seconds / iterations, "peak_python_mb": peak / 1024**2}, hashes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=int, default=264)
+    parser.add_argument("--dim", type=int, default=32)
+    parser.add_argument("--features", type=int, default=1280)
+    parser.add_argument("--dtype", type=str, default="bf16", choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.dtype]
+    torch.manual_seed(0)
+    state_dict = {}
+    for i in range(args.modules):
+        state_dict[f"lora_unet_module_{i}.lora_down.weight"] = torch.randn(args.dim, args.features).to(dtype)
+        state_dict[f"lora_unet_module_{i}.lora_up.weight"] = torch.randn(args.features, args.dim).to(dtype)
+        state_dict[f"lora_unet_module_{i}.alpha"] = torch.tensor(args.dim / 2).to(dtype)
+    metadata = {"ss_network_dim": str(args.dim), "ss_tag_frequency": json.dumps({"tags": {f"tag{i}": i for i in range(2000)}})}
+
+    with tempfile.TemporaryDirectory(prefix="lora-save-benchmark-") as directory:
+        before_file = os.path.join(directory, "before.safetensors")
+        after_file = os.path.join(directory, "after.safetensors")
+        before, before_hashes = measure(save_serialized_first, state_dict, metadata, before_file, args.iterations)
+        after, after_hashes = measure(model_io.save_safetensors_with_hashes, state_dict, metadata, after_file, args.iterations)
+
+        if before_hashes != after_hashes:
+            raise SystemExit(f"hashes differ: {before_hashes} != {after_hashes}")
+        loaded = load_file(after_file)
+        if any(not torch.equal(loaded[key], tensor) for key, tensor in state_dict.items()):
+            raise SystemExit("saved tensors differ")
+        file_mb = os.path.getsize(after_file) / 1024**2
+
+    report = {
+        "modules": args.modules,
+        "dim": args.dim,
+        "dtype": args.dtype,
+        "file_mb": file_mb,
+        "serialized_first": before,
+        "streaming": after,
+        "speedup": before["seconds_per_save"] / after["seconds_per_save"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import functools
 import gc
 import importlib
 import argparse
@@ -39,6 +40,7 @@ import library.logging_util as logging_util
 import library.loss as loss_util
 import library.checkpoint_io as checkpoint_io
 import library.sampling as sampling
+import library.sample_worker as sample_worker
 import library.config_util as config_util
 from library.config_util import (
     ConfigSanitizer,
@@ -67,6 +69,8 @@ class NetworkTrainer:
     def __init__(self):
         self.vae_scale_factor = 0.18215
         self.is_sdxl = False
+        self._checkpoint_saver: Optional[checkpoint_io.AsyncNetworkSaver] = None
+        self._sample_worker: Optional[sample_worker.SampleWorker] = None
 
     # TODO 他のスクリプトと共通化する
     def generate_step_logs(
@@ -228,7 +232,28 @@ class NetworkTrainer:
                 param.grad = accelerator.reduce(param.grad, reduction="mean")
 
     def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizers, text_encoder, unet):
-        sampling.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizers[0], text_encoder, unet)
+        """Returns the seconds spent if images were sampled (trainers returning None are not timed)."""
+        return sampling.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizers[0], text_encoder, unet)
+
+    def _log_sampling_time(self, accelerator: Accelerator, sample_seconds: Optional[float], global_step: int, epoch: int):
+        if sample_seconds is not None:
+            self.step_logging(accelerator, {"samples/seconds": sample_seconds}, global_step, epoch)
+
+    def _sample_images_or_submit(self, accelerator, args, epoch, global_step, network, vae, tokenizers, text_encoder, unet):
+        """Sample in this process, or send the network weights to the sample worker (``--sample_worker_device``)."""
+        if args.sample_worker_device is None:
+            return self.sample_images(accelerator, args, epoch, global_step, accelerator.device, vae, tokenizers, text_encoder, unet)
+        # the worker is started by the main process only and samples all prompts
+        if self._sample_worker is not None and sampling.is_sampling_step(args, epoch, global_step):
+            self._sample_worker.submit(accelerator.unwrap_model(network).state_dict(), args.sample_prompts, epoch, global_step)
+        return None
+
+    def _log_worker_samples(self, accelerator: Accelerator, global_step: int, epoch: int):
+        """Log the samples finished by the worker since the last call (also picked up by the telemetry stream)."""
+        if self._sample_worker is None:
+            return
+        for logs in self._sample_worker.completed():
+            self.step_logging(accelerator, logs, global_step, epoch)
 
     # region SD/SDXL
 
@@ -885,15 +910,52 @@ class NetworkTrainer:
         sai_metadata = self.get_sai_model_spec(args)
         metadata_to_save.update(sai_metadata)
 
+        if self._checkpoint_saver is not None:
+            # the state dict is snapshotted now, serialized, hashed and uploaded by the saver's thread
+            upload = None
+            if args.huggingface_repo_id is not None:
+                upload = functools.partial(
+                    huggingface_util.upload, args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload
+                )
+            self._checkpoint_saver.submit(
+                unwrapped_nw.state_dict(), save_dtype, ckpt_file, dict(metadata_to_save), steps, epoch_no, after_save=upload
+            )
+            return
+
         unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
         if args.huggingface_repo_id is not None:
             huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
 
     def _remove_model(self, *, args: argparse.Namespace, accelerator: Accelerator, old_ckpt_name: str):
         old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
-        if os.path.exists(old_ckpt_file):
-            accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
-            os.remove(old_ckpt_file)
+
+        def remove():
+            if os.path.exists(old_ckpt_file):
+                accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
+                os.remove(old_ckpt_file)
+
+        if self._checkpoint_saver is not None:
+            self._checkpoint_saver.enqueue(remove)  # after the pending saves
+        else:
+            remove()
+
+    def _close_checkpoint_saver_on_error(self):
+        """Wait for the background saves when training stops with an exception; their own failure is only logged."""
+        if self._checkpoint_saver is None:
+            return
+        logger.info("waiting for the checkpoint saves in progress / 保存中のチェックポイントの完了を待っています")
+        try:
+            self._checkpoint_saver.close()
+        except Exception:
+            logger.exception("failed to save checkpoint / チェックポイントの保存に失敗しました")
+        self._checkpoint_saver = None
+
+    def _log_checkpoint_saves(self, accelerator: Accelerator, global_step: int, epoch: int):
+        """Log the background saves finished since the last call (also picked up by the telemetry stream)."""
+        if self._checkpoint_saver is None:
+            return
+        for logs in self._checkpoint_saver.completed():
+            self.step_logging(accelerator, logs, global_step, epoch)
 
     def train(self, args):
         session_id = random.randint(0, 2**32)
@@ -1499,9 +1561,16 @@ class NetworkTrainer:
             gc.collect()
             clean_memory_on_device(accelerator.device)
 
+        if args.sample_worker_device is not None and args.sample_prompts is not None and is_main_process:
+            resolutions = train_dataset_group.get_resolutions()
+            if val_dataset_group is not None:
+                resolutions = resolutions + val_dataset_group.get_resolutions()
+            self._sample_worker = sample_worker.start_sample_worker(type(self), args, resolutions)
+
         # For --sample_at_first
         optimizer_eval_fn()
-        self.sample_images(accelerator, args, 0, global_step, accelerator.device, vae, tokenizers, text_encoder, unet)
+        sample_seconds = self._sample_images_or_submit(accelerator, args, 0, global_step, network, vae, tokenizers, text_encoder, unet)
+        self._log_sampling_time(accelerator, sample_seconds, global_step, 0)
         optimizer_train_fn()
         is_tracking = len(accelerator.trackers) > 0
         if is_tracking:
@@ -1526,6 +1595,9 @@ class NetworkTrainer:
 
         clean_memory_on_device(accelerator.device)
 
+        if args.async_checkpoint_save and is_main_process:
+            self._checkpoint_saver = checkpoint_io.AsyncNetworkSaver(args.max_pending_checkpoint_saves)
+
         progress_bar = tqdm(
             range(args.max_train_steps - initial_step), smoothing=0, disable=not accelerator.is_local_main_process, desc="steps"
         )
@@ -1570,157 +1642,207 @@ class NetworkTrainer:
                     torch.cuda.set_rng_state(gpu_rng_state)
             random.setstate(python_rng_state)
 
-        for epoch in range(epoch_to_start, num_train_epochs):
-            accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}\n")
-            current_epoch.value = epoch + 1
-
-            self._metadata["ss_epoch"] = str(epoch + 1)
+        try:
+            for epoch in range(epoch_to_start, num_train_epochs):
+                accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}\n")
+                current_epoch.value = epoch + 1
 
-            accelerator.unwrap_model(network).on_epoch_start(text_encoder, unet)  # network.train() is called here
+                self._metadata["ss_epoch"] = str(epoch + 1)
 
-            # TRAINING
-            skipped_dataloader = None
-            if initial_step > 0:
-                skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
-                initial_step = 1
+                accelerator.unwrap_model(network).on_epoch_start(text_encoder, unet)  # network.train() is called here
 
-            for step, batch in enumerate(skipped_dataloader or train_dataloader):
-                current_step.value = global_step
+                # TRAINING
+                skipped_dataloader = None
                 if initial_step > 0:
-                    initial_step -= 1
-                    continue
+                    skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
+                    initial_step = 1
 
-                with accelerator.accumulate(training_model):
-                    on_step_start_for_network(text_encoder, unet)
-
-                    # preprocess batch for each model
-                    self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=True)
+                for step, batch in enumerate(skipped_dataloader or train_dataloader):
+                    current_step.value = global_step
+                    if initial_step > 0:
+                        initial_step -= 1
+                        continue
 
-                    loss = self.process_batch(
-                        batch,
-                        text_encoders,
-                        unet,
-                        network,
-                        vae,
-                        noise_scheduler,
-                        vae_dtype,
-                        weight_dtype,
-                        accelerator,
-                        args,
-                        text_encoding_strategy,
-                        tokenize_strategy,
-                        is_train=True,
-                        train_text_encoder=train_text_encoder,
-                        train_unet=train_unet,
-                    )
+                    with accelerator.accumulate(training_model):
+                        on_step_start_for_network(text_encoder, unet)
+
+                        # preprocess batch for each model
+                        self.on_step_start(args, accelerator, network, text_encoders, unet, batch, weight_dtype, is_train=True)
+
+                        loss = self.process_batch(
+                            batch,
+                            text_encoders,
+                            unet,
+                            network,
+                            vae,
+                            noise_scheduler,
+                            vae_dtype,
+                            weight_dtype,
+                            accelerator,
+                            args,
+                            text_encoding_strategy,
+                            tokenize_strategy,
+                            is_train=True,
+                            train_text_encoder=train_text_encoder,
+                            train_unet=train_unet,
+                        )
 
-                    accelerator.backward(loss)
-                    if accelerator.sync_gradients:
-                        self.all_reduce_network(accelerator, network)  # sync DDP grad manually
-                        if args.max_grad_norm != 0.0:
-                            params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
-                            accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
-
-                        if hasattr(network, "update_grad_norms"):
-                            network.update_grad_norms()
-                        if hasattr(network, "update_norms"):
-                            network.update_norms()
-
-                    optimizer.step()
-                    lr_scheduler.step()
-                    optimizer.zero_grad(set_to_none=True)
-
-                if args.scale_weight_norms:
-                    keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
-                        args.scale_weight_norms, accelerator.device
-                    )
-                    mean_grad_norm = None
-                    mean_combined_norm = None
-                    max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
-                else:
-                    if hasattr(network, "weight_norms"):
-                        weight_norms = network.weight_norms()
-                        mean_norm = weight_norms.mean().item() if weight_norms is not None else None
-                        grad_norms = network.grad_norms()
-                        mean_grad_norm = grad_norms.mean().item() if grad_norms is not None else None
-                        combined_weight_norms = network.combined_weight_norms()
-                        mean_combined_norm = combined_weight_norms.mean().item() if combined_weight_norms is not None else None
-                        maximum_norm = weight_norms.max().item() if weight_norms is not None else None
-                        keys_scaled = None
-                        max_mean_logs = {}
-                    else:
-                        keys_scaled, mean_norm, maximum_norm = None, None, None
+                        accelerator.backward(loss)
+                        if accelerator.sync_gradients:
+                            self.all_reduce_network(accelerator, network)  # sync DDP grad manually
+                            if args.max_grad_norm != 0.0:
+                                params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
+                                accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+
+                            if hasattr(network, "update_grad_norms"):
+                                network.update_grad_norms()
+                            if hasattr(network, "update_norms"):
+                                network.update_norms()
+
+                        optimizer.step()
+                        lr_scheduler.step()
+                        optimizer.zero_grad(set_to_none=True)
+
+                    if args.scale_weight_norms:
+                        keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
+                            args.scale_weight_norms, accelerator.device
+                        )
                         mean_grad_norm = None
                         mean_combined_norm = None
-                        max_mean_logs = {}
+                        max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
+                    else:
+                        if hasattr(network, "weight_norms"):
+                            weight_norms = network.weight_norms()
+                            mean_norm = weight_norms.mean().item() if weight_norms is not None else None
+                            grad_norms = network.grad_norms()
+                            mean_grad_norm = grad_norms.mean().item() if grad_norms is not None else None
+                            combined_weight_norms = network.combined_weight_norms()
+                            mean_combined_norm = combined_weight_norms.mean().item() if combined_weight_norms is not None else None
+                            maximum_norm = weight_norms.max().item() if weight_norms is not None else None
+                            keys_scaled = None
+                            max_mean_logs = {}
+                        else:
+                            keys_scaled, mean_norm, maximum_norm = None, None, None
+                            mean_grad_norm = None
+                            mean_combined_norm = None
+                            max_mean_logs = {}
+
+                    # Checks if the accelerator has performed an optimization step behind the scenes
+                    if accelerator.sync_gradients:
+                        progress_bar.update(1)
+                        global_step += 1
 
-                # Checks if the accelerator has performed an optimization step behind the scenes
-                if accelerator.sync_gradients:
-                    progress_bar.update(1)
-                    global_step += 1
+                        optimizer_eval_fn()
+                        sample_seconds = self._sample_images_or_submit(
+                            accelerator, args, None, global_step, network, vae, tokenizers, text_encoder, unet
+                        )
+                        self._log_sampling_time(accelerator, sample_seconds, global_step, epoch + 1)
+                        progress_bar.unpause()
+
+                        # 指定ステップごとにモデルを保存
+                        if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
+                            accelerator.wait_for_everyone()
+                            if accelerator.is_main_process:
+                                ckpt_name = checkpoint_io.get_step_ckpt_name(args, "." + args.save_model_as, global_step)
+                                self._save_model(
+                                    args=args,
+                                    accelerator=accelerator,
+                                    save_dtype=save_dtype,
+                                    ckpt_name=ckpt_name,
+                                    unwrapped_nw=accelerator.unwrap_model(network),
+                                    steps=global_step,
+                                    epoch_no=epoch,
+                                )
 
-                    optimizer_eval_fn()
-                    self.sample_images(
-                        accelerator, args, None, global_step, accelerator.device, vae, tokenizers, text_encoder, unet
-                    )
-                    progress_bar.unpause()
+                                if args.save_state:
+                                    checkpoint_io.save_and_remove_state_stepwise(args, accelerator, global_step)
+
+                                remove_step_no = checkpoint_io.get_remove_step_no(args, global_step)
+                                if remove_step_no is not None:
+                                    remove_ckpt_name = checkpoint_io.get_step_ckpt_name(args, "." + args.save_model_as, remove_step_no)
+                                    self._remove_model(args=args, accelerator=accelerator, old_ckpt_name=remove_ckpt_name)
+                        optimizer_train_fn()
+
+                    current_loss = loss.detach().item()
+                    loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
+                    avr_loss: float = loss_recorder.moving_average
+                    logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
+                    progress_bar.set_postfix(**{**max_mean_logs, **logs})
+
+                    if is_tracking:
+                        logs = self.generate_step_logs(
+                            args,
+                            current_loss,
+                            avr_loss,
+                            lr_scheduler,
+                            lr_descriptions,
+                            optimizer,
+                            keys_scaled,
+                            mean_norm,
+                            maximum_norm,
+                            mean_grad_norm,
+                            mean_combined_norm,
+                        )
+                        self.step_logging(accelerator, logs, global_step, epoch + 1)
+                    self._log_checkpoint_saves(accelerator, global_step, epoch + 1)
+                    self._log_worker_samples(accelerator, global_step, epoch + 1)
+
+                    # VALIDATION PER STEP: global_step is already incremented
+                    # for example, if validate_every_n_steps=100, validate at step 100, 200, 300, ...
+                    should_validate_step = args.validate_every_n_steps is not None and global_step % args.validate_every_n_steps == 0
+                    if accelerator.sync_gradients and validation_steps > 0 and should_validate_step:
+                        optimizer_eval_fn()
+                        accelerator.unwrap_model(network).eval()
+                        rng_states = switch_rng_state(args.validation_seed if args.validation_seed is not None else args.seed)
+
+                        self._run_validation_loop(
+                            mode="step",
+                            accelerator=accelerator,
+                            args=args,
+                            network=network,
+                            text_encoders=text_encoders,
+                            unet=unet,
+                            vae=vae,
+                            noise_scheduler=noise_scheduler,
+                            vae_dtype=vae_dtype,
+                            weight_dtype=weight_dtype,
+                            text_encoding_strategy=text_encoding_strategy,
+                            tokenize_strategy=tokenize_strategy,
+                            val_dataloader=val_dataloader,
+                            validation_steps=validation_steps,
+                            validation_timesteps=validation_timesteps,
+                            validation_total_steps=validation_total_steps,
+                            train_text_encoder=train_text_encoder,
+                            train_unet=train_unet,
+                            epoch=epoch,
+                            global_step=global_step,
+                            is_tracking=is_tracking,
+                            loss_recorder=val_step_loss_recorder,
+                            train_loss_recorder=loss_recorder,
+                        )
 
-                    # 指定ステップごとにモデルを保存
-                    if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
-                        accelerator.wait_for_everyone()
-                        if accelerator.is_main_process:
-                            ckpt_name = checkpoint_io.get_step_ckpt_name(args, "." + args.save_model_as, global_step)
-                            self._save_model(
-                                args=args,
-                                accelerator=accelerator,
-                                save_dtype=save_dtype,
-                                ckpt_name=ckpt_name,
-                                unwrapped_nw=accelerator.unwrap_model(network),
-                                steps=global_step,
-                                epoch_no=epoch,
-                            )
-
-                            if args.save_state:
-                                checkpoint_io.save_and_remove_state_stepwise(args, accelerator, global_step)
-
-                            remove_step_no = checkpoint_io.get_remove_step_no(args, global_step)
-                            if remove_step_no is not None:
-                                remove_ckpt_name = checkpoint_io.get_step_ckpt_name(args, "." + args.save_model_as, remove_step_no)
-                                self._remove_model(args=args, accelerator=accelerator, old_ckpt_name=remove_ckpt_name)
-                    optimizer_train_fn()
+                        restore_rng_state(rng_states)
+                        args.min_timestep = original_args_min_timestep
+                        args.max_timestep = original_args_max_timestep
+                        optimizer_train_fn()
+                        accelerator.unwrap_model(network).train()
+                        progress_bar.unpause()
 
-                current_loss = loss.detach().item()
-                loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
-                avr_loss: float = loss_recorder.moving_average
-                logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**{**max_mean_logs, **logs})
+                    if global_step >= args.max_train_steps:
+                        break
 
-                if is_tracking:
-                    logs = self.generate_step_logs(
-                        args,
-                        current_loss,
-                        avr_loss,
-                        lr_scheduler,
-                        lr_descriptions,
-                        optimizer,
-                        keys_scaled,
-                        mean_norm,
-                        maximum_norm,
-                        mean_grad_norm,
-                        mean_combined_norm,
-                    )
-                    self.step_logging(accelerator, logs, global_step, epoch + 1)
+                # EPOCH VALIDATION
+                should_validate_epoch = (
+                    (epoch + 1) % args.validate_every_n_epochs == 0 if args.validate_every_n_epochs is not None else True
+                )
 
-                # VALIDATION PER STEP: global_step is already incremented
-                # for example, if validate_every_n_steps=100, validate at step 100, 200, 300, ...
-                should_validate_step = args.validate_every_n_steps is not None and global_step % args.validate_every_n_steps == 0
-                if accelerator.sync_gradients and validation_steps > 0 and should_validate_step:
+                if should_validate_epoch and len(val_dataloader) > 0:
                     optimizer_eval_fn()
                     accelerator.unwrap_model(network).eval()
                     rng_states = switch_rng_state(args.validation_seed if args.validation_seed is not None else args.seed)
 
                     self._run_validation_loop(
-                        mode="step",
+                        mode="epoch",
                         accelerator=accelerator,
                         args=args,
                         network=network,
@@ -1741,7 +1863,7 @@ class NetworkTrainer:
                         epoch=epoch,
                         global_step=global_step,
                         is_tracking=is_tracking,
-                        loss_recorder=val_step_loss_recorder,
+                        loss_recorder=val_epoch_loss_recorder,
                         train_loss_recorder=loss_recorder,
                     )
 
@@ -1752,88 +1874,50 @@ class NetworkTrainer:
                     accelerator.unwrap_model(network).train()
                     progress_bar.unpause()
 
-                if global_step >= args.max_train_steps:
-                    break
+                # END OF EPOCH
+                if is_tracking:
+                    logs = {"loss/epoch_average": loss_recorder.moving_average}
+                    self.epoch_logging(accelerator, logs, global_step, epoch + 1)
 
-            # EPOCH VALIDATION
-            should_validate_epoch = (
-                (epoch + 1) % args.validate_every_n_epochs == 0 if args.validate_every_n_epochs is not None else True
-            )
+                accelerator.wait_for_everyone()
 
-            if should_validate_epoch and len(val_dataloader) > 0:
+                # 指定エポックごとにモデルを保存
                 optimizer_eval_fn()
-                accelerator.unwrap_model(network).eval()
-                rng_states = switch_rng_state(args.validation_seed if args.validation_seed is not None else args.seed)
-
-                self._run_validation_loop(
-                    mode="epoch",
-                    accelerator=accelerator,
-                    args=args,
-                    network=network,
-                    text_encoders=text_encoders,
-                    unet=unet,
-                    vae=vae,
-                    noise_scheduler=noise_scheduler,
-                    vae_dtype=vae_dtype,
-                    weight_dtype=weight_dtype,
-                    text_encoding_strategy=text_encoding_strategy,
-                    tokenize_strategy=tokenize_strategy,
-                    val_dataloader=val_dataloader,
-                    validation_steps=validation_steps,
-                    validation_timesteps=validation_timesteps,
-                    validation_total_steps=validation_total_steps,
-                    train_text_encoder=train_text_encoder,
-                    train_unet=train_unet,
-                    epoch=epoch,
-                    global_step=global_step,
-                    is_tracking=is_tracking,
-                    loss_recorder=val_epoch_loss_recorder,
-                    train_loss_recorder=loss_recorder,
-                )
-
-                restore_rng_state(rng_states)
-                args.min_timestep = original_args_min_timestep
-                args.max_timestep = original_args_max_timestep
-                optimizer_train_fn()
-                accelerator.unwrap_model(network).train()
-                progress_bar.unpause()
-
-            # END OF EPOCH
-            if is_tracking:
-                logs = {"loss/epoch_average": loss_recorder.moving_average}
-                self.epoch_logging(accelerator, logs, global_step, epoch + 1)
-
-            accelerator.wait_for_everyone()
-
-            # 指定エポックごとにモデルを保存
-            optimizer_eval_fn()
-            if args.save_every_n_epochs is not None:
-                saving = (epoch + 1) % args.save_every_n_epochs == 0 and (epoch + 1) < num_train_epochs
-                if is_main_process and saving:
-                    ckpt_name = checkpoint_io.get_epoch_ckpt_name(args, "." + args.save_model_as, epoch + 1)
-                    self._save_model(
-                        args=args,
-                        accelerator=accelerator,
-                        save_dtype=save_dtype,
-                        ckpt_name=ckpt_name,
-                        unwrapped_nw=accelerator.unwrap_model(network),
-                        steps=global_step,
-                        epoch_no=epoch + 1,
-                    )
+                if args.save_every_n_epochs is not None:
+                    saving = (epoch + 1) % args.save_every_n_epochs == 0 and (epoch + 1) < num_train_epochs
+                    if is_main_process and saving:
+                        ckpt_name = checkpoint_io.get_epoch_ckpt_name(args, "." + args.save_model_as, epoch + 1)
+                        self._save_model(
+                            args=args,
+                            accelerator=accelerator,
+                            save_dtype=save_dtype,
+                            ckpt_name=ckpt_name,
+                            unwrapped_nw=accelerator.unwrap_model(network),
+                            steps=global_step,
+                            epoch_no=epoch + 1,
+                        )
 
-                    remove_epoch_no = checkpoint_io.get_remove_epoch_no(args, epoch + 1)
-                    if remove_epoch_no is not None:
-                        remove_ckpt_name = checkpoint_io.get_epoch_ckpt_name(args, "." + args.save_model_as, remove_epoch_no)
-                        self._remove_model(args=args, accelerator=accelerator, old_ckpt_name=remove_ckpt_name)
+                        remove_epoch_no = checkpoint_io.get_remove_epoch_no(args, epoch + 1)
+                        if remove_epoch_no is not None:
+                            remove_ckpt_name = checkpoint_io.get_epoch_ckpt_name(args, "." + args.save_model_as, remove_epoch_no)
+                            self._remove_model(args=args, accelerator=accelerator, old_ckpt_name=remove_ckpt_name)
 
-                    if args.save_state:
-                        checkpoint_io.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1)
+                        if args.save_state:
+                            checkpoint_io.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1)
 
-            self.sample_images(accelerator, args, epoch + 1, global_step, accelerator.device, vae, tokenizers, text_encoder, unet)
-            progress_bar.unpause()
-            optimizer_train_fn()
+                sample_seconds = self._sample_images_or_submit(
+                    accelerator, args, epoch + 1, global_step, network, vae, tokenizers, text_encoder, unet
+                )
+                self._log_sampling_time(accelerator, sample_seconds, global_step, epoch + 1)
+                progress_bar.unpause()
+                optimizer_train_fn()
 
-            # end of epoch
+                # end of epoch
+        except BaseException:
+            # the telemetry launcher's pause / cancel raise KeyboardInterrupt from the loop, as do failures: finish the
+            # queued saves and uploads of the saver's (daemon) thread before the exception ends the process
+            self._close_checkpoint_saver_on_error()
+            raise
 
         # metadata["ss_epoch"] = str(num_train_epochs)
         self._metadata["ss_training_finished_at"] = str(time.time())
@@ -1841,6 +1925,18 @@ class NetworkTrainer:
         if is_main_process:
             network = accelerator.unwrap_model(network)
 
+        if self._checkpoint_saver is not None:
+            # wait for the background saves while the trackers are open; the last model is saved synchronously
+            self._checkpoint_saver.close()
+            self._log_checkpoint_saves(accelerator, global_step, num_train_epochs)
+            self._checkpoint_saver = None
+
+        if self._sample_worker is not None:
+            # wait for the samples of the last steps
+            self._sample_worker.close()
+            self._log_worker_samples(accelerator, global_step, num_train_epochs)
+            self._sample_worker = None
+
         accelerator.end_training()
         optimizer_eval_fn()
 
@@ -1886,6 +1982,25 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--no_metadata", action="store_true", help="do not save metadata in output model / メタデータを出力先モデルに保存しない"
     )
+    parser.add_argument(
+        "--async_checkpoint_save",
+        action="store_true",
+        help="save the network weights on a background thread while training goes on (the last model is saved synchronously)"
+        + " / 学習を続けながらバックグラウンドのスレッドでnetworkの重みを保存する（最終モデルは同期的に保存する）",
+    )
+    parser.add_argument(
+        "--max_pending_checkpoint_saves",
+        type=int,
+        default=2,
+        help="max number of background saves not yet written, training waits beyond that (default 2) / 書き込み待ちのバックグラウンド保存の最大数、超えると学習が待機する（デフォルト2）",
+    )
+    parser.add_argument(
+        "--sample_worker_device",
+        type=str,
+        default=None,
+        help="generate sample images in a separate process on this device (e.g. cuda:1, cpu) while training goes on; the process loads its own copy of the base model"
+        + " / 学習を続けながら別プロセスでこのデバイス（例: cuda:1、cpu）を使ってサンプル画像を生成する。プロセスはベースモデルを別途読み込む",
+    )
     parser.add_argument(
         "--save_model_as",
         type=str,
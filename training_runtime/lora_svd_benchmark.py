@@ -0,0 +1,177 @@
+"""Timing benchmark for lora_svd_inspector.py on a synthetic LoRA.
+
+Run with the selected training runtime:
+python lora_svd_benchmark.py --modules 1000 --rank 32
+
+A kohya-style LoRA with ``--modules`` factor pairs is written to a temporary
+directory; no user checkpoint is read.  ``--layout sdxl`` (the default) cycles
+through the distinct (out, in) shapes of an SDXL UNet and text encoder LoRA,
+``--layout widths`` through three square widths.  ``cache`` times a cold
+analysis, a warm repeat served from the report cache, and a repeat after the
+file's mtime was touched (one re-hash, still a cache hit).  ``read`` analyses
+the file uncached in fresh processes, once through the bundled
+``MemoryEfficientSafeOpen`` reader and once through ``safetensors.safe_open``,
+and reports time and peak RSS (Linux), and once more through the bundled
+reader with no cap on the factors pending across shapes (``pending_mb``
+unbounded) for comparison; it also times the former
+quadratic exclusion scan against the set-based one on a LoHa-style key list.
+The result is printed as one JSON document.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import torch
+from safetensors.torch import save_file
+
+import lora_svd_inspector as inspector
+
+
+# (out, in) of the linear layers an SDXL LoRA adapts: attention, cross-attention, feed-forward, projections,
+# time embeddings, and both text encoders
+SDXL_SHAPES = (
+    (640, 640), (640, 2048), (5120, 640), (640, 2560), (640, 1280),
+    (1280, 1280), (1280, 2048), (10240, 1280), (1280, 5120), (320, 1280),
+    (768, 768), (3072, 768), (768, 3072), (5120, 1280),
+)
+LAYOUTS = {"sdxl": SDXL_SHAPES, "widths": ((320, 320), (640, 640), (1280, 1280))}
+
+
+def synthetic_lora(path: Path, modules: int, rank: int, seed: int = 0, layout: str = "sdxl") -> None:
+    generator = torch.Generator().manual_seed(seed)
+    shapes = LAYOUTS[layout]
+    tensors: dict[str, torch.Tensor] = {}
+    for index in range(modules):
+        out_features, in_features = shapes[index % len(shapes)]
+        base = f"lora_unet_block_{index}"
+        tensors[f"{base}.lora_down.weight"] = torch.randn((rank, in_features), generator=generator).to(torch.float16)
+        tensors[f"{base}.lora_up.weight"] = torch.randn((out_features, rank), generator=generator).to(torch.float16)
+        tensors[f"{base}.alpha"] = torch.tensor(float(rank))
+    save_file(tensors, str(path), metadata={"ss_network_dim": str(rank), "ss_steps": "1000"})
+
+
+def timed_run(path: Path) -> tuple[float, dict[str, Any]]:
+    started = time.perf_counter()
+    result = inspector.run({"files": [{"path": str(path)}]}, "cpu")
+    return time.perf_counter() - started, result
+
+
+def cache_benchmark(path: Path, cache_root: Path) -> dict[str, Any]:
+    os.environ["LORA_SVD_CACHE"] = str(cache_root)
+    cold_seconds, cold = timed_run(path)
+    warm_seconds, warm = timed_run(path)
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    touched_seconds, touched = timed_run(path)
+    if warm["reports"][0]["modules"] != cold["reports"][0]["modules"]:
+        raise SystemExit("warm report differs from the cold analysis")
+    return {
+        "cold_ms": cold_seconds * 1000,
+        "warm_ms": warm_seconds * 1000,
+        "touched_ms": touched_seconds * 1000,
+        "warm_cached": warm["reports"][0]["cached"],
+        "touched_cached": touched["reports"][0]["cached"],
+    }
+
+
+def peak_rss_mib() -> float | None:
+    """Peak RSS of this process; ``ru_maxrss`` would include the forking parent."""
+    try:
+        for line in Path("/proc/self/status").read_text(encoding="ascii").splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def read_child(path: Path, reader: str) -> dict[str, Any]:
+    baseline = peak_rss_mib()
+    if reader == "safe_open":
+        inspector.memory_efficient_safe_open = lambda: None  # type: ignore[assignment]
+    elif reader == "uncapped":
+        inspector.MODULE_PENDING_MB = float("inf")
+    started = time.perf_counter()
+    inspector.model_report({"path": str(path)}, torch.device("cpu"), "cpu")
+    seconds = time.perf_counter() - started
+    peak = peak_rss_mib()
+    return {
+        "ms": seconds * 1000,
+        "peak_rss_mib": peak,
+        "analysis_rss_mib": peak - baseline if peak is not None and baseline is not None else None,
+    }
+
+
+def legacy_exclusions(keys: list[str], excluded: list[dict[str, str]]) -> None:
+    """The former quadratic de-duplication, kept verbatim for comparison."""
+    unsupported_tokens = ("hada_", "lokr_", "dora_", "loha_")
+    for key in keys:
+        if any(token in key.lower() for token in unsupported_tokens):
+            base = key.rsplit(".", 1)[0]
+            if not any(entry["id"] == base for entry in excluded):
+                excluded.append({"id": base, "reason": "检测到非标准 LoRA 适配器，未纳入通用 SVD"})
+
+
+def read_benchmark(path: Path, modules: int) -> dict[str, Any]:
+    result: dict[str, Any] = {}
+    for reader in ("memory_efficient", "safe_open", "uncapped"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", "read-child", "--reader", reader, "--path", str(path)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result[reader] = json.loads(output)
+    keys = sorted(
+        f"lora_unet_block_{index}.hada_{name}"
+        for index in range(modules) for name in ("w1_a", "w1_b", "w2_a", "w2_b", "t1", "t2")
+    )
+    timings = {}
+    for name, function in (("legacy", legacy_exclusions), ("set", inspector.unsupported_exclusions)):
+        excluded: list[dict[str, str]] = []
+        started = time.perf_counter()
+        function(keys, excluded)
+        timings[f"{name}_ms"] = (time.perf_counter() - started) * 1000
+        timings[f"{name}_excluded"] = len(excluded)
+    result["exclusion_scan"] = timings
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=int, default=1000)
+    parser.add_argument("--rank", type=int, default=32)
+    parser.add_argument("--layout", choices=tuple(LAYOUTS), default="sdxl")
+    parser.add_argument("--mode", choices=("cache", "read", "read-child"), default="cache")
+    parser.add_argument("--reader", choices=("memory_efficient", "safe_open", "uncapped"), default="memory_efficient")
+    parser.add_argument("--path", type=Path)
+    args = parser.parse_args()
+    if args.mode == "read-child":
+        print(json.dumps(read_child(args.path, args.reader)))
+        return 0
+    with tempfile.TemporaryDirectory(prefix="lora-svd-benchmark-") as directory:
+        path = Path(directory) / "synthetic.safetensors"
+        synthetic_lora(path, args.modules, args.rank, layout=args.layout)
+        report: dict[str, Any] = {
+            "modules": args.modules,
+            "rank": args.rank,
+            "layout": args.layout,
+            "file_mib": path.stat().st_size / (1024 * 1024),
+        }
+        if args.mode == "read":
+            report["read"] = read_benchmark(path, args.modules)
+        else:
+            report["cache"] = cache_benchmark(path, Path(directory) / "cache")
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -2,18 +2,26 @@
 
 The desktop backend invokes this script with an isolated training Python.  It
 intentionally knows only the safetensors container and common factor-pair
-conventions: architecture-specific training code is not imported here.
+conventions: architecture-specific training code is not imported here.  Only
+the bundled runtime's container reader (``library.safetensors_utils``) is
+used when it is installed next to this script.
+``--batch`` analyses any number of checkpoints in one process and streams one
+JSONL report per checkpoint, for comparing a whole training sweep.  Finished
+reports are kept in a small on-disk cache so an unchanged checkpoint is not
+re-analysed when the rank view is opened again.
 """
 
 from __future__ import annotations
 
 import argparse
+import contextlib
 import hashlib
 import json
 import math
 import os
 import re
 import sys
+import tempfile
 import time
 from dataclasses import dataclass
 from pathlib import Path
@@ -26,6 +34,12 @@ from safetensors import safe_open
 ALGORITHM_VERSION = "lora-svd-qr-v1"
 ENERGY_THRESHOLDS = (0.95, 0.99, 0.999)
 NUMERICAL_RANK_EPSILON = 1e-6
+MODULE_BATCH_SIZE = 32
+MODULE_PENDING_MB = 64
+REPORT_CACHE_SCHEMA_VERSION = 1
+REPORT_CACHE_MAX_MB = 64
+KOHYA_SCRIPTS = Path(__file__).resolve().parent / "kohya-ss-v26.0.0" / "sd-scripts"
+UNSUPPORTED_TOKENS = ("hada_", "lokr_", "dora_", "loha_")
 
 
 @dataclass(frozen=True)
@@ -96,6 +110,159 @@ def sha256(path: Path) -> str:
     return digest.hexdigest()
 
 
+def report_cache_root() -> Path:
+    configured = os.environ.get("LORA_SVD_CACHE")
+    return Path(configured).expanduser() if configured else Path.home() / ".cache" / "danbooru-lora-svd"
+
+
+class ReportCache:
+    """Size-bounded on-disk cache of checkpoint reports.
+
+    A report depends only on the file content and the analysis algorithm, so
+    it is stored under the file's SHA-256 and ``ALGORITHM_VERSION``.  A small
+    per-path index remembers the digest for a ``(size, mtime)`` pair; while
+    both still match, the full-file hash is skipped.  A touched but unchanged
+    file is re-hashed once and then hits the same report.  The least recently
+    used reports are removed once the directory exceeds its byte budget, and
+    with them the index entries that point at them.
+    """
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @classmethod
+    def open(cls) -> "ReportCache":
+        try:
+            max_bytes = int(float(os.environ.get("LORA_SVD_CACHE_MAX_MB", REPORT_CACHE_MAX_MB)) * 1024 * 1024)
+        except ValueError:
+            max_bytes = REPORT_CACHE_MAX_MB * 1024 * 1024
+        return cls(report_cache_root(), max(0, max_bytes))
+
+    def _index_path(self, path: Path) -> Path:
+        return self.root / "index" / f"{hashlib.sha256(str(path).encode('utf-8')).hexdigest()[:40]}.json"
+
+    def _report_path(self, digest: str) -> Path:
+        return self.root / "reports" / digest[:2] / f"{digest}-{ALGORITHM_VERSION}-v{REPORT_CACHE_SCHEMA_VERSION}.json"
+
+    def digest(self, path: Path) -> str:
+        """SHA-256 of ``path``, reusing the indexed digest while size and mtime match."""
+        stat = path.stat()
+        index = self._index_path(path)
+        try:
+            entry = json.loads(index.read_text(encoding="utf-8"))
+            if (
+                isinstance(entry, dict) and entry.get("path") == str(path)
+                and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns
+                and isinstance(entry.get("sha256"), str)
+            ):
+                return entry["sha256"]
+        except (OSError, ValueError):
+            pass
+        digest = sha256(path)
+        after = path.stat()
+        if self.max_bytes > 0 and (after.st_size, after.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            self._write(index, {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest})
+        return digest
+
+    def get(self, digest: str) -> dict[str, Any] | None:
+        path = self._report_path(digest)
+        try:
+            report = json.loads(path.read_text(encoding="utf-8"))
+            if not isinstance(report, dict):
+                raise ValueError("report cache entry is not an object")
+            os.utime(path)  # recency for LRU eviction
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return report
+
+    def put(self, digest: str, report: dict[str, Any]) -> None:
+        if self.max_bytes <= 0:
+            return
+        if self._write(self._report_path(digest), json_safe(report)):
+            self.stored += 1
+
+    def _write(self, path: Path, value: dict[str, Any]) -> bool:
+        temporary: str | None = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                mode="w", encoding="utf-8", prefix=f"{path.stem}-", suffix=".tmp", dir=path.parent, delete=False,
+            ) as stream:
+                temporary = stream.name
+                json.dump(value, stream, ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+            os.replace(temporary, path)
+            return True
+        except (OSError, ValueError):
+            # A read-only or full cache disk must not fail the analysis.
+            if temporary is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(temporary)
+            return False
+
+    def prune(self) -> None:
+        """Remove least recently used reports until 90% of the budget remains.
+
+        Index entries whose digest no longer has a report are removed too, so
+        the lookups of evicted reports do not pile up.
+        """
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        try:
+            for shard in os.scandir(self.root / "reports"):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        except OSError:
+            return
+        kept: set[str] = set()
+        target = int(self.max_bytes * 0.9) if total > self.max_bytes else total
+        for _, size, path in sorted(entries):
+            if total > target:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                else:
+                    total -= size
+                    self.evicted += 1
+                    continue
+            kept.add(os.path.basename(path).split("-", 1)[0])
+        self._prune_index(kept)
+
+    def _prune_index(self, digests: set[str]) -> None:
+        try:
+            entries = list(os.scandir(self.root / "index"))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                digest = json.loads(Path(entry.path).read_text(encoding="utf-8")).get("sha256")
+            except (OSError, ValueError, AttributeError):
+                digest = None
+            if digest not in digests:
+                with contextlib.suppress(OSError):
+                    os.unlink(entry.path)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "stored": self.stored, "evicted": self.evicted}
+
+
+def open_report_cache(request: dict[str, Any]) -> ReportCache | None:
+    return ReportCache.open() if request.get("cache", True) is not False else None
+
+
 def numeric(value: Any) -> float | None:
     try:
         parsed = float(value)
@@ -222,9 +389,77 @@ def pair_candidates(keys: list[str]) -> tuple[list[tuple[str, PairConvention]],
     return pairs, consumed
 
 
+def memory_efficient_safe_open() -> Any | None:
+    """Return kohya's ``MemoryEfficientSafeOpen`` if the bundled runtime has it."""
+    try:
+        from library.safetensors_utils import MemoryEfficientSafeOpen  # type: ignore
+    except ImportError:
+        if not KOHYA_SCRIPTS.is_dir() or str(KOHYA_SCRIPTS) in sys.path:
+            return None
+        sys.path.append(str(KOHYA_SCRIPTS))
+        try:
+            from library.safetensors_utils import MemoryEfficientSafeOpen  # type: ignore
+        except ImportError:
+            return None
+    return MemoryEfficientSafeOpen
+
+
+class FactorReader:
+    """Header-indexed, one-tensor-at-a-time view of a safetensors file.
+
+    Keys and metadata come from the JSON header only; tensor bytes are read
+    when a factor is requested, so peak memory follows the largest module
+    rather than the file.  ``MemoryEfficientSafeOpen`` from the bundled
+    runtime is preferred, ``safetensors.safe_open`` is the fallback.
+    """
+
+    def __init__(self, path: Path) -> None:
+        opener = memory_efficient_safe_open()
+        if opener is not None:
+            self._handle = opener(str(path))
+            self._close = self._handle.__exit__
+        else:
+            context = safe_open(str(path), framework="pt", device="cpu")
+            self._handle = context.__enter__()
+            self._close = context.__exit__
+        # Same sorted order as ``safe_open().keys()``.
+        self._keys = sorted(self._handle.keys())
+        self._key_set = set(self._keys)
+
+    def __enter__(self) -> "FactorReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._close(None, None, None)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._key_set
+
+    def keys(self) -> list[str]:
+        return self._keys
+
+    def metadata(self) -> dict[str, str]:
+        return dict(self._handle.metadata() or {})
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        return self._handle.get_tensor(key)
+
+
+def unsupported_exclusions(keys: Iterable[str], excluded: list[dict[str, str]]) -> None:
+    """Append one exclusion per non-standard adapter module not yet excluded."""
+    seen = {entry["id"] for entry in excluded}
+    for key in keys:
+        lowered = key.lower()
+        if any(token in lowered for token in UNSUPPORTED_TOKENS):
+            base = key.rsplit(".", 1)[0]
+            if base not in seen:
+                seen.add(base)
+                excluded.append({"id": base, "reason": "检测到非标准 LoRA 适配器，未纳入通用 SVD"})
+
+
 def alpha_for(handle: Any, base: str, rank: int, metadata: dict[str, str], device: torch.device) -> float:
     for key in (base + ".alpha", base + ".lora_alpha", base + ".alpha.weight"):
-        if key not in handle.keys():
+        if key not in handle:
             continue
         tensor = handle.get_tensor(key).detach().to(device="cpu", dtype=torch.float32)
         if tensor.numel() == 1:
@@ -234,13 +469,14 @@ def alpha_for(handle: Any, base: str, rank: int, metadata: dict[str, str], devic
     return numeric(metadata.get("ss_network_alpha")) or float(rank)
 
 
-def analyse_pair(
+def load_pair(
     handle: Any,
     base: str,
     convention: PairConvention,
     metadata: dict[str, str],
     device: torch.device,
-) -> tuple[dict[str, Any] | None, str | None]:
+) -> tuple[tuple[torch.Tensor, torch.Tensor, float] | None, str | None]:
+    """Validate one factor pair and return its float32 ``(B, A, alpha)``."""
     down = handle.get_tensor(base + convention.down_suffix)
     up = handle.get_tensor(base + convention.up_suffix)
     if down.ndim < 2 or up.ndim < 2:
@@ -258,17 +494,25 @@ def analyse_pair(
         right = down.detach().to(device=device, dtype=torch.float32).reshape(rank, -1)
         if not torch.isfinite(left).all() or not torch.isfinite(right).all():
             return None, "因子包含 NaN 或 Infinity"
-        # ΔW = B A.  QR(B)=QbRb and QR(Aᵀ)=QaRa, so its non-zero singular
-        # values equal svdvals(Rb Raᵀ).  This avoids materialising ΔW.
-        _, r_left = torch.linalg.qr(left, mode="reduced")
-        _, r_right = torch.linalg.qr(right.transpose(0, 1), mode="reduced")
-        core = r_left @ r_right.transpose(0, 1)
         alpha = alpha_for(handle, base, rank, metadata, device)
-        scale = alpha / rank
-        singular = torch.linalg.svdvals(core).detach().to(device="cpu", dtype=torch.float64)
-        singular = singular.mul(abs(scale))
     except RuntimeError as error:
         return None, f"SVD 计算失败：{error}"
+    return (left, right, alpha), None
+
+
+def spectrum(left: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+    """Singular values of ``left @ right``, batched over leading dimensions."""
+    # ΔW = B A.  QR(B)=QbRb and QR(Aᵀ)=QaRa, so its non-zero singular
+    # values equal svdvals(Rb Raᵀ).  This avoids materialising ΔW.
+    _, r_left = torch.linalg.qr(left, mode="reduced")
+    _, r_right = torch.linalg.qr(right.transpose(-2, -1), mode="reduced")
+    core = r_left @ r_right.transpose(-2, -1)
+    return torch.linalg.svdvals(core)
+
+
+def module_result(base: str, rank: int, alpha: float, singular: torch.Tensor) -> tuple[dict[str, Any] | None, str | None]:
+    scale = alpha / rank
+    singular = singular.detach().to(device="cpu", dtype=torch.float64).mul(abs(scale))
     if not singular.numel() or float(singular[0]) <= 0:
         return None, "ΔW 为零矩阵，无法形成有效奇异值谱"
     energy = singular.square()
@@ -294,6 +538,84 @@ def analyse_pair(
     }, None
 
 
+def analyse_pair(
+    handle: Any,
+    base: str,
+    convention: PairConvention,
+    metadata: dict[str, str],
+    device: torch.device,
+) -> tuple[dict[str, Any] | None, str | None]:
+    loaded, reason = load_pair(handle, base, convention, metadata, device)
+    if loaded is None:
+        return None, reason
+    left, right, alpha = loaded
+    try:
+        singular = spectrum(left, right)
+    except RuntimeError as error:
+        return None, f"SVD 计算失败：{error}"
+    return module_result(base, int(left.shape[1]), alpha, singular)
+
+
+def analyse_pairs(
+    handle: Any,
+    candidates: list[tuple[str, PairConvention]],
+    metadata: dict[str, str],
+    device: torch.device,
+    batch_size: int = MODULE_BATCH_SIZE,
+    pending_mb: float | None = None,
+) -> list[tuple[dict[str, Any] | None, str | None]]:
+    """Analyse every candidate pair, in candidate order.
+
+    Pairs whose factors have the same shapes are stacked and decomposed by
+    one batched QR/QR/svdvals call of at most ``batch_size`` modules, which
+    replaces thousands of tiny serial LAPACK calls.  Partial groups of all
+    shapes together hold at most ``pending_mb`` (``MODULE_PENDING_MB``) of
+    factors, or one module if that is larger; beyond it the largest group is decomposed early, so
+    a LoRA with many distinct shapes is never held in memory as a whole.  A
+    group that fails is retried module by module so an error stays scoped
+    to its own module.
+    """
+    results: list[tuple[dict[str, Any] | None, str | None]] = [(None, None)] * len(candidates)
+    pending: dict[tuple[tuple[int, ...], tuple[int, ...]], list[tuple[int, str, torch.Tensor, torch.Tensor, float]]] = {}
+    pending_bytes: dict[tuple[tuple[int, ...], tuple[int, ...]], int] = {}
+    limit = (MODULE_PENDING_MB if pending_mb is None else pending_mb) * 1024 * 1024
+
+    def flush(group: list[tuple[int, str, torch.Tensor, torch.Tensor, float]]) -> None:
+        try:
+            singular = spectrum(torch.stack([entry[2] for entry in group]), torch.stack([entry[3] for entry in group]))
+        except RuntimeError:
+            singular = None
+        for row, (index, base, left, right, alpha) in enumerate(group):
+            if singular is not None:
+                results[index] = module_result(base, int(left.shape[1]), alpha, singular[row])
+                continue
+            try:
+                results[index] = module_result(base, int(left.shape[1]), alpha, spectrum(left, right))
+            except RuntimeError as error:
+                results[index] = (None, f"SVD 计算失败：{error}")
+
+    for index, (base, convention) in enumerate(candidates):
+        loaded, reason = load_pair(handle, base, convention, metadata, device)
+        if loaded is None:
+            results[index] = (None, reason)
+            continue
+        left, right, alpha = loaded
+        key = (tuple(left.shape), tuple(right.shape))
+        group = pending.setdefault(key, [])
+        group.append((index, base, left, right, alpha))
+        pending_bytes[key] = pending_bytes.get(key, 0) + left.numel() * left.element_size() + right.numel() * right.element_size()
+        if len(group) >= max(1, batch_size):
+            pending_bytes.pop(key)
+            flush(pending.pop(key))
+        while pending and sum(pending_bytes.values()) > limit:
+            largest = max(pending_bytes, key=pending_bytes.__getitem__)
+            pending_bytes.pop(largest)
+            flush(pending.pop(largest))
+    for group in pending.values():
+        flush(group)
+    return results
+
+
 def global_uniform_rank(modules: list[dict[str, Any]]) -> tuple[dict[str, int], float]:
     total = sum(float(module["energy"]) for module in modules)
     max_rank = max((int(module["rank"]) for module in modules), default=0)
@@ -333,6 +655,7 @@ def nonstandard_report(
     adapter_format: str,
     started: float,
     device_reason: str,
+    digest: str,
 ) -> dict[str, Any]:
     """Report LoHa/LoKr without fabricating a standard-LoRA SVD result."""
     step = numeric(metadata.get("ss_steps"))
@@ -342,7 +665,7 @@ def nonstandard_report(
         "label": str(item.get("label") or path.stem),
         "path": str(path),
         "file_size_bytes": path.stat().st_size,
-        "sha256": sha256(path),
+        "sha256": digest,
         "modified_at": int(path.stat().st_mtime),
         "step": int(step) if step is not None else None,
         "architecture": architecture_for(metadata, keys),
@@ -366,40 +689,71 @@ def nonstandard_report(
         "global_cumulative_energy": [],
         "analysis_duration_ms": int((time.perf_counter() - started) * 1000),
         "device_reason": device_reason,
+        "cached": False,
     }
 
 
-def model_report(item: dict[str, Any], device: torch.device, device_reason: str) -> dict[str, Any]:
+def model_report(
+    item: dict[str, Any],
+    device: torch.device,
+    device_reason: str,
+    module_batch_size: int = MODULE_BATCH_SIZE,
+    cache: ReportCache | None = None,
+) -> dict[str, Any]:
     path = Path(str(item["path"])).expanduser().resolve()
     if path.suffix.lower() != ".safetensors":
         raise ValueError(f"仅支持 .safetensors LoRA：{path}")
     if not path.is_file():
         raise ValueError(f"LoRA 文件不存在或不是常规文件：{path}")
     started = time.perf_counter()
-    with safe_open(str(path), framework="pt", device="cpu") as handle:
-        keys = list(handle.keys())
-        metadata = dict(handle.metadata() or {})
+    digest = cache.digest(path) if cache is not None else sha256(path)
+    cached = cache.get(digest) if cache is not None else None
+    if cached is not None:
+        # Content-addressed: refresh the fields that describe this path/request.
+        cached.update({
+            "id": hashlib.sha256(str(path).encode("utf-8")).hexdigest()[:20],
+            "label": str(item.get("label") or path.stem),
+            "path": str(path),
+            "modified_at": int(path.stat().st_mtime),
+            "analysis_duration_ms": int((time.perf_counter() - started) * 1000),
+            "device_reason": device_reason,
+            "cached": True,
+        })
+        return cached
+    report = analysed_report(item, path, device, device_reason, module_batch_size, started, digest)
+    if cache is not None:
+        cache.put(digest, report)
+    return report
+
+
+def analysed_report(
+    item: dict[str, Any],
+    path: Path,
+    device: torch.device,
+    device_reason: str,
+    module_batch_size: int,
+    started: float,
+    digest: str,
+) -> dict[str, Any]:
+    with FactorReader(path) as handle:
+        keys = handle.keys()
+        metadata = handle.metadata()
         candidates, _ = pair_candidates(keys)
         modules: list[dict[str, Any]] = []
         excluded: list[dict[str, str]] = []
         formats: set[str] = set()
-        for base, convention in candidates:
+        analysed = analyse_pairs(handle, candidates, metadata, device, module_batch_size)
+        for (base, convention), (result, reason) in zip(candidates, analysed):
             formats.add(convention.name)
-            result, reason = analyse_pair(handle, base, convention, metadata, device)
             if result is None:
                 excluded.append({"id": base, "reason": reason or "未知分析错误"})
             else:
                 modules.append(result)
-        unsupported_tokens = ("hada_", "lokr_", "dora_", "loha_")
-        for key in keys:
-            if any(token in key.lower() for token in unsupported_tokens):
-                base = key.rsplit(".", 1)[0]
-                if not any(entry["id"] == base for entry in excluded):
-                    excluded.append({"id": base, "reason": "检测到非标准 LoRA 适配器，未纳入通用 SVD"})
+        unsupported_exclusions(keys, excluded)
     if not modules:
         adapter_format = nonstandard_adapter_format(keys)
         if adapter_format:
-            return nonstandard_report(item, path, metadata, keys, excluded, adapter_format, started, device_reason)
+            return nonstandard_report(item, path, metadata, keys, excluded, adapter_format, started, device_reason, digest)
         raise ValueError("没有可分析的 LoRA 因子对；请确认这是标准 LoRA safetensors 文件")
     modules.sort(key=lambda module: (-float(module["energy"]), module["id"]))
     ranks = [int(module["rank"]) for module in modules]
@@ -435,7 +789,7 @@ def model_report(item: dict[str, Any], device: torch.device, device_reason: str)
         "label": str(item.get("label") or path.stem),
         "path": str(path),
         "file_size_bytes": path.stat().st_size,
-        "sha256": sha256(path),
+        "sha256": digest,
         "modified_at": int(path.stat().st_mtime),
         "step": int(step) if step is not None else None,
         "architecture": architecture_for(metadata, keys),
@@ -461,6 +815,7 @@ def model_report(item: dict[str, Any], device: torch.device, device_reason: str)
         "global_cumulative_energy": cumulative_energy,
         "analysis_duration_ms": int((time.perf_counter() - started) * 1000),
         "device_reason": device_reason,
+        "cached": False,
     }
 
 
@@ -504,7 +859,10 @@ def run(request: dict[str, Any], requested_device: str) -> dict[str, Any]:
         raise ValueError("一次分析必须选择 1 到 5 个 LoRA 文件")
     device, reason = resolve_device(requested_device)
     started = time.perf_counter()
-    reports = [model_report(item, device, reason) for item in files]
+    cache = open_report_cache(request)
+    reports = [model_report(item, device, reason, cache=cache) for item in files]
+    if cache is not None and cache.stored:
+        cache.prune()
     reports.sort(key=lambda report: (report["step"] is None, report["step"] or report["modified_at"], report["label"]))
     return {
         "algorithm_version": ALGORITHM_VERSION,
@@ -514,16 +872,71 @@ def run(request: dict[str, Any], requested_device: str) -> dict[str, Any]:
             "device": str(device), "reason": reason,
             "duration_ms": int((time.perf_counter() - started) * 1000),
             "fallback": requested_device.startswith("cuda") and device.type != "cuda",
+            "cache": cache.stats() if cache is not None else None,
         },
     }
 
 
+def run_batch(request: dict[str, Any], requested_device: str, write: Any = print) -> int:
+    """Stream one JSONL record per checkpoint for an unbounded sweep.
+
+    Unlike ``run`` there is no file-count limit and reports are not held
+    until the end: each ``report`` (or per-file ``error``) record is written
+    as soon as that checkpoint is analysed, and a final ``complete`` record
+    carries the comparison built from the checkpoint summaries.
+    """
+    files = request.get("files")
+    if not isinstance(files, list) or not files:
+        raise ValueError("批量分析至少需要一个 LoRA 文件")
+    try:
+        module_batch_size = max(1, int(request.get("module_batch_size", MODULE_BATCH_SIZE)))
+    except (TypeError, ValueError) as error:
+        raise ValueError("module_batch_size 必须为正整数") from error
+    device, reason = resolve_device(requested_device)
+    started = time.perf_counter()
+    cache = open_report_cache(request)
+    summaries: list[dict[str, Any]] = []
+    failed = 0
+    for index, item in enumerate(files):
+        try:
+            report = model_report(item, device, reason, module_batch_size, cache)
+        except Exception as error:
+            failed += 1
+            write(json_for_stdout({"type": "error", "index": index, "path": str(item.get("path", "")), "error": str(error)}))
+            continue
+        write(json_for_stdout({"type": "report", "index": index, "report": report}))
+        summaries.append({key: report[key] for key in (
+            "id", "label", "step", "modified_at", "architecture", "format", "svd_applicable",
+            "effective_rank", "rank_distribution", "tail_energy_20",
+        )})
+    summaries.sort(key=lambda report: (report["step"] is None, report["step"] or report["modified_at"], report["label"]))
+    if cache is not None and cache.stored:
+        cache.prune()
+    write(json_for_stdout({
+        "type": "complete",
+        "algorithm_version": ALGORITHM_VERSION,
+        "count": len(summaries),
+        "failed": failed,
+        "comparison": comparison_for(summaries),
+        "execution": {
+            "device": str(device), "reason": reason,
+            "duration_ms": int((time.perf_counter() - started) * 1000),
+            "fallback": requested_device.startswith("cuda") and device.type != "cuda",
+            "cache": cache.stats() if cache is not None else None,
+        },
+    }))
+    return 0 if summaries else 1
+
+
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch", action="store_true", help="stream one JSONL report per checkpoint")
     args = parser.parse_args()
     try:
         request = json_from_utf8_bytes(sys.stdin.buffer.read())
+        if args.batch:
+            return run_batch(request, args.device, lambda line: print(line, flush=True))
         print(json_for_stdout(run(request, args.device)))
         return 0
     except Exception as error:  # backend turns this into a structured API failure
@@ -5,9 +5,11 @@ python lora_svd_inspector_test.py
 from __future__ import annotations
 
 import json
+import os
 import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
 import torch
 from safetensors.torch import save_file
@@ -15,7 +17,26 @@ from safetensors.torch import save_file
 import lora_svd_inspector as inspector
 
 
+def sweep_checkpoint(path: Path, seed: int, steps: int) -> None:
+    generator = torch.Generator().manual_seed(seed)
+    tensors: dict[str, torch.Tensor] = {}
+    for index in range(12):
+        rank, width = (4, 24) if index % 3 else (8, 40)
+        tensors[f"lora_unet_block_{index}.lora_down.weight"] = torch.randn((rank, width), generator=generator)
+        tensors[f"lora_unet_block_{index}.lora_up.weight"] = torch.randn((width + 8, rank), generator=generator)
+        tensors[f"lora_unet_block_{index}.alpha"] = torch.tensor(float(rank) / 2)
+    save_file(tensors, str(path), metadata={"ss_steps": str(steps)})
+
+
 class LoraSvdInspectorTests(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_root = Path(directory.name)
+        patcher = mock.patch.dict(os.environ, {"LORA_SVD_CACHE": str(self.cache_root)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_json_safe_replaces_unpaired_unicode_surrogates_before_stdout(self) -> None:
         payload = {"metadata": {"broken": "value\udcff"}, "items": ["正常文本"]}
 
@@ -108,5 +129,165 @@ class LoraSvdInspectorTests(unittest.TestCase):
         self.assertFalse(report["modules"])
 
 
+    def test_batched_module_spectra_match_the_per_module_decomposition(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "sweep.safetensors"
+            sweep_checkpoint(path, 7, 100)
+            batched = inspector.model_report({"path": str(path)}, torch.device("cpu"), "cpu", module_batch_size=5)
+            serial = inspector.model_report({"path": str(path)}, torch.device("cpu"), "cpu", module_batch_size=1)
+
+        self.assertEqual([module["id"] for module in batched["modules"]], [module["id"] for module in serial["modules"]])
+        for left, right in zip(batched["modules"], serial["modules"]):
+            self.assertEqual(left["effective_rank"], right["effective_rank"])
+            for value, expected in zip(left["singular_values"], right["singular_values"]):
+                self.assertAlmostEqual(value, expected, delta=1e-4 * max(1.0, expected))
+        self.assertEqual(batched["effective_rank"], serial["effective_rank"])
+
+    def test_pending_modules_of_many_shapes_stay_under_the_memory_cap(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "shapes.safetensors"
+            generator = torch.Generator().manual_seed(3)
+            tensors: dict[str, torch.Tensor] = {}
+            for index in range(40):
+                width = 16 + 8 * (index % 20)  # twenty distinct shapes, interleaved as in a real LoRA
+                tensors[f"lora_unet_block_{index}.lora_down.weight"] = torch.randn((4, width), generator=generator)
+                tensors[f"lora_unet_block_{index}.lora_up.weight"] = torch.randn((width, 4), generator=generator)
+            save_file(tensors, str(path))
+            largest_module = 2 * 4 * (16 + 8 * 19) * 4
+
+            limit = 3 * largest_module
+            live: dict[str, int] = {}
+            peak = [0]
+            load_pair, module_result = inspector.load_pair, inspector.module_result
+
+            def counting_load_pair(handle: object, base: str, *args: object) -> object:
+                loaded = load_pair(handle, base, *args)
+                live[base] = sum(factor.numel() * factor.element_size() for factor in loaded[0][:2])
+                peak[0] = max(peak[0], sum(live.values()))
+                return loaded
+
+            def counting_module_result(base: str, *args: object) -> object:
+                del live[base]
+                return module_result(base, *args)
+
+            with inspector.FactorReader(path) as handle:
+                candidates, _ = inspector.pair_candidates(handle.keys())
+                unbounded = inspector.analyse_pairs(handle, candidates, {}, torch.device("cpu"))
+                with mock.patch.object(inspector, "load_pair", counting_load_pair), \
+                        mock.patch.object(inspector, "module_result", counting_module_result):
+                    capped = inspector.analyse_pairs(
+                        handle, candidates, {}, torch.device("cpu"), pending_mb=limit / (1024 * 1024)
+                    )
+
+        self.assertEqual([result["singular_values"] for result, _ in capped], [result["singular_values"] for result, _ in unbounded])
+        self.assertLessEqual(peak[0], limit + largest_module)  # the cap plus the module that crossed it
+        self.assertEqual(live, {})
+
+    def test_batch_mode_streams_one_record_per_checkpoint_and_keeps_going_after_errors(self) -> None:
+        lines: list[str] = []
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for index, steps in enumerate((300, 100, 200)):
+                path = Path(directory) / f"step-{steps}.safetensors"
+                sweep_checkpoint(path, index, steps)
+                files.append({"path": str(path)})
+            files.insert(1, {"path": str(Path(directory) / "missing.safetensors")})
+
+            self.assertEqual(inspector.run_batch({"files": files}, "cpu", lines.append), 0)
+
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([record["type"] for record in records], ["report", "error", "report", "report", "complete"])
+        self.assertEqual([record["index"] for record in records[:4]], [0, 1, 2, 3])
+        self.assertEqual(records[0]["report"]["step"], 300)
+        self.assertEqual(records[-1]["count"], 3)
+        self.assertEqual(records[-1]["failed"], 1)
+        self.assertEqual([checkpoint["step"] for checkpoint in records[-1]["comparison"]["checkpoints"]], [100, 200, 300])
+
+
+    def test_unchanged_checkpoint_is_served_from_the_report_cache_without_rehashing(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "sweep.safetensors"
+            sweep_checkpoint(path, 3, 50)
+            cold = inspector.run({"files": [{"path": str(path), "label": "cold"}]}, "cpu")
+            with mock.patch.object(inspector, "sha256", wraps=inspector.sha256) as hashed, \
+                    mock.patch.object(inspector, "analysed_report") as analysed:
+                warm = inspector.run({"files": [{"path": str(path), "label": "warm"}]}, "cpu")
+            self.assertEqual(hashed.call_count, 0)
+            analysed.assert_not_called()
+
+            # A touched but identical file is hashed once more and still hits.
+            stat = path.stat()
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+            with mock.patch.object(inspector, "sha256", wraps=inspector.sha256) as hashed:
+                touched = inspector.run({"files": [{"path": str(path)}]}, "cpu")
+            self.assertEqual(hashed.call_count, 1)
+
+            sweep_checkpoint(path, 4, 50)
+            changed = inspector.run({"files": [{"path": str(path)}]}, "cpu")
+
+        self.assertEqual(cold["execution"]["cache"], {"hits": 0, "misses": 1, "stored": 1, "evicted": 0})
+        self.assertEqual(warm["execution"]["cache"]["hits"], 1)
+        self.assertTrue(warm["reports"][0]["cached"])
+        self.assertEqual(warm["reports"][0]["label"], "warm")
+        self.assertEqual(warm["reports"][0]["modules"], cold["reports"][0]["modules"])
+        self.assertTrue(touched["reports"][0]["cached"])
+        self.assertFalse(changed["reports"][0]["cached"])
+        self.assertNotEqual(changed["reports"][0]["sha256"], cold["reports"][0]["sha256"])
+
+    def test_a_new_algorithm_version_never_returns_an_older_report(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "sweep.safetensors"
+            sweep_checkpoint(path, 3, 50)
+            inspector.run({"files": [{"path": str(path)}]}, "cpu")
+            with mock.patch.object(inspector, "ALGORITHM_VERSION", "lora-svd-qr-test"):
+                report = inspector.run({"files": [{"path": str(path)}]}, "cpu")["reports"][0]
+
+        self.assertFalse(report["cached"])
+
+    def test_report_cache_evicts_least_recently_used_reports_beyond_its_budget(self) -> None:
+        cache = inspector.ReportCache(self.cache_root, max_bytes=2500)
+        for index, digest in enumerate(("aa" * 32, "bb" * 32, "cc" * 32)):
+            cache.put(digest, {"payload": "x" * 1000})
+            os.utime(cache._report_path(digest), (1000 + index, 1000 + index))
+        for digest in ("aa" * 32, "bb" * 32, "cc" * 32, "dd" * 32):  # dd: analysed, but its report was never stored
+            cache._write(cache._index_path(Path(f"/loras/{digest[0]}.safetensors")), {"sha256": digest})
+        self.assertIsNotNone(cache.get("aa" * 32))
+
+        cache.prune()
+
+        self.assertIsNotNone(cache.get("aa" * 32))
+        self.assertIsNone(cache.get("bb" * 32))
+        self.assertIsNotNone(cache.get("cc" * 32))
+        self.assertEqual(cache.evicted, 1)
+        self.assertEqual(
+            sorted(path.name for path in (self.cache_root / "index").iterdir()),
+            sorted(cache._index_path(Path(f"/loras/{name}.safetensors")).name for name in ("a", "c")),
+        )
+
+
+    def test_memory_efficient_reader_and_safe_open_fallback_produce_the_same_report(self) -> None:
+        self.assertIsNotNone(inspector.memory_efficient_safe_open())
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "sweep.safetensors"
+            sweep_checkpoint(path, 5, 10)
+            preferred = inspector.model_report({"path": str(path)}, torch.device("cpu"), "cpu")
+            with mock.patch.object(inspector, "memory_efficient_safe_open", return_value=None):
+                fallback = inspector.model_report({"path": str(path)}, torch.device("cpu"), "cpu")
+
+        for key in ("modules", "effective_rank", "global_singular_values", "excluded", "sha256"):
+            self.assertEqual(preferred[key], fallback[key])
+
+    def test_unsupported_adapter_modules_are_excluded_once_in_key_order(self) -> None:
+        excluded = [{"id": "lora_unet_b0", "reason": "上下因子的 rank 维度不匹配"}]
+        keys = [
+            "lora_unet_b0.hada_w1_a", "lora_unet_b1.hada_w1_a", "lora_unet_b1.hada_w1_b",
+            "lora_unet_b2.lokr_w1", "lora_unet_b3.lora_down.weight",
+        ]
+
+        inspector.unsupported_exclusions(keys, excluded)
+
+        self.assertEqual([entry["id"] for entry in excluded], ["lora_unet_b0", "lora_unet_b1", "lora_unet_b2"])
+
+
 if __name__ == "__main__":
     unittest.main()
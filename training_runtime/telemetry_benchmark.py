@@ -0,0 +1,198 @@
+"""Per-step hook overhead benchmark for telemetry_launcher.py.
+
+Run with the selected training runtime (psutil/pynvml are optional):
+python telemetry_benchmark.py --steps 5000 --sample-every 20
+python telemetry_benchmark.py --mode read --steps 100000
+
+Both variants log the same synthetic loss/lr values into a temporary run
+folder.  ``inline`` is the former hook: resources sampled on the training
+thread (including ``nvmlInit``) and ``metrics.jsonl`` reopened per record.
+The former hook also opened and parsed ``control.json`` on every step.
+``background`` is the current hook, which only enqueues numbers and reads the
+control flag kept by the background poller.
+``--sample-every`` emulates the 2-second resource cadence at a realistic
+step rate (20 steps = 10 it/s).  ``read`` logs ``--steps`` records and then
+compares loading the last 1000 steps of ``loss`` by parsing the whole JSONL
+stream with a columnar ``read_series`` range read.  The result is printed as
+one JSON document.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import telemetry_launcher as launcher
+
+
+_LEGACY_LOCK = threading.Lock()
+
+
+def legacy_resource_metrics(run_dir: Path) -> dict[str, float]:
+    """The former per-sample implementation, kept verbatim for comparison."""
+    values: dict[str, float] = {}
+    try:
+        import psutil  # type: ignore
+
+        values["resource.cpu_percent"] = float(psutil.cpu_percent(interval=None))
+        values["resource.ram_percent"] = float(psutil.virtual_memory().percent)
+    except Exception:
+        pass
+    try:
+        disk = shutil.disk_usage(run_dir)
+        values["resource.disk_free_gib"] = disk.free / (1024 ** 3)
+    except Exception:
+        pass
+    try:
+        import pynvml  # type: ignore
+
+        pynvml.nvmlInit()
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES", "0").split(",")[0].strip() or "0"
+        handle = pynvml.nvmlDeviceGetHandleByIndex(int(visible))
+        memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        values["resource.gpu_memory_used_gib"] = memory.used / (1024 ** 3)
+        values["resource.gpu_memory_total_gib"] = memory.total / (1024 ** 3)
+        values["resource.gpu_utilization_percent"] = float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+        values["resource.gpu_temperature_c"] = float(pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU))
+        values["resource.gpu_power_w"] = pynvml.nvmlDeviceGetPowerUsage(handle) / 1000.0
+    except Exception:
+        pass
+    return values
+
+
+def legacy_write_metrics(run_dir: Path, metrics_file: Path, step: int, metrics: dict[str, float]) -> None:
+    if not metrics:
+        return
+    run_dir.mkdir(parents=True, exist_ok=True)
+    record = {"step": max(0, step), "timestamp": int(time.time() * 1000), "metrics": metrics}
+    with _LEGACY_LOCK:
+        with metrics_file.open("a", encoding="utf-8") as stream:
+            stream.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def legacy_read_action(control_file: Path) -> str | None:
+    try:
+        value = json.loads(control_file.read_text(encoding="utf-8"))
+        action = value.get("action") if isinstance(value, dict) else None
+        return action if action in {"pause", "cancel"} else None
+    except (FileNotFoundError, json.JSONDecodeError, OSError):
+        return None
+
+
+def step_values(step: int) -> dict[str, float]:
+    return {"loss": 0.1 + (step % 97) / 1000.0, "lr": 1e-4}
+
+
+def timings(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "mean_us": statistics.fmean(ordered) * 1e6,
+        "p50_us": ordered[len(ordered) // 2] * 1e6,
+        "p99_us": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1e6,
+        "max_us": ordered[-1] * 1e6,
+    }
+
+
+def inline(run_dir: Path, steps: int, sample_every: int) -> dict[str, Any]:
+    metrics_file = run_dir / "inline.jsonl"
+    samples: list[float] = []
+    for step in range(steps):
+        started = time.perf_counter()
+        numeric = step_values(step)
+        if step % sample_every == 0:
+            numeric.update(legacy_resource_metrics(run_dir))
+        launcher._training_progress_metrics(step, numeric)
+        legacy_write_metrics(run_dir, metrics_file, step, numeric)
+        legacy_read_action(run_dir / "control.json")
+        samples.append(time.perf_counter() - started)
+    return {**timings(samples), "records": len(metrics_file.read_text(encoding="utf-8").splitlines())}
+
+
+def background(run_dir: Path, steps: int) -> dict[str, Any]:
+    metrics_file = run_dir / "background.jsonl"
+    launcher.RUN_DIR = run_dir
+    launcher.METRICS_FILE = metrics_file
+    launcher.CONTROL_FILE = run_dir / "control.json"
+    samples: list[float] = []
+    for step in range(steps):
+        started = time.perf_counter()
+        numeric = step_values(step)
+        launcher._attach_resources(numeric)
+        launcher._training_progress_metrics(step, numeric)
+        launcher._write_metrics(step, numeric)
+        launcher._control_action()
+        samples.append(time.perf_counter() - started)
+    launcher._flush_telemetry()
+    return {**timings(samples), "records": len(metrics_file.read_text(encoding="utf-8").splitlines())}
+
+
+def read(run_dir: Path, steps: int) -> dict[str, Any]:
+    metrics_file = run_dir / "metrics.jsonl"
+    launcher.RUN_DIR = run_dir
+    launcher.METRICS_FILE = metrics_file
+    background = launcher._BackgroundTelemetry()
+    for step in range(steps):
+        numeric = step_values(step)
+        launcher._training_progress_metrics(step, numeric)
+        background.enqueue({"step": step, "timestamp": int(time.time() * 1000), "metrics": numeric})
+    background.stop()
+    low = max(0, steps - 1000)
+
+    started = time.perf_counter()
+    parsed = []
+    with metrics_file.open(encoding="utf-8") as stream:
+        for line in stream:
+            record = json.loads(line)
+            if record["step"] >= low and "loss" in record["metrics"]:
+                parsed.append(record["metrics"]["loss"])
+    jsonl_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    window = launcher.read_series("loss", metrics_file, start_step=low)
+    columns_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    launcher.read_series("loss", metrics_file, max_points=1200)
+    overview_seconds = time.perf_counter() - started
+    if window["value"] != parsed:
+        raise SystemExit("columnar window differs from the JSONL stream")
+    return {
+        "jsonl_mib": metrics_file.stat().st_size / (1024 * 1024),
+        "window_points": len(parsed),
+        "jsonl_window_ms": jsonl_seconds * 1000,
+        "columns_window_ms": columns_seconds * 1000,
+        "columns_1200_point_overview_ms": overview_seconds * 1000,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=5000)
+    parser.add_argument("--sample-every", type=int, default=20)
+    parser.add_argument("--mode", choices=("hook", "read"), default="hook")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="telemetry-benchmark-") as directory:
+        run_dir = Path(directory)
+        report: dict[str, Any] = {"steps": args.steps}
+        if args.mode == "read":
+            report["read"] = read(run_dir, args.steps)
+        else:
+            (run_dir / "control.json").write_text(json.dumps({"action": "running"}), encoding="utf-8")
+            report["sample_every"] = args.sample_every
+            report["inline"] = inline(run_dir, args.steps, max(1, args.sample_every))
+            report["background"] = background(run_dir, args.steps)
+        if launcher._BACKGROUND is not None:
+            launcher._BACKGROUND.stop()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
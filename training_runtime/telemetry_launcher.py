@@ -4,14 +4,30 @@ The bridge deliberately does not own a model or a training loop.  It only
 observes Accelerate's per-step ``log`` calls, writes an append-only JSONL stream
 for the native monitor, and cooperatively stops at the next log boundary when
 the desktop application places a pause/cancel control file in the run folder.
+Resource sampling, control-file polling and file writes happen on one
+background thread; the step hooks only hand over numbers and read a flag.
+
+Next to the JSONL stream the thread keeps a columnar sidecar
+(``metrics.columns``): one directory per metric holding fixed-width
+``(step, timestamp, value)`` segments, so a long run's curve can be read by
+step range without parsing the whole stream.  ``list_series`` and
+``read_series`` are the reader API.  Setting
+``DANBOORU_TRAINING_METRICS_ROTATE_MB`` additionally rotates the JSONL stream
+into numbered segments; it is off by default because the desktop monitor
+tails a single ``metrics.jsonl``.
 """
 
 from __future__ import annotations
 
+import atexit
+import bisect
+import contextlib
 import json
+import mmap
 import os
 import runpy
 import shutil
+import struct
 import sys
 import threading
 import time
@@ -23,8 +39,16 @@ RUN_DIR = Path(os.environ.get("DANBOORU_TRAINING_RUN_DIR", ".")).resolve()
 METRICS_FILE = Path(os.environ.get("DANBOORU_TRAINING_METRICS_FILE", RUN_DIR / "metrics.jsonl"))
 CONTROL_FILE = Path(os.environ.get("DANBOORU_TRAINING_CONTROL_FILE", RUN_DIR / "control.json"))
 RESUME_DIR = RUN_DIR / "resume_state"
+RESOURCE_INTERVAL = 2.0
+FLUSH_INTERVAL = 1.0
+CONTROL_INTERVAL = 0.25
+COLUMN_SCHEMA = "danbooru-training-metric-columns"
+COLUMN_SCHEMA_VERSION = 1
+COLUMN_RECORD = struct.Struct("<qqd")
+COLUMN_SEGMENT_RECORDS = 65536
 _LOCK = threading.Lock()
-_LAST_RESOURCE_SAMPLE = 0.0
+_BACKGROUND: _BackgroundTelemetry | None = None
+_LAST_RESOURCE_SAMPLE = 0
 _LOSS_TOTAL = 0.0
 _LOSS_COUNT = 0
 _LAST_STEP: int | None = None
@@ -32,6 +56,13 @@ _LAST_STEP_AT: float | None = None
 _MAX_STEPS = 0
 
 
+def _rotate_bytes() -> int:
+    try:
+        return max(0, int(float(os.environ.get("DANBOORU_TRAINING_METRICS_ROTATE_MB", "0")) * 1024 * 1024))
+    except ValueError:
+        return 0
+
+
 def _number(value: Any) -> float | None:
     try:
         if hasattr(value, "detach"):
@@ -44,55 +75,383 @@ def _number(value: Any) -> float | None:
         return None
 
 
-def _resource_metrics() -> dict[str, float]:
-    """Best-effort resources. Missing optional packages never stop training."""
-    values: dict[str, float] = {}
-    try:
-        import psutil  # type: ignore
+class _ResourceSampler:
+    """Best-effort resources. Missing optional packages never stop training.
 
-        values["resource.cpu_percent"] = float(psutil.cpu_percent(interval=None))
-        values["resource.ram_percent"] = float(psutil.virtual_memory().percent)
-    except Exception:
-        pass
-    try:
-        disk = shutil.disk_usage(RUN_DIR)
-        values["resource.disk_free_gib"] = disk.free / (1024 ** 3)
-    except Exception:
-        pass
+    ``psutil`` and the NVML device handle are resolved once and reused for
+    every sample instead of re-running ``nvmlInit`` per sample.
+    """
+
+    def __init__(self) -> None:
+        self._psutil: Any = None
+        self._pynvml: Any = None
+        self._gpu: Any = None
+        try:
+            import psutil  # type: ignore
+
+            psutil.cpu_percent(interval=None)
+            self._psutil = psutil
+        except Exception:
+            pass
+        try:
+            import pynvml  # type: ignore
+
+            pynvml.nvmlInit()
+            visible = os.environ.get("CUDA_VISIBLE_DEVICES", "0").split(",")[0].strip() or "0"
+            self._gpu = pynvml.nvmlDeviceGetHandleByIndex(int(visible))
+            self._pynvml = pynvml
+        except Exception:
+            pass
+
+    def sample(self) -> dict[str, float]:
+        values: dict[str, float] = {}
+        if self._psutil is not None:
+            try:
+                values["resource.cpu_percent"] = float(self._psutil.cpu_percent(interval=None))
+                values["resource.ram_percent"] = float(self._psutil.virtual_memory().percent)
+            except Exception:
+                pass
+        try:
+            disk = shutil.disk_usage(RUN_DIR)
+            values["resource.disk_free_gib"] = disk.free / (1024 ** 3)
+        except Exception:
+            pass
+        if self._pynvml is not None:
+            pynvml, handle = self._pynvml, self._gpu
+            try:
+                memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                values["resource.gpu_memory_used_gib"] = memory.used / (1024 ** 3)
+                values["resource.gpu_memory_total_gib"] = memory.total / (1024 ** 3)
+                values["resource.gpu_utilization_percent"] = float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+                values["resource.gpu_temperature_c"] = float(pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU))
+                values["resource.gpu_power_w"] = pynvml.nvmlDeviceGetPowerUsage(handle) / 1000.0
+            except Exception:
+                pass
+        return values
+
+    def close(self) -> None:
+        if self._pynvml is not None:
+            try:
+                self._pynvml.nvmlShutdown()
+            except Exception:
+                pass
+            self._pynvml = None
+
+
+def columns_dir(metrics_file: Path) -> Path:
+    """Columnar sidecar directory that belongs to a ``metrics.jsonl`` stream."""
+    return metrics_file.with_suffix(".columns")
+
+
+def metric_segments(metrics_file: Path) -> list[Path]:
+    """Rotated JSONL segments oldest first, ending with the live stream."""
+    rotated = sorted(metrics_file.parent.glob(f"{metrics_file.stem}.[0-9][0-9][0-9][0-9][0-9][0-9]{metrics_file.suffix}"))
+    return [*rotated, metrics_file] if metrics_file.exists() else rotated
+
+
+def _segment_path(root: Path, directory: str, index: int) -> Path:
+    return root / directory / f"{index:05d}.bin"
+
+
+def _segment_files(root: Path, directory: str) -> list[Path]:
+    return sorted((root / directory).glob("[0-9][0-9][0-9][0-9][0-9].bin"))
+
+
+class _ColumnWriter:
+    """Appends each metric to its own fixed-width segment files.
+
+    Every segment holds at most ``COLUMN_SEGMENT_RECORDS`` records with
+    non-decreasing steps; a step that goes backwards (a resumed run logging
+    again from its checkpoint) starts a new segment, so readers can bisect
+    every segment independently.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.series: dict[str, str] = _load_series(root)
+        # name -> (segment index, records in it, last step)
+        self._tails: dict[str, tuple[int, int, int]] = {}
+
+    def _tail(self, name: str) -> tuple[int, int, int]:
+        if name not in self._tails:
+            files = _segment_files(self.root, self.series[name])
+            tail = (0, 0, 0)
+            if files:
+                data = files[-1].read_bytes()
+                count = len(data) // COLUMN_RECORD.size
+                last = COLUMN_RECORD.unpack_from(data, (count - 1) * COLUMN_RECORD.size)[0] if count else 0
+                tail = (int(files[-1].stem), count, last)
+            self._tails[name] = tail
+        return self._tails[name]
+
+    def append(self, records: list[dict[str, Any]]) -> None:
+        added = False
+        chunks: dict[tuple[str, int], bytearray] = {}
+        for record in records:
+            step, timestamp = int(record["step"]), int(record["timestamp"])
+            for name, value in record["metrics"].items():
+                if name not in self.series:
+                    self.series[name] = f"{len(self.series):04d}"
+                    added = True
+                segment, count, last = self._tail(name)
+                if count and (count >= COLUMN_SEGMENT_RECORDS or step < last):
+                    segment, count = segment + 1, 0
+                chunks.setdefault((name, segment), bytearray()).extend(COLUMN_RECORD.pack(step, timestamp, float(value)))
+                self._tails[name] = (segment, count + 1, step)
+        if added:
+            self.root.mkdir(parents=True, exist_ok=True)
+            temporary = self.root / "series.json.tmp"
+            temporary.write_text(json.dumps({
+                "schema": COLUMN_SCHEMA,
+                "schema_version": COLUMN_SCHEMA_VERSION,
+                "series": self.series,
+            }, ensure_ascii=False), encoding="utf-8")
+            os.replace(temporary, self.root / "series.json")
+        for (name, segment), data in chunks.items():
+            path = _segment_path(self.root, self.series[name], segment)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open("ab") as stream:
+                stream.write(data)
+
+
+def _load_series(root: Path) -> dict[str, str]:
     try:
-        import pynvml  # type: ignore
-
-        pynvml.nvmlInit()
-        visible = os.environ.get("CUDA_VISIBLE_DEVICES", "0").split(",")[0].strip() or "0"
-        handle = pynvml.nvmlDeviceGetHandleByIndex(int(visible))
-        memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
-        values["resource.gpu_memory_used_gib"] = memory.used / (1024 ** 3)
-        values["resource.gpu_memory_total_gib"] = memory.total / (1024 ** 3)
-        values["resource.gpu_utilization_percent"] = float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
-        values["resource.gpu_temperature_c"] = float(pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU))
-        values["resource.gpu_power_w"] = pynvml.nvmlDeviceGetPowerUsage(handle) / 1000.0
-    except Exception:
-        pass
-    return values
+        value = json.loads((root / "series.json").read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError, OSError):
+        return {}
+    if not isinstance(value, dict) or value.get("schema") != COLUMN_SCHEMA:
+        return {}
+    series = value.get("series")
+    return {str(name): str(directory) for name, directory in series.items()} if isinstance(series, dict) else {}
+
+
+def list_series(metrics_file: Path | None = None) -> list[str]:
+    """Metric names recorded in the columnar sidecar of ``metrics_file``."""
+    return sorted(_load_series(columns_dir(metrics_file or METRICS_FILE)))
+
+
+def read_series(
+    name: str,
+    metrics_file: Path | None = None,
+    start_step: int | None = None,
+    end_step: int | None = None,
+    max_points: int | None = None,
+) -> dict[str, list[Any]]:
+    """Read one metric for ``start_step <= step <= end_step``.
+
+    Only the segments overlapping the range are mapped, and each is bisected
+    to the requested steps, so the cost follows the range rather than the
+    run length.  ``max_points`` keeps an evenly strided subset that always
+    includes the last point.  Returns ``step``/``timestamp``/``value`` lists.
+    """
+    root = columns_dir(metrics_file or METRICS_FILE)
+    directory = _load_series(root).get(name)
+    result: dict[str, list[Any]] = {"step": [], "timestamp": [], "value": []}
+    if directory is None:
+        return result
+    low = start_step if start_step is not None else -(1 << 63)
+    high = end_step if end_step is not None else (1 << 63) - 1
+    size = COLUMN_RECORD.size
+    with contextlib.ExitStack() as stack:
+        # (mapped segment, first record, end record) for every overlap.
+        ranges: list[tuple[Any, int, int]] = []
+        for path in _segment_files(root, directory):
+            stream = stack.enter_context(path.open("rb"))
+            count = os.fstat(stream.fileno()).st_size // size
+            if not count:
+                continue
+            view = stack.enter_context(mmap.mmap(stream.fileno(), count * size, access=mmap.ACCESS_READ))
+            steps = _StepColumn(view, count)
+            if steps[0] > high or steps[count - 1] < low:
+                continue
+            first, last = bisect.bisect_left(steps, low), bisect.bisect_right(steps, high)
+            if first < last:
+                ranges.append((view, first, last))
+        total = sum(last - first for _, first, last in ranges)
+        if max_points is not None and 0 < max_points < total:
+            # Unpack only the strided records instead of the whole range.
+            picked = [total - 1] if max_points == 1 else [
+                round(index * (total - 1) / (max_points - 1)) for index in range(max_points)
+            ]
+            offset = 0
+            position = 0
+            for view, first, last in ranges:
+                while position < len(picked) and picked[position] < offset + last - first:
+                    step, timestamp, value = COLUMN_RECORD.unpack_from(view, (first + picked[position] - offset) * size)
+                    result["step"].append(step)
+                    result["timestamp"].append(timestamp)
+                    result["value"].append(value)
+                    position += 1
+                offset += last - first
+            return result
+        for view, first, last in ranges:
+            for step, timestamp, value in COLUMN_RECORD.iter_unpack(view[first * size:last * size]):
+                result["step"].append(step)
+                result["timestamp"].append(timestamp)
+                result["value"].append(value)
+    return result
+
+
+class _StepColumn:
+    """Sequence view of the step field of a mapped segment, for ``bisect``."""
+
+    def __init__(self, view: Any, count: int) -> None:
+        self._view = view
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> int:
+        return struct.unpack_from("<q", self._view, index * COLUMN_RECORD.size)[0]
+
+
+class _BackgroundTelemetry(threading.Thread):
+    """Samples resources and appends queued records off the training thread.
+
+    Records are written through one long-lived append handle, flushed every
+    ``FLUSH_INTERVAL`` seconds and once more on shutdown, so the monitor
+    still sees every record of a run that pauses, cancels or crashes.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(name="danbooru-telemetry", daemon=True)
+        self._pending: list[dict[str, Any]] = []
+        self._pending_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._stream: Any = None
+        self._columns: _ColumnWriter | None = None
+        self._sampler: _ResourceSampler | None = None
+        self._next_sample = 0.0
+        # (sequence, values); replaced as a whole so readers need no lock.
+        self.resources: tuple[int, dict[str, float]] = (0, {})
+        self.control_action: str | None = None
+        self._control_signature: tuple[int, int, int] | None = None
+
+    def enqueue(self, record: dict[str, Any]) -> None:
+        with self._pending_lock:
+            self._pending.append(record)
+
+    def run(self) -> None:
+        next_flush = 0.0
+        while True:
+            now = time.monotonic()
+            self.poll_control()
+            if now >= self._next_sample:
+                if self._sampler is None:
+                    self._sampler = _ResourceSampler()
+                self.resources = (self.resources[0] + 1, self._sampler.sample())
+                self._next_sample = now + RESOURCE_INTERVAL
+            if now >= next_flush:
+                self.flush()
+                next_flush = now + FLUSH_INTERVAL
+            wake = min(self._next_sample, next_flush, now + CONTROL_INTERVAL) - time.monotonic()
+            if self._stopping.wait(max(0.0, wake)):
+                break
+        self.flush()
+
+    def poll_control(self) -> None:
+        """Re-read the control file only when its stat signature changes.
+
+        A document that does not parse (for example one caught mid-write)
+        leaves the signature unrecorded so the next poll reads it again.
+        """
+        try:
+            stat = CONTROL_FILE.stat()
+        except OSError:
+            self._control_signature = None
+            self.control_action = None
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self._control_signature:
+            return
+        try:
+            value = json.loads(CONTROL_FILE.read_text(encoding="utf-8"))
+        except (json.JSONDecodeError, OSError, UnicodeDecodeError):
+            return
+        self._control_signature = signature
+        action = value.get("action") if isinstance(value, dict) else None
+        self.control_action = action if action in {"pause", "cancel"} else None
+
+    def flush(self) -> None:
+        # Swapped and written under one lock: a flush from the training
+        # thread must not write its records before an earlier swap's.
+        with _LOCK:
+            with self._pending_lock:
+                records, self._pending = self._pending, []
+            if not records:
+                return
+            try:
+                if self._stream is None:
+                    RUN_DIR.mkdir(parents=True, exist_ok=True)
+                    self._stream = METRICS_FILE.open("a", encoding="utf-8")
+                self._stream.write("".join(
+                    json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records
+                ))
+                self._stream.flush()
+                rotate = _rotate_bytes()
+                if rotate and self._stream.tell() >= rotate:
+                    self._rotate()
+            except OSError:
+                pass
+            try:
+                if self._columns is None:
+                    self._columns = _ColumnWriter(columns_dir(METRICS_FILE))
+                self._columns.append(records)
+            except OSError:
+                pass
+
+    def _rotate(self) -> None:
+        self._stream.close()
+        self._stream = None
+        existing = metric_segments(METRICS_FILE)
+        index = int(existing[-2].stem.rsplit(".", 1)[-1]) + 1 if len(existing) > 1 else 1
+        os.replace(METRICS_FILE, METRICS_FILE.with_name(f"{METRICS_FILE.stem}.{index:06d}{METRICS_FILE.suffix}"))
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self.is_alive():
+            self.join(timeout=5.0)
+        self.flush()
+        with _LOCK:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+        if self._sampler is not None:
+            self._sampler.close()
+
+
+def _background() -> _BackgroundTelemetry:
+    global _BACKGROUND
+    if _BACKGROUND is None:
+        with _LOCK:
+            if _BACKGROUND is None:
+                background = _BackgroundTelemetry()
+                background.start()
+                atexit.register(background.stop)
+                _BACKGROUND = background
+    return _BACKGROUND
+
+
+def _flush_telemetry() -> None:
+    """Write every queued record now; used before the process stops."""
+    if _BACKGROUND is not None:
+        _BACKGROUND.flush()
 
 
 def _write_metrics(step: int, metrics: dict[str, float]) -> None:
     if not metrics:
         return
-    RUN_DIR.mkdir(parents=True, exist_ok=True)
-    record = {"step": max(0, step), "timestamp": int(time.time() * 1000), "metrics": metrics}
-    with _LOCK:
-        with METRICS_FILE.open("a", encoding="utf-8") as stream:
-            stream.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+    _background().enqueue({"step": max(0, step), "timestamp": int(time.time() * 1000), "metrics": metrics})
 
 
 def _attach_resources(numeric: dict[str, float]) -> None:
-    """Attach best-effort resource metrics at most every 2 seconds."""
+    """Attach the newest background resource sample once (every 2 seconds)."""
     global _LAST_RESOURCE_SAMPLE
-    now = time.monotonic()
-    if now - _LAST_RESOURCE_SAMPLE >= 2.0:
-        numeric.update(_resource_metrics())
-        _LAST_RESOURCE_SAMPLE = now
+    sequence, values = _background().resources
+    if sequence != _LAST_RESOURCE_SAMPLE:
+        numeric.update(values)
+        _LAST_RESOURCE_SAMPLE = sequence
 
 
 def _training_progress_metrics(step: int, values: dict[str, float]) -> None:
@@ -129,6 +488,11 @@ def _training_progress_metrics(step: int, values: dict[str, float]) -> None:
             _LAST_STEP_AT = now
 
 
+def _control_action() -> str | None:
+    """Pending pause/cancel request as last seen by the background poller."""
+    return _background().control_action
+
+
 def _read_action() -> str | None:
     try:
         value = json.loads(CONTROL_FILE.read_text(encoding="utf-8"))
@@ -157,7 +521,12 @@ def _install_accelerate_hook() -> None:
         actual_step = step if step is not None else 0
         _training_progress_metrics(actual_step, numeric)
         _write_metrics(actual_step, numeric)
-        action = _read_action()
+        action = _control_action()
+        if action in {"pause", "cancel"}:
+            # The request is consumed here; the poller picks up the
+            # paused/cancelled document written below.
+            _background().control_action = None
+            _flush_telemetry()
         if action == "pause":
             try:
                 RESUME_DIR.mkdir(parents=True, exist_ok=True)
@@ -251,11 +620,16 @@ def main() -> int:
     _install_network_trainer_hook()
     _install_progress_hook()
     sys.argv = [str(trainer), *sys.argv[2:]]
+    # Start sampling before the trainer imports torch so the first logged
+    # step already has a resource sample to attach.
+    _background()
     try:
         runpy.run_path(str(trainer), run_name="__main__")
     except KeyboardInterrupt:
         action = _read_action()
         raise SystemExit(75 if action in {"pause", "paused", "pause_failed"} else 76)
+    finally:
+        _flush_telemetry()
     return 0
 
 
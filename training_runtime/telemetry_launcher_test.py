@@ -0,0 +1,291 @@
+"""Run with an installed training runtime:
+python telemetry_launcher_test.py
+"""
+
+from __future__ import annotations
+
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+from unittest import mock
+
+import telemetry_launcher as launcher
+
+
+class FakeNvml:
+    NVML_TEMPERATURE_GPU = 0
+
+    def __init__(self) -> None:
+        self.init_calls = 0
+
+    def nvmlInit(self) -> None:
+        self.init_calls += 1
+
+    def nvmlShutdown(self) -> None:
+        pass
+
+    def nvmlDeviceGetHandleByIndex(self, index: int) -> str:
+        return f"gpu-{index}"
+
+    def nvmlDeviceGetMemoryInfo(self, handle: str) -> Any:
+        return SimpleNamespace(used=2 * 1024 ** 3, total=8 * 1024 ** 3)
+
+    def nvmlDeviceGetUtilizationRates(self, handle: str) -> Any:
+        return SimpleNamespace(gpu=90)
+
+    def nvmlDeviceGetTemperature(self, handle: str, sensor: int) -> int:
+        return 60
+
+    def nvmlDeviceGetPowerUsage(self, handle: str) -> int:
+        return 250_000
+
+
+class FakeAccelerator:
+    def __init__(self) -> None:
+        self.saved: list[str] = []
+
+    def log(self, values: Any, step: int | None = None, **kwargs: Any) -> None:
+        pass
+
+    def save_state(self, output_dir: str) -> None:
+        self.saved.append(output_dir)
+
+
+class TelemetryLauncherTests(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.run_dir = Path(directory.name)
+        for name, value in {
+            "RUN_DIR": self.run_dir,
+            "METRICS_FILE": self.run_dir / "metrics.jsonl",
+            "CONTROL_FILE": self.run_dir / "control.json",
+            "RESUME_DIR": self.run_dir / "resume_state",
+            "_BACKGROUND": None,
+            "_LAST_RESOURCE_SAMPLE": 0,
+        }.items():
+            patcher = mock.patch.object(launcher, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def records(self) -> list[dict[str, Any]]:
+        return [json.loads(line) for line in launcher.METRICS_FILE.read_text(encoding="utf-8").splitlines()]
+
+    def test_hook_only_enqueues_and_the_background_writer_flushes_in_order(self) -> None:
+        background = launcher._BackgroundTelemetry()
+        launcher._BACKGROUND = background
+        for step in range(5):
+            launcher._write_metrics(step, {"loss": step / 10})
+        self.assertFalse(launcher.METRICS_FILE.exists())
+
+        background.stop()
+
+        self.assertEqual([record["step"] for record in self.records()], [0, 1, 2, 3, 4])
+        self.assertEqual(self.records()[3]["metrics"], {"loss": 0.3})
+
+    def test_concurrent_flushes_write_the_steps_in_order(self) -> None:
+        background = launcher._BackgroundTelemetry()
+        launcher._BACKGROUND = background
+        done = threading.Event()
+        lock = threading.Lock()
+
+        class SlowLock:
+            """Yields before acquiring, so a flush waiting for the writer lets the other one overtake it."""
+
+            def __enter__(self) -> None:
+                time.sleep(0.0005)
+                lock.acquire()
+
+            def __exit__(self, *exc: object) -> None:
+                lock.release()
+
+        patcher = mock.patch.object(launcher, "_LOCK", SlowLock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def flush_until_done() -> None:
+            while not done.is_set():
+                launcher._flush_telemetry()  # as the pause/cancel/exit path does next to the background thread
+
+        flushers = [threading.Thread(target=flush_until_done) for _ in range(2)]
+        for flusher in flushers:
+            flusher.start()
+        for step in range(1000):
+            launcher._write_metrics(step, {"loss": 1.0})
+            if step % 10 == 0:
+                time.sleep(0.0002)  # let the flushers take small batches
+        done.set()
+        for flusher in flushers:
+            flusher.join()
+        background.stop()
+
+        steps = [record["step"] for record in self.records()]
+        self.assertEqual(steps, list(range(1000)))
+        self.assertEqual(launcher.read_series("loss")["step"], steps)
+        directory = launcher.columns_dir(launcher.METRICS_FILE) / "0000"
+        self.assertEqual([path.name for path in directory.iterdir()], ["00000.bin"])  # no backwards step started a segment
+
+    def test_each_resource_sample_is_attached_to_one_step_only(self) -> None:
+        background = launcher._BackgroundTelemetry()
+        launcher._BACKGROUND = background
+        background.resources = (1, {"resource.cpu_percent": 12.0})
+        first: dict[str, float] = {"loss": 1.0}
+        second: dict[str, float] = {"loss": 0.9}
+
+        launcher._attach_resources(first)
+        launcher._attach_resources(second)
+
+        self.assertEqual(first["resource.cpu_percent"], 12.0)
+        self.assertNotIn("resource.cpu_percent", second)
+
+    def test_sampler_initializes_nvml_once_for_every_sample(self) -> None:
+        nvml = FakeNvml()
+        with mock.patch.dict(sys.modules, {"pynvml": nvml}):
+            sampler = launcher._ResourceSampler()
+            samples = [sampler.sample() for _ in range(3)]
+            sampler.close()
+
+        self.assertEqual(nvml.init_calls, 1)
+        self.assertEqual(samples[-1]["resource.gpu_utilization_percent"], 90.0)
+        self.assertEqual(samples[-1]["resource.gpu_power_w"], 250.0)
+
+    def test_background_thread_samples_and_writes_until_stopped(self) -> None:
+        with mock.patch.object(launcher, "FLUSH_INTERVAL", 0.01), \
+                mock.patch.dict(sys.modules, {"pynvml": FakeNvml()}):
+            background = launcher._background()
+            launcher._write_metrics(7, {"loss": 0.5})
+            background.stop()
+
+        self.assertGreaterEqual(background.resources[0], 1)
+        self.assertIn("resource.gpu_memory_total_gib", background.resources[1])
+        self.assertEqual(self.records(), [{"step": 7, "timestamp": self.records()[0]["timestamp"], "metrics": {"loss": 0.5}}])
+
+    def test_control_file_is_reparsed_only_when_its_stat_signature_changes(self) -> None:
+        background = launcher._BackgroundTelemetry()
+        launcher.CONTROL_FILE.write_text(json.dumps({"action": "running"}), encoding="utf-8")
+        with mock.patch.object(launcher.json, "loads", wraps=json.loads) as parse:
+            background.poll_control()
+            background.poll_control()
+            self.assertIsNone(background.control_action)
+            self.assertEqual(parse.call_count, 1)
+
+            launcher.CONTROL_FILE.write_text(json.dumps({"action": "cancel"}), encoding="utf-8")
+            background.poll_control()
+            self.assertEqual(background.control_action, "cancel")
+            self.assertEqual(parse.call_count, 2)
+
+        launcher.CONTROL_FILE.unlink()
+        background.poll_control()
+        self.assertIsNone(background.control_action)
+
+    def test_partially_written_control_file_is_read_again_on_the_next_poll(self) -> None:
+        background = launcher._BackgroundTelemetry()
+        launcher.CONTROL_FILE.write_text('{"action": "pau', encoding="utf-8")
+        background.poll_control()
+        self.assertIsNone(background.control_action)
+
+        launcher.CONTROL_FILE.write_text(json.dumps({"action": "pause"}), encoding="utf-8")
+        background.poll_control()
+        self.assertEqual(background.control_action, "pause")
+
+    def install_fake_accelerate(self) -> type[FakeAccelerator]:
+        accelerator = type("Accelerator", (FakeAccelerator,), {})
+        patcher = mock.patch.dict(sys.modules, {"accelerate": SimpleNamespace(Accelerator=accelerator)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        launcher._install_accelerate_hook()
+        launcher._BACKGROUND = launcher._BackgroundTelemetry()
+        return accelerator
+
+    def test_pause_saves_resume_state_and_stops_at_the_log_boundary(self) -> None:
+        accelerator = self.install_fake_accelerate()()
+        accelerator.log({"loss": 0.5}, step=1)
+        launcher.CONTROL_FILE.write_text(json.dumps({"action": "pause"}), encoding="utf-8")
+        launcher._BACKGROUND.poll_control()
+
+        with self.assertRaises(KeyboardInterrupt):
+            accelerator.log({"loss": 0.4}, step=2)
+
+        self.assertEqual(accelerator.saved, [str(launcher.RESUME_DIR)])
+        self.assertEqual(
+            json.loads(launcher.CONTROL_FILE.read_text(encoding="utf-8")),
+            {"action": "paused", "resume_state": str(launcher.RESUME_DIR)},
+        )
+        self.assertEqual([record["step"] for record in self.records()], [1, 2])
+        self.assertIsNone(launcher._control_action())
+
+    def test_cancel_marks_the_control_file_and_exits_with_the_cancel_code(self) -> None:
+        accelerator = self.install_fake_accelerate()()
+        launcher.CONTROL_FILE.write_text(json.dumps({"action": "cancel"}), encoding="utf-8")
+        launcher._BACKGROUND.poll_control()
+
+        with self.assertRaises(KeyboardInterrupt):
+            accelerator.log({"loss": 0.4}, step=3)
+        self.assertEqual(json.loads(launcher.CONTROL_FILE.read_text(encoding="utf-8")), {"action": "cancelled"})
+
+        trainer = self.run_dir / "train.py"
+        trainer.write_text("raise KeyboardInterrupt\n", encoding="utf-8")
+        with mock.patch.object(sys, "argv", ["telemetry_launcher.py", str(trainer)]), \
+                mock.patch.object(launcher, "_install_accelerate_hook"), \
+                mock.patch.object(launcher, "_install_network_trainer_hook"), \
+                mock.patch.object(launcher, "_install_progress_hook"), \
+                mock.patch.object(sys, "path", list(sys.path)), \
+                self.assertRaises(SystemExit) as stopped:
+            launcher.main()
+        self.assertEqual(stopped.exception.code, 76)
+
+
+    def write_steps(self, steps: list[int]) -> None:
+        background = launcher._BackgroundTelemetry()
+        for step in steps:
+            background.enqueue({"step": step, "timestamp": 1000 + step, "metrics": {"loss": step / 100, "lr": 1e-4}})
+        background.flush()
+        background.stop()
+
+    def test_columnar_sidecar_reads_step_ranges_and_downsamples(self) -> None:
+        self.write_steps(list(range(100)))
+
+        self.assertEqual(launcher.list_series(), ["loss", "lr"])
+        everything = launcher.read_series("loss")
+        self.assertEqual(everything["step"], list(range(100)))
+        self.assertEqual(everything["timestamp"][5], 1005)
+        window = launcher.read_series("loss", start_step=40, end_step=44)
+        self.assertEqual(window, {
+            "step": [40, 41, 42, 43, 44],
+            "timestamp": [1040, 1041, 1042, 1043, 1044],
+            "value": [0.4, 0.41, 0.42, 0.43, 0.44],
+        })
+        self.assertEqual(launcher.read_series("loss", max_points=5)["step"], [0, 25, 50, 74, 99])
+        self.assertEqual(launcher.read_series("missing"), {"step": [], "timestamp": [], "value": []})
+
+    def test_full_or_backwards_segments_start_a_new_file_and_stay_readable(self) -> None:
+        with mock.patch.object(launcher, "COLUMN_SEGMENT_RECORDS", 4):
+            self.write_steps([0, 1, 2, 3, 4, 5, 2, 3, 9])
+            # A later writer continues from the tail already on disk.
+            self.write_steps([10, 11])
+
+        directory = launcher.columns_dir(launcher.METRICS_FILE) / "0000"
+        self.assertEqual(sorted(path.name for path in directory.iterdir()), ["00000.bin", "00001.bin", "00002.bin", "00003.bin"])
+        self.assertEqual(launcher.read_series("loss")["step"], [0, 1, 2, 3, 4, 5, 2, 3, 9, 10, 11])
+        self.assertEqual(launcher.read_series("loss", start_step=3, end_step=9)["step"], [3, 4, 5, 3, 9])
+
+    def test_jsonl_stream_rotates_into_numbered_segments_when_enabled(self) -> None:
+        with mock.patch.dict(launcher.os.environ, {"DANBOORU_TRAINING_METRICS_ROTATE_MB": "0.0001"}):
+            for chunk in range(3):
+                self.write_steps(list(range(chunk * 3, chunk * 3 + 3)))
+
+        segments = launcher.metric_segments(launcher.METRICS_FILE)
+        self.assertEqual([path.name for path in segments], ["metrics.000001.jsonl", "metrics.000002.jsonl", "metrics.000003.jsonl"])
+        steps = [json.loads(line)["step"] for path in segments for line in path.read_text(encoding="utf-8").splitlines()]
+        self.assertEqual(steps, list(range(9)))
+        self.assertEqual(launcher.read_series("lr")["step"], list(range(9)))
+
+
+if __name__ == "__main__":
+    unittest.main()